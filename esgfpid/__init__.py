@@ -6,6 +6,7 @@ from .check import check_pid_queue_availability
 # Making this available directly via esgfpid.make_handle_from_drsid_and_versionnumber
 # instead of esgfpid.utils.make_handle_from_drsid_and_versionnumber
 from .utils import make_handle_from_drsid_and_versionnumber
+from .utils import make_handles_from_drsids_and_versionnumbers
 
 # Making this available directly via esgfpid.Connector
 # instead of esgfpid.connector.Connector
@@ -1,4 +1,6 @@
+import uuid
 import logging
+import threading
 import esgfpid
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
 
@@ -6,37 +8,106 @@ from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+'''
+Checks whether the files of a republished dataset version
+are the same as the ones that were published before (as
+solr knows them).
+
+The previous files are retrieved from solr during preparation
+and kept in a hashed set (in compact form, see
+:class:`_CompactHandleSet`). The files of the republication
+can then be passed one by one as they are added (see
+:func:`~esgfpid.assistant.consistency.Checker.add_file_handle`),
+so that at the end, only the previous files that were not
+found need to be collected.
+
+The preparation can be run in a background thread, so that
+the solr queries run while the files are being added. Files
+that are added before solr replied are compared later, and
+the methods that need the reply wait for it.
+'''
 class Checker(object):
 
     def __init__(self, **args):
 
         mandatory_args = ['drs_id', 'data_node', 'version_number', 'coupler']
+        optional_args = ['prefix', 'in_background']
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+        esgfpid.utils.add_missing_optional_args_with_value_none(args, optional_args)
 
         # Needed to retrieve stuff from solr:
         self.__coupler = args['coupler']
         self.__drs_id = args['drs_id']
         self.__version_number = args['version_number']
         self.__data_node = args['data_node']
+        self.__prefix = args['prefix']
 
-        # Other         
-        self.__list_of_previous_files = None # from solr
+        # Other
+        self.__previous_files = None # _CompactHandleSet, from solr
         self.__will_run_check = True
         self.__message_why_not = 'No reason specified.'
+        self.__reset_given_files()
+        self.__pending_files = [] # added before solr replied
+        self.__prepared = threading.Event()
+        self.__preparation_error = None
 
         # Is solr switched off?
         if self.__coupler.is_solr_switched_off():
             self.__will_run_check = False
+            self.__prepared.set()
+        elif args['in_background']:
+            # query solr for previous file handles, while files are added:
+            self.__start_preparation_in_background()
         else:
             # query solr for previous file handles:
             self.__data_consistency_check_preparation()
+            self.__prepared.set()
 
-
+    '''
+    :return: True if the check can be run. Waits for the
+        preparation if it runs in the background.
+    '''
     def can_run_check(self):
+        self.__wait_for_preparation()
         return self.__will_run_check
 
+    '''
+    :return: True if solr replied already (or was not asked),
+        i.e. if no method of the checker will wait for it.
+    '''
+    def is_prepared(self):
+        return self.__prepared.is_set()
+
     ### Preparation ###
 
+    def __start_preparation_in_background(self):
+        logdebug(LOGGER, 'Starting to ask solr for info for consistency check in background.')
+        thread = threading.Thread(target=self.__run_preparation_in_background)
+        thread.daemon = True
+        thread.start()
+
+    def __run_preparation_in_background(self):
+        try:
+            self.__data_consistency_check_preparation()
+        except Exception as e:
+            self.__preparation_error = e
+        finally:
+            self.__prepared.set()
+
+    '''
+    Wait until solr replied (if it has not yet), and compare
+    the files that were added meanwhile. Errors other than
+    solr errors (which only disable the check) are passed on.
+    '''
+    def __wait_for_preparation(self):
+        if not self.__prepared.is_set():
+            logdebug(LOGGER, 'Waiting for solr info for consistency check...')
+            self.__prepared.wait()
+            logdebug(LOGGER, 'Waiting for solr info for consistency check... done.')
+        if self.__preparation_error is not None:
+            raise self.__preparation_error
+        self.__add_pending_file_handles()
+
     def __data_consistency_check_preparation(self):
         logdebug(LOGGER, 'Asking solr for info for consistency check.')
         self.__retrieve_list_of_previous_files_from_solr()
@@ -44,15 +115,20 @@ class Checker(object):
         self.__decide_whether_run_check_and_inform()
 
     def __retrieve_list_of_previous_files_from_solr(self):
-        self.__list_of_previous_files = None
+        self.__previous_files = None
         try:
-            self.__list_of_previous_files = self.__retrieve_from_solr()
+            files = self.__retrieve_from_solr()
+            if files is not None:
+                self.__previous_files = _CompactHandleSet(self.__prefix)
+                for file_handle in files: # streamed from solr
+                    self.__previous_files.add(file_handle)
         except (esgfpid.exceptions.SolrSwitchedOff, esgfpid.exceptions.SolrError) as e:
+            self.__previous_files = None
             self.__will_run_check = False
-            self.__log_solr_error_occured(e)            
+            self.__log_solr_error_occured(e)
 
     def __retrieve_from_solr(self):
-        files = self.__coupler.retrieve_file_handles_of_same_dataset(
+        files = self.__coupler.iterate_file_handles_of_same_dataset(
             drs_id=self.__drs_id,
             version_number=self.__version_number,
             data_node=self.__data_node
@@ -60,9 +136,9 @@ class Checker(object):
         return files
 
     def __decide_whether_run_check_and_inform(self):
-        if self.__list_of_previous_files is not None:
+        if self.__previous_files is not None:
             
-            if len(self.__list_of_previous_files) > 0:
+            if len(self.__previous_files) > 0:
                 self.__will_run_check = True
                 self.__log_previously_stored_files_found()
 
@@ -80,9 +156,7 @@ class Checker(object):
         loginfo(LOGGER, msg)
 
     def __log_previously_stored_files_found(self):
-        concat_files = ', '.join(self.__list_of_previous_files)
-        type_files = type(self.__list_of_previous_files)
-        logdebug(LOGGER, 'Previously published fileset: %s (%s)', concat_files, type_files)
+        logdebug(LOGGER, 'Previously published fileset found (%i files)', len(self.__previous_files))
         loginfo(LOGGER, 'Data integrity check will be run after files were specified.')
 
     def __log_previously_stored_was_empty(self):
@@ -100,22 +174,78 @@ class Checker(object):
         loginfo(LOGGER, msg)
 
 
+    ### Adding the given files ###
+
+    '''
+    Compare one file of the republication to the previous
+    files. Ignored if the check cannot be run. Never waits
+    for solr: If it did not reply yet, the file is compared
+    later.
+
+    :param file_handle: The handle of the file (string).
+    '''
+    def add_file_handle(self, file_handle):
+        if not self.__prepared.is_set():
+            self.__pending_files.append(file_handle)
+            return
+        self.__add_pending_file_handles()
+        self.__compare_file_handle(file_handle)
+
+    def __add_pending_file_handles(self):
+        if len(self.__pending_files) > 0:
+            pending_files = self.__pending_files
+            self.__pending_files = []
+            for file_handle in pending_files:
+                self.__compare_file_handle(file_handle)
+
+    def __compare_file_handle(self, file_handle):
+        if not self.__will_run_check:
+            return
+        self.__num_given_files += 1
+        if file_handle in self.__previous_files:
+            self.__found_files.add(file_handle)
+        elif file_handle not in self.__superfluous_files:
+            self.__superfluous_files.add(file_handle)
+            self.__list_too_many_files.append(file_handle)
+
+    def __reset_given_files(self):
+        self.__num_given_files = 0
+        self.__found_files = _CompactHandleSet(self.__prefix)
+        self.__superfluous_files = _CompactHandleSet(self.__prefix)
+        self.__list_too_many_files = [] # in the order they were added
+
+
     ### Perform the check ###
 
-    def data_consistency_check(self, list_of_given_files):
-        if self.__will_run_check:
+    '''
+    :param list_of_given_files: Optional. The handles of the
+        files of the republication. If not given, the ones
+        passed to :func:`add_file_handle` are used.
+    :return: True if the given files are the same as the
+        previous ones, False otherwise.
+    :raise ValueError: If the check cannot be run (see
+        :func:`can_run_check`), or if no files were given.
+    '''
+    def data_consistency_check(self, list_of_given_files=None):
+        if self.can_run_check():
 
-            if list_of_given_files is None or len(list_of_given_files)==0:
+            if list_of_given_files is not None:
+                self.__reset_given_files()
+                for file_handle in list_of_given_files:
+                    self.add_file_handle(file_handle)
+
+            if self.__num_given_files == 0:
                 raise ValueError('Please provide a list of file handles for the consistency check.')
 
-            return self.__data_consistency_check(list_of_given_files)
+            return self.__data_consistency_check()
         else:
             raise ValueError('Consistency check can not be run. Reason: %s' % self.__message_why_not)
 
-    def __data_consistency_check(self, list_of_given_files):
+    def __data_consistency_check(self):
         logdebug(LOGGER, 'Performing consistency check...')
-        list_too_many_files = self.__check_for_superfluous_files(list_of_given_files)
-        list_missing_files = self.__check_for_missing_files(list_of_given_files)
+        diff = self.get_diff()
+        list_missing_files = diff['missing_files']
+        list_too_many_files = diff['superfluous_files']
 
         any_inconsistency = len(list_missing_files) > 0 or len(list_too_many_files) > 0
         
@@ -128,19 +258,22 @@ class Checker(object):
             logdebug(LOGGER, 'Performing consistency check... done (success)')
             return True
 
-    def __check_for_superfluous_files(self, list_of_given_files):
-        list_too_many_files = []
-        for file_handle in list_of_given_files:
-            if file_handle not in self.__list_of_previous_files:
-                list_too_many_files.append(file_handle)
-        return list_too_many_files
-
-    def __check_for_missing_files(self, list_of_given_files):
-        list_missing_files = []
-        for file_handle in self.__list_of_previous_files:
-            if file_handle not in list_of_given_files:
-                list_missing_files.append(file_handle)
-        return list_missing_files
+    '''
+    :return: Dict with the handles of the previous files that
+        were not given ("missing_files") and of the given files
+        that were not published before ("superfluous_files"),
+        and the number of previous and given files. Empty if
+        the check cannot be run.
+    '''
+    def get_diff(self):
+        if not self.can_run_check():
+            return {}
+        return dict(
+            missing_files=self.__previous_files.difference(self.__found_files),
+            superfluous_files=list(self.__list_too_many_files),
+            num_previous_files=len(self.__previous_files),
+            num_given_files=self.__num_given_files
+        )
 
     def __log_too_many_files_if_any(self, list_too_many_files):
         if len(list_too_many_files)>0:
@@ -154,3 +287,52 @@ class Checker(object):
             LOGGER.warning(
                 'Some files were missing in republication of dataset: %s',
                 list_string)
+
+
+'''
+A set of file handles that stores the usual ones, i.e.
+"hdl:<prefix>/<uuid>", as the 16 bytes of the uuid instead
+of the whole string. Other handles are stored as they are.
+'''
+class _CompactHandleSet(object):
+
+    def __init__(self, prefix):
+        self.__start = None if prefix is None else 'hdl:'+prefix+'/'
+        self.__uuids = set()
+        self.__others = set()
+
+    def __compact(self, file_handle):
+        if self.__start is not None and file_handle.startswith(self.__start):
+            suffix = file_handle[len(self.__start):]
+            try:
+                uuid_bytes = uuid.UUID(suffix)
+                if str(uuid_bytes) == suffix: # Only if we can restore the exact handle
+                    return uuid_bytes.bytes
+            except ValueError:
+                pass
+        return None
+
+    def add(self, file_handle):
+        uuid_bytes = self.__compact(file_handle)
+        if uuid_bytes is None:
+            self.__others.add(file_handle)
+        else:
+            self.__uuids.add(uuid_bytes)
+
+    def __contains__(self, file_handle):
+        uuid_bytes = self.__compact(file_handle)
+        if uuid_bytes is None:
+            return file_handle in self.__others
+        return uuid_bytes in self.__uuids
+
+    def __len__(self):
+        return len(self.__uuids) + len(self.__others)
+
+    '''
+    :return: List of the handles that are not in the other set.
+    '''
+    def difference(self, other):
+        handles = [self.__start+str(uuid.UUID(bytes=uuid_bytes))
+                   for uuid_bytes in self.__uuids.difference(other.__uuids)]
+        handles.extend(self.__others.difference(other.__others))
+        return handles
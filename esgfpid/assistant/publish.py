@@ -1,8 +1,11 @@
 import logging
+import itertools
+import esgfpid.defaults
 import esgfpid.exceptions
 import esgfpid.assistant.consistency
 import esgfpid.assistant.messages
 import esgfpid.utils as utils
+from esgfpid.rabbit.asynchronous.exceptions import MessageQueueFull
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
 
 LOGGER = logging.getLogger(__name__)
@@ -30,7 +33,7 @@ class DatasetPublicationAssistant(object):
         mandatory_args = ['drs_id', 'version_number', 'data_node', 'prefix',
                           'thredds_service_path', 'is_replica', 'coupler',
                           'consumer_solr_url']
-        optional_args = []
+        optional_args = ['stream_files']
         utils.check_presence_of_mandatory_args(args, mandatory_args)
         utils.add_missing_optional_args_with_value_none(args, optional_args)
         self.__enforce_integer_version_number(args)
@@ -41,6 +44,7 @@ class DatasetPublicationAssistant(object):
         self.__define_other_attributes()
         self.__create_and_store_dataset_handle()
         self.__init_state_machine()
+        self.__start_consistency_check_preparation()
 
         logdebug(LOGGER, 'Done: Constructor for Publication assistant for dataset "%s", version "%i" at host "%s".',
             args['drs_id'],
@@ -74,8 +78,13 @@ class DatasetPublicationAssistant(object):
 
     def __define_other_attributes(self):
         self.__dataset_handle = None
-        self.__list_of_file_handles = []
-        self.__list_of_file_messages = []
+        self.__file_records = [] # messages are made from them only when sending
+        self.__sent_file_handles = [] # streaming mode: sent before the commit
+        self.__rejected_messages = [] # not accepted by the full queue, to be sent at the commit
+        self.__commit_tried = False
+        self.__shared_strings = {} # so that equal values of many files are stored once
+        self.__rabbit_business_started = False
+        self.__consistency_checker = None
         self.__message_timestamp = utils.get_now_utc_as_formatted_string()
 
     def __store_args_in_attributes(self, args):
@@ -87,6 +96,7 @@ class DatasetPublicationAssistant(object):
         self.__is_replica = args['is_replica']
         self.__coupler = args['coupler']
         self.__consumer_solr_url = args['consumer_solr_url']
+        self.__stream_files = args['stream_files'] == True
 
     def __init_state_machine(self):
         self.__machine_states = {'dataset_added':0, 'files_added':1, 'publication_finished':2}
@@ -99,6 +109,22 @@ class DatasetPublicationAssistant(object):
             prefix = self.__prefix
         )
 
+    '''
+    The previous files of the dataset are retrieved from solr
+    in the background, while the publisher adds the files, so
+    that the commit does not have to wait for solr (unless it
+    is slower than the publisher).
+    '''
+    def __start_consistency_check_preparation(self):
+        self.__consistency_checker = esgfpid.assistant.consistency.Checker(
+            coupler=self.__coupler,
+            drs_id=self.__drs_id,
+            version_number=self.__version_number,
+            data_node=self.__data_node,
+            prefix=self.__prefix,
+            in_background=True
+        )
+
     def get_dataset_handle(self):
         '''
         This returns the handle string of the dataset to be
@@ -182,14 +208,15 @@ class DatasetPublicationAssistant(object):
 
     def __add_file(self, **args):
         logdebug(LOGGER, 'Adding file "%s" with handle "%s".', args['file_name'], args['file_handle'])
-        self.__add_file_to_datasets_children(args['file_handle'])
-        self.__adapt_file_args(args)
-        self.__create_and_store_file_publication_message(args)        
+        self.__add_file_to_consistency_check(args['file_handle'])
+        self.__create_and_store_file_record(args)
         self.__set_machine_state_to_files_added()
+        if self.__stream_files:
+            self.__stream_file_messages_if_possible()
         logtrace(LOGGER, 'Adding file done.')
 
-    def __add_file_to_datasets_children(self, file_handle):
-        self.__list_of_file_handles.append(file_handle)
+    def __add_file_to_consistency_check(self, file_handle):
+        self.__consistency_checker.add_file_handle(file_handle)
 
     def __make_sure_hdl_is_added(self, args):
         if not args['file_handle'].startswith('hdl:'):
@@ -210,20 +237,59 @@ class DatasetPublicationAssistant(object):
             raise esgfpid.exceptions.ESGFException(msg)
 
 
-    def __adapt_file_args(self, args):
-        url = self.__create_file_url(args['publish_path'])
-        args['data_url'] = url
-        del args['publish_path']
-
     def __create_file_url(self, publish_path):
         url = self.__data_node +'/'+ self.__thredds_service_path +'/'+ publish_path.strip('/')
         if not url.startswith('http'):
             url = 'http://'+url
         return url
 
-    def __create_and_store_file_publication_message(self, args):
-        message = self.__create_file_publication_message(args)
-        self.__list_of_file_messages.append(message)
+    def __create_and_store_file_record(self, args):
+        record = _FileRecord(
+            file_handle=args['file_handle'],
+            file_name=args['file_name'],
+            file_size=args['file_size'],
+            checksum=args['checksum'],
+            checksum_type=self.__share_string(args['checksum_type']),
+            publish_path=args['publish_path'],
+            file_version=self.__share_string(args['file_version'])
+        )
+        self.__file_records.append(record)
+
+    def __share_string(self, string):
+        return self.__shared_strings.setdefault(string, string)
+
+    '''
+    Streaming mode: Send the messages of the files added so far,
+    once there are enough for a batch, and only if the consistency
+    check cannot fail anymore, i.e. once solr replied that it will
+    not be run (e.g. first publication). Otherwise, a file message
+    might be sent for a dataset whose publication is then refused,
+    and there is no message to retract it. So in republications,
+    all files are held back until the commit.
+
+    If the queue of the messaging module is full and does not
+    accept all of them, the rest is sent at the commit, and no
+    more files are streamed.
+    '''
+    def __stream_file_messages_if_possible(self):
+        if len(self.__file_records) < esgfpid.defaults.PUBLICATION_STREAM_BATCH_SIZE:
+            return
+        if not self.__consistency_checker.is_prepared():
+            return # Never wait for solr while files are added
+        if self.__consistency_checker.can_run_check():
+            return
+        if len(self.__rejected_messages) > 0:
+            return
+
+        records_to_send = self.__file_records
+        self.__file_records = []
+        self.__sent_file_handles.extend(record.file_handle for record in records_to_send)
+        self.__start_rabbit_business_once()
+        try:
+            self.__send_file_messages_to_queue(records_to_send)
+        except MessageQueueFull as e:
+            logwarn(LOGGER, 'Queue is full, %i file messages will be sent at the commit.', len(e.rejected_messages))
+            self.__rejected_messages = e.rejected_messages
 
     def __set_machine_state_to_files_added(self):
         self.__machine_state = self.__machine_states['files_added']
@@ -244,17 +310,54 @@ class DatasetPublicationAssistant(object):
         
         * Check if the set of files corresponds to the previously published set (if applicable, and if solr url given, and if solr replied)
         * The dataset publication message is created and sent to the queue.
-        * All file publication messages are sent to the queue.
+        * All file publication messages are sent to the queue (in
+          streaming mode, the ones that were not sent yet).
+
+        If the queue of the messaging module is full and does not
+        accept all messages (:class:`~esgfpid.rabbit.asynchronous.exceptions.MessageQueueFull`,
+        only with the "raise" policy), the publication is not
+        finished, and the commit can be called again. Then only the
+        messages that were not accepted before are sent.
+
+        '''
+        self.__check_if_dataset_publication_allowed_right_now()
+        self.__check_data_consistency(ignore_exception)
+        self.__start_rabbit_business_once()
+        self.__send_publication_messages_to_queue(self.__coupler.send_many_messages_to_queue)
+        self.__done_with_rabbit_business()
+        self.__coupler.invalidate_solr_cache(self.__drs_id) # solr will change
+        self.__set_machine_state_to_finished()
+        loginfo(LOGGER, 'Requesting to publish PID for dataset "%s" (version %s) and its files at "%s" (handle %s).', self.__drs_id, self.__version_number, self.__data_node, self.__dataset_handle)
 
+    def dataset_publication_finished_with_completion(self, ignore_exception=False):
+        '''
+        Like :meth:`~esgfpid.assistant.publish.DatasetPublicationAssistant.dataset_publication_finished`,
+        but returns a Completion object that tells when RabbitMQ
+        has confirmed all messages of this dataset (or when they
+        failed), so that publishers that run an event loop can
+        commit many datasets without blocking.
+
+        In synchronous mode, it blocks until the messages were
+        confirmed, and the returned Completion is done already.
+        Not available in active-active mode.
+
+        In streaming mode, the Completion does not cover the file
+        messages that were sent while the files were added. If the
+        commit is called again after MessageQueueFull, it only
+        covers the messages sent then.
+
+        :return: A Completion object (see
+            :meth:`~esgfpid.connector.Connector.finish_messaging_thread_in_background`).
         '''
         self.__check_if_dataset_publication_allowed_right_now()
         self.__check_data_consistency(ignore_exception)
-        self.__coupler.start_rabbit_business() # Synchronous: Opens connection. Asynchronous: Ignored.
-        self.__create_and_send_dataset_publication_message_to_queue()
-        self.__send_existing_file_messages_to_queue()
-        self.__coupler.done_with_rabbit_business() # Synchronous: Closes connection. Asynchronous: Ignored.
+        self.__start_rabbit_business_once()
+        completion = self.__send_publication_messages_to_queue(self.__coupler.send_many_messages_to_queue_with_completion)
+        self.__done_with_rabbit_business()
+        self.__coupler.invalidate_solr_cache(self.__drs_id) # solr will change
         self.__set_machine_state_to_finished()
         loginfo(LOGGER, 'Requesting to publish PID for dataset "%s" (version %s) and its files at "%s" (handle %s).', self.__drs_id, self.__version_number, self.__data_node, self.__dataset_handle)
+        return completion
 
     def __check_if_dataset_publication_allowed_right_now(self):
         if not self.__machine_state == self.__machine_states['files_added']:
@@ -270,62 +373,101 @@ class DatasetPublicationAssistant(object):
 
 
     def __check_data_consistency(self, ignore_exception):
-        checker = esgfpid.assistant.consistency.Checker(
-            coupler=self.__coupler,
-            drs_id=self.__drs_id,
-            version_number=self.__version_number,
-            data_node=self.__data_node
-        )
+        checker = self.__consistency_checker
         check_possible = checker.can_run_check()
         if check_possible:
-            check_passed = checker.data_consistency_check(self.__list_of_file_handles)
+            check_passed = checker.data_consistency_check() # files were passed in add_file
             if check_passed:
                 loginfo(LOGGER, 'Data consistency check passed for dataset %s.', self.__dataset_handle)
             else:
-                msg = 'Dataset consistency check failed'
+                diff = checker.get_diff()
+                msg = ('Dataset consistency check failed (%i missing, %i superfluous files)'
+                       % (len(diff['missing_files']), len(diff['superfluous_files'])))
                 logwarn(LOGGER, msg)
                 if not ignore_exception:
-                    raise esgfpid.exceptions.InconsistentFilesetException(msg)
+                    raise esgfpid.exceptions.InconsistentFilesetException(msg, diff=diff)
         else:
             logdebug(LOGGER, 'No consistency check was carried out.')
 
-    def __create_and_send_dataset_publication_message_to_queue(self):
-        self.__remove_duplicates_from_list_of_file_handles()
-        message = self.__create_dataset_publication_message()
-        self.__send_message_to_queue(message)
-        logdebug(LOGGER, 'Dataset publication message handed to rabbit thread.')
+    '''
+    Synchronous: Opens connection (only once, even if messages
+    were sent while the files were added). Asynchronous: Ignored.
+    '''
+    def __start_rabbit_business_once(self):
+        if not self.__rabbit_business_started:
+            self.__coupler.start_rabbit_business()
+            self.__rabbit_business_started = True
+
+    def __done_with_rabbit_business(self):
+        if self.__rabbit_business_started:
+            self.__coupler.done_with_rabbit_business() # Synchronous: Closes connection. Asynchronous: Ignored.
+            self.__rabbit_business_started = False
+
+    '''
+    The dataset message and all file messages are sent at once,
+    so that in synchronous mode they are published without
+    waiting for each confirm before the next publish.
+
+    If the queue did not accept all of them, only the rejected
+    ones are sent when the commit is called again, as the others
+    will be published already.
+
+    :param send: The coupler's function to send many messages.
+    :return: What the function returned.
+    '''
+    def __send_publication_messages_to_queue(self, send):
+        if self.__commit_tried:
+            messages = self.__rejected_messages
+        else:
+            messages = itertools.chain(
+                [self.__create_dataset_publication_message()],
+                self.__rejected_messages,
+                self.__iterate_file_publication_messages(self.__file_records))
+        self.__commit_tried = True
+        try:
+            result = send(messages)
+        except MessageQueueFull as e:
+            logwarn(LOGGER, 'Queue is full, %i messages were not accepted. The publication can be finished again to send them.', len(e.rejected_messages))
+            self.__rejected_messages = e.rejected_messages
+            self.__done_with_rabbit_business()
+            raise
+        self.__rejected_messages = []
+        logdebug(LOGGER, 'Dataset and file publication messages handed to rabbit thread.')
         logtrace(LOGGER, 'Dataset publication message: %s (%s, version %s).', self.__dataset_handle, self.__drs_id, self.__version_number)
+        return result
 
-    def __remove_duplicates_from_list_of_file_handles(self):
-        self.__list_of_file_handles = list(set(self.__list_of_file_handles))
-
-    def __send_existing_file_messages_to_queue(self):
-        for i in xrange(0, len(self.__list_of_file_messages)):
-            self.__try_to_send_one_file_message(i)
-        msg = 'All file publication jobs handed to rabbit thread.'
-        logdebug(LOGGER, msg)
-        
-    def __try_to_send_one_file_message(self, list_index):
-        msg = self.__list_of_file_messages[list_index]
-        success = self.__send_message_to_queue(msg)
-        logdebug(LOGGER, 'File publication message handed to rabbit thread: %s (%s)', msg['handle'], msg['file_name'])
-        return success
+    def __send_file_messages_to_queue(self, records):
+        if len(records) == 0:
+            return
+        self.__coupler.send_many_messages_to_queue(self.__iterate_file_publication_messages(records))
+        for record in records:
+            logdebug(LOGGER, 'File publication message handed to rabbit thread: %s (%s)', record.file_handle, record.file_name)
 
     def __set_machine_state_to_finished(self):
         self.__machine_state = self.__machine_states['publication_finished']
 
-    def __create_file_publication_message(self, args):
+    '''
+    The messages are made one by one while they are handed to
+    the messaging module. It serializes each one right away, so
+    the message dicts are not all in memory at the same time.
+    Their serialized forms are, though (as a list of envelopes).
+    '''
+    def __iterate_file_publication_messages(self, records):
+        for record in records:
+            yield self.__create_file_publication_message(record)
+
+    def __create_file_publication_message(self, record):
         
         message = esgfpid.assistant.messages.publish_file(
-            file_handle=args['file_handle'],
-            file_size=args['file_size'],
-            file_name=args['file_name'],
-            checksum=args['checksum'],
-            data_url=args['data_url'],
+            file_handle=record.file_handle,
+            file_size=record.file_size,
+            file_name=record.file_name,
+            checksum=record.checksum,
+            data_url=self.__create_file_url(record.publish_path),
             data_node=self.__data_node,
             parent_dataset=self.__dataset_handle,
-            checksum_type=args['checksum_type'],
-            file_version=args['file_version'],
+            checksum_type=record.checksum_type,
+            file_version=record.file_version,
             is_replica=self.__is_replica,
             timestamp=self.__message_timestamp,
         )
@@ -338,13 +480,30 @@ class DatasetPublicationAssistant(object):
             is_replica=self.__is_replica,
             drs_id=self.__drs_id,
             version_number=self.__version_number,
-            list_of_files=self.__list_of_file_handles,
+            list_of_files=self.__get_list_of_file_handles(),
             data_node=self.__data_node,
             timestamp=self.__message_timestamp,
             consumer_solr_url=self.__consumer_solr_url
         )
         return message
 
-    def __send_message_to_queue(self, message):
-        success = self.__coupler.send_message_to_queue(message)
-        return success
\ No newline at end of file
+    def __get_list_of_file_handles(self):
+        handles = set(self.__sent_file_handles)
+        handles.update(record.file_handle for record in self.__file_records)
+        return list(handles) # without duplicates
+
+
+'''
+What the assistant keeps of each file until the publication
+is finished. The values that are the same for all files of
+the dataset (data node, dataset handle, timestamp, replica
+flag) are kept only once, by the assistant.
+'''
+class _FileRecord(object):
+
+    __slots__ = ['file_handle', 'file_name', 'file_size', 'checksum',
+                 'checksum_type', 'publish_path', 'file_version']
+
+    def __init__(self, **args):
+        for name in self.__slots__:
+            setattr(self, name, args[name])
@@ -89,6 +89,7 @@ class AssistantOneVersion(object):
 
     def _send_message_to_queue(self, message):
         self._coupler.send_message_to_queue(message)
+        self._coupler.invalidate_solr_cache(self._drs_id) # solr will change
 
 class AssistantAllVersions(AssistantOneVersion):
 
@@ -68,6 +68,80 @@ class Connector(object):
             sending should work in synchronous mode. Defaults to
             the value defined in defaults.py.
 
+        :param message_service_spool_dir: Optional. Directory in
+            which every message is stored until RabbitMQ confirmed
+            it (only in asynchronous mode). Messages that were not
+            confirmed (e.g. because the process died, or the thread
+            was force-finished) are published again the next time
+            the messaging thread is started with the same directory.
+            Defaults to the value defined in defaults.py (no spool).
+
+        :param message_service_spool_fsync: Optional. When to sync
+            the spool to disk: "always" (after every message, safest
+            but slowest), "interval" (at most once a second) or "never"
+            (leave it to the operating system). Defaults to the value
+            defined in defaults.py.
+
+        :param message_service_queue_max_messages: Optional. Maximum
+            number of messages that wait to be published (only in
+            asynchronous mode), e.g. while RabbitMQ is not reachable.
+            Defaults to the value defined in defaults.py (no limit).
+
+        :param message_service_queue_max_bytes: Optional. Maximum
+            size (in bytes) of the messages that wait to be published
+            (only in asynchronous mode). Defaults to the value defined
+            in defaults.py (no limit).
+
+        :param message_service_queue_full_policy: Optional. What to
+            do when a PID request is made while the queue of waiting
+            messages is full: "block" (wait until there is space, up
+            to a timeout, then raise), "raise" (raise a
+            :class:`~esgfpid.rabbit.asynchronous.exceptions.MessageQueueFull`
+            immediately) or "spill" (store the message in a temporary
+            file on disk). Defaults to the value defined in defaults.py.
+            If a publication's commit raises MessageQueueFull, it can be
+            called again, and only sends the messages that were not
+            accepted the first time.
+
+        :param message_service_persistent_session: Optional. Boolean.
+            Only in synchronous mode: If True, one connection to
+            RabbitMQ is kept open across many datasets (instead of
+            opening and closing one per dataset). It is kept alive
+            in the background and reopened if it was lost. It is
+            closed by
+            :meth:`~esgfpid.connector.Connector.finish_messaging_thread`.
+            Defaults to the value defined in defaults.py (False).
+
+        :param message_service_node_state_file: Optional. Path of a
+            small JSON file in which the library keeps the connect
+            latency and failures of every RabbitMQ node, so that the
+            next process starts with the fastest healthy node (among
+            the nodes of the same priority), and which nodes are
+            currently skipped because they failed repeatedly (their
+            "circuit" is open). Processes on the same host can share
+            the file. Defaults to the value defined in defaults.py
+            (None, i.e. not stored).
+
+        :param message_service_warm_up: Optional. Boolean. If True,
+            the thread that communicates with RabbitMQ is started
+            right away (only in asynchronous mode), so that the
+            connection is ready when the first PID requests are
+            made. Calling
+            :meth:`~esgfpid.connector.Connector.start_messaging_thread`
+            later does no harm. Please do not forget to finish
+            the thread. Defaults to the value defined in
+            defaults.py (False).
+
+        :param message_service_active_active: Optional. Boolean. Only
+            in asynchronous mode: If True, the library does not use
+            the other trusted RabbitMQ nodes of the best priority as
+            fallback only, but keeps a connection to each healthy one
+            and distributes the PID requests among them. If a node
+            fails, its pending requests are sent via the others.
+            Requests of one dataset may then arrive in a different
+            order. Spooling is not used in this mode. Defaults to the
+            value defined in defaults.py (False).
+
         :param data_node: Mandatory/Optional.
 
             (Mandatory for publications and unpublications,
@@ -112,6 +186,38 @@ class Connector(object):
             should be switched off. In that case, no connections to solr
             are made. 
 
+        :param solr_http_pool_maxsize: Optional. Number of connections
+            to solr that are kept open and reused for later queries.
+            Defaults to SOLR_HTTP_POOL_MAXSIZE.
+
+        :param solr_http_keep_alive: Optional flag. If False, every
+            query to solr opens a new connection. Defaults to
+            SOLR_HTTP_KEEP_ALIVE.
+
+        :param solr_http_max_retries: Optional. How often a query to
+            solr is retried after connection errors or HTTP 502/503/504.
+            Defaults to SOLR_HTTP_MAX_RETRIES.
+
+        :param solr_http_gzip: Optional flag. Whether to ask solr for
+            compressed responses. Defaults to SOLR_HTTP_GZIP.
+
+        :param solr_cache_max_entries: Optional. How many results of
+            solr lookups are kept in memory. 0 switches the cache off.
+            Defaults to SOLR_CACHE_MAX_ENTRIES.
+
+        :param solr_cache_ttl_seconds: Optional. How long the results
+            of solr lookups are kept. Empty results are kept for
+            SOLR_CACHE_NEGATIVE_TTL_SECONDS at most. Defaults to
+            SOLR_CACHE_TTL_SECONDS.
+
+        :param solr_file_handle_query_mode: Optional. How the two solr
+            queries for the files of a dataset (during the consistency
+            check) are sent: 'sequential' (the second only if the first
+            found nothing), 'concurrent' (both at once), or 'hedged'
+            (the second if the first did not find anything after
+            SOLR_HEDGE_DELAY_SECONDS). Defaults to
+            SOLR_FILE_HANDLE_QUERY_MODE.
+
         :param consumer_solr_url: Optional. URL of a solr instance that
             is to be used by the consumer (e.g. for finding versions), *not*
             by this library.
@@ -124,6 +230,15 @@ class Connector(object):
         :returns: An instance of the connector, configured for one 
             data node, and for connection with a specific RabbitMQ node.
 
+        Note:
+        The connector can be created before forking worker processes
+        (e.g. with multiprocessing). Each child gets its own
+        connection to RabbitMQ (and its own messaging thread, if the
+        parent had started one) as soon as it uses the connector, and
+        the parent's connection is not touched. Each child has to
+        finish its own messaging thread. Spooling is not used in the
+        children.
+
         '''
         LOGGER.debug(40*'-')
         LOGGER.debug('Creating PID connector object ..')
@@ -134,6 +249,9 @@ class Connector(object):
         self.__throw_error_if_prefix_not_in_list()
         self.__coupler = esgfpid.coupling.Coupler(**args)
         loginfo(LOGGER, 'Created PID connector.')
+        if args['message_service_warm_up']:
+            logdebug(LOGGER, 'Warming up the connection to the messaging service...')
+            self.__coupler.start_rabbit_connection()
 
     def __check_presence_of_args(self, args):
         mandatory_args = [
@@ -149,8 +267,24 @@ class Connector(object):
             'solr_https_verify',
             'disable_insecure_request_warning',
             'solr_switched_off',
+            'solr_http_pool_maxsize',
+            'solr_http_keep_alive',
+            'solr_http_max_retries',
+            'solr_http_gzip',
+            'solr_cache_max_entries',
+            'solr_cache_ttl_seconds',
+            'solr_file_handle_query_mode',
             'consumer_solr_url',
-            'message_service_synchronous'
+            'message_service_synchronous',
+            'message_service_spool_dir',
+            'message_service_spool_fsync',
+            'message_service_queue_max_messages',
+            'message_service_queue_max_bytes',
+            'message_service_queue_full_policy',
+            'message_service_persistent_session',
+            'message_service_node_state_file',
+            'message_service_warm_up',
+            'message_service_active_active'
         ]
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
 
@@ -179,6 +313,27 @@ class Connector(object):
         if 'solr_https_verify' not in args or args['solr_https_verify'] is None:
             args['solr_https_verify'] = esgfpid.defaults.SOLR_HTTPS_VERIFY_DEFAULT
 
+        if 'solr_http_pool_maxsize' not in args or args['solr_http_pool_maxsize'] is None:
+            args['solr_http_pool_maxsize'] = esgfpid.defaults.SOLR_HTTP_POOL_MAXSIZE
+
+        if 'solr_http_keep_alive' not in args or args['solr_http_keep_alive'] is None:
+            args['solr_http_keep_alive'] = esgfpid.defaults.SOLR_HTTP_KEEP_ALIVE
+
+        if 'solr_http_max_retries' not in args or args['solr_http_max_retries'] is None:
+            args['solr_http_max_retries'] = esgfpid.defaults.SOLR_HTTP_MAX_RETRIES
+
+        if 'solr_http_gzip' not in args or args['solr_http_gzip'] is None:
+            args['solr_http_gzip'] = esgfpid.defaults.SOLR_HTTP_GZIP
+
+        if 'solr_cache_max_entries' not in args or args['solr_cache_max_entries'] is None:
+            args['solr_cache_max_entries'] = esgfpid.defaults.SOLR_CACHE_MAX_ENTRIES
+
+        if 'solr_cache_ttl_seconds' not in args or args['solr_cache_ttl_seconds'] is None:
+            args['solr_cache_ttl_seconds'] = esgfpid.defaults.SOLR_CACHE_TTL_SECONDS
+
+        if 'solr_file_handle_query_mode' not in args or args['solr_file_handle_query_mode'] is None:
+            args['solr_file_handle_query_mode'] = esgfpid.defaults.SOLR_FILE_HANDLE_QUERY_MODE
+
         if 'disable_insecure_request_warning' not in args or args['disable_insecure_request_warning'] is None:
             args['disable_insecure_request_warning'] = False
 
@@ -188,6 +343,33 @@ class Connector(object):
         if 'consumer_solr_url' not in args or args['consumer_solr_url'] is None:
             args['consumer_solr_url'] = None
 
+        if 'message_service_spool_dir' not in args or args['message_service_spool_dir'] is None:
+            args['message_service_spool_dir'] = esgfpid.defaults.RABBIT_SPOOL_DIR
+
+        if 'message_service_spool_fsync' not in args or args['message_service_spool_fsync'] is None:
+            args['message_service_spool_fsync'] = esgfpid.defaults.RABBIT_SPOOL_FSYNC
+
+        if 'message_service_queue_max_messages' not in args or args['message_service_queue_max_messages'] is None:
+            args['message_service_queue_max_messages'] = esgfpid.defaults.RABBIT_QUEUE_MAX_MESSAGES
+
+        if 'message_service_queue_max_bytes' not in args or args['message_service_queue_max_bytes'] is None:
+            args['message_service_queue_max_bytes'] = esgfpid.defaults.RABBIT_QUEUE_MAX_BYTES
+
+        if 'message_service_queue_full_policy' not in args or args['message_service_queue_full_policy'] is None:
+            args['message_service_queue_full_policy'] = esgfpid.defaults.RABBIT_QUEUE_FULL_POLICY
+
+        if 'message_service_persistent_session' not in args or args['message_service_persistent_session'] is None:
+            args['message_service_persistent_session'] = esgfpid.defaults.RABBIT_SYN_PERSISTENT_SESSION
+
+        if 'message_service_node_state_file' not in args or args['message_service_node_state_file'] is None:
+            args['message_service_node_state_file'] = esgfpid.defaults.RABBIT_NODE_STATE_FILE
+
+        if 'message_service_warm_up' not in args or args['message_service_warm_up'] is None:
+            args['message_service_warm_up'] = esgfpid.defaults.RABBIT_ASYN_WARM_UP
+
+        if 'message_service_active_active' not in args or args['message_service_active_active'] is None:
+            args['message_service_active_active'] = esgfpid.defaults.RABBIT_ACTIVE_ACTIVE
+
     def __check_rabbit_credentials_completeness(self, args):
         for credentials in args['messaging_service_credentials']:
             if 'url' not in credentials:
@@ -234,6 +416,17 @@ class Connector(object):
             namely if the dataset was already published at a different
             host. For this, please refer to the consumer documentation.
 
+        :param stream_files: Optional. If True, the file publication
+            messages are handed to the messaging module while the
+            files are added (in batches of PUBLICATION_STREAM_BATCH_SIZE),
+            instead of all at once when the publication is finished.
+            The dataset message is still sent then. Files are only
+            streamed if the consistency check cannot fail, i.e. if it
+            is not run (e.g. first publication). In republications,
+            they are all sent at the end, as usual.
+            In asynchronous mode, the messaging thread must be started
+            before files are added. Defaults to False.
+
         :return: A publication assistant which provides all necessary
             methods to publish a dataset and its files.
         '''
@@ -266,7 +459,8 @@ class Connector(object):
             prefix=self.prefix,
             coupler=self.__coupler,
             is_replica=args['is_replica'],
-            consumer_solr_url=self.__consumer_solr_url # may be None
+            consumer_solr_url=self.__consumer_solr_url, # may be None
+            stream_files=args.get('stream_files', False)
         )
         logdebug(LOGGER, 'Creating publication assistant.. done')
         return assistant
@@ -488,21 +682,60 @@ class Connector(object):
         '''
         self.__coupler.start_rabbit_connection()
 
-    def finish_messaging_thread(self):
+    def finish_messaging_thread(self, timeout=None):
         '''
         Finish and join the parallel thread that takes care of
         the asynchronous communication with RabbitMQ.
 
         If some messages are still in the stack to be sent,
         or if some messages were not confirmed yet, this method
-        blocks and waits for some time while it iteratively
-        checks for message confirmation.
+        blocks until the last of them was confirmed, or until
+        the timeout is over. If no messages are pending, it
+        returns at once.
+
+        :param timeout: Optional. Maximum number of seconds to
+            wait for pending messages. Messages that are still
+            pending then are treated like in
+            :meth:`~esgfpid.connector.Connector.force_finish_messaging_thread`.
+            Defaults to the value defined in defaults.py (5 seconds).
+
+        In synchronous mode, this closes the connection of a
+        persistent session (see the argument
+        "message_service_persistent_session").
+        '''
+        self.__coupler.finish_rabbit_connection(timeout)
 
-        Currently, it waits up to 5 seconds: It checks up to
-        11 times, waiting 0.5 seconds in between - these
-        values can be configured in the defaults module).
+    def finish_messaging_thread_in_background(self, timeout=None):
+        '''
+        Like :meth:`~esgfpid.connector.Connector.finish_messaging_thread`,
+        but does not block, for publishers that run an event loop.
+        The thread is finished and joined by a helper thread.
+
+        :param timeout: Optional. Maximum number of seconds to
+            wait for pending messages.
+
+        :return: A Completion object. Its method "done()" tells
+            whether the thread has ended, "wait(timeout)" blocks
+            until then, and "add_done_callback(function)" registers
+            a function to be called with it (on the helper thread).
+            Its method "get_failed_messages()" returns the messages
+            that were not sent or not confirmed, as envelopes
+            (:class:`~esgfpid.rabbit.rabbitutils.MessageEnvelope`,
+            a namedtuple whose "body" is the message as JSON string),
+            not as the dictionaries that were passed. Not available
+            in active-active mode.
+        '''
+        return self.__coupler.finish_rabbit_connection_in_background(timeout)
+
+    def flush_messaging_thread(self):
+        '''
+        Get a Completion object (see
+        :meth:`~esgfpid.connector.Connector.finish_messaging_thread_in_background`)
+        that is done once all PID requests that were sent with a
+        Completion so far were confirmed by RabbitMQ (or failed).
+        This does not block. Not available in active-active mode.
         '''
-        self.__coupler.finish_rabbit_connection()
+        return self.__coupler.flush_rabbit_connection()
 
     def force_finish_messaging_thread(self):
         '''
@@ -525,6 +758,70 @@ class Connector(object):
         '''
         self.__coupler.force_finish_rabbit_connection()
 
+    def get_message_queue_status(self):
+        '''
+        Get the status of the queue of PID requests that wait to
+        be sent to RabbitMQ (only in asynchronous mode). Publishers
+        can use this to slow down before the queue is full.
+
+        :return: Dictionary with the entries "num_messages" (waiting
+            messages, in memory and on disk), "num_bytes" (size of the
+            messages in memory), "num_spilled" (messages on disk),
+            "max_messages", "max_bytes" and "full_policy". None in
+            synchronous mode.
+        '''
+        return self.__coupler.get_message_queue_status()
+
+    def get_message_node_status(self):
+        '''
+        Get the status of every RabbitMQ node (only in active-active
+        mode, see the argument "message_service_active_active").
+
+        :return: Dictionary by host name. For each node, a dictionary
+            with the entries "state" ("available", "connecting",
+            "failed" or "finished"), "num_sent" (requests handed to
+            this node), "num_moved_away" (requests sent via other
+            nodes after this one failed) and "num_pending" (requests
+            waiting to be sent or confirmed). None if not in
+            active-active mode.
+        '''
+        return self.__coupler.get_message_node_status()
+
+    def prefetch_solr_info_for_consistency_check(self, datasets):
+        '''
+        Retrieve the info needed for the consistency checks of
+        many dataset publications from solr at once, in a few
+        batched queries instead of one or two per dataset. Call
+        this before creating the publication assistants.
+
+        The info is kept in memory until the consistency check of
+        each dataset uses it, however long the publications take.
+        So only prefetch datasets that are published soon.
+
+        Datasets whose files are not found at this data node are
+        looked up as usual during their publication. Nothing
+        happens if solr is switched off.
+
+        :param datasets: List of tuples (drs_id, version_number),
+            of datasets to be published at this data node.
+        :return: The number of datasets whose files were found.
+        '''
+        if self.__coupler.is_solr_switched_off():
+            logdebug(LOGGER, 'No prefetching, as solr is switched off.')
+            return 0
+
+        if self.__data_node is None:
+            msg = 'No data_node given (but it is mandatory for prefetching)'
+            logwarn(LOGGER, msg)
+            raise esgfpid.exceptions.ArgumentError(msg)
+
+        data_node = self.__data_node.rstrip('/') # as in the publication assistant
+        datasets = [(drs_id, int(version_number), data_node) for drs_id, version_number in datasets]
+        result = self.__coupler.prefetch_file_handles_of_many_datasets(datasets)
+        num_found = len([handles for handles in result.itervalues() if handles])
+        loginfo(LOGGER, 'Prefetched info for consistency check of %i of %i datasets.', num_found, len(datasets))
+        return num_found
+
     def make_handle_from_drsid_and_versionnumber(self, **args):
         '''
         Create a handle string for a specific dataset, based
@@ -537,4 +834,20 @@ class Connector(object):
         :return: A handle string (e.g. "hdl:21.14100/abcxyzfoo")
         '''
         args['prefix'] = self.prefix
-        return esgfpid.utils.make_handle_from_drsid_and_versionnumber(**args)
\ No newline at end of file
+        return esgfpid.utils.make_handle_from_drsid_and_versionnumber(**args)
+
+    def make_handles_from_drsids_and_versionnumbers(self, datasets, processes=None):
+        '''
+        Create the handle strings of many datasets at once (e.g.
+        to map a whole index to PIDs), with the prefix passed to
+        the library at initializing.
+
+        :param datasets: Iterable of tuples (drs_id, version_number).
+        :param processes: Optional. If more than 1, the handles are
+            made in this many processes (only worth it for millions
+            of datasets).
+        :return: List of handle strings, in the same order as
+            the datasets.
+        '''
+        return esgfpid.utils.make_handles_from_drsids_and_versionnumbers(
+            datasets, self.prefix, processes=processes)
\ No newline at end of file
@@ -1,7 +1,9 @@
+import os
 import logging
 import esgfpid.rabbit
 import esgfpid.solr
 import esgfpid.utils
+from esgfpid.utils import logdebug, logwarn
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -20,6 +22,11 @@ Everything that the library needs to know from solr
 or RabbitMQ is done via this coupling module, which
 basically just forwards all request to the responsible
 module.
+
+The Coupler is fork-aware: If the process was forked
+(e.g. by multiprocessing) after the Coupler was created,
+the child gets its own RabbitMessageSender the first time
+it uses it (see __renew_message_sender_after_fork()).
 '''
 class Coupler(object):
 
@@ -30,18 +37,38 @@ class Coupler(object):
     :param messaging_service_exchange_name: Mandatory.
     :param message_service_synchronous: Mandatory. Boolean.
     :param test_publication: Mandatory. Boolean.
+    :param message_service_spool_dir: Optional. May be None.
+    :param message_service_spool_fsync: Optional. May be None.
+    :param message_service_queue_max_messages: Optional. May be None.
+    :param message_service_queue_max_bytes: Optional. May be None.
+    :param message_service_queue_full_policy: Optional. May be None.
+    :param message_service_persistent_session: Optional. May be None.
+    :param message_service_node_state_file: Optional. May be None.
+    :param message_service_active_active: Optional. May be None.
 
     :param solr_switched_off: Mandatory. Boolean.
     :param solr_url: Mandatory. May be None if switched off.
     :param handle_prefix: Mandatory. May be None if switched off.
     :param solr_https_verify: Mandatory. May be None if switched off.
     :param disable_insecure_request_warning: Mandatory. May be None if switched off.
+    :param solr_http_pool_maxsize: Optional. May be None.
+    :param solr_http_keep_alive: Optional. May be None.
+    :param solr_http_max_retries: Optional. May be None.
+    :param solr_http_gzip: Optional. May be None.
+    :param solr_cache_max_entries: Optional. May be None.
+    :param solr_cache_ttl_seconds: Optional. May be None.
+    :param solr_file_handle_query_mode: Optional. May be None.
 
     '''
     def __init__(self, **args):
         self.args = args # only for unit testing
         self.__create_message_sender(args)
-        self.__create_solr_sender(args)     
+        self.__create_solr_sender(args)
+        self.__pid = self.__getpid()
+        self.__rabbit_thread_started = False
+
+    def __getpid(self): # easy to mock/patch in unit test!
+        return os.getpid()
 
     def __create_message_sender(self, args):
         self.__complete_credentials_for_open_nodes(args)
@@ -49,9 +76,54 @@ class Coupler(object):
             exchange_name=args['messaging_service_exchange_name'],
             credentials=args['messaging_service_credentials'],
             test_publication=args['test_publication'],
-            is_synchronous_mode=args['message_service_synchronous']
+            is_synchronous_mode=args['message_service_synchronous'],
+            spool_dir=args.get('message_service_spool_dir'),
+            spool_fsync=args.get('message_service_spool_fsync'),
+            queue_max_messages=args.get('message_service_queue_max_messages'),
+            queue_max_bytes=args.get('message_service_queue_max_bytes'),
+            queue_full_policy=args.get('message_service_queue_full_policy'),
+            persistent_session=args.get('message_service_persistent_session'),
+            node_state_file=args.get('message_service_node_state_file'),
+            active_active=args.get('message_service_active_active')
         )
 
+    '''
+    Called before every use of the RabbitMessageSender.
+
+    If the process was forked since it was created, it belongs
+    to the parent process: Its rabbit thread does not exist in
+    the child, its queue contains copies of the parent's locks
+    and messages, and its connection is the parent's socket.
+    So the child leaves it alone (the parent is not disturbed)
+    and creates its own.
+
+    If the parent had started the rabbit thread (asynchronous
+    mode), the child's thread is started right away, so the
+    child can send messages without starting it. The child has
+    to finish its own thread, though.
+
+    The child does not use the parent's spool directory, as a
+    spool must only be used by one process at a time.
+    '''
+    def __renew_message_sender_after_fork(self):
+        pid = self.__getpid()
+        if pid == self.__pid:
+            return
+        logdebug(LOGGER, 'Process was forked (%i -> %i). Creating a new message sender.', self.__pid, pid)
+        args = dict(self.args)
+        if args.get('message_service_spool_dir') is not None:
+            logwarn(LOGGER, 'Not using spool directory "%s" in forked process %i: It belongs to process %i.',
+                args['message_service_spool_dir'], pid, self.__pid)
+            args['message_service_spool_dir'] = None
+        self.__pid = pid
+        self.__create_message_sender(args)
+        if self.__rabbit_thread_started:
+            self.__rabbit_message_sender.start()
+
+    def __get_message_sender(self):
+        self.__renew_message_sender_after_fork()
+        return self.__rabbit_message_sender
+
     def __complete_credentials_for_open_nodes(self, args):
         credentials = args['messaging_service_credentials']
         for cred in credentials:
@@ -64,7 +136,14 @@ class Coupler(object):
             prefix=args['handle_prefix'],
             https_verify=args['solr_https_verify'],
             switched_off=args['solr_switched_off'],
-            disable_insecure_request_warning = ['disable_insecure_request_warning']
+            disable_insecure_request_warning = ['disable_insecure_request_warning'],
+            http_pool_maxsize=args.get('solr_http_pool_maxsize'),
+            http_keep_alive=args.get('solr_http_keep_alive'),
+            http_max_retries=args.get('solr_http_max_retries'),
+            http_gzip=args.get('solr_http_gzip'),
+            cache_max_entries=args.get('solr_cache_max_entries'),
+            cache_ttl_seconds=args.get('solr_cache_ttl_seconds'),
+            file_handle_query_mode=args.get('solr_file_handle_query_mode')
         )
 
     ### Communications with rabbit
@@ -73,7 +152,19 @@ class Coupler(object):
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.send_message_to_queue`).
     '''
     def send_message_to_queue(self, message):
-        self.__rabbit_message_sender.send_message_to_queue(message)
+        self.__get_message_sender().send_message_to_queue(message)
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.send_many_messages_to_queue`).
+    '''
+    def send_many_messages_to_queue(self, messages):
+        self.__get_message_sender().send_many_messages_to_queue(messages)
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.send_many_messages_to_queue_with_completion`).
+    '''
+    def send_many_messages_to_queue_with_completion(self, messages):
+        return self.__get_message_sender().send_many_messages_to_queue_with_completion(messages)
 
     ### For synchronous
 
@@ -81,13 +172,13 @@ class Coupler(object):
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.open_rabbit_connection`).
     '''
     def start_rabbit_business(self):
-        self.__rabbit_message_sender.open_rabbit_connection()
+        self.__get_message_sender().open_rabbit_connection()
 
     '''
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.close_rabbit_connection`).
     '''
     def done_with_rabbit_business(self):
-        self.__rabbit_message_sender.close_rabbit_connection()
+        self.__get_message_sender().close_rabbit_connection()
 
     ### For asynchronous
 
@@ -95,19 +186,48 @@ class Coupler(object):
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.start`).
     '''
     def start_rabbit_connection(self):
-        self.__rabbit_message_sender.start()
+        self.__get_message_sender().start()
+        self.__rabbit_thread_started = True
 
     '''
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.finish`).
     '''
-    def finish_rabbit_connection(self):
-        self.__rabbit_message_sender.finish()
+    def finish_rabbit_connection(self, timeout=None):
+        self.__get_message_sender().finish(timeout)
+        self.__rabbit_thread_started = False
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.finish_in_background`).
+    '''
+    def finish_rabbit_connection_in_background(self, timeout=None):
+        completion = self.__get_message_sender().finish_in_background(timeout)
+        self.__rabbit_thread_started = False
+        return completion
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.flush`).
+    '''
+    def flush_rabbit_connection(self):
+        return self.__get_message_sender().flush()
 
     '''
     Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.force_finish`).
     '''
     def force_finish_rabbit_connection(self):
-        self.__rabbit_message_sender.force_finish()
+        self.__get_message_sender().force_finish()
+        self.__rabbit_thread_started = False
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.get_queue_status`).
+    '''
+    def get_message_queue_status(self):
+        return self.__get_message_sender().get_queue_status()
+
+    '''
+    Please see documentation of rabbit module (:func:`~rabbit.RabbitMessageSender.get_node_status`).
+    '''
+    def get_message_node_status(self):
+        return self.__get_message_sender().get_node_status()
 
     ### Communications with solr
 
@@ -135,12 +255,44 @@ class Coupler(object):
         result_dict = self.__solr_sender.retrieve_file_handles_of_same_dataset(
             drs_id=args['drs_id'],
             data_node=args['data_node'],
-            version_number=args['data_node']
+            version_number=args['version_number']
         )
         return result_dict
 
+    '''
+    Please see documentation of solr module (:func:`~solr.SolrInteractor.iterate_file_handles_of_same_dataset`).
+    '''
+    def iterate_file_handles_of_same_dataset(self, **args):
+        mandatory_args = ['drs_id', 'data_node', 'version_number']
+        esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+        esgfpid.utils.check_noneness_of_mandatory_args(args, mandatory_args)
+
+        return self.__solr_sender.iterate_file_handles_of_same_dataset(
+            drs_id=args['drs_id'],
+            data_node=args['data_node'],
+            version_number=args['version_number']
+        )
+
+    '''
+    Please see documentation of solr module (:func:`~solr.SolrInteractor.prefetch_file_handles_of_many_datasets`).
+    '''
+    def prefetch_file_handles_of_many_datasets(self, datasets):
+        return self.__solr_sender.prefetch_file_handles_of_many_datasets(datasets)
+
     '''
     Please see documentation of solr module (:func:`~solr.SolrInteractor.is_switched_off`).
     '''
     def is_solr_switched_off(self):
-        return self.__solr_sender.is_switched_off()
\ No newline at end of file
+        return self.__solr_sender.is_switched_off()
+
+    '''
+    Please see documentation of solr module (:func:`~solr.SolrInteractor.invalidate_cache`).
+    '''
+    def invalidate_solr_cache(self, drs_id):
+        self.__solr_sender.invalidate_cache(drs_id)
+
+    '''
+    Please see documentation of solr module (:func:`~solr.SolrInteractor.get_cache_status`).
+    '''
+    def get_solr_cache_status(self):
+        return self.__solr_sender.get_cache_status()
\ No newline at end of file
@@ -13,12 +13,35 @@ LOG_SHOW_TO_INFO=False # So I can selectively show some log messages to Katharin
 # Solr:
 SOLR_HTTPS_VERIFY_DEFAULT=False
 SOLR_QUERY_DISTRIB=False
+SOLR_HTTP_POOL_MAXSIZE=4 # Connections to the solr index node that are kept open for reuse
+SOLR_HTTP_KEEP_ALIVE=True # Reuse connections. If False, every query opens a new one.
+SOLR_HTTP_MAX_RETRIES=2 # Retries of a query after connection errors or HTTP 502/503/504 ...
+SOLR_HTTP_RETRY_BACKOFF_FACTOR=0.5 # ... waiting 0, 1, 2, 4, ... times this (seconds) before each
+SOLR_HTTP_GZIP=True # Ask solr for gzip-compressed responses
+SOLR_CACHE_MAX_ENTRIES=1000 # Results of solr lookups kept in memory. 0 switches the cache off.
+SOLR_CACHE_TTL_SECONDS=300 # How long a result is kept ...
+SOLR_CACHE_NEGATIVE_TTL_SECONDS=30 # ... and an empty one
+SOLR_FILE_HANDLE_QUERY_MODE='sequential' # How to send the two queries for file handles: 'sequential', 'concurrent' or 'hedged'
+SOLR_BULK_DATASETS_PER_QUERY=50 # When prefetching the files of many datasets, ask for this many datasets per query ...
+SOLR_BULK_PAGE_SIZE=10000 # ... and retrieve this many files per page (10000 is the maximum of the ESGF search API)
+SOLR_HEDGE_DELAY_SECONDS=0.2 # In 'hedged' mode, send the second query if the first did not return handles after this
+SOLR_FACET_PAGE_SIZE=10000 # When retrieving the file handles of a dataset, ask for this many per query (facet paging) ...
+SOLR_FACET_MAX_PAGES=1000 # ... give up after this many pages ...
+SOLR_STREAM_CHUNK_BYTES=65536 # ... and, when streaming them, read the responses in chunks of this size
+
+# Handles:
+HANDLE_MEMO_MAX_ENTRIES=10000 # Dataset handle suffixes kept in memory, as they are often made several times for the same dataset. 0 switches it off.
+HANDLE_BULK_CHUNK_SIZE=10000 # When making many dataset handles in several processes, pass this many datasets to a process at a time
+
+# Publication assistant:
+PUBLICATION_STREAM_BATCH_SIZE=100 # In streaming mode, hand the file messages to the messaging module in batches of this many
 
 # Rabbit
 RABBIT_IS_ASYNCHRONOUS = True
 ROUTING_KEY_BASIS = 'cmip6.publisher.HASH.'
 RABBIT_DEFAULT_ROUTING_KEY=ROUTING_KEY_BASIS+'fallback' # Default, if none is included in message
 RABBIT_EMERGENCY_ROUTING_KEY='UNROUTABLE' # If the message was returned as unroutable by the sender
+RABBIT_JSON_ENCODER='auto' # 'auto' (fastest installed of orjson, rapidjson, ujson), or one of them, or 'json' (stdlib)
 _persistent = 2
 _nonpersistent = 1
 RABBIT_DELIVERY_MODE = _persistent # 'delivery_mode': See https://pika.readthedocs.org/en/0.9.6/examples/comparing_publishing_sync_async.html#comparing-message-publishing-with-blockingconnection-and-selectconnection
@@ -29,15 +52,47 @@ RABBIT_FALLBACK_EXCHANGE_NAME = "FALLBACK"
 RABBIT_PIKA_SOCKET_TIMEOUT=0.25 # defaults to 0.25 sec
 RABBIT_PIKA_CONNECTION_ATTEMPTS=1 # defaults to 1
 RABBIT_PIKA_CONNECTION_RETRY_DELAY_SECONDS=0 # no default
+# Rabbit node selection (latency-aware, among nodes of same priority):
+RABBIT_NODE_LATENCY_EWMA_ALPHA=0.3 # Weight of the newest connect latency in the moving average
+RABBIT_NODE_SOCKET_TIMEOUT_FACTOR=4 # Socket timeout is this multiple of the node's average connect latency...
+RABBIT_NODE_SOCKET_TIMEOUT_MIN=0.1 # ... but at least this (seconds) ...
+RABBIT_NODE_SOCKET_TIMEOUT_MAX=5 # ... and at most this (seconds). Nodes without known latency use RABBIT_PIKA_SOCKET_TIMEOUT.
+RABBIT_NODE_STATE_FILE=None # JSON file to keep the node scores and circuits across processes. None means in memory only.
+RABBIT_NODE_BREAKER_FAILURE_THRESHOLD=3 # Open a node's circuit (skip the node) after this many consecutive failures
+RABBIT_NODE_BREAKER_COOLDOWN_SECONDS=30 # After this, one probe connection to a node with open circuit is allowed
+RABBIT_ACTIVE_ACTIVE=False # Publish via all trusted nodes of the best priority at the same time (asynchronous only), instead of using the others as fallback only
+RABBIT_ACTIVE_ACTIVE_STRATEGY='least_outstanding' # How to distribute the messages among the nodes in active-active mode: 'round_robin' or 'least_outstanding'
 # Rabbit reconnection attempts
 RABBIT_RECONNECTION_SECONDS=0.5 # after how much time try to retry connecting to same hosts if connection was closed?
 RABBIT_RECONNECTION_MAX_TRIES=2 # how many times should the module try reconnecting? Not so many times, rather throw exception to publisher.
 # Rabbit attempts to send message (synchronous only):
 RABBIT_SYN_MESSAGE_MAX_TRIES=3
 RABBIT_SYN_MESSAGE_TIMEOUT_MILLISEC=10
+RABBIT_SYN_CONFIRM_WINDOW=100 # How many messages may be published but not confirmed yet, when sending many messages
+RABBIT_SYN_PERSISTENT_SESSION=False # Keep one connection open across datasets (synchronous only)
+RABBIT_SYN_HEARTBEAT_KEEPER_SECONDS=10 # How often to service heartbeats of an idle persistent session
+RABBIT_SYN_CONFIRM_TIMEOUT_SECONDS=10 # How long to wait for confirms when sending many messages, before sending the unconfirmed ones one by one
 # Rabbit closing down algorithm (asynchronous only):
-RABBIT_ASYN_FINISH_MAX_TRIES=10 # How many times to recheck if all messages are published+confirmed (on finish)
-RABBIT_ASYN_FINISH_WAIT_SECONDS=0.5 # How much time to wait until you recheck (on finish)
+RABBIT_ASYN_FINISH_MAX_WAIT_SECONDS=5 # How long to wait (at most) for pending messages to be published+confirmed (on finish)
+RABBIT_ASYN_FINISH_SAFETY_CHECK_SECONDS=1 # How often to recheck for pending messages, in case no confirm arrives (on finish)
+RABBIT_ASYN_JOIN_TIMEOUT_SECONDS=2 # How long to wait (at most) for the thread to end, after it was asked to finish
+RABBIT_ASYN_WARM_UP=False # Start the thread (and connect) already when the Connector is created
+RABBIT_ASYN_CONNECTION_RACE_SIZE=1 # To how many nodes to open connections at the same time (the first one to be ready is used). 1 means one after the other.
+RABBIT_ASYN_NUM_CHANNELS=1 # On how many channels (of the one connection) to publish. Messages of the same dataset stay on one channel, in order.
+# Rabbit publishing in batches (asynchronous only):
+RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES=100 # How many messages to publish (at most) during one ioloop callback. 1 means one message per callback.
+RABBIT_ASYN_FEEDER_BATCH_MAX_BYTES=1048576 # How many bytes of message bodies to publish (at most) during one ioloop callback. None means no byte limit.
+# Rabbit queue of unpublished messages (asynchronous only):
+RABBIT_QUEUE_MAX_MESSAGES=None # How many messages may wait to be published (in memory). None means no limit.
+RABBIT_QUEUE_MAX_BYTES=None # How many bytes of message bodies may wait to be published (in memory). None means no limit.
+RABBIT_QUEUE_FULL_POLICY='block' # If a limit is reached: 'block' (wait, up to RABBIT_QUEUE_BLOCK_TIMEOUT_SECONDS), 'raise' (raise MessageQueueFull), 'spill' (write to temporary file)
+RABBIT_QUEUE_BLOCK_TIMEOUT_SECONDS=60
+RABBIT_QUEUE_SPILL_DIR=None # Directory for the temporary spill file. None means the system's temp directory.
+# Rabbit on-disk spool of unconfirmed messages (asynchronous only):
+RABBIT_SPOOL_DIR=None # Directory for the spool. None means no spool (messages are only kept in memory).
+RABBIT_SPOOL_FSYNC='interval' # 'always' (fsync after every message), 'interval' (at most every RABBIT_SPOOL_FSYNC_INTERVAL_SECONDS), 'never' (leave it to the OS)
+RABBIT_SPOOL_FSYNC_INTERVAL_SECONDS=1
+RABBIT_SPOOL_SEGMENT_MAX_BYTES=16777216 # Start a new segment file after this many bytes. Segments are deleted once all their messages are confirmed.
 
 # Other
 RABBIT_LOG_MESSAGE_INCREMENT = 10
@@ -3,6 +3,10 @@
 When the library was started in the synchronous mode and
 a message could not be delivered, this exception is raised.
 
+If several messages were sent at once, the undelivered
+message is a list of all the messages that were not
+delivered.
+
 We use an exception instead of a boolean return value, as 
 the asynchronous mode cannot return any success booleans,
 so we prefer to not even pretend we can return anything.
@@ -32,11 +36,16 @@ class OperationUnsupportedException(Exception):
 
         super(self.__class__, self).__init__(self.msg)
 
+'''
+If the check found which files differ, they are in the
+attribute "diff" (see :func:`esgfpid.assistant.consistency.Checker.get_diff`).
+'''
 class InconsistentFilesetException(Exception):
 
-    def __init__(self, custom_message=None):
+    def __init__(self, custom_message=None, diff=None):
         self.msg = 'Fileset is inconsistent with previously published copy'
         self.custom_message = custom_message
+        self.diff = diff
 
         if self.custom_message is not None:
             self.msg += ': '+self.custom_message
@@ -1,2 +1,4 @@
 
 from .asynchronous import AsynchronousRabbitConnector
+from .sharded import ShardedRabbitConnector
+from .completion import Completion
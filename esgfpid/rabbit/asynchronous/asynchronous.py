@@ -12,7 +12,10 @@ After initialisation, it is necessary to start the thread by calling
 the connection to the server.
 
 Then, the messages can be sent using "send_message_to_queue()" or
-"send_many_messages()".
+"send_many_messages()". Callers that must not block (e.g. because
+they run an event loop) can use "send_many_messages_to_queue_with_completion()",
+"flush()" and "finish_rabbit_thread_in_background()", which return
+Completion objects (see completion.py).
 
 After the messaging business is done, it is necessary to close the
 thread by calling "finish_rabbit_thread()" or "force_finish_rabbit_thread()".
@@ -32,10 +35,15 @@ import copy
 import datetime
 import logging
 import esgfpid.utils
+import esgfpid.defaults
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from .rabbitthread import RabbitThread
 from .thread_statemachine import StateMachine
-from .exceptions import OperationNotAllowed
+from .thread_feeder import get_num_publish_events_needed
+from .bounded_queue import BoundedMessageQueue
+from .completion import Completion, CompletionTracker
+from .. import rabbitutils
+from .exceptions import OperationNotAllowed, MessageQueueFull
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -51,9 +59,16 @@ class AsynchronousRabbitConnector(object):
     :param node_manager: NodeManager object that contains 
         the info about all the available RabbitMQ instances,
         their credentials, their priorities.
+    :param spool: Optional. A MessageSpool object. If passed, every
+        message is written to this on-disk spool before it is
+        published, and the unconfirmed messages from the spool
+        are published again when the thread is started.
+    :param queue: Optional. A BoundedMessageQueue object for the
+        messages that wait to be published. If not passed, one
+        is created with the limits defined in defaults.py.
 
     '''
-    def __init__(self, node_manager):
+    def __init__(self, node_manager, spool=None, queue=None):
         logdebug(LOGGER, 'Initializing rabbit connector...')
 
         '''
@@ -70,7 +85,11 @@ class AsynchronousRabbitConnector(object):
 
         # Shared objects
         self.__statemachine = StateMachine()
-        self.__unpublished_messages_queue = Queue.Queue()
+        self.__unpublished_messages_queue = queue
+        if queue is None:
+            self.__unpublished_messages_queue = BoundedMessageQueue()
+        self.__spool = spool # thread-safe, written to by both threads
+        self.__tracker = CompletionTracker() # thread-safe, written to by both threads
 
         # Log flags
         self.__first_message_receival = True
@@ -84,7 +103,7 @@ class AsynchronousRabbitConnector(object):
         logdebug(LOGGER, 'Initializing rabbit connector... done.')
 
     def __create_thread(self, node_manager): # easy to mock/patch in unit test!
-        return RabbitThread(self.__statemachine, self.__unpublished_messages_queue, self, node_manager)
+        return RabbitThread(self.__statemachine, self.__unpublished_messages_queue, self, node_manager, self.__spool)
 
 
     '''
@@ -104,12 +123,32 @@ class AsynchronousRabbitConnector(object):
     * Testing of the library is easier.
     * If starting needs to be called explicitly, it is less likely that the stopping is forgotten, so abandoned connections and unjoined threads are avoided.
 
+    If there is a spool, the messages that were left unconfirmed
+    in it (e.g. by a previous process that died) are put into the
+    stack of unpublished messages, so they are published as soon
+    as the connection is ready.
+
+    If the thread was already started (e.g. for an early warm-up
+    of the connection), this does nothing.
+
     '''
     def start_rabbit_thread(self):
+        if not self.__not_started_yet:
+            logdebug(LOGGER, 'Rabbit thread was already started.')
+            return
         self.__not_started_yet = False
         self.__statemachine.set_to_waiting_to_be_available()
+        self.__replay_spooled_messages()
         self.__thread.start()
 
+    def __replay_spooled_messages(self):
+        if self.__spool is not None:
+            spooled_messages = self.__spool.open()
+            if len(spooled_messages) > 0:
+                loginfo(LOGGER, 'Republishing %i messages that were not confirmed in a previous session.', len(spooled_messages))
+                for message in spooled_messages:
+                    self.__unpublished_messages_queue.put(message, block=False) # not limited
+
     #################
     ### Finishing ###
     #################
@@ -117,16 +156,73 @@ class AsynchronousRabbitConnector(object):
     def is_finished(self):
         return (not self.__thread.is_alive())
 
+    '''
+    Whether the thread has ended without being asked to, i.e.
+    because it could not (re)connect to RabbitMQ and gave up.
+    Then, :func:`take_leftovers` returns its pending messages.
+    '''
+    def has_failed(self):
+        return (not self.__not_started_yet and
+            not self.__thread.is_alive() and
+            not self.__statemachine.detail_asked_to_closed_by_publisher)
+
+    '''
+    Whether the connection is ready and messages are being
+    published (not waiting for a connection, not finishing).
+    '''
+    def is_available(self):
+        return self.__statemachine.is_AVAILABLE()
+
+    '''
+    Used by the active-active mode, to move the messages of a
+    thread that failed to the other nodes.
+
+    Returns the messages that were not published, not confirmed
+    or rejected (NACKed) by RabbitMQ, and forgets them. Can only
+    be called after the thread has ended.
+
+    :raises: OperationNotAllowed: If the thread is still alive.
+    :return: A list of messages (envelopes).
+    '''
+    def take_leftovers(self):
+        if self.__thread.is_alive():
+            raise OperationNotAllowed('thread has not finished', 'retrieving leftover messages')
+        self.__rescue_leftovers()
+        leftovers = self.__leftovers_unpublished + self.__leftovers_unconfirmed + self.__leftovers_nacked
+        self.__leftovers_unpublished = []
+        self.__leftovers_unconfirmed = []
+        self.__leftovers_nacked = []
+        return leftovers
+
+    '''
+    Returns the messages that were not published, not confirmed
+    or rejected (NACKed) by RabbitMQ, once the thread was finished.
+    Unlike :func:`take_leftovers`, they are kept.
+
+    :return: A list of messages (envelopes). Empty while the
+        thread is running.
+    '''
+    def get_leftovers(self):
+        return self.__leftovers_unpublished + self.__leftovers_unconfirmed + self.__leftovers_nacked
+
+    def any_leftovers(self):
+        return len(self.get_leftovers()) > 0
+
     '''
     "Gentle" finish of the thread.
     If any messages are not published or confirmed yet, the
-    thread waits and rechecks for some time.
+    thread waits for them, up to a deadline. It closes as soon
+    as the last pending message was confirmed.
 
     So this message may block while the rabbit thread waits
     for some pending messages, and it may block while the
     main thread tries to join the rabbit thread.
+
+    :param timeout: Optional. Maximum number of seconds to wait
+        for pending messages. Defaults to the value defined in
+        defaults.py.
     '''
-    def finish_rabbit_thread(self):
+    def finish_rabbit_thread(self, timeout=None):
         logdebug(LOGGER, 'Finishing...')
 
         # Make sure no more messages are accepted from publisher
@@ -136,10 +232,32 @@ class AsynchronousRabbitConnector(object):
         self.__statemachine.detail_asked_to_closed_by_publisher = True
 
         # Asking the thread to finish:
-        self.__thread.add_event_gently_finish() # (this blocks!)
+        self.__thread.add_event_gently_finish(timeout) # (this blocks!)
         logdebug(LOGGER, 'Finishing... done')
         self.__join_and_rescue()
 
+    '''
+    Like :func:`finish_rabbit_thread`, but does not block: The
+    gentle finish (and the joining) is done by a helper thread.
+
+    :param timeout: Optional. Maximum number of seconds to wait
+        for pending messages.
+    :return: A Completion that is done once the thread has ended.
+        Its failed messages are the leftovers (messages that were
+        not published, not confirmed or rejected).
+    '''
+    def finish_rabbit_thread_in_background(self, timeout=None):
+        completion = Completion(1)
+        def finish():
+            try:
+                self.finish_rabbit_thread(timeout)
+            finally:
+                leftovers = self.__leftovers_unpublished + self.__leftovers_unconfirmed + self.__leftovers_nacked
+                completion.report(1, leftovers)
+        finisher = threading.Thread(target=finish, name='esgfpid-finisher')
+        finisher.start()
+        return completion
+
     '''
     Forces the immediate close-down of the thread, no matter
     if messages are still pending (i.e. not published or not
@@ -163,16 +281,16 @@ class AsynchronousRabbitConnector(object):
         self.__join_and_rescue()
 
     '''
-    Tries several times to join the thread.
-    Note: May block for up to 10 seconds!
+    Tries twice to join the thread (the second time after
+    asking it to finish by force).
+    Joining returns as soon as the thread has ended.
+    Note: May block for up to 2*RABBIT_ASYN_JOIN_TIMEOUT_SECONDS!
     '''
     def __join_and_rescue(self):
         success = self.__join()
         if success:
             self.__rescue_leftovers()
         else:
-            for i in xrange(10):
-                time.sleep(1) # blocking
             loginfo(LOGGER, 'Joining the thread failed once... Retrying.')
             self.__thread.add_event_force_finish()
             success = self.__join()
@@ -180,10 +298,20 @@ class AsynchronousRabbitConnector(object):
                 self.__rescue_leftovers()
             else:
                 logerror(LOGGER, 'Joining failed again. No idea why.')
+        self.__close_spool()
+        self.__tracker.fail_all_pending()
+
+    '''
+    The leftovers stay in the spool, to be published
+    the next time the thread is started.
+    '''
+    def __close_spool(self):
+        if self.__spool is not None:
+            self.__spool.close()
 
     def __join(self):        
         logdebug(LOGGER, 'Joining...')
-        timeout_seconds=2 # blocking
+        timeout_seconds = esgfpid.defaults.RABBIT_ASYN_JOIN_TIMEOUT_SECONDS # blocking
         self.__thread.join(timeout_seconds)
         if self.__thread.is_alive():
             logdebug(LOGGER, 'Joining failed.')
@@ -270,16 +398,6 @@ class AsynchronousRabbitConnector(object):
             self.__leftovers_nacked = []
     '''
 
-    #def any_leftovers(self):
-    #    if (len(self.__leftovers_unpublished)+
-    #        len(self.__leftovers_unconfirmed)+
-    #        len(self.__leftovers_nacked))>0:
-    #        return True
-    #    return False
-
-    #def get_leftovers(self):
-    #    return self.__leftovers_unpublished + self.__leftovers_unconfirmed + self.__leftovers_nacked
-
 
     ####################
     # Sending messages #
@@ -318,14 +436,50 @@ class AsynchronousRabbitConnector(object):
             raise OperationNotAllowed(msg)
         self.__send_many_messages(list_of_messages)
 
+    '''
+    Send many JSON messages to RabbitMQ, and get a Completion
+    that tells when they were all confirmed (or failed). Does not
+    block (unless the queue is full, depending on its policy).
+
+    :param list_of_messages: List of JSON message to be published.
+    :return: A Completion (see completion.py).
+    :raises: OperationNotAllowed: If the rabbit thread was not started yet
+    or stopped again.
+    '''
+    def send_many_messages_to_queue_with_completion(self, list_of_messages):
+        if self.__not_started_yet:
+            msg = ('Cannot publish message. The message sending module was not initalized yet. '+
+                   '(Please call the PID connector\'s "start_messaging_thread()" before trying '+
+                   'to send messages, and do not forget to "finish_messaging_thread()" afterwards.')
+            raise OperationNotAllowed(msg)
+        # Tracked by their envelopes, so they must be made here:
+        messages = [rabbitutils.make_message_envelope(msg) for msg in list_of_messages]
+        return self.__send_many_messages(messages, track=True)
+
+    '''
+    :return: A Completion that is done once all messages that
+        were sent with a Completion so far are done. Does not
+        block.
+    '''
+    def flush(self):
+        return self.__tracker.get_completion_of_all_pending()
+
+    '''
+    Called by the rabbit thread (confirmer), for every confirm.
+    '''
+    def report_confirms(self, acked, nacked):
+        self.__tracker.report_confirms(acked, nacked)
+
     def __send_a_message(self, message):
         if self.__statemachine.is_WAITING_TO_BE_AVAILABLE():
             self.__log_receival_one_message(message)
-            self.__put_one_message_into_queue_of_unsent_messages(message)
+            message = self.__write_to_spool([message])[0]
+            self.__put_all_messages_into_queue_of_unsent_messages([message])
 
         elif self.__statemachine.is_AVAILABLE():
             self.__log_receival_one_message(message)
-            self.__put_one_message_into_queue_of_unsent_messages(message)
+            message = self.__write_to_spool([message])[0]
+            self.__put_all_messages_into_queue_of_unsent_messages([message])
             self.__trigger_one_publish_action()
 
         elif self.__statemachine.is_AVAILABLE_BUT_WANTS_TO_STOP() or self.__statemachine.is_PERMANENTLY_UNAVAILABLE():
@@ -345,15 +499,20 @@ class AsynchronousRabbitConnector(object):
             # This is almost the same as the one raised if self.__not_started_yet is True.
 
 
-    def __send_many_messages(self, messages):
+    def __send_many_messages(self, messages, track=False):
         if self.__statemachine.is_WAITING_TO_BE_AVAILABLE():
             self.__log_receival_many_messages(messages)
+            messages = self.__write_to_spool(messages)
+            completion = self.__track_if_asked(messages, track)
             self.__put_all_messages_into_queue_of_unsent_messages(messages)
+            return completion
 
         elif self.__statemachine.is_AVAILABLE():
             self.__log_receival_many_messages(messages)
-            self.__put_all_messages_into_queue_of_unsent_messages(messages)
-            self.__trigger_n_publish_actions(len(messages))
+            messages = self.__write_to_spool(messages)
+            completion = self.__track_if_asked(messages, track)
+            self.__put_all_messages_and_trigger_publish_actions(messages)
+            return completion
 
         elif self.__statemachine.is_AVAILABLE_BUT_WANTS_TO_STOP() or self.__statemachine.is_PERMANENTLY_UNAVAILABLE():
             errormsg = 'Accepting no more messages'
@@ -365,9 +524,44 @@ class AsynchronousRabbitConnector(object):
             logwarn(LOGGER, errormsg+' (dropping %i messages).', len(messages))
             raise OperationNotAllowed(errormsg)
 
+    '''
+    Messages must be tracked before they are handed to the
+    thread, as they might be confirmed right away.
+    '''
+    def __track_if_asked(self, messages, track):
+        if track:
+            return self.__tracker.track(messages)
+        return None
+
+    '''
+    Messages that were spooled already (e.g. when the thread
+    republishes them after a reconnection) are not spooled again.
+    '''
+    def __write_to_spool(self, messages):
+        if self.__spool is None:
+            return messages
+        return self.__spool.put_many(messages)
+
+    '''
+    Messages from the library caller are subject to the queue's
+    limits (so this may block, or raise MessageQueueFull, depending
+    on the policy).
+    Messages from the rabbit thread itself (republished after a
+    reconnection) are not, as the thread would wait for itself.
+    '''
     def __put_one_message_into_queue_of_unsent_messages(self, message):
         logtrace(LOGGER, 'Putting a message into stack that waits to be published...')
-        self.__unpublished_messages_queue.put(message, block=False)
+        if threading.current_thread() is self.__thread:
+            self.__unpublished_messages_queue.put(message, block=False)
+        else:
+            try:
+                self.__unpublished_messages_queue.put_message(message)
+            except Queue.Full:
+                status = self.__unpublished_messages_queue.get_status()
+                errormsg = ('%i messages (%i bytes) are waiting to be published (limits: %s messages, %s bytes)' %
+                    (status['num_messages'], status['num_bytes'], status['max_messages'], status['max_bytes']))
+                logwarn(LOGGER, 'Cannot accept message: Queue is full. %s.', errormsg)
+                raise MessageQueueFull(errormsg)
 
     def __log_receival_one_message(self, message):
         if self.__first_message_receival:
@@ -384,27 +578,95 @@ class AsynchronousRabbitConnector(object):
         logdebug(LOGGER, 'Batch sending: Handing %i messages over to the sender.', len(messages))
         self.__logcounter_received += len(messages)
 
-    def __put_all_messages_into_queue_of_unsent_messages(self, messages):
-        counter = 1
-        for message in messages:
-            logtrace(LOGGER, 'Adding message %i/%i to stack to be sent.', counter, len(messages))
-            counter += 1
-            self.__put_one_message_into_queue_of_unsent_messages(message)
+    '''
+    If the queue is full and refuses a message (MessageQueueFull),
+    this one and the following ones are withdrawn before the caller
+    is told, see :func:`__withdraw_rejected_messages`. The exception
+    carries them, so the caller can send exactly these again (the
+    ones before were accepted and must not be sent again).
+
+    :param start: Optional. Index of the first message to put.
+    :param stop: Optional. Index after the last message to put.
+    '''
+    def __put_all_messages_into_queue_of_unsent_messages(self, messages, start=0, stop=None):
+        if stop is None or stop > len(messages):
+            stop = len(messages)
+        for i in xrange(start, stop):
+            logtrace(LOGGER, 'Adding message %i/%i to stack to be sent.', i+1, len(messages))
+            try:
+                self.__put_one_message_into_queue_of_unsent_messages(messages[i])
+            except MessageQueueFull as e:
+                rejected = self.__withdraw_rejected_messages(messages[i:])
+                raise MessageQueueFull(e.custom_message, rejected_messages=rejected)
+
+    '''
+    The caller is told that these messages were not accepted, so
+    they are marked as confirmed in the spool (or they would be
+    published when it is opened the next time), and they fail
+    their Completion (if they were tracked).
+
+    :return: The messages, without their spool ids, so they
+        are spooled again if they are sent again.
+    '''
+    def __withdraw_rejected_messages(self, messages):
+        logdebug(LOGGER, 'Withdrawing %i messages that the queue did not accept.', len(messages))
+        self.__tracker.report_confirms([], messages)
+        if self.__spool is not None:
+            self.__spool.confirm_many(messages)
+            messages = [msg._replace(spool_id=None) if isinstance(msg, rabbitutils.MessageEnvelope) else msg for msg in messages]
+        return messages
 
     def __trigger_one_publish_action(self):
         self.__thread.add_event_publish_message()
 
-    def __trigger_n_publish_actions(self, num_messages_to_publish):
-        logdebug(LOGGER, 'Asking rabbit thread to publish %i messages...', num_messages_to_publish)
+    '''
+    Every publish action publishes a batch of messages. The action
+    for a batch is triggered as soon as the batch is in the queue,
+    so the thread can already publish while the rest is put into
+    the queue (which may block, if the queue is full).
+    '''
+    def __put_all_messages_and_trigger_publish_actions(self, messages):
+        logdebug(LOGGER, 'Asking rabbit thread to publish %i messages...', len(messages))
         to_be_sure = 10
-        for i in xrange(num_messages_to_publish+to_be_sure):
-            self.__thread.add_event_publish_message()
+        num_events = get_num_publish_events_needed(len(messages)+to_be_sure)
+        batch_size = max(1, esgfpid.defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES)
+        for start in xrange(0, len(messages), batch_size):
+            try:
+                self.__put_all_messages_into_queue_of_unsent_messages(messages, start, start+batch_size)
+            except MessageQueueFull:
+                self.__trigger_one_publish_action() # for the ones put already
+                raise
+            self.__trigger_one_publish_action()
+            num_events -= 1
+        for i in xrange(num_events):
+            self.__trigger_one_publish_action()
 
 
     ###############
     ### Getters ###
     ###############
 
+    '''
+    Returns the current depth and memory use of the queue of
+    messages that wait to be published, so that the library
+    caller can throttle. Thread-safe.
+
+    :return: Dictionary with the entries "num_messages" (in
+        memory and spilled to disk), "num_bytes" (in memory),
+        "num_spilled", "max_messages", "max_bytes", "full_policy".
+    '''
+    def get_queue_status(self):
+        return self.__unpublished_messages_queue.get_status()
+
+    '''
+    Returns how many messages wait to be published or to be
+    confirmed. The number of unconfirmed messages is read from
+    the running thread without synchronization, so it is only
+    an estimate (good enough for balancing the load).
+    '''
+    def get_num_pending(self):
+        return self.__unpublished_messages_queue.qsize() + self.__thread.get_num_unconfirmed()
+
     '''
     Returns a copy of the messages that were not confirmed during
     the rabbit thread's lifetime.
@@ -0,0 +1,239 @@
+'''
+This module provides the thread-safe queue in which the messages
+wait until the rabbit thread publishes them.
+
+The queue can be limited by number of messages and by (approximate)
+number of bytes, so a large publication does not pile up all its
+messages in memory while RabbitMQ is slow or not reachable.
+
+If the limit is reached, the library caller's thread is affected
+according to the configured policy:
+
+ * "block": Wait until the rabbit thread published some messages
+   (up to a timeout, then Queue.Full is raised).
+ * "raise": Raise Queue.Full immediately.
+ * "spill": Write the message to a temporary file on disk. Spilled
+   messages are moved back into memory (in order) as soon as there
+   is space.
+
+Only the library caller's puts (:func:`put_message`) are limited.
+The rabbit thread itself must never block on its own queue, so it
+uses the normal (unlimited) put().
+
+'''
+
+import os
+import time
+import Queue
+import logging
+import tempfile
+import esgfpid.defaults as defaults
+import esgfpid.exceptions
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+from .. import rabbitutils
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+FULL_POLICIES = ['block', 'raise', 'spill']
+
+
+class BoundedMessageQueue(Queue.Queue):
+
+    '''
+    :param max_messages: Optional. Maximum number of messages in
+        memory. Defaults to RABBIT_QUEUE_MAX_MESSAGES (None means
+        no limit).
+    :param max_bytes: Optional. Maximum number of bytes (of message
+        bodies) in memory. Defaults to RABBIT_QUEUE_MAX_BYTES (None
+        means no limit).
+    :param full_policy: Optional. "block", "raise" or "spill".
+        Defaults to RABBIT_QUEUE_FULL_POLICY.
+    :raises: ArgumentError: If the policy is unknown.
+    '''
+    def __init__(self, max_messages=None, max_bytes=None, full_policy=None):
+        Queue.Queue.__init__(self) # No maxsize, the limits are checked here
+
+        if max_messages is None:
+            max_messages = defaults.RABBIT_QUEUE_MAX_MESSAGES
+        if max_bytes is None:
+            max_bytes = defaults.RABBIT_QUEUE_MAX_BYTES
+        if full_policy is None:
+            full_policy = defaults.RABBIT_QUEUE_FULL_POLICY
+        if full_policy not in FULL_POLICIES:
+            raise esgfpid.exceptions.ArgumentError('Unknown queue full policy "%s" (allowed: %s)' % (full_policy, ', '.join(FULL_POLICIES)))
+
+        self.__max_messages = max_messages
+        self.__max_bytes = max_bytes
+        self.__full_policy = full_policy
+        self.__block_timeout_seconds = defaults.RABBIT_QUEUE_BLOCK_TIMEOUT_SECONDS
+        self.__num_bytes = 0
+        self.__spill = None
+        if full_policy == 'spill':
+            self.__spill = SpillFile(defaults.RABBIT_QUEUE_SPILL_DIR)
+
+    '''
+    Put a message into the queue, respecting the limits.
+    Called by the library caller's thread.
+
+    :raises: Queue.Full: If the queue is full and the policy
+        is "raise", or if it is "block" and the timeout passed.
+    '''
+    def put_message(self, item):
+        with self.not_full:
+            if self.__full_policy == 'spill':
+                if self.__is_full() or len(self.__spill) > 0:
+                    logtrace(LOGGER, 'Queue is full. Spilling message to disk.')
+                    self.__spill.append(rabbitutils.make_message_envelope(item))
+                    self.__notify_new_item()
+                    return
+            elif self.__full_policy == 'raise':
+                if self.__is_full():
+                    raise Queue.Full()
+            else:
+                self.__wait_until_not_full()
+            self._put(item)
+            self.__notify_new_item()
+
+    def get_num_bytes(self):
+        with self.mutex:
+            return self.__num_bytes
+
+    def get_num_spilled(self):
+        with self.mutex:
+            if self.__spill is None:
+                return 0
+            return len(self.__spill)
+
+    '''
+    :return: Dictionary with the current number of messages
+        (in memory and spilled to disk), the bytes in memory,
+        and the limits.
+    '''
+    def get_status(self):
+        with self.mutex:
+            num_spilled = 0
+            if self.__spill is not None:
+                num_spilled = len(self.__spill)
+            return dict(
+                num_messages=len(self.queue)+num_spilled,
+                num_bytes=self.__num_bytes,
+                num_spilled=num_spilled,
+                max_messages=self.__max_messages,
+                max_bytes=self.__max_bytes,
+                full_policy=self.__full_policy
+            )
+
+    def __notify_new_item(self):
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def __wait_until_not_full(self):
+        endtime = time.time() + self.__block_timeout_seconds
+        while self.__is_full():
+            remaining = endtime - time.time()
+            if remaining <= 0.0:
+                raise Queue.Full()
+            self.not_full.wait(remaining)
+
+    '''
+    An empty queue is never full, so one message that is
+    larger than the byte limit does not block forever.
+    '''
+    def __is_full(self):
+        if self.__max_messages is not None and len(self.queue) >= self.__max_messages:
+            return True
+        if self.__max_bytes is not None and len(self.queue) > 0 and self.__num_bytes >= self.__max_bytes:
+            return True
+        return False
+
+    def __get_size(self, item):
+        if isinstance(item, rabbitutils.MessageEnvelope):
+            return len(item.body)
+        elif isinstance(item, basestring):
+            return len(item)
+        return 0
+
+    ### Override the internals of Queue.Queue (called with mutex held)
+
+    def _qsize(self, len=len):
+        num = len(self.queue)
+        if self.__spill is not None:
+            num += len(self.__spill)
+        return num
+
+    def _put(self, item):
+        self.queue.append(item)
+        self.__num_bytes += self.__get_size(item)
+
+    def _get(self):
+        if len(self.queue) > 0:
+            item = self.queue.popleft()
+            self.__num_bytes -= self.__get_size(item)
+        else:
+            item = self.__spill.popleft()
+        self.__move_spilled_back_to_memory()
+        return item
+
+    def __move_spilled_back_to_memory(self):
+        if self.__spill is not None:
+            while len(self.__spill) > 0 and not self.__is_full():
+                self._put(self.__spill.popleft())
+
+
+class SpillFile(object):
+    '''
+    First-in-first-out storage of message envelopes in a
+    temporary file, which is deleted when it is closed.
+
+    Not thread-safe, used by the BoundedMessageQueue only,
+    with its mutex held.
+    '''
+
+    def __init__(self, directory=None):
+        self.__directory = directory
+        self.__file = None
+        self.__read_pos = 0
+        self.__num = 0
+
+    def __len__(self):
+        return self.__num
+
+    def append(self, envelope):
+        if self.__file is None:
+            self.__file = tempfile.TemporaryFile(prefix='esgfpid-spill-', dir=self.__directory)
+            loginfo(LOGGER, 'Queue of unpublished messages is full. Spilling messages to disk.')
+        body = self.__to_bytes(envelope.body)
+        spool_id = envelope.spool_id
+        if spool_id is None:
+            spool_id = -1
+        ordering_key = ''
+        if envelope.ordering_key is not None:
+            ordering_key = self.__to_bytes(envelope.ordering_key)
+        self.__file.seek(0, os.SEEK_END)
+        self.__file.write('%i %i %i %s\n%s%s' % (len(body), spool_id, len(ordering_key),
+            self.__to_bytes(envelope.routing_key), ordering_key, body))
+        self.__num += 1
+
+    def popleft(self):
+        if self.__num == 0:
+            raise IndexError('pop from empty spill file')
+        self.__file.seek(self.__read_pos)
+        length, spool_id, key_length, routing_key = self.__file.readline().rstrip('\n').split(' ', 3)
+        ordering_key = self.__file.read(int(key_length)) or None
+        body = self.__file.read(int(length))
+        self.__read_pos = self.__file.tell()
+        self.__num -= 1
+        if self.__num == 0:
+            self.__file.seek(0)
+            self.__file.truncate()
+            self.__read_pos = 0
+        spool_id = int(spool_id)
+        if spool_id < 0:
+            spool_id = None
+        return rabbitutils.MessageEnvelope(routing_key, body, spool_id, ordering_key)
+
+    def __to_bytes(self, string):
+        if isinstance(string, unicode):
+            return string.encode('utf-8')
+        return str(string)
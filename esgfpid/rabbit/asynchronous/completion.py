@@ -0,0 +1,215 @@
+'''
+This module provides "Completion" objects, which let the library
+caller find out when messages handed to the rabbit thread were
+confirmed by RabbitMQ, without blocking while they are pending.
+
+They are meant for publishers that run their own event loop and
+cannot block in "finish_rabbit_thread()" or wait for each message:
+They hand many messages over at once, get one Completion for them,
+and register a callback (e.g. one that passes the result to their
+loop in a thread-safe way), or check it whenever convenient.
+
+A Completion is done when each of its messages was either
+confirmed (ACK) or failed: Rejected by RabbitMQ (NACK), or still
+pending when the rabbit thread was finished (the leftovers).
+
+Messages that are republished by the rabbit thread (after a
+reconnection, to the fallback exchange) stay tracked, as they
+are the same envelopes. Messages that RabbitMQ returned as
+unroutable are republished by the library with a different
+routing key. They count as confirmed once RabbitMQ confirmed
+the first publication.
+
+  .. note:: Python 2 has no asyncio. The callbacks are called on
+    the thread that completes the Completion (usually the rabbit
+    thread), so they must be quick and must not call the library.
+
+'''
+
+import threading
+import logging
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Completion(object):
+
+    '''
+    :param num_parts: Mandatory. How many parts (messages, or
+        other Completions) have to be done before this one is.
+    '''
+    def __init__(self, num_parts):
+        self.__lock = threading.Lock()
+        self.__done_event = threading.Event()
+        self.__num_pending = num_parts
+        self.__failed_messages = []
+        self.__callbacks = []
+        if num_parts <= 0:
+            self.__done_event.set()
+
+    def done(self):
+        return self.__done_event.is_set()
+
+    ''' Whether it is done and no message failed. '''
+    def succeeded(self):
+        return self.done() and len(self.__failed_messages) == 0
+
+    '''
+    :return: List of the messages (envelopes) that were rejected
+        by RabbitMQ or left over, so far.
+    '''
+    def get_failed_messages(self):
+        with self.__lock:
+            return self.__failed_messages[:]
+
+    '''
+    Block until it is done (for callers without event loop).
+
+    :param timeout: Optional. Maximum number of seconds to wait.
+    :return: True if it is done.
+    '''
+    def wait(self, timeout=None):
+        self.__done_event.wait(timeout)
+        return self.done()
+
+    '''
+    Register a function to be called with this Completion once it
+    is done. If it is done already, the function is called at once.
+    Otherwise, it is called on the thread that completes it.
+    '''
+    def add_done_callback(self, callback):
+        with self.__lock:
+            if not self.done():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    '''
+    Called by the tracker (or by the Completion of a part).
+
+    :param num_done: How many parts are done.
+    :param failed_messages: Optional. The messages that failed.
+    '''
+    def report(self, num_done, failed_messages=()):
+        with self.__lock:
+            if self.done():
+                return
+            self.__failed_messages.extend(failed_messages)
+            self.__num_pending -= num_done
+            if self.__num_pending > 0:
+                return
+            self.__done_event.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logerror(LOGGER, 'Error in callback of a message completion: %s', repr(e))
+
+
+'''
+A Completion that is done when all the given Completions are.
+Its failed messages are those of all of them.
+'''
+def gather_completions(completions):
+    gathered = Completion(len(completions))
+    for completion in completions:
+        completion.add_done_callback(
+            lambda part: gathered.report(1, part.get_failed_messages()))
+    return gathered
+
+
+'''
+Keeps track of which Completion every pending message belongs to.
+
+The messages are recognized by their envelopes, which are
+immutable and travel from the queue to the confirmer (and back,
+if they are republished). They are compared by value, not by
+identity, as the queue may spill them to disk and read them back.
+Equal messages are assigned to their Completions in turn.
+Accessed by the library caller's thread (track) and by the rabbit
+thread (confirms), so it is protected by a lock.
+'''
+class CompletionTracker(object):
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # envelope -> list of Completions, oldest first
+        self.__pending = {}
+
+    '''
+    :param messages: List of envelopes, which must not have been
+        handed to the rabbit thread yet.
+    :return: A Completion for these messages.
+    '''
+    def track(self, messages):
+        completion = Completion(len(messages))
+        with self.__lock:
+            for message in messages:
+                self.__pending.setdefault(message, []).append(completion)
+        logtrace(LOGGER, 'Tracking %i messages.', len(messages))
+        return completion
+
+    def is_tracking(self):
+        return len(self.__pending) > 0
+
+    '''
+    Called by the rabbit module (via the thread) for every
+    confirm from RabbitMQ.
+
+    :param acked: List of the confirmed messages.
+    :param nacked: List of the rejected messages.
+    '''
+    def report_confirms(self, acked, nacked):
+        if not self.is_tracking():
+            return
+        with self.__lock:
+            acked_by_completion = self.__pop_completions(acked)
+            nacked_by_completion = self.__pop_completions(nacked)
+        for completion, messages in acked_by_completion.iteritems():
+            completion.report(len(messages))
+        for completion, messages in nacked_by_completion.iteritems():
+            completion.report(len(messages), messages)
+
+    '''
+    Called after the rabbit thread has ended: All messages that
+    are still pending have failed.
+    '''
+    def fail_all_pending(self):
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = {}
+        failed = {}
+        for message, completions in pending.iteritems():
+            for completion in completions:
+                failed.setdefault(completion, []).append(message)
+        if len(failed) > 0:
+            logdebug(LOGGER, 'Reporting pending messages of %i completions as failed.', len(failed))
+        for completion, messages in failed.iteritems():
+            completion.report(len(messages), messages)
+
+    '''
+    A Completion that is done once all messages tracked so
+    far are done.
+    '''
+    def get_completion_of_all_pending(self):
+        with self.__lock:
+            completions = set()
+            for message_completions in self.__pending.itervalues():
+                completions.update(message_completions)
+        return gather_completions(list(completions))
+
+    def __pop_completions(self, messages):
+        messages_by_completion = {}
+        for message in messages:
+            completions = self.__pending.get(message)
+            if completions is None:
+                continue
+            completion = completions.pop(0)
+            if len(completions) == 0:
+                del self.__pending[message]
+            messages_by_completion.setdefault(completion, []).append(message)
+        return messages_by_completion
@@ -40,4 +40,24 @@ class UnknownServerResponse(Exception):
             self.msg += ': '+self.custom_message
         self.msg += '.'
 
-        super(self.__class__, self).__init__(self.msg)
\ No newline at end of file
+        super(self.__class__, self).__init__(self.msg)
+
+'''
+Raised if the queue of unpublished messages does not accept
+(all of) the messages that were sent.
+
+The messages in "rejected_messages" (envelopes) were not
+accepted, all others were. To try again, send only these.
+'''
+class MessageQueueFull(Exception):
+
+    def __init__(self, custom_message=None, rejected_messages=None):
+        self.msg = 'The queue of messages waiting to be published is full'
+        self.custom_message = custom_message
+        self.rejected_messages = rejected_messages or []
+
+        if self.custom_message is not None:
+            self.msg += ': '+self.custom_message
+        self.msg += '.'
+
+        super(self.__class__, self).__init__(self.msg)
@@ -3,16 +3,18 @@ import threading
 import pika
 import time
 import copy
+import functools
 import datetime
 import logging
 import esgfpid.utils
+import esgfpid.defaults as defaults
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from .thread_returnhandler import UnacceptedMessagesHandler
 from .thread_statemachine import StateMachine
 from .thread_builder import ConnectionBuilder
 from .thread_feeder import RabbitFeeder
 from .thread_shutter import ShutDowner
-from .thread_confirmer import Confirmer
+from .thread_channels import ChannelPool
 from .exceptions import OperationNotAllowed
 
 LOGGER = logging.getLogger(__name__)
@@ -67,7 +69,7 @@ without needed references to each other.
 '''
 class RabbitThread(threading.Thread):
 
-    def __init__(self, statemachine, queue, facade, node_manager):
+    def __init__(self, statemachine, queue, facade, node_manager, spool=None):
         threading.Thread.__init__(self)
 
         '''
@@ -130,17 +132,17 @@ class RabbitThread(threading.Thread):
         self._connection = None
 
         '''
-        An object of type "pika.channel.Channel".
+        The channels of the connection on which the messages are
+        published (objects of type "pika.channel.Channel"), each
+        with its own confirmer and delivery number.
 
-        Used by the feeder for basic_publish, for logging
-        its channel number, and for checking whether it
-        exists (before publishing).
+        The channels are opened by the builder. The feeder asks
+        the pool on which channel to publish each message.
         '''
-        self._channel = None
+        self._channels = ChannelPool(defaults.RABBIT_ASYN_NUM_CHANNELS, spool, self)
 
         # Submodules that do the actual work:
         self.__nodemanager = node_manager
-        self.__confirmer = Confirmer()
         self.__returnhandler = UnacceptedMessagesHandler(self)
         self.__feeder = RabbitFeeder(self, self.__statemachine, self.__nodemanager)
         self.__shutter = ShutDowner(self, self.__statemachine)
@@ -148,7 +150,7 @@ class RabbitThread(threading.Thread):
         '''
         Needed to trigger the connection in run()
         '''
-        self.__builder = ConnectionBuilder(self, self.__statemachine, self.__confirmer, self.__returnhandler, self.__shutter, node_manager)
+        self.__builder = ConnectionBuilder(self, self.__statemachine, self.__returnhandler, self.__shutter, node_manager)
 
 
         '''
@@ -208,10 +210,20 @@ class RabbitThread(threading.Thread):
         logdebug(LOGGER, 'Asking rabbit thread to finish quickly...')
         self.__add_event(self.__shutter.force_finish)
 
-    def add_event_gently_finish(self):
+    '''
+    Ask the thread to finish once all pending messages are
+    published and confirmed, and wait for it.
+
+    :param timeout: Optional. Maximum number of seconds to wait
+        for pending messages. Defaults to the value defined in
+        defaults.py.
+    :return: True if the gentle finish is done, False if the
+        thread did not report back within the timeout.
+    '''
+    def add_event_gently_finish(self, timeout=None):
         logdebug(LOGGER, 'Asking rabbit thread to finish...')
-        self.__add_event(self.__shutter.finish_gently)
-        self.__wait_for_thread_to_finish_gently()
+        self.__add_event(functools.partial(self.__shutter.finish_gently, timeout))
+        return self.__wait_for_thread_to_finish_gently(timeout)
 
     '''
     Allows the main thread to retrieve all unconfirmed messages.
@@ -222,7 +234,7 @@ class RabbitThread(threading.Thread):
     without causing any harm.
 
     Note: If the method needs to be called inside the running
-    thread, it can be called on the confirmer module directly,
+    thread, it can be called on the channel pool directly,
     not using this facade.
 
     :raises: OperationNotAllowed: If the thread is still alive.
@@ -230,7 +242,7 @@ class RabbitThread(threading.Thread):
     '''
     def get_unconfirmed_messages_as_list_copy(self):
         if not self.is_alive():
-            return self.__confirmer.get_unconfirmed_messages_as_list_copy()
+            return self._channels.get_unconfirmed_messages_as_list_copy()
         else:
             raise OperationNotAllowed('thread has not finished','retrieving unconfirmed messages')
 
@@ -243,7 +255,7 @@ class RabbitThread(threading.Thread):
     without causing any harm.
 
     Note: If the method needs to be called inside the running
-    thread, it can be called on the confirmer module directly,
+    thread, it can be called on the channel pool directly,
     not using this facade.
 
     :raises: OperationNotAllowed: If the thread is still alive.
@@ -251,7 +263,7 @@ class RabbitThread(threading.Thread):
     '''
     def get_nacked_messages_as_list(self):
         if not self.is_alive():
-            return self.__confirmer.get_copy_of_nacked()
+            return self._channels.get_copy_of_nacked()
         else:
             raise OperationNotAllowed('thread has not finished','retrieving nacked messages')
  
@@ -291,13 +303,20 @@ class RabbitThread(threading.Thread):
     Executed by the main thread.
     BLOCKS THE MAIN THREAD (this is its purpose!)
     '''
-    def __wait_for_thread_to_finish_gently(self):
+    def __wait_for_thread_to_finish_gently(self, timeout=None):
         # This is executed by the main thread and thus should be placed in the
         # main thread's method, but it is so important not to forget to wait,
         # that it is better to have it boung to the thread's method "add_event_gently_finish()"
         logdebug(LOGGER, 'Now waiting for gentle close-down of RabbitMQ connection...')
-        self.__gently_finish_ready.wait()
-        logdebug(LOGGER, 'Finished waiting for gentle close-down of RabbitMQ connection.')
+        if timeout is None:
+            self.__gently_finish_ready.wait() # the thread has its own deadline
+        else:
+            self.__gently_finish_ready.wait(timeout)
+        if self.__gently_finish_ready.is_set():
+            logdebug(LOGGER, 'Finished waiting for gentle close-down of RabbitMQ connection.')
+            return True
+        logwarn(LOGGER, 'Gentle close-down of RabbitMQ connection did not finish within %s seconds.', timeout)
+        return False
 
     def __wait_for_thread_to_accept_events(self):
         logdebug(LOGGER, 'Now waiting for the connection before I can even close RabbitMQ connection...')
@@ -338,9 +357,18 @@ class RabbitThread(threading.Thread):
     def get_num_unpublished(self):
         return self.__unpublished_messages_queue.qsize()
 
-    ''' Called by shutter, to check if all messages were confirmed. '''
+    ''' Called by shutter, to check if all messages were confirmed (on all channels). '''
     def get_num_unconfirmed(self):
-        return self.__confirmer.get_num_unconfirmed()
+        return self._channels.get_num_unconfirmed()
+
+    '''
+    Called by feeder, if it used up the budget of one batch while
+    messages are left. The next batch is published in a new ioloop
+    callback, so that confirms and heartbeats are processed in between.
+    Must only be called from inside the thread.
+    '''
+    def add_event_publish_next_batch(self):
+        self._connection.add_timeout(self.__PUBLISH_INTERVAL_SECONDS, self.__feeder.publish_message)
 
     ''' Called by feeder, to publish a message. May raise Queue.Empty. '''
     def get_message_from_unpublished_stack(self, seconds):
@@ -358,25 +386,13 @@ class RabbitThread(threading.Thread):
     def send_a_message(self, message):
         return self.__facade.send_message_to_queue(message)
 
-    '''Called by feeder, to notify confirmer about which message it needs to get confirmed. '''
-    def put_to_unconfirmed_delivery_tags(self, delivery_tag):
-        return self.__confirmer.put_to_unconfirmed_delivery_tags(delivery_tag)
+    ''' Called by feeder, to choose the channel to publish a message on. '''
+    def get_publishing_channel(self, ordering_key):
+        return self._channels.get_channel_for(ordering_key)
 
-    '''Called by feeder, to notify confirmer about which message it needs to get confirmed. '''
-    def put_to_unconfirmed_messages_dict(self, delivery_tag, message):
-        return self.__confirmer.put_to_unconfirmed_messages_dict(delivery_tag, message)
-
-    ''' Called by builder, to prepare message republication after reconnect/channel reopen. '''
-    def reset_unconfirmed_messages_and_delivery_tags(self):
-        return self.__confirmer.reset_unconfirmed_messages_and_delivery_tags()
-
-    ''' Called by builder, to prepare message republication after reconnect/channel reopen. '''
-    def get_unconfirmed_messages_as_list_copy_during_lifetime(self):
-        return self.__confirmer.get_unconfirmed_messages_as_list_copy()
-
-    ''' Called by builder, to prepare message republication after reconnect/channel reopen. '''
-    def reset_delivery_number(self):
-        return self.__feeder.reset_delivery_number()
+    ''' Called by builder, to open, close and reset the channels. '''
+    def get_publishing_channels(self):
+        return self._channels.get_all()
 
     ''' Called by feeder. Called by builder, only for logging. '''
     def get_exchange_name(self):
@@ -393,6 +409,14 @@ class RabbitThread(threading.Thread):
     def make_permanently_closed_by_user(self):
         return self.__builder.make_permanently_closed_by_user()
 
+    ''' Called by confirmer, for the completions the publisher may wait for.'''
+    def report_confirms(self, acked, nacked):
+        return self.__facade.report_confirms(acked, nacked)
+
+    ''' Called by confirmer, when no more messages are waiting for a confirm.'''
+    def finish_gently_if_nothing_pending(self):
+        return self.__shutter.finish_gently_if_nothing_pending()
+
     ''' Called by builder any time a new ioloop starts to listen.'''
     def continue_gently_closing_if_applicable(self):
         return self.__shutter.continue_gently_closing_if_applicable()
@@ -0,0 +1,322 @@
+'''
+This module provides the "ShardedRabbitConnector", which is used
+instead of the "AsynchronousRabbitConnector" in active-active mode.
+
+In active-active mode, the library does not publish to one RabbitMQ
+node and use the others as fallback only, but it keeps a connection
+to every healthy trusted node of the best priority and distributes
+the messages among them.
+
+Every node is served by its own AsynchronousRabbitConnector (with its
+own thread, queue and NodeManager that contains only this node), a
+"shard". The ShardedRabbitConnector has the same API, so it can be
+used by the RabbitMessageSender in the same way.
+
+The messages are distributed to the shards whose connection is
+available, either in turn ("round_robin"), or to the shard with
+the fewest messages waiting to be published or confirmed
+("least_outstanding"), see RABBIT_ACTIVE_ACTIVE_STRATEGY. While
+no connection is available yet, they are distributed to all
+shards that are still trying.
+
+If a shard gives up (as its node cannot be reached any more), its
+unpublished, unconfirmed and rejected messages are moved to the
+other shards. This is checked whenever messages are sent, and
+before finishing.
+
+  .. note:: The messages of one dataset may be published via
+    different nodes, so they are not guaranteed to arrive in
+    the order in which they were sent.
+
+'''
+
+import logging
+import esgfpid.defaults
+import esgfpid.exceptions
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+from .asynchronous import AsynchronousRabbitConnector
+from .bounded_queue import BoundedMessageQueue
+from .exceptions import OperationNotAllowed, MessageQueueFull
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class ShardedRabbitConnector(object):
+
+    '''
+    Constructor. This does not open any connection or start
+    any thread yet.
+
+    :param node_managers: Mandatory. List of NodeManager objects,
+        each containing one RabbitMQ node (see
+        :func:`~esgfpid.rabbit.nodemanager.NodeManager.get_node_managers_for_active_nodes`).
+    :param strategy: Optional. How to distribute the messages
+        ("round_robin" or "least_outstanding"). Defaults to the
+        value defined in defaults.py.
+    :param queue_args: Optional. Dictionary with the limits of
+        the queue of unpublished messages (see BoundedMessageQueue),
+        applied to every shard's queue.
+    :raises: ArgumentError: If the strategy is unknown.
+    '''
+    def __init__(self, node_managers, strategy=None, queue_args=None):
+        logdebug(LOGGER, 'Initializing active-active rabbit connector...')
+
+        if strategy is None:
+            strategy = esgfpid.defaults.RABBIT_ACTIVE_ACTIVE_STRATEGY
+        if strategy not in ['round_robin', 'least_outstanding']:
+            raise esgfpid.exceptions.ArgumentError('Unknown active-active strategy "%s" (known: round_robin, least_outstanding).' % strategy)
+        self.__strategy = strategy
+
+        if queue_args is None:
+            queue_args = {}
+
+        # The shards, by host, in the order of the node managers:
+        self.__hosts = []
+        self.__shards = {}
+        for node_manager in node_managers:
+            node_manager.set_next_host()
+            host = node_manager.get_connection_parameters().host
+            self.__hosts.append(host)
+            self.__shards[host] = self.__create_shard(node_manager, queue_args)
+
+        # Per node reporting:
+        self.__num_sent = dict((host, 0) for host in self.__hosts)
+        self.__num_moved_away = dict((host, 0) for host in self.__hosts)
+        self.__failed = set() # hosts whose messages were moved away
+
+        self.__next = 0 # for round robin
+        self.__not_started_yet = True
+        logdebug(LOGGER, 'Initializing active-active rabbit connector... done (nodes: %s).', ', '.join(self.__hosts))
+
+    def __create_shard(self, node_manager, queue_args): # easy to mock/patch in unit test!
+        return AsynchronousRabbitConnector(node_manager, None, BoundedMessageQueue(**queue_args))
+
+    ###############################
+    ### Starting and finishing  ###
+    ###############################
+
+    ''' Starts the threads of all shards. '''
+    def start_rabbit_thread(self):
+        if not self.__not_started_yet:
+            logdebug(LOGGER, 'Rabbit threads were already started.')
+            return
+        self.__not_started_yet = False
+        for host in self.__hosts:
+            logdebug(LOGGER, 'Starting rabbit thread for %s...', host)
+            self.__shards[host].start_rabbit_thread()
+
+    def is_finished(self):
+        for shard in self.__shards.itervalues():
+            if not shard.is_finished():
+                return False
+        return True
+
+    '''
+    Gentle finish of all shards. The messages of shards that
+    failed before are moved to the others first.
+
+    :param timeout: Optional. Maximum number of seconds to wait
+        for the pending messages of each shard.
+    '''
+    def finish_rabbit_thread(self, timeout=None):
+        logdebug(LOGGER, 'Finishing all rabbit threads...')
+        self.__move_messages_of_failed_shards()
+        for host in self.__hosts:
+            if host not in self.__failed:
+                self.__shards[host].finish_rabbit_thread(timeout)
+        logdebug(LOGGER, 'Finishing all rabbit threads... done.')
+
+    def force_finish_rabbit_thread(self):
+        logdebug(LOGGER, 'Force finishing all rabbit threads...')
+        for host in self.__hosts:
+            if host not in self.__failed:
+                self.__shards[host].force_finish_rabbit_thread()
+        logdebug(LOGGER, 'Force finishing all rabbit threads... done.')
+
+    ########################
+    ### Sending messages ###
+    ########################
+
+    '''
+    Send a message to one of the RabbitMQ nodes.
+
+    :param message: Message (envelope) to be published.
+    :raises: OperationNotAllowed: If the rabbit threads were
+        not started yet.
+    '''
+    def send_message_to_queue(self, message):
+        self.__check_started()
+        self.__move_messages_of_failed_shards()
+        host = self.__choose_hosts(1)[0]
+        logtrace(LOGGER, 'Handing one message to the rabbit thread for %s.', host)
+        self.__num_sent[host] += 1
+        self.__shards[host].send_message_to_queue(message)
+
+    '''
+    Send many messages, distributed among the RabbitMQ nodes.
+
+    :param list_of_messages: List of messages (envelopes).
+    :raises: OperationNotAllowed: If the rabbit threads were
+        not started yet.
+    :raises: MessageQueueFull: If the queues of some nodes did
+        not accept all their messages. The others are handed
+        to their nodes anyway, and the exception carries the
+        messages of all nodes that were not accepted.
+    '''
+    def send_many_messages_to_queue(self, list_of_messages):
+        self.__check_started()
+        self.__move_messages_of_failed_shards()
+        self.__distribute(list_of_messages)
+
+    def __distribute(self, messages):
+        if len(messages) == 0:
+            return
+        messages_by_host = dict((host, []) for host in self.__hosts)
+        for host, message in zip(self.__choose_hosts(len(messages)), messages):
+            messages_by_host[host].append(message)
+        rejected = []
+        error = None
+        for host in self.__hosts:
+            if len(messages_by_host[host]) > 0:
+                logdebug(LOGGER, 'Handing %i messages to the rabbit thread for %s.', len(messages_by_host[host]), host)
+                self.__num_sent[host] += len(messages_by_host[host])
+                try:
+                    self.__shards[host].send_many_messages_to_queue(messages_by_host[host])
+                except MessageQueueFull as e:
+                    self.__num_sent[host] -= len(e.rejected_messages)
+                    rejected.extend(e.rejected_messages)
+                    error = e
+        if error is not None:
+            raise MessageQueueFull(error.custom_message, rejected_messages=rejected)
+
+    def __check_started(self):
+        if self.__not_started_yet:
+            msg = ('Cannot publish message. The message sending module was not initalized yet. '+
+                   '(Please call the PID connector\'s "start_messaging_thread()" before trying '+
+                   'to send messages, and do not forget to "finish_messaging_thread()" afterwards.')
+            raise OperationNotAllowed(msg)
+
+    '''
+    Returns the hosts to which to hand the next messages (one
+    per message), according to the strategy.
+
+    Only shards whose connection is available are used. If
+    there is none, all shards that did not fail are used (they
+    keep the messages until they are connected).
+    '''
+    def __choose_hosts(self, num):
+        candidates = [host for host in self.__hosts if host not in self.__failed and self.__shards[host].is_available()]
+        if len(candidates) == 0:
+            candidates = [host for host in self.__hosts if host not in self.__failed]
+
+        if self.__strategy == 'least_outstanding':
+            return self.__choose_least_outstanding(candidates, num)
+        return self.__choose_round_robin(candidates, num)
+
+    def __choose_round_robin(self, candidates, num):
+        chosen = []
+        for i in xrange(num):
+            chosen.append(candidates[self.__next % len(candidates)])
+            self.__next += 1
+        return chosen
+
+    def __choose_least_outstanding(self, candidates, num):
+        pending = dict((host, self.__shards[host].get_num_pending()) for host in candidates)
+        chosen = []
+        for i in xrange(num):
+            host = min(candidates, key=lambda host: pending[host])
+            pending[host] += 1
+            chosen.append(host)
+        return chosen
+
+    '''
+    If a shard gave up, its pending messages are taken from it
+    and sent to the other shards.
+
+    If all shards gave up, the last one is kept (not marked as
+    failed), so messages are still handed to it, which drops
+    and logs them, like in the normal asynchronous mode.
+    '''
+    def __move_messages_of_failed_shards(self):
+        newly_failed = [host for host in self.__hosts if host not in self.__failed and self.__shards[host].has_failed()]
+        if len(newly_failed) == 0:
+            return
+        if len(self.__failed) + len(newly_failed) == len(self.__hosts):
+            logerror(LOGGER, 'Connections to all RabbitMQ nodes failed.')
+            newly_failed = newly_failed[:-1]
+        self.__failed.update(newly_failed)
+        for host in newly_failed:
+            leftovers = self.__shards[host].take_leftovers()
+            logwarn(LOGGER, 'Connection to RabbitMQ node %s failed. Moving its %i pending messages to the other nodes.', host, len(leftovers))
+            self.__num_moved_away[host] += len(leftovers)
+            self.__distribute(leftovers)
+
+    ###############
+    ### Getters ###
+    ###############
+
+    '''
+    Returns the leftovers of all shards, once they were finished
+    (see :func:`~esgfpid.rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector.get_leftovers`).
+    The messages of shards that failed before were moved to the
+    others, so they are not among them.
+
+    :return: A list of messages (envelopes).
+    '''
+    def get_leftovers(self):
+        leftovers = []
+        for host in self.__hosts:
+            leftovers.extend(self.__shards[host].get_leftovers())
+        return leftovers
+
+    def any_leftovers(self):
+        return len(self.get_leftovers()) > 0
+
+    '''
+    Returns the sum of the status of the queues of all shards
+    (see :func:`~esgfpid.rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector.get_queue_status`).
+    The limits are those of one shard.
+    '''
+    def get_queue_status(self):
+        status = None
+        for host in self.__hosts:
+            shard_status = self.__shards[host].get_queue_status()
+            if status is None:
+                status = shard_status
+            else:
+                for key in ['num_messages', 'num_bytes', 'num_spilled']:
+                    status[key] += shard_status[key]
+        return status
+
+    '''
+    Returns the status of every RabbitMQ node.
+
+    :return: Dictionary by host. For each node, a dictionary with
+        the entries "state" ("available", "connecting", "failed"
+        or "finished"), "num_sent" (messages handed to the node's
+        thread), "num_moved_away" (messages moved to other nodes
+        after a failure) and "num_pending" (estimate of the messages
+        waiting to be published or confirmed).
+    '''
+    def get_node_status(self):
+        node_status = {}
+        for host in self.__hosts:
+            shard = self.__shards[host]
+            node_status[host] = dict(
+                state=self.__get_state(host),
+                num_sent=self.__num_sent[host],
+                num_moved_away=self.__num_moved_away[host],
+                num_pending=shard.get_num_pending()
+            )
+        return node_status
+
+    def __get_state(self, host):
+        shard = self.__shards[host]
+        if host in self.__failed or shard.has_failed():
+            return 'failed'
+        elif shard.is_available():
+            return 'available'
+        elif not self.__not_started_yet and shard.is_finished():
+            return 'finished'
+        return 'connecting'
@@ -0,0 +1,396 @@
+'''
+This module provides an on-disk spool for the messages that
+are sent by the asynchronous rabbit module.
+
+Every message that is handed over to the rabbit thread is
+appended to the spool first, and marked as confirmed once
+RabbitMQ confirmed it. If the process dies, or the thread
+is force-finished, the messages that were not confirmed
+(unpublished, unconfirmed, NACKed) are still on disk and
+are published again the next time the rabbit thread is
+started with the same spool directory ("at least once").
+
+The spool is a directory of append-only segment files. Each
+segment contains two kinds of records:
+
+ * "P <spool_id> <body_length> <ordering_key> <routing_key>\\n<body>\\n"
+   for every message that was put into the spool (the ordering
+   key URL-quoted, or empty if there is none),
+ * "C <spool_id>\\n" for every message that was confirmed.
+
+When a segment reaches a maximum size, a new one is started.
+Segments are deleted once all the messages they contain were
+confirmed (oldest first, as confirm records are always written
+to the same or a later segment than the message itself).
+
+How often the segments are synced to disk (fsync) can be
+configured. Confirm records are never synced explicitly: If
+they are lost, messages are published twice, but not lost.
+
+Puts happen on the thread of the library's caller, confirms
+on the rabbit thread, so all access is protected by a lock.
+
+Only one process can use a spool directory at a time (it holds
+an exclusive lock on the file "spool.lock" in it while the
+spool is open). If another process holds it, the spool is not
+used, and the messages are only kept in memory.
+
+'''
+
+import os
+import time
+import urllib
+import logging
+import threading
+import collections
+import esgfpid.defaults as defaults
+import esgfpid.exceptions
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+from .. import rabbitutils
+
+try:
+    import fcntl
+except ImportError: # not on Windows
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+FSYNC_POLICIES = ['always', 'interval', 'never']
+
+LOCK_FILE_NAME = 'spool.lock'
+
+
+class MessageSpool(object):
+
+    '''
+    Create a spool (this does not touch the disk yet).
+
+    :param directory: Mandatory. The directory to store the segments
+        in. Is created if it does not exist.
+    :param fsync: Optional. When to sync the segments to disk:
+        "always" (after every message), "interval" (at most every
+        RABBIT_SPOOL_FSYNC_INTERVAL_SECONDS) or "never" (leave it
+        to the operating system). Defaults to RABBIT_SPOOL_FSYNC.
+    :raises: ArgumentError: If the fsync policy is unknown.
+    '''
+    def __init__(self, directory, fsync=None):
+        if fsync is None:
+            fsync = defaults.RABBIT_SPOOL_FSYNC
+        if fsync not in FSYNC_POLICIES:
+            raise esgfpid.exceptions.ArgumentError('Unknown spool fsync policy "%s" (allowed: %s)' % (fsync, ', '.join(FSYNC_POLICIES)))
+
+        self.__directory = directory
+        self.__fsync = fsync
+        self.__fsync_interval_seconds = defaults.RABBIT_SPOOL_FSYNC_INTERVAL_SECONDS
+        self.__segment_max_bytes = defaults.RABBIT_SPOOL_SEGMENT_MAX_BYTES
+        self.__lock = threading.Lock()
+
+        # Segments, oldest first (the last one is the one written to):
+        self.__segments = collections.deque()
+        self.__num_unconfirmed_in_segment = {} # segment number -> number of unconfirmed messages
+        self.__segment_of_unconfirmed = {}     # spool id -> segment number, for unconfirmed messages
+        self.__file = None
+        self.__lock_file = None
+        self.__is_locked_out = False
+        self.__current_segment_bytes = 0
+        self.__next_spool_id = 1
+        self.__last_fsync = time.time()
+        self.__have_warned_about_write_error = False
+
+    '''
+    Open the spool: Read the existing segments and start
+    a new one.
+
+    Called by the rabbit module when the thread is started.
+
+    :return: The messages that are in the spool and were not
+        confirmed, as list of envelopes (in the order they
+        were put into the spool). They still have to be
+        published. Empty if another process uses the spool.
+    '''
+    def open(self):
+        with self.__lock:
+            if not os.path.isdir(self.__directory):
+                os.makedirs(self.__directory)
+            if not self.__acquire_directory_lock():
+                self.__is_locked_out = True
+                logerror(LOGGER, 'Spool %s is used by another process. Messages are only kept in memory.', self.__directory)
+                return []
+
+            unconfirmed = collections.OrderedDict()
+            for segment_number in self.__list_segments():
+                self.__read_segment(segment_number, unconfirmed)
+                self.__segments.append(segment_number)
+                self.__num_unconfirmed_in_segment[segment_number] = 0
+
+            replay = []
+            for spool_id, (routing_key, body, ordering_key, segment_number) in unconfirmed.iteritems():
+                self.__segment_of_unconfirmed[spool_id] = segment_number
+                self.__num_unconfirmed_in_segment[segment_number] += 1
+                replay.append(rabbitutils.MessageEnvelope(routing_key, body, spool_id, ordering_key))
+
+            next_segment_number = 1
+            if len(self.__segments) > 0:
+                next_segment_number = self.__segments[-1]+1
+            self.__start_segment(next_segment_number)
+            self.__remove_confirmed_segments()
+
+        if len(replay) > 0:
+            loginfo(LOGGER, 'Found %i unconfirmed messages in spool %s.', len(replay), self.__directory)
+        else:
+            logdebug(LOGGER, 'Found no unconfirmed messages in spool %s.', self.__directory)
+        return replay
+
+    '''
+    Append messages to the spool.
+
+    Messages that were spooled already (e.g. because they are
+    republished after a reconnection) are not appended again.
+
+    If the spool cannot be written, an error is logged and the
+    messages are returned as they are, so they can still be
+    published.
+
+    :param messages: List of envelopes (or of JSON messages,
+        which are then serialized).
+    :return: List of the envelopes, carrying their spool ids.
+    '''
+    def put_many(self, messages):
+        envelopes = [rabbitutils.make_message_envelope(msg) for msg in messages]
+        with self.__lock:
+            if self.__file is None:
+                if not self.__is_locked_out: # was logged when opening
+                    logwarn(LOGGER, 'Spool %s is not open. Cannot spool %i messages.', self.__directory, len(envelopes))
+                return envelopes
+            try:
+                spooled = [self.__write_put_record(envelope) for envelope in envelopes]
+                self.__flush_and_sync_if_needed()
+                self.__start_next_segment_if_full()
+                return spooled
+            except (IOError, OSError) as e:
+                self.__log_write_error(e)
+                return envelopes
+
+    def put(self, message):
+        return self.put_many([message])[0]
+
+    '''
+    Mark messages as confirmed, so they will not be published
+    again. Called by the confirmer (in the rabbit thread).
+
+    :param messages: List of envelopes. Messages without spool
+        id are ignored.
+    '''
+    def confirm_many(self, messages):
+        with self.__lock:
+            try:
+                for msg in messages:
+                    self.__write_confirm_record(msg)
+                self.__remove_confirmed_segments()
+            except (IOError, OSError) as e:
+                self.__log_write_error(e)
+
+    '''
+    Sync and close the current segment. If all messages were
+    confirmed, all segments are deleted. Then the spool is
+    released for other processes.
+
+    Called by the rabbit module after the thread was joined.
+    '''
+    def close(self):
+        with self.__lock:
+            if self.__file is None:
+                self.__release_directory_lock()
+                return
+            try:
+                self.__close_segment()
+                if len(self.__segment_of_unconfirmed) == 0:
+                    while len(self.__segments) > 0:
+                        self.__remove_segment(self.__segments.popleft())
+                    logdebug(LOGGER, 'All spooled messages were confirmed. Removed all segments.')
+                else:
+                    loginfo(LOGGER, 'Leaving %i unconfirmed messages in spool %s.', len(self.__segment_of_unconfirmed), self.__directory)
+            except (IOError, OSError) as e:
+                self.__log_write_error(e)
+            finally:
+                self.__release_directory_lock()
+
+    def get_num_unconfirmed(self):
+        with self.__lock:
+            return len(self.__segment_of_unconfirmed)
+
+    def get_num_segments(self):
+        with self.__lock:
+            return len(self.__segments)
+
+    ### Writing
+
+    def __write_put_record(self, envelope):
+        if envelope.spool_id is not None:
+            return envelope # spooled already
+
+        body = self.__to_bytes(envelope.body)
+        routing_key = self.__to_bytes(envelope.routing_key)
+        ordering_key = ''
+        if envelope.ordering_key is not None:
+            ordering_key = urllib.quote(self.__to_bytes(envelope.ordering_key), safe='')
+        spool_id = self.__next_spool_id
+        self.__next_spool_id += 1
+
+        record = 'P %i %i %s %s\n%s\n' % (spool_id, len(body), ordering_key, routing_key, body)
+        self.__write(record)
+        self.__segment_of_unconfirmed[spool_id] = self.__segments[-1]
+        self.__num_unconfirmed_in_segment[self.__segments[-1]] += 1
+        return envelope._replace(spool_id=spool_id)
+
+    def __write_confirm_record(self, msg):
+        spool_id = getattr(msg, 'spool_id', None)
+        if spool_id is None:
+            return
+        segment_number = self.__segment_of_unconfirmed.pop(spool_id, None)
+        if segment_number is None:
+            logtrace(LOGGER, 'Confirmed message %i is not in spool.', spool_id)
+            return
+        self.__num_unconfirmed_in_segment[segment_number] -= 1
+        if self.__file is not None:
+            self.__write('C %i\n' % spool_id)
+
+    def __write(self, record):
+        self.__file.write(record)
+        self.__current_segment_bytes += len(record)
+
+    def __to_bytes(self, string):
+        if isinstance(string, unicode):
+            return string.encode('utf-8')
+        return str(string)
+
+    def __flush_and_sync_if_needed(self):
+        self.__file.flush()
+        if self.__fsync == 'always':
+            self.__sync()
+        elif self.__fsync == 'interval':
+            if time.time() - self.__last_fsync >= self.__fsync_interval_seconds:
+                self.__sync()
+
+    def __sync(self):
+        os.fsync(self.__file.fileno())
+        self.__last_fsync = time.time()
+
+    def __log_write_error(self, e):
+        if not self.__have_warned_about_write_error:
+            logerror(LOGGER, 'Could not write to spool %s (%s: %s). Messages are only kept in memory.', self.__directory, e.__class__.__name__, e)
+            self.__have_warned_about_write_error = True
+
+    ### Lock
+
+    '''
+    :return: True if this process now holds the lock on the
+        spool directory, False if another process holds it.
+    '''
+    def __acquire_directory_lock(self):
+        if fcntl is None:
+            logwarn(LOGGER, 'Cannot lock spool %s on this platform. Make sure that no other process uses it.', self.__directory)
+            return True
+        lock_file = open(os.path.join(self.__directory, LOCK_FILE_NAME), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return False
+        self.__lock_file = lock_file
+        return True
+
+    def __release_directory_lock(self):
+        if self.__lock_file is not None:
+            self.__lock_file.close() # releases the lock
+            self.__lock_file = None
+
+    ### Segments
+
+    def __get_segment_path(self, segment_number):
+        return os.path.join(self.__directory, 'segment-%010i.spool' % segment_number)
+
+    def __list_segments(self):
+        segment_numbers = []
+        for filename in os.listdir(self.__directory):
+            if filename.startswith('segment-') and filename.endswith('.spool'):
+                try:
+                    segment_numbers.append(int(filename[len('segment-'):-len('.spool')]))
+                except ValueError:
+                    logwarn(LOGGER, 'Ignoring file %s in spool %s.', filename, self.__directory)
+        return sorted(segment_numbers)
+
+    def __start_segment(self, segment_number):
+        self.__file = open(self.__get_segment_path(segment_number), 'ab')
+        self.__current_segment_bytes = 0
+        self.__segments.append(segment_number)
+        self.__num_unconfirmed_in_segment[segment_number] = 0
+        logdebug(LOGGER, 'Started spool segment %i.', segment_number)
+
+    def __start_next_segment_if_full(self):
+        if self.__current_segment_bytes >= self.__segment_max_bytes:
+            self.__close_segment()
+            self.__start_segment(self.__segments[-1]+1)
+            self.__remove_confirmed_segments()
+
+    def __close_segment(self):
+        self.__file.flush()
+        if self.__fsync != 'never':
+            self.__sync()
+        self.__file.close()
+        self.__file = None
+
+    '''
+    Removes the oldest segments, as long as all their messages
+    were confirmed. The segment that is currently written to
+    is never removed.
+    '''
+    def __remove_confirmed_segments(self):
+        while len(self.__segments) > 1 and self.__num_unconfirmed_in_segment[self.__segments[0]] == 0:
+            self.__remove_segment(self.__segments.popleft())
+
+    def __remove_segment(self, segment_number):
+        del self.__num_unconfirmed_in_segment[segment_number]
+        os.remove(self.__get_segment_path(segment_number))
+        logdebug(LOGGER, 'Removed spool segment %i (all messages confirmed).', segment_number)
+
+    ### Reading
+
+    '''
+    Reads the records of one segment. Puts the messages into
+    the dict of unconfirmed messages, and removes them again
+    if they were confirmed.
+
+    An incomplete record at the end of the segment (if the
+    process died while writing it) is ignored.
+    '''
+    def __read_segment(self, segment_number, unconfirmed):
+        with open(self.__get_segment_path(segment_number), 'rb') as segment:
+            data = segment.read()
+
+        pos = 0
+        while pos < len(data):
+            end_of_header = data.find('\n', pos)
+            if end_of_header < 0:
+                break # incomplete record
+            try:
+                fields = data[pos:end_of_header].split(' ', 4)
+                if fields[0] == 'P':
+                    spool_id, length, routing_key = int(fields[1]), int(fields[2]), fields[4]
+                    ordering_key = urllib.unquote(fields[3]) or None
+                    end_of_body = end_of_header+1+length
+                    if end_of_body >= len(data):
+                        break # incomplete record
+                    body = data[end_of_header+1:end_of_body]
+                    unconfirmed[spool_id] = (routing_key, body, ordering_key, segment_number)
+                    self.__next_spool_id = max(self.__next_spool_id, spool_id+1)
+                    pos = end_of_body+1
+                elif fields[0] == 'C':
+                    unconfirmed.pop(int(fields[1]), None)
+                    pos = end_of_header+1
+                else:
+                    raise ValueError('Unknown record type "%s"' % fields[0])
+            except (ValueError, IndexError) as e:
+                logwarn(LOGGER, 'Spool segment %i is corrupt at byte %i (%s). Ignoring the rest of it.', segment_number, pos, e)
+                break
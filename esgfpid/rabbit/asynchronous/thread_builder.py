@@ -1,12 +1,16 @@
 import logging
 import pika
+import pika.adapters.select_connection
 import time
 import copy
 import datetime
+import functools
+import threading
 from esgfpid.utils import get_now_utc_as_formatted_string as get_now_utc_as_formatted_string
 import esgfpid.defaults as defaults
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from ..exceptions import PIDServerException
+from .thread_feeder import get_num_publish_events_needed
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -23,18 +27,24 @@ seconds before that.
 There is a maximum number of times that this is tried before
 giving up Permanently.
 
+Once the connection is open, it opens the channels to publish on
+(RABBIT_ASYN_NUM_CHANNELS), each with its own confirmer. Publishing
+may start as soon as the first channel is open. If a channel is
+closed (e.g. as the exchange does not exist), only that channel
+is reopened, and only its unconfirmed messages are republished.
+
+In racing mode (RABBIT_ASYN_CONNECTION_RACE_SIZE > 1), it opens
+connections to several RabbitMQ nodes at the same time, uses the
+first one whose channel is open and closes the others. So slow
+or unreachable nodes do not add up their timeouts.
+
 '''
 class ConnectionBuilder(object):
     
-    def __init__(self, thread, statemachine, confirmer, returnhandler, shutter, nodemanager):
+    def __init__(self, thread, statemachine, returnhandler, shutter, nodemanager):
         self.thread = thread
         self.statemachine = statemachine
 
-        '''
-        We need to pass the "confirmer.on_delivery_confirmation()" callback to
-        RabbitMQ's channel.'''
-        self.confirmer = confirmer
-        
         '''
         We need to pass the "returnhandler.on_message_not_accepted()"" callback
         to RabbitMQ's channel as "on_return_callback" '''
@@ -91,6 +101,17 @@ class ConnectionBuilder(object):
         '''
         self.__fallback_exchange_name = defaults.RABBIT_FALLBACK_EXCHANGE_NAME
 
+        '''
+        Racing mode: How many nodes to connect to at the same time,
+        the racing connections by host, the hosts whose connection
+        has not failed yet, and the host whose channel opened first.
+        '''
+        self.__race_size = defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE
+        self.__racers = {}
+        self.__racer_errors = {}
+        self.__race_pending = set()
+        self.__race_winner = None
+
     ####################
     ### Start ioloop ###
     ####################
@@ -192,6 +213,12 @@ class ConnectionBuilder(object):
 
     ''' Asynchronous, waits for answer from RabbitMQ.'''
     def __please_open_connection(self):
+        if self.__race_size > 1 and self.__node_manager.has_more_urls():
+            self.__please_open_racing_connections()
+        else:
+            self.__please_open_single_connection()
+
+    def __please_open_single_connection(self):
         params = self.__node_manager.get_connection_parameters()
         self.__start_connect_time = datetime.datetime.now()
         logdebug(LOGGER, 'Connecting to RabbitMQ at %s... (%s)',
@@ -209,9 +236,11 @@ class ConnectionBuilder(object):
     ''' Callback, called by RabbitMQ.'''
     def on_connection_open(self, unused_connection):
         logdebug(LOGGER, 'Opening connection... done.')
+        host = self.__node_manager.get_connection_parameters().host
         loginfo(LOGGER, 'Connection to RabbitMQ at %s opened... (%s)',
-            self.__node_manager.get_connection_parameters().host,
-            get_now_utc_as_formatted_string())
+            host, get_now_utc_as_formatted_string())
+        time_passed = datetime.datetime.now() - self.__start_connect_time
+        self.__node_manager.report_connection_success(host, time_passed.total_seconds())
 
         # Tell the main thread we're open for events now:
         # When the connection is open, the thread is ready to accept events.
@@ -221,35 +250,50 @@ class ConnectionBuilder(object):
         # certainly was carried out before this callback. So this call to
         # "...stop_waiting..." is likelily redundant!
         self.thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
-        self.__please_open_rabbit_channel()
+        self.__please_open_rabbit_channels()
+
+    ''' Asynchronous, waits for answers from RabbitMQ.'''
+    def __please_open_rabbit_channels(self, pubchannels=None):
+        if pubchannels is None:
+            pubchannels = self.thread.get_publishing_channels()
+        for pubchannel in pubchannels:
+            self.__please_open_rabbit_channel(pubchannel)
 
     ''' Asynchronous, waits for answer from RabbitMQ.'''
-    def __please_open_rabbit_channel(self):
-        logdebug(LOGGER, 'Opening channel...')
-        self.thread._connection.channel(on_open_callback=self.on_channel_open)
+    def __please_open_rabbit_channel(self, pubchannel):
+        logdebug(LOGGER, 'Opening channel %i...', pubchannel.number)
+        self.thread._connection.channel(on_open_callback=functools.partial(self.on_channel_open, pubchannel=pubchannel))
 
-    ''' Callback, called by RabbitMQ. '''
-    def on_channel_open(self, channel):
+    '''
+    Callback, called by RabbitMQ.
+
+    :param channel: The pika channel that was opened.
+    :param pubchannel: The publishing channel (of the thread's
+        pool) to which it belongs. If not given, the first one.
+    '''
+    def on_channel_open(self, channel, pubchannel=None):
+        if pubchannel is None:
+            pubchannel = self.thread.get_publishing_channels()[0]
         time_passed = datetime.datetime.now() - self.__start_connect_time
-        logdebug(LOGGER, 'Opening channel... done. Took %s seconds.' % time_passed.total_seconds())
+        logdebug(LOGGER, 'Opening channel %i... done. Took %s seconds.' % (pubchannel.number, time_passed.total_seconds()))
         logtrace(LOGGER, 'Channel has number: %s.', channel.channel_number)
-        self.thread._channel = channel
+        pubchannel.channel = channel
         self.__reconnect_counter = 0
-        self.__add_on_channel_close_callback()
-        self.__add_on_return_callback()
-        self.__make_channel_confirm_delivery()
-        self.__make_ready_for_publishing()
+        self.__add_on_channel_close_callback(pubchannel)
+        self.__add_on_return_callback(pubchannel)
+        self.__make_channel_confirm_delivery(pubchannel)
+        self.__make_ready_for_publishing(pubchannel)
 
-    def __make_channel_confirm_delivery(self):
+    def __make_channel_confirm_delivery(self, pubchannel):
         logtrace(LOGGER, 'Set confirm delivery... (Issue Confirm.Select RPC command)')
-        self.thread._channel.confirm_delivery(callback=self.confirmer.on_delivery_confirmation)
+        pubchannel.channel.confirm_delivery(callback=pubchannel.confirmer.on_delivery_confirmation)
         logdebug(LOGGER, 'Set confirm delivery... done.')
  
-    def __make_ready_for_publishing(self):
+    def __make_ready_for_publishing(self, pubchannel):
         logdebug(LOGGER, '(Re)connection established, making ready for publication...')
 
         # Check for unexpected errors:
-        if self.thread._channel is None:
+        if pubchannel.channel is None:
             logerror(LOGGER, 'Channel is None after connecting to server. This should not happen.')
             self.statemachine.set_to_permanently_unavailable()
         if self.thread._connection is None:
@@ -259,10 +303,15 @@ class ConnectionBuilder(object):
         # Normally, it should already be waiting to be available:
         if self.statemachine.is_WAITING_TO_BE_AVAILABLE():
             logdebug(LOGGER, 'Setup is finished. Publishing may start.')
-            logtrace(LOGGER, 'Publishing will use channel no. %s!', self.thread._channel.channel_number)
+            logtrace(LOGGER, 'Publishing will use channel no. %s!', pubchannel.channel.channel_number)
             self.statemachine.set_to_available()
             self.__check_for_already_arrived_messages_and_publish_them()
 
+        # Another channel was opened before, so publishing has started:
+        elif self.statemachine.is_AVAILABLE():
+            logdebug(LOGGER, 'Channel %i is ready too. Publishing may use it.', pubchannel.number)
+            self.__check_for_already_arrived_messages_and_publish_them()
+
         # It was asked to close in the meantime (but might be able to publish the last messages):
         elif self.statemachine.is_AVAILABLE_BUT_WANTS_TO_STOP():
             logdebug(LOGGER, 'Setup is finished, but the module was already asked to be closed in the meantime.')
@@ -285,13 +334,174 @@ class ConnectionBuilder(object):
         num = self.thread.get_num_unpublished()
         if num > 0:
             loginfo(LOGGER, 'Ready to publish messages to RabbitMQ. %s messages are already waiting to be published.', num)
-            for i in xrange(int(num*1.1)):
+            for i in xrange(get_num_publish_events_needed(int(num*1.1))):
                 self.thread.add_event_publish_message()
         else:
             loginfo(LOGGER, 'Ready to publish messages to RabbitMQ.')
             logdebug(LOGGER, 'Ready to publish messages to RabbitMQ. No messages waiting yet.')
         
 
+    #########################
+    ### Connection racing ###
+    #########################
+
+    '''
+    Open connections to the next few RabbitMQ nodes at the same
+    time. The first one whose channel is open is used, the others
+    are closed.
+
+    pika connects the socket in the connection's constructor
+    (blocking up to the socket timeout), so the connections are
+    created by short-lived helper threads. They all share one
+    ioloop (which is not running yet), so the rabbit thread
+    serves all of them. Their callbacks are passed on through
+    the ioloop, so that all decisions are made in the rabbit
+    thread.
+
+    Connections that cannot even be created are reported as
+    failed right away (by the rabbit thread, after the helpers
+    are done). If none could be created, the best candidate is
+    connected to on its own.
+    '''
+    def __please_open_racing_connections(self):
+        list_of_params = self.__node_manager.get_candidate_connection_parameters(self.__race_size)
+        hosts = [params.host for params in list_of_params]
+        loginfo(LOGGER, 'Opening connections to %i RabbitMQ nodes at once (%s)...', len(hosts), ', '.join(hosts))
+        self.__start_connect_time = datetime.datetime.now()
+        self.__racers = {}
+        self.__racer_errors = {}
+        self.__race_pending = set(hosts)
+        self.__race_winner = None
+        ioloop = self.__make_ioloop()
+
+        helpers = []
+        for params in list_of_params:
+            self.__all_hosts_that_were_tried.add(params.host)
+            helper = threading.Thread(target=self.__open_racing_connection, args=(params, ioloop))
+            helper.start()
+            helpers.append(helper)
+        for helper in helpers:
+            helper.join()
+
+        # The thread needs one of them, to run the (shared) ioloop:
+        for host in hosts:
+            if host in self.__racers:
+                self.thread._connection = self.__racers[host]
+                for failed_host in hosts:
+                    if failed_host in self.__racer_errors:
+                        self.on_racing_connection_error(failed_host, None, self.__racer_errors[failed_host])
+                return
+
+        # None could be created. The failure of the one we retry
+        # is reported by the normal connection handling:
+        fallback_host = hosts[0]
+        for failed_host in hosts[1:]:
+            self.__node_manager.report_connection_failure(failed_host)
+        logerror(LOGGER, 'Could not create any racing connection. Connecting to %s only.', fallback_host)
+        self.__node_manager.select_candidate(fallback_host)
+        self.__please_open_single_connection()
+
+    def __make_ioloop(self): # this is easy to mock during unit tests
+        return pika.adapters.select_connection.IOLoop()
+
+    '''
+    Called by the helper threads. Errors are only stored, they
+    are handled by the rabbit thread once all helpers are done.
+    '''
+    def __open_racing_connection(self, params, ioloop):
+        host = params.host
+        try:
+            self.__racers[host] = self.__make_racing_connection(params, ioloop,
+                self.__pass_on(ioloop, self.on_racing_connection_open, host),
+                self.__pass_on(ioloop, self.on_racing_connection_error, host),
+                self.__pass_on(ioloop, self.on_racing_connection_closed, host))
+        except Exception as e:
+            logerror(LOGGER, 'Error creating connection to %s: %s: %s', host, e.__class__.__name__, e)
+            self.__racer_errors[host] = repr(e)
+
+    def __make_racing_connection(self, params, ioloop, on_open, on_open_error, on_close): # this is easy to mock during unit tests
+        return pika.SelectConnection(
+            parameters=params,
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=on_close,
+            stop_ioloop_on_close=False,
+            custom_ioloop=ioloop
+        )
+
+    def __pass_on(self, ioloop, handler, host):
+        def callback(*args):
+            ioloop.add_timeout(0, functools.partial(handler, host, *args))
+        return callback
+
+    ''' Callback, called by RabbitMQ (via the ioloop).'''
+    def on_racing_connection_open(self, host, connection):
+        if self.__race_winner is not None:
+            logdebug(LOGGER, 'Connection to %s opened, but %s was faster. Closing it.', host, self.__race_winner)
+            connection.close()
+            return
+        logdebug(LOGGER, 'Connection to %s opened. Opening channel...', host)
+        connection.channel(on_open_callback=functools.partial(self.on_racing_channel_open, host, connection))
+
+    ''' Callback, called by RabbitMQ.'''
+    def on_racing_channel_open(self, host, connection, channel):
+        if self.__race_winner is not None:
+            logdebug(LOGGER, 'Channel to %s opened, but %s was faster. Closing it.', host, self.__race_winner)
+            connection.close()
+            return
+
+        self.__race_winner = host
+        time_passed = datetime.datetime.now() - self.__start_connect_time
+        loginfo(LOGGER, 'Connection to RabbitMQ at %s opened first, after %s seconds... (%s)',
+            host, time_passed.total_seconds(), get_now_utc_as_formatted_string())
+        self.__node_manager.select_candidate(host)
+        self.__node_manager.report_connection_success(host, time_passed.total_seconds())
+        self.thread._connection = connection
+        self.__close_losing_racers()
+
+        # Now, go on like after opening one connection. The
+        # racing channel is the first one, the others are opened
+        # on the winning connection:
+        self.thread.tell_publisher_to_stop_waiting_for_thread_to_accept_events()
+        pubchannels = self.thread.get_publishing_channels()
+        self.on_channel_open(channel, pubchannels[0])
+        self.__please_open_rabbit_channels(pubchannels[1:])
+
+    def __close_losing_racers(self):
+        for host, connection in self.__racers.iteritems():
+            if host != self.__race_winner and connection.is_open:
+                logdebug(LOGGER, 'Closing connection to %s (not needed).', host)
+                connection.close()
+
+    '''
+    Callback, called by RabbitMQ (via the ioloop).
+    Only if the connections to all candidates failed, this is
+    handled like any failed connection (see on_connection_error),
+    which then tries the next nodes.
+    '''
+    def on_racing_connection_error(self, host, connection, msg):
+        if host not in self.__race_pending:
+            return # already handled
+        self.__race_pending.discard(host)
+
+        if self.__race_winner is None and len(self.__race_pending) == 0:
+            self.__node_manager.select_candidate(host)
+            if connection is None:
+                connection = self.thread._connection
+            self.on_connection_error(connection, msg)
+        else:
+            loginfo(LOGGER, 'Failed connection to RabbitMQ at %s. Reason: %s.', host, msg)
+            self.__node_manager.report_connection_failure(host)
+
+    ''' Callback, called by RabbitMQ (via the ioloop).'''
+    def on_racing_connection_closed(self, host, connection, reply_code, reply_text):
+        if host == self.__race_winner and connection is self.thread._connection:
+            self.on_connection_closed(connection, reply_code, reply_text)
+        elif self.__race_winner is not None:
+            logtrace(LOGGER, 'Connection to %s closed (not needed).', host)
+        else:
+            self.on_racing_connection_error(host, connection, reply_text)
+
     ########################
     ### Connection error ###
     ########################
@@ -311,6 +521,7 @@ class ConnectionBuilder(object):
         oldhost = self.__node_manager.get_connection_parameters().host
         time_passed = datetime.datetime.now() - self.__start_connect_time
         loginfo(LOGGER, 'Failed connection to RabbitMQ at %s after %s seconds. Reason: %s.', oldhost, time_passed.total_seconds(), msg)
+        self.__node_manager.report_connection_failure(oldhost)
 
         # If there was a force-finish, we do not reconnect.
         if self.statemachine.is_FORCE_FINISHED():
@@ -361,8 +572,8 @@ class ConnectionBuilder(object):
     ''' This tells RabbitMQ what to do if it receives 
     a message it cannot accept, e.g. if it cannot
     route it. '''
-    def __add_on_return_callback(self):
-        self.thread._channel.add_on_return_callback(self.returnhandler.on_message_not_accepted)
+    def __add_on_return_callback(self, pubchannel):
+        pubchannel.channel.add_on_return_callback(self.returnhandler.on_message_not_accepted)
 
     '''
     This tells RabbitMQ what to do if the channel
@@ -373,8 +584,8 @@ class ConnectionBuilder(object):
     called if the channel is closed without the underlying
     connection being closed. I am not 100 percent sure though.
     '''
-    def __add_on_channel_close_callback(self):
-        self.thread._channel.add_on_close_callback(self.on_channel_closed)
+    def __add_on_channel_close_callback(self, pubchannel):
+        pubchannel.channel.add_on_close_callback(self.on_channel_closed)
 
     '''
     Callback, called by RabbitMQ.
@@ -393,9 +604,15 @@ class ConnectionBuilder(object):
         the channel to close.
         In this case, we want to reopen a connection.
 
+    Every channel of the pool has this callback. Only the channel
+    that was closed is reopened in case (2); the other channels go
+    on publishing.
+
     '''
     def on_channel_closed(self, channel, reply_code, reply_text):
-        logdebug(LOGGER, 'Channel was closed: %s (code %s)', reply_text, reply_code)
+        pubchannel = self.__find_publishing_channel(channel)
+        logdebug(LOGGER, 'Channel %s was closed: %s (code %s)', pubchannel.number, reply_text, reply_code)
+        pubchannel.channel = None
 
         # Channel closed because user wants to close:
         if self.statemachine.is_PERMANENTLY_UNAVAILABLE():
@@ -410,24 +627,41 @@ class ConnectionBuilder(object):
         # Channel closed because exchange did not exist:
         elif reply_code == 404:
             logdebug(LOGGER, 'Channel closed because the exchange "%s" did not exist.', self.__node_manager.get_exchange_name())
-            self.__use_different_exchange_and_reopen_channel()
+            self.__use_different_exchange_and_reopen_channel(pubchannel)
 
         # Other unexpected channel close:
         else:
             logerror(LOGGER,'Unexpected channel shutdown. Need to close connection to trigger all the necessary close down steps.')
             self.thread._connection.close() # This will reconnect!
 
+    def __find_publishing_channel(self, channel):
+        for pubchannel in self.thread.get_publishing_channels():
+            if pubchannel.channel is channel:
+                return pubchannel
+        return self.thread.get_publishing_channels()[0]
+
+    def __is_any_channel_open(self):
+        for pubchannel in self.thread.get_publishing_channels():
+            if pubchannel.is_open():
+                return True
+        return False
+
     '''
     An attempt to publish to a nonexistent exchange will close
     the channel. In this case, we use a different exchange name
     and reopen the channel. The underlying connection was kept
     open.
+
+    The exchange name is used by all channels. The other channels
+    are closed too when they publish to the nonexistent exchange,
+    and are then reopened the same way.
     '''
-    def __use_different_exchange_and_reopen_channel(self):
+    def __use_different_exchange_and_reopen_channel(self, pubchannel):
 
         # Set to waiting to be available, so that incoming
-        # messages are stored:
-        self.statemachine.set_to_waiting_to_be_available()
+        # messages are stored (unless other channels are open):
+        if not self.__is_any_channel_open():
+            self.statemachine.set_to_waiting_to_be_available()
 
         # New exchange name
         logdebug(LOGGER, 'Setting exchange name to fallback exchange "%s"', self.__fallback_exchange_name)
@@ -435,13 +669,11 @@ class ConnectionBuilder(object):
 
         # If this happened while sending message to the wrong exchange, we
         # have to trigger their resending...
-        self.__prepare_channel_reopen('Channel reopen')
+        self.__prepare_channel_reopen('Channel %i reopen' % pubchannel.number, [pubchannel])
 
         # Reopen channel
-        # TODO Reihenfolge richtigen? Erst prepare, dann open?
-        logdebug(LOGGER, 'Reopening channel...')
-        self.statemachine.set_to_waiting_to_be_available()
-        self.__please_open_rabbit_channel()
+        logdebug(LOGGER, 'Reopening channel %i...', pubchannel.number)
+        self.__please_open_rabbit_channel(pubchannel)
 
     '''
     Callback, called by RabbitMQ.
@@ -455,7 +687,8 @@ class ConnectionBuilder(object):
     '''
     def on_connection_closed(self, connection, reply_code, reply_text):
         loginfo(LOGGER, 'Connection to RabbitMQ was closed. Reason: %s.', reply_text)
-        self.thread._channel = None
+        for pubchannel in self.thread.get_publishing_channels():
+            pubchannel.channel = None
         if self.__was_user_shutdown(reply_code, reply_text):
             loginfo(LOGGER, 'Connection to %s closed.', self.__node_manager.get_connection_parameters().host)
             self.make_permanently_closed_by_user()
@@ -572,7 +805,7 @@ class ConnectionBuilder(object):
 
         # We need to reset delivery tags, unconfirmed messages,
         # republish the unconfirmed, ...
-        self.__prepare_channel_reopen('Reconnect')
+        self.__prepare_channel_reopen('Reconnect', self.thread.get_publishing_channels())
         
         # This is the old connection ioloop instance, stop its ioloop
         logdebug(LOGGER, 'Reconnect: Stopping ioloop of connection %s...', self.thread._connection)
@@ -586,35 +819,32 @@ class ConnectionBuilder(object):
         self.first_connection()
 
     '''
-    This is called during reconnection and during channel reopen.
+    This is called during reconnection (for all channels) and
+    during channel reopen (for the reopened channel).
     Both implies that a new channel is opened.
     '''
-    def __prepare_channel_reopen(self, operation_string):
-        # We need to reset the message number, as
-        # it works by channel:
-        logdebug(LOGGER, operation_string+': Resetting delivery number (for publishing messages).')
-        self.thread.reset_delivery_number()
-
-        # Furthermore, as we'd like to re-publish messages
+    def __prepare_channel_reopen(self, operation_string, pubchannels):
+        # As we'd like to re-publish messages
         # that had not been confirmed yet, we remove them
         # from the stack of unconfirmed messages, and put them
         # back to the stack of unpublished messages.
         logdebug(LOGGER, operation_string+': Sending all messages that have not been confirmed yet...')
-        self.__prepare_republication_of_unconfirmed()
+        for pubchannel in pubchannels:
+            self.__prepare_republication_of_unconfirmed(pubchannel)
 
-        # Reset the unconfirmed delivery tags, as they also work by channel:
-        logdebug(LOGGER, operation_string+': Resetting delivery tags (for confirming messages).')
-        self.thread.reset_unconfirmed_messages_and_delivery_tags()
+            # We need to reset the message number and the unconfirmed
+            # delivery tags, as they work by channel:
+            logdebug(LOGGER, operation_string+': Resetting delivery number and tags of channel %i.', pubchannel.number)
+            pubchannel.reset()
         
-    def __prepare_republication_of_unconfirmed(self):
+    def __prepare_republication_of_unconfirmed(self, pubchannel):
         # Get all unconfirmed messages - we won't be able to receive their confirms anymore:
         # IMPORTANT: This has to happen before we reset the delivery_tags of the confirmer
         # module, as this deletes the collection of unconfirmed messages.
-        rescued_messages = self.thread.get_unconfirmed_messages_as_list_copy_during_lifetime()
+        rescued_messages = pubchannel.confirmer.get_unconfirmed_messages_as_list_copy()
         if len(rescued_messages)>0:
             logdebug(LOGGER, '%s unconfirmed messages were saved and are sent now.', len(rescued_messages))
             self.thread.send_many_messages(rescued_messages)
             # Note: The actual publish of these messages to rabbit
             # happens when the connection is there again, so no wrong delivery
             # tags etc. are created by this line!
-
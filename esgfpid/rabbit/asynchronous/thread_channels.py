@@ -0,0 +1,148 @@
+import logging
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+from .thread_confirmer import Confirmer
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+============
+Channel pool
+============
+
+The rabbit thread publishes on several confirm-mode channels
+of the same connection (see RABBIT_ASYN_NUM_CHANNELS). RabbitMQ
+processes the messages of one channel one after the other, so
+with many messages, one channel limits the throughput long
+before the network or the broker do.
+
+Delivery tags are only valid within their channel, so every
+channel has its own delivery number and its own confirmer.
+
+Messages that carry an ordering key (all messages that belong
+to the same dataset, see rabbitutils.get_ordering_key()) are
+always published on the same channel, so they arrive in the
+order in which they were sent. Messages without ordering key
+are spread over the open channels in turn.
+
+If the channel of an ordering key is not open (e.g. while it
+is being reopened), the message is published on another open
+channel rather than waiting.
+
+API:
+ * get_channel_for() called by feeder, for every message
+ * get_all() called by builder, to open, close and reset channels
+ * get_num_unconfirmed(), get_unconfirmed_messages_as_list_copy(),
+   get_copy_of_nacked() called by thread, summing up all confirmers
+
+'''
+class ChannelPool(object):
+
+    '''
+    :param num_channels: Mandatory. How many channels to publish on.
+        Values below one are treated as one.
+    :param spool: Optional. Passed on to the confirmers.
+    :param thread: Optional. Passed on to the confirmers.
+    '''
+    def __init__(self, num_channels, spool=None, thread=None):
+        num_channels = max(1, num_channels)
+        self.__channels = [PublishingChannel(i, Confirmer(spool, thread)) for i in xrange(num_channels)]
+        self.__next = 0 # for spreading the messages without ordering key
+
+    def get_all(self):
+        return self.__channels[:]
+
+    '''
+    Choose the channel on which to publish a message.
+
+    :param ordering_key: The message's ordering key, or None.
+    :return: A PublishingChannel. If no channel is open, the
+        first one is returned (publishing on it will fail and
+        the message is put back).
+    '''
+    def get_channel_for(self, ordering_key=None):
+        num = len(self.__channels)
+        if ordering_key is not None:
+            pubchannel = self.__channels[hash(ordering_key) % num]
+            if pubchannel.is_open():
+                return pubchannel
+            logtrace(LOGGER, 'Channel %i for ordering key %s is not open.', pubchannel.number, ordering_key)
+
+        for i in xrange(num):
+            pubchannel = self.__channels[(self.__next + i) % num]
+            if pubchannel.is_open():
+                self.__next = (pubchannel.number + 1) % num
+                return pubchannel
+        return self.__channels[0]
+
+    def get_num_unconfirmed(self):
+        return sum(pubchannel.confirmer.get_num_unconfirmed() for pubchannel in self.__channels)
+
+    def get_unconfirmed_messages_as_list_copy(self):
+        messages = []
+        for pubchannel in self.__channels:
+            messages.extend(pubchannel.confirmer.get_unconfirmed_messages_as_list_copy())
+        return messages
+
+    def get_copy_of_nacked(self):
+        messages = []
+        for pubchannel in self.__channels:
+            messages.extend(pubchannel.confirmer.get_copy_of_nacked())
+        return messages
+
+'''
+One channel of the pool: The pika channel (None while it is
+not open), its confirmer and its delivery number.
+'''
+class PublishingChannel(object):
+
+    def __init__(self, number, confirmer):
+
+        ''' Position in the pool (not the pika channel number). '''
+        self.number = number
+
+        '''
+        An object of type "pika.channel.Channel", set by the
+        builder once it is open, and reset to None when it
+        was closed.
+        '''
+        self.channel = None
+
+        self.confirmer = confirmer
+
+        '''
+        The delivery number of the next message published on
+        this channel. It must be counted exactly like RabbitMQ
+        counts it on its side: Incremented at every successful
+        publish, reset to one when the channel is reopened.
+        (See the feeder).
+        '''
+        self.__delivery_number = 1
+
+    def is_open(self):
+        return self.channel is not None and self.channel.is_open
+
+    def get_delivery_number(self):
+        return self.__delivery_number
+
+    '''
+    Called by feeder, after a successful publish: Hands the
+    message to this channel's confirmer and increments the
+    delivery number.
+
+    :return: The delivery tag of the message.
+    '''
+    def put_to_unconfirmed_messages(self, message):
+        delivery_tag = self.__delivery_number
+        self.confirmer.put_to_unconfirmed_messages(delivery_tag, message)
+        self.__delivery_number += 1
+        return delivery_tag
+
+    '''
+    Called by builder, when this channel is reopened.
+    Before, the unconfirmed messages must be retrieved from
+    the confirmer to be republished!
+    '''
+    def reset(self):
+        self.__delivery_number = 1
+        self.confirmer.reset_unconfirmed_messages_and_delivery_tags()
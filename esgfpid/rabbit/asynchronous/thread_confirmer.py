@@ -1,5 +1,4 @@
 import logging
-import copy
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from .exceptions import UnknownServerResponse
 
@@ -15,6 +14,12 @@ The confirmer is responsible for handling the confirms sent by RabbitMQ.
 This is a quite simple module, it only reacts and does not trigger any
 other actions itself.
 
+When the last unconfirmed message was confirmed, it tells the thread
+(if it has a reference to it), so that a gentle finish that waits for
+pending messages can close down at once. It also tells the thread
+which messages were confirmed or rejected, for the completions that
+the library caller may be waiting for (see completion.py).
+
 It has a stack of unconfirmed messages (which is filled by the feeder,
 it puts every message it has successfully published into that stack).
 
@@ -25,18 +30,32 @@ extra stack.
 
 The unconfirmed messages can be retrieved from the confirmer to be republished.
 
+The stack is a dict keyed by the (integer) delivery tag, plus a low-water
+mark (no tag below it is unconfirmed) and a high-water mark (the highest
+tag handed over by the feeder). As the feeder hands over increasing tags,
+a confirm for "tag n and all below" only has to look at the tags between
+the low-water mark and n, and the low-water mark only ever moves up. So
+every ack/nack costs (amortised) time proportional to the number of
+messages it confirms, not to the number of messages in flight.
+
 API:
  * on_delivery_confirmation() is called by RabbitMQ.
  * reset_unconfirmed_messages_and_delivery_tags() called by builder, during reconnection
  * get_unconfirmed_messages_as_list_copy() called by builder, during reconnection
- * put_to_unconfirmed_delivery_tags() called by feeder, to fill the stack
- * put_to_unconfirmed_messages_dict() called by feeder, to fill the stack
+ * put_to_unconfirmed_messages() called by feeder, to fill the stack
 
 '''
 
 class Confirmer(object):
 
-    def __init__(self):
+    '''
+    :param spool: Optional. The on-disk spool (MessageSpool) in which
+        the confirmed messages have to be marked as confirmed.
+    :param thread: Optional. The RabbitThread, to be told when
+        no more messages are waiting for a confirm, and which
+        messages were confirmed or rejected.
+    '''
+    def __init__(self, spool=None, thread=None):
 
         # Logging:
         self.__first_confirm_receival = True
@@ -44,9 +63,12 @@ class Confirmer(object):
         self.__LOGFREQUENCY = 10
 
         # Stacks of unconfirmed/nacked messages:
-        self.__unconfirmed_delivery_tags = [] # only accessed internally
-        self.__unconfirmed_messages_dict = {} # dict, because I need to retrieve them by delivery tag (on ack/nack)
-        self.__nacked_messages = []           # only accessed internally, and from outside after thread is dead
+        self.__unconfirmed_messages = {} # dict, because I need to retrieve them by delivery tag (on ack/nack)
+        self.__low_water_mark = 1        # no unconfirmed delivery tag is lower than this
+        self.__high_water_mark = 0       # highest delivery tag that was handed over by the feeder
+        self.__nacked_messages = []      # only accessed internally, and from outside after thread is dead
+        self.__spool = spool
+        self.__thread = thread
 
     '''
     Callback, called by RabbitMQ.
@@ -68,6 +90,9 @@ class Confirmer(object):
             raise UnknownServerResponse(msg+':'+str(method_frame))
             # This should never happen, unless if I parse the server's response wrongly.
 
+        if len(self.__unconfirmed_messages) == 0 and self.__thread is not None:
+            self.__thread.finish_gently_if_nothing_pending()
+
     def __react_on_ack(self, deliv_tag, multiple):
         if self.__first_confirm_receival:
             self.__first_confirm_receival = False
@@ -90,14 +115,16 @@ class Confirmer(object):
             self.__nack_delivery_tag_and_message_single(deliv_tag)
 
     def __nack_delivery_tag_and_message_single(self, deliv_tag):
-        msg = self.__unconfirmed_messages_dict.pop(str(deliv_tag))
-        self.__nacked_messages.append(msg)
-        self.__unconfirmed_delivery_tags.remove(deliv_tag)
+        msg = self.__pop_unconfirmed_message(deliv_tag)
+        if msg is not None:
+            self.__nacked_messages.append(msg)
+            self.__report_to_thread([], [msg])
+        self.__raise_low_water_mark()
 
     def __nack_delivery_tag_and_message_several(self, deliv_tag):
-        for candidate_deliv_tag in copy.copy(self.__unconfirmed_delivery_tags):
-            if candidate_deliv_tag <= deliv_tag:
-                self.__nack_delivery_tag_and_message_single(candidate_deliv_tag)
+        nacked = self.__pop_unconfirmed_messages_up_to(deliv_tag)
+        self.__nacked_messages.extend(nacked)
+        self.__report_to_thread([], nacked)
 
     def __get_confirm_info(self, method_frame):
         try:
@@ -112,37 +139,92 @@ class Confirmer(object):
 
     def __react_on_single_delivery_ack(self, deliv_tag):
         self.__remove_delivery_tag_and_message_single(deliv_tag)
-        logdebug(LOGGER, 'Received ack for delivery tag %i. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed_delivery_tags))
+        logdebug(LOGGER, 'Received ack for delivery tag %i. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed_messages))
         logtrace(LOGGER, 'Received ack for delivery tag %i.', deliv_tag)
-        logtrace(LOGGER, 'Now left in queue to be confirmed: %i messages.', len(self.__unconfirmed_delivery_tags))
+        logtrace(LOGGER, 'Now left in queue to be confirmed: %i messages.', len(self.__unconfirmed_messages))
 
     def __react_on_multiple_delivery_ack(self, deliv_tag):
         self.__remove_delivery_tag_and_message_several(deliv_tag)
-        logdebug(LOGGER, 'Received ack for delivery tag %i and all below. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed_delivery_tags))
+        logdebug(LOGGER, 'Received ack for delivery tag %i and all below. Waiting for %i confirms.', deliv_tag, len(self.__unconfirmed_messages))
         logtrace(LOGGER, 'Received ack for delivery tag %i and all below.', deliv_tag)
-        logtrace(LOGGER, 'Now left in queue to be confirmed: %i messages.', len(self.__unconfirmed_delivery_tags))
+        logtrace(LOGGER, 'Now left in queue to be confirmed: %i messages.', len(self.__unconfirmed_messages))
 
     def __remove_delivery_tag_and_message_single(self, deliv_tag):
-        try:
-            self.__unconfirmed_delivery_tags.remove(deliv_tag)
-            ms = self.__unconfirmed_messages_dict.pop(str(deliv_tag))
+        ms = self.__pop_unconfirmed_message(deliv_tag)
+        if ms is not None:
             logtrace(LOGGER, 'Received ack for message %s.', ms)
-        except ValueError as e:
-            logdebug(LOGGER, 'Could not remove %i from unconfirmed.', deliv_tag)
+            self.__confirm_in_spool([ms])
+            self.__report_to_thread([ms], [])
+        self.__raise_low_water_mark()
 
     def __remove_delivery_tag_and_message_several(self, deliv_tag):
-        for candidate_deliv_tag in copy.copy(self.__unconfirmed_delivery_tags):
-            if candidate_deliv_tag <= deliv_tag:
-                self.__remove_delivery_tag_and_message_single(candidate_deliv_tag)
+        confirmed = self.__pop_unconfirmed_messages_up_to(deliv_tag)
+        for ms in confirmed:
+            logtrace(LOGGER, 'Received ack for message %s.', ms)
+        self.__confirm_in_spool(confirmed)
+        self.__report_to_thread(confirmed, [])
 
+    '''
+    Acked messages do not have to be published again, so
+    they are marked as confirmed in the spool (if any).
+    Nacked messages are left in the spool.
+    '''
+    def __confirm_in_spool(self, messages):
+        if self.__spool is not None and len(messages) > 0:
+            self.__spool.confirm_many(messages)
 
-    ''' Called by unit test.'''
+    def __report_to_thread(self, acked, nacked):
+        if self.__thread is not None and len(acked)+len(nacked) > 0:
+            self.__thread.report_confirms(acked, nacked)
+
+    '''
+    Removes one message from the stack.
+
+    :return: The message, or None if there was no
+        unconfirmed message with this delivery tag.
+    '''
+    def __pop_unconfirmed_message(self, deliv_tag):
+        try:
+            return self.__unconfirmed_messages.pop(deliv_tag)
+        except KeyError:
+            logdebug(LOGGER, 'Could not remove %i from unconfirmed.', deliv_tag)
+            return None
+
+    '''
+    Removes all messages with this delivery tag and below from
+    the stack, and returns them in the order they were published.
+
+    Only the tags between the low-water mark and the given tag
+    are visited. Afterwards, the low-water mark is above the
+    given tag, so these tags are never visited again.
+    '''
+    def __pop_unconfirmed_messages_up_to(self, deliv_tag):
+        popped = []
+        highest = min(deliv_tag, self.__high_water_mark)
+        for candidate_deliv_tag in xrange(self.__low_water_mark, highest+1):
+            msg = self.__unconfirmed_messages.pop(candidate_deliv_tag, None)
+            if msg is not None:
+                popped.append(msg)
+        self.__low_water_mark = max(self.__low_water_mark, highest+1)
+        self.__raise_low_water_mark()
+        return popped
+
+    '''
+    Moves the low-water mark up to the lowest tag that is still
+    unconfirmed (or to above the high-water mark, if none is).
+    '''
+    def __raise_low_water_mark(self):
+        while (self.__low_water_mark <= self.__high_water_mark and
+               self.__low_water_mark not in self.__unconfirmed_messages):
+            self.__low_water_mark += 1
+
+    ''' Called by unit test, by shutter (via thread).'''
     def get_num_unconfirmed(self):
-        return len(self.__unconfirmed_messages_dict)
+        return len(self.__unconfirmed_messages)
 
     ''' Called by unit test.'''
     def get_copy_of_unconfirmed_tags(self):
-        return self.__unconfirmed_delivery_tags[:]
+        return [tag for tag in self.__get_window() if tag in self.__unconfirmed_messages]
 
     '''
     Called by the main thread, for rescuing, after joining.
@@ -154,16 +236,13 @@ class Confirmer(object):
     '''
     Called by feeder, to let the confirmer know which had been sent.
     '''
-    def put_to_unconfirmed_delivery_tags(self, delivery_tag):
-        logtrace(LOGGER, 'Adding delivery tag %i to unconfirmed.', delivery_tag)
-        self.__unconfirmed_delivery_tags.append(delivery_tag)
-
-    '''
-    Called by feeder, to let the confirmer know which had been sent.
-    '''
-    def put_to_unconfirmed_messages_dict(self, delivery_tag, msg):
+    def put_to_unconfirmed_messages(self, delivery_tag, msg):
         logtrace(LOGGER, 'Adding message with delivery tag %i to unconfirmed: %s', delivery_tag, msg)
-        self.__unconfirmed_messages_dict[str(delivery_tag)] = msg
+        if len(self.__unconfirmed_messages) == 0:
+            self.__low_water_mark = delivery_tag
+        self.__unconfirmed_messages[delivery_tag] = msg
+        self.__low_water_mark = min(self.__low_water_mark, delivery_tag)
+        self.__high_water_mark = max(self.__high_water_mark, delivery_tag)
 
     '''
     This resets which messages had not be confirmed yet.
@@ -190,8 +269,9 @@ class Confirmer(object):
 
     '''
     def reset_unconfirmed_messages_and_delivery_tags(self):
-        self.__unconfirmed_delivery_tags = []
-        self.__unconfirmed_messages_dict = {}
+        self.__unconfirmed_messages = {}
+        self.__low_water_mark = 1
+        self.__high_water_mark = 0
 
     '''
     Called by builder, during reconnection,
@@ -202,11 +282,19 @@ class Confirmer(object):
     Also called by the main thread, for rescuing messages
     after joining.
 
+    The messages are returned in the order they were
+    published.
+
     As dict objects are not thread-safe, better call
     this only after joining.
     '''
     def get_unconfirmed_messages_as_list_copy(self):
         newlist = []
-        for deliv_tag,message in self.__unconfirmed_messages_dict.iteritems():
-            newlist.append(message)
+        for deliv_tag in self.__get_window():
+            message = self.__unconfirmed_messages.get(deliv_tag)
+            if message is not None:
+                newlist.append(message)
         return newlist
+
+    def __get_window(self):
+        return xrange(self.__low_water_mark, self.__high_water_mark+1)
@@ -1,4 +1,5 @@
 import logging
+import math
 import pika
 import Queue
 from .. import rabbitutils
@@ -8,6 +9,21 @@ from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_ev
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+'''
+Returns how many "publish_message" events are needed to publish
+a number of messages, given that every event publishes a batch.
+
+Note: If batches are cut short by the byte limit, the feeder
+schedules the following batches itself, so this does not need
+to be exact.
+
+:param num_messages: Number of messages to be published.
+:return: Number of publish events (integer).
+'''
+def get_num_publish_events_needed(num_messages):
+    batch_size = max(1, defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES)
+    return int(math.ceil(float(num_messages)/batch_size))
+
 '''
 The RabbitFeeder is responsible for publishing messages to RabbitMQ.
 
@@ -15,6 +31,13 @@ It is very simple. Basically the only method it exposes
 (except for some simple getter/setter which is rarely ever used)
 is publish_message(), which is called from the main thread.
 
+Every call of publish_message() drains a batch of messages from
+the Queue of unpublished messages: It publishes messages until the
+Queue is empty or until the batch budget (number of messages and/or
+bytes, see defaults) is used up. If the budget is used up and there
+are messages left, it asks the thread to schedule another batch,
+so that the ioloop can process confirms and heartbeats in between.
+
 '''
 class RabbitFeeder(object):
 
@@ -36,14 +59,28 @@ class RabbitFeeder(object):
 
         It makes sure that rabbit server and this client talk about the
         same message.
-        NEVER EVER INCREMENT OR OTHERWISE MODIFY THIS!
+        NEVER EVER INCREMENT OR OTHERWISE MODIFY IT, except after a
+        successful publish!
 
         From the RabbitMQ docs:
         "The delivery tag is valid only within the channel from which
         the message was received. I.e. a client MUST NOT receive a
         message on one channel and then acknowledge it on another."
-        Source: https://www.rabbitmq.com/amqp-0-9-1-reference.html '''
-        self.__delivery_number = 1
+        Source: https://www.rabbitmq.com/amqp-0-9-1-reference.html
+
+        So the delivery number is kept per channel, by the publishing
+        channel objects (see thread_channels). Here we only count all
+        published messages, for logging.'''
+        self.__num_published = 0
+
+        '''
+        The budget for one batch, i.e. for one publish_message()
+        call. If the number of messages or the number of bytes
+        is reached, the feeder gives control back to the ioloop.
+        The byte limit may be None (no limit).
+        '''
+        self.__batch_max_messages = max(1, defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES)
+        self.__batch_max_bytes = defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_BYTES
 
         # Logging
         self.__first_publication_trigger = True
@@ -54,14 +91,14 @@ class RabbitFeeder(object):
         self.__have_not_warned_about_force_close_yet = True
 
     '''
-    Triggers the publication of one message to RabbitMQ, if the
-    state machine currently allows this.
+    Triggers the publication of a batch of messages to RabbitMQ,
+    if the state machine currently allows this.
 
-    The message is fetched from the Queue of unpublished messages.
+    The messages are fetched from the Queue of unpublished messages.
 
     So far, whenever the library wants to publish messages, it
-    fires as many of these "publish_message" events as messages
-    were published (and some extra, to be sure).
+    fires as many of these "publish_message" events as batches
+    are needed for the messages (and some extra, to be sure).
     If some of these triggers cannot be acted upon, as the module
     is not in a state where it is allowed to publish, the triggers
     should be fired as soon as the module is in available state
@@ -93,7 +130,7 @@ class RabbitFeeder(object):
         elif self.statemachine.is_AVAILABLE() or self.statemachine.is_AVAILABLE_BUT_WANTS_TO_STOP():
             log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Received trigger for publishing message to RabbitMQ (trigger %i).', self.__logcounter_trigger)
             self.__log_publication_trigger()
-            self.__publish_message_to_channel()
+            self.__publish_batch_to_channel()
 
         elif self.statemachine.is_PERMANENTLY_UNAVAILABLE():
             log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Received late trigger for feeding the rabbit (trigger %i).', self.__logcounter_trigger)
@@ -125,9 +162,43 @@ class RabbitFeeder(object):
                     logwarn(LOGGER, 'Could not publish message(s) to RabbitMQ. The sender was closed by the user.')
                     self.__have_not_warned_about_force_close_yet = False
         else:
-            if self.thread._channel is None:
+            if self.thread.get_publishing_channel(None).channel is None:
                 logerror(LOGGER, 'Very unexpected. Could not publish message(s) to RabbitMQ. There is no channel.')
 
+    '''
+    Publishes messages from the stack until the stack is empty,
+    until a publish fails, or until the batch budget is used up.
+
+    If the budget is used up and messages are left, another batch
+    is scheduled on the ioloop (instead of publishing them right
+    away), so that confirms and heartbeats are not starved.
+    '''
+    def __publish_batch_to_channel(self):
+        num_published = 0
+        num_bytes = 0
+        while True:
+            body_size = self.__publish_message_to_channel()
+            if body_size is None:
+                break # Queue empty or publish failed
+
+            num_published += 1
+            num_bytes += body_size
+            if self.__is_batch_budget_used_up(num_published, num_bytes):
+                if self.thread.get_num_unpublished() > 0:
+                    logtrace(LOGGER, 'Batch budget used up after %i messages (%i bytes). Scheduling next batch.', num_published, num_bytes)
+                    self.thread.add_event_publish_next_batch()
+                break
+
+        if num_published > 1:
+            logtrace(LOGGER, 'Published %i messages (%i bytes) in one batch.', num_published, num_bytes)
+
+    def __is_batch_budget_used_up(self, num_published, num_bytes):
+        if num_published >= self.__batch_max_messages:
+            return True
+        if self.__batch_max_bytes is not None and num_bytes >= self.__batch_max_bytes:
+            return True
+        return False
+
     '''
     Retrieves a message from stack and tries to publish it
     to RabbitMQ.
@@ -138,6 +209,9 @@ class RabbitFeeder(object):
     Note: The publish may cause an error if the Channel was closed.
     A closed Channel should be handled in the on_channel_close()
     callback, but we catch it here in case the clean up was not quick enough.
+
+    :return: The size of the published body (in bytes), or None if
+        no message was published.
     '''
     def __publish_message_to_channel(self):
 
@@ -147,32 +221,42 @@ class RabbitFeeder(object):
             message = self.__get_message_from_stack()
         except Queue.Empty as e:
             logtrace(LOGGER, 'Queue empty. No more messages to be published.')
-            return
+            return None
+
+        # Choose the channel to publish it on:
+        try:
+            envelope = rabbitutils.make_message_envelope(message)
+        except ValueError as e:
+            logwarn(LOGGER, 'Message was not published. Putting back to queue. Reason: %s: "%s"',e.__class__.__name__, e.message)
+            self.thread.put_one_message_into_queue_of_unsent_messages(message)
+            raise e
+        pubchannel = self.thread.get_publishing_channel(envelope.ordering_key)
 
         # Now try to publish it.
         # If anything goes wrong, you need to put it back to
         # the stack of unpublished messages!
         try:
-            success = self.__try_publishing_otherwise_put_back_to_stack(message)
-            if success:
-                self.__postparations_after_successful_feeding(message)
+            self.__try_publishing_otherwise_put_back_to_stack(message, envelope, pubchannel)
+            self.__postparations_after_successful_feeding(envelope, pubchannel)
+            return len(envelope.body)
 
         # Treat various errors that may occur during publishing:
         except pika.exceptions.ChannelClosed as e:
-            logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because the Channel is closed (%s)', self.__delivery_number+1, e.message)
+            logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because the Channel is closed (%s)', self.__num_published+1, e.message)
 
         except AttributeError as e:
-            if self.thread._channel is None:
-                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because there is no channel.', self.__delivery_number+1)
+            if pubchannel.channel is None:
+                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ because there is no channel.', self.__num_published+1)
             else:
-                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ (unexpected error %s:%s)', self.__delivery_number+1, e.__class__.__name__, e.message)
+                logwarn(LOGGER, 'Cannot publish message %i to RabbitMQ (unexpected error %s:%s)', self.__num_published+1, e.__class__.__name__, e.message)
 
         except AssertionError as e:
-            logwarn(LOGGER, 'Cannot publish message to RabbitMQ %i because of AssertionError: "%s"', self.__delivery_number+1,e)
+            logwarn(LOGGER, 'Cannot publish message to RabbitMQ %i because of AssertionError: "%s"', self.__num_published+1,e)
             if e.message == 'A non-string value was supplied for self.exchange':
                 exch = self.thread.get_exchange_name()
                 logwarn(LOGGER, 'Exchange was "%s" (type %s)', exch, type(exch))
 
+        return None
 
     '''
     Retrieve an unpublished message from stack.
@@ -190,30 +274,35 @@ class RabbitFeeder(object):
     This tries to publish the message and puts it back into the
     Queue if it failed.
 
-    :param message: Message to be sent.
+    The messages are usually serialized already (by the
+    thread that sent them). Only messages that were put into
+    the stack as JSON string or dictionary are serialized here.
+
+    :param message: Message as it was taken from the stack
+        (to be put back if the publish fails).
+    :param envelope: The message as envelope.
+    :param pubchannel: The PublishingChannel to publish on.
     :raises: pika.exceptions.ChannelClosed, if the Channel is closed.
     '''
-    def __try_publishing_otherwise_put_back_to_stack(self, message):
+    def __try_publishing_otherwise_put_back_to_stack(self, message, envelope, pubchannel):
         try:
             # Getting message info:
             properties = self.nodemanager.get_properties_for_message_publications()
-            routing_key, msg_string = rabbitutils.get_routing_key_and_string_message_from_message_if_possible(message)
-            routing_key = routing_key+'.'+self.thread.get_open_word_for_routing_key()
+            routing_key = envelope.routing_key+'.'+self.thread.get_open_word_for_routing_key()
             
             # Logging
-            logtrace(LOGGER, 'Publishing message %i (key %s) (body %s)...', self.__delivery_number+1, routing_key, msg_string) # +1 because it will be incremented after the publish.
+            logtrace(LOGGER, 'Publishing message %i (key %s) (body %s)...', self.__num_published+1, routing_key, envelope.body) # +1 because it will be incremented after the publish.
             log_every_x_times(LOGGER, self.__logcounter_trigger, self.__LOGFREQUENCY, 'Trying actual publish... (trigger no. %i).', self.__logcounter_trigger)
-            logtrace(LOGGER, '(Publish to channel no. %i).', self.thread._channel.channel_number)
+            logtrace(LOGGER, '(Publish to channel no. %i, delivery number %i).', pubchannel.channel.channel_number, pubchannel.get_delivery_number())
 
             # Actual publish to exchange
-            self.thread._channel.basic_publish(
+            pubchannel.channel.basic_publish(
                 exchange=self.thread.get_exchange_name(),
                 routing_key=routing_key,
-                body=msg_string,
+                body=envelope.body,
                 properties=properties,
                 mandatory=defaults.RABBIT_MANDATORY_DELIVERY
             )
-            return True
 
         # If anything went wrong, put it back into the stack of
         # unpublished messages before re-raising the exception
@@ -227,39 +316,21 @@ class RabbitFeeder(object):
 
     '''
     If a publish was successful, pass it to the confirmer module
-    and in increment delivery_number for the next message.
+    of its channel, which also increments the channel's delivery
+    number for the next message.
     '''
-    def __postparations_after_successful_feeding(self, msg):
+    def __postparations_after_successful_feeding(self, msg, pubchannel):
 
-        # Pass the successfully published message and its delivery_number
-        # to the confirmer module, to wait for its confirmation.
-        # Increase the delivery number for the next message.
-        self.thread.put_to_unconfirmed_delivery_tags(self.__delivery_number)
-        self.thread.put_to_unconfirmed_messages_dict(self.__delivery_number, msg)
-        self.__delivery_number += 1
+        # Pass the successfully published message to the channel,
+        # which hands it to its confirmer (with its delivery_number),
+        # to wait for its confirmation.
+        pubchannel.put_to_unconfirmed_messages(msg)
+        self.__num_published += 1
 
         # Logging
         self.__logcounter_success += 1
         log_every_x_times(LOGGER, self.__logcounter_success, self.__LOGFREQUENCY, 'Actual publish to channel done (trigger no. %i, publish no. %i).', self.__logcounter_trigger, self.__logcounter_success)
-        logtrace(LOGGER, 'Publishing messages %i to RabbitMQ... done.', self.__delivery_number-1)
-        if (self.__delivery_number-1 == 1):
+        logtrace(LOGGER, 'Publishing messages %i to RabbitMQ... done.', self.__num_published)
+        if (self.__num_published == 1):
             loginfo(LOGGER, 'First message published to RabbitMQ.')
-        logdebug(LOGGER, 'Message published (no. %i)', self.__delivery_number-1)
-
-    '''
-    Reset the delivery_number for the messages.
-    This must be called on a reconnection / channel reopen!
-    And may not be called during any other situation!
-
-    The number is not sent along to the RabbitMQ server, but
-    the server keeps track of the delivery number
-    separately on its side.
-
-    That's why it is important to make sure it is incremented
-    and reset exactly the same way (incremented at each successfully
-    published message, and reset to one at channel reopen).
-
-    (called by the builder during reconnection / channel reopen).
-    '''
-    def reset_delivery_number(self):
-        self.__delivery_number = 1
+        logdebug(LOGGER, 'Message published (no. %i)', self.__num_published)
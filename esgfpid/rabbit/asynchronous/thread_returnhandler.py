@@ -3,6 +3,7 @@ import pika
 import json
 import esgfpid.defaults as defaults
 import esgfpid.assistant.messages
+from .. import rabbitutils
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 
 LOGGER = logging.getLogger(__name__)
@@ -54,7 +55,7 @@ class UnacceptedMessagesHandler(object):
         try:
             body_json = json.loads(body)
             body_json = self.__add_emergency_routing_key(body_json)
-            self.__resend_an_unroutable_message(json.dumps(body_json))
+            self.__resend_an_unroutable_message(rabbitutils.make_message_envelope(body_json))
         except pika.exceptions.ChannelClosed as e:
             logdebug(LOGGER, 'Error during "on_message_not_accepted": %s: %s', e.__class__.__name__, e.message)
             logerror(LOGGER, 'Could not resend message: %s: %s', e.__class__.__name__, e.message)
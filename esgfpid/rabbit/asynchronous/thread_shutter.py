@@ -1,5 +1,6 @@
 import logging
 import esgfpid.defaults as defaults
+from .thread_feeder import get_num_publish_events_needed
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
 from esgfpid.utils import get_now_utc_as_formatted_string as get_now_utc_as_formatted_string
 import time
@@ -27,6 +28,12 @@ class ShutDowner(object):
         '''
         self.__is_in_process_of_gently_closing = False
 
+        '''
+        Point in time (seconds since epoch) at which a gentle
+        finish stops waiting for pending messages.
+        '''
+        self.__finish_deadline = None
+
     ####################
     ### Force finish ###
     ####################
@@ -42,27 +49,34 @@ class ShutDowner(object):
     ### Gentle finish ###
     #####################
 
-    def finish_gently(self):
+    '''
+    The gentle finish is event-driven: If messages are pending,
+    the thread does not sleep and recheck, but closes as soon as
+    the confirmer tells (via the thread) that the last pending
+    message was confirmed (see :func:`finish_gently_if_nothing_pending`).
+
+    Only in case an event was lost (e.g. during a reconnection),
+    or the module stopped progressing, or the deadline passed,
+    a (rare) safety check decides about closing.
+
+    :param timeout: Optional. Maximum number of seconds to wait for
+        pending messages. Defaults to RABBIT_ASYN_FINISH_MAX_WAIT_SECONDS.
+    '''
+    def finish_gently(self, timeout=None):
         try:
-            return self.__finish_gently()
+            return self.__finish_gently(timeout)
         except Exception as e:
             logwarn(LOGGER, 'Error in shutter.finish_gently(): %s: %s', e.__class__.__name__, e.message)
             raise e
 
-    def __finish_gently(self):
-        # Called directly from outside the thread!
-        #self.statemachine.asked_to_closed_by_publisher = True # TODO
-
-        # Make sure no more messages are accepted from publisher # TODO
-        # while publishes/confirms are still accepted:
-        #if self.statemachine.is_available_for_client_publishes():
-        #    self.statemachine.set_to_wanting_to_stop()
+    def __finish_gently(self, timeout):
+        if timeout is None:
+            timeout = defaults.RABBIT_ASYN_FINISH_MAX_WAIT_SECONDS
+        self.__finish_deadline = time.time() + timeout
 
         # Inform user
         if self.__are_any_messages_pending():
-            wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
-            max_waits = defaults.RABBIT_ASYN_FINISH_MAX_TRIES
-            loginfo(LOGGER, 'Preparing to close PID module. Some messages are pending. Maximum waiting time: %i seconds. (%s)', wait_seconds*max_waits, get_now_utc_as_formatted_string())
+            loginfo(LOGGER, 'Preparing to close PID module. Some messages are pending. Maximum waiting time: %.1f seconds. (%s)', timeout, get_now_utc_as_formatted_string())
         else:
             loginfo(LOGGER, 'Closing PID module. No pending messages. (%s)', get_now_utc_as_formatted_string())
 
@@ -70,21 +84,33 @@ class ShutDowner(object):
         self.__close_decision_iterations = 1
         self.__is_in_process_of_gently_closing = True
         self.recursive_decision_about_closing()
-        # This iteratively checks if all messages are published+confirmed.
-        # If not, it waits and then rechecks, up to a maximum number of iterations.
-        # THe main thread waits for this by using a threading.Event.
+        # If messages are pending, this returns and the thread continues
+        # publishing and receiving confirms. The main thread waits for the
+        # end of the gentle finish by using a threading.Event.
+
+    '''
+    Called by confirmer (via thread), whenever the last unconfirmed
+    message was confirmed. This is what ends a gentle finish
+    without any waiting.
+    '''
+    def finish_gently_if_nothing_pending(self):
+        if self.__is_in_process_of_gently_closing and not self.__are_any_messages_pending():
+            logdebug(LOGGER, 'Gentle finish: Last pending message was confirmed.')
+            self.__close_because_all_done(self.__close_decision_iterations)
 
     ''' Called by builder (via thread), so close-events are not lost if a new ioloop is started.'''
     def continue_gently_closing_if_applicable(self):
         if self.__is_in_process_of_gently_closing:
             logdebug(LOGGER, 'Continue gentle shutdown even after reconnect (iteration %i)...', self.__close_decision_iterations)
             if self.thread._connection is not None:
-                wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
-                self.thread._connection.add_timeout(wait_seconds, self.recursive_decision_about_closing)
+                self.thread._connection.add_timeout(0, self.recursive_decision_about_closing)
             else:
                 logerror(LOGGER, 'Connection was None when trying to wait for pending messages (after reconnect). Synchronization error between threads!')
 
     def recursive_decision_about_closing(self):
+        if not self.__is_in_process_of_gently_closing:
+            logdebug(LOGGER, 'Gentle finish: Already closed.')
+            return
         logdebug(LOGGER, 'Gentle finish (iteration %i): Deciding about whether we can close the thread or not...', self.__close_decision_iterations)
         iteration = self.__close_decision_iterations
         if self.__are_any_messages_pending():
@@ -104,36 +130,26 @@ class ShutDowner(object):
             # were lost during reconnecting or something...
             num_unpub = self.thread.get_num_unpublished()
             logdebug(LOGGER, 'Triggering %i publish events...' % num_unpub)
-            for i in xrange(int(1.1*num_unpub)):
+            for i in xrange(get_num_publish_events_needed(int(1.1*num_unpub))):
                 self.thread.add_event_publish_message()
-            # Now wait some more...
+            # Now wait for the confirms (or the safety check)...
             self.__wait_some_more_and_redecide(iteration)
 
     # Decision rules:
 
     def __have_we_waited_enough_now(self, iteration):
         logdebug(LOGGER, 'Gentle finish (iteration %i): Check if the rabbit thread has waited long enough...', self.__close_decision_iterations)
-
-        wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
-        max_waits = defaults.RABBIT_ASYN_FINISH_MAX_TRIES
-
-        tried = iteration
-        waited = iteration-1
-
-        # Logging:
-        logdebug(LOGGER, 'Gentle finish (iteration %i): At this point we have tried %i times and waited %i/%i times (%i seconds)', self.__close_decision_iterations, tried, waited, max_waits, waited*wait_seconds)
-        log_every_x_seconds = 2
-        if ((waited*wait_seconds)%log_every_x_seconds==0 or waited>=max_waits):
+        remaining = self.__get_remaining_seconds()
+        if remaining <= 0:
             msg = self.__get_string_about_pending_messages()
-            loginfo(LOGGER, 'Still pending: %s messages... (waited %.1f/%.1f seconds)', msg, waited*wait_seconds, max_waits*wait_seconds)
-        
-        # Return:
-        if waited >= max_waits:
-            logdebug(LOGGER, 'Gentle finish (iteration %i): The rabbit thread has waited long enough for pending messages at close down.', self.__close_decision_iterations)
+            loginfo(LOGGER, 'Still pending: %s messages. The rabbit thread has waited long enough for pending messages at close down.', msg)
             return True
-        logdebug(LOGGER, 'Gentle finish (iteration %i): We should wait a little more for pending messages.', self.__close_decision_iterations)
+        logdebug(LOGGER, 'Gentle finish (iteration %i): We should wait a little more for pending messages (%.1f seconds left).', self.__close_decision_iterations, remaining)
         return False
 
+    def __get_remaining_seconds(self):
+        return self.__finish_deadline - time.time()
+
     def __are_any_messages_pending(self):
         logdebug(LOGGER, 'Gentle finish (iteration %i): Checking for any pending messages...', self.__close_decision_iterations)
         sent_done = self.__check_all_were_sent()
@@ -163,8 +179,14 @@ class ShutDowner(object):
             return True
         return False
 
+    '''
+    The thread is not blocked while waiting. Normally, the confirmer
+    ends the waiting. This safety check is only needed in case no
+    confirm arrives (e.g. events were lost, or the connection is not
+    available), and to enforce the deadline.
+    '''
     def __wait_some_more_and_redecide(self, iteration):
-        wait_seconds = defaults.RABBIT_ASYN_FINISH_WAIT_SECONDS
+        wait_seconds = min(defaults.RABBIT_ASYN_FINISH_SAFETY_CHECK_SECONDS, max(self.__get_remaining_seconds(), 0))
         logdebug(LOGGER, 'Gentle finish (iteration %i): Waiting some more for pending messages...', self.__close_decision_iterations)
         # Instead of time.sleep(), add an event to the thread's ioloop
         self.__close_decision_iterations += 1
@@ -176,13 +198,9 @@ class ShutDowner(object):
             # So, during a reconnection, we check if gently-finish was running,
             # and add a new timeout to the new ioloop, using
             # "continue_gently_closing_if_applicable()".
-            # This may mess up the amount of time the gently-finish takes, though.
-            # TODO Maybe one day it is possible to transfer events from one ioloop to
-            # another?
         else:
             logerror(LOGGER, 'Connection was None when trying to wait for pending messages. Synchronization error between threads!')
 
-    
     def __tell_publisher_to_stop_waiting_for_gentle_finish(self):
         logdebug(LOGGER, 'Main thread does not need to wait anymore. (%s).', get_now_utc_as_formatted_string())
 
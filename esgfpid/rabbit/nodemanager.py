@@ -1,7 +1,11 @@
+import os
 import pika
 import copy
+import json
 import logging
+import time
 import random
+import threading
 import esgfpid.defaults
 import esgfpid.exceptions
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn, log_every_x_times
@@ -28,16 +32,37 @@ responsible for providing this info to the library.
 It can deal with trusted and open nodes and with integer
 priorities. It returns the instance access info dictionaries
 in a well-defined order, 
+
+Among nodes of the same priority, the healthiest and fastest
+node is used first: The connection modules report the duration
+of every successful connection attempt and every failure, and
+the node manager keeps an exponentially weighted moving average
+(EWMA) of the connect latency and the number of consecutive
+failures per host. The socket timeout of each node is adapted
+to its observed latency. The scores can be stored in a small
+state file, so the next process starts with the best node.
+
+Every node also has a circuit breaker: After a number of
+consecutive failures, its circuit is "open" and the node is
+skipped without any connection attempt. After a cool-down,
+it is "half-open": One connection attempt (probe) is allowed.
+If it succeeds, the circuit is "closed" again, otherwise it
+stays open for another cool-down. If a state file is used, the
+circuits are shared by all processes that use the same file.
 '''
 class NodeManager(object):
 
     '''
-    Constructor that takes no params. It creates an empty
-    container for RabbitMQ node information. The node 
-    information then has to be added using "add_trusted_node()"
-    and "add_open_node()".
+    Constructor. It creates an empty container for RabbitMQ
+    node information. The node information then has to be
+    added using "add_trusted_node()" and "add_open_node()".
+
+    :param state_file: Optional. Path of a JSON file in which
+        the latency and failure scores of the nodes are kept
+        across processes. Defaults to RABBIT_NODE_STATE_FILE
+        (None means the scores are only kept in memory).
     '''
-    def __init__(self):
+    def __init__(self, state_file=None):
 
         # Props for basic_publish (needed by thread_feeder)
         self.__properties = pika.BasicProperties(
@@ -62,9 +87,27 @@ class NodeManager(object):
         # Current node
         self.__current_node = None
 
+        # Nodes that are tried at the same time (by host),
+        # see get_candidate_connection_parameters()
+        self.__candidate_nodes = {}
+
         # Important info
         self.__has_trusted = False
 
+        # Latency and failure scores, by host:
+        # self.__node_stats = {
+        #     "foo.org": {"latency": 0.03, "failures": 0, "opened_at": None}
+        # }
+        # "latency" is the EWMA of the connect time in seconds (None
+        # if never connected), "failures" counts the failed attempts
+        # since the last success, "opened_at" is the time when the
+        # circuit breaker was opened (or the last probe started), or
+        # None if it is closed.
+        if state_file is None:
+            state_file = esgfpid.defaults.RABBIT_NODE_STATE_FILE
+        self.__state_file = state_file
+        self.__node_stats = self.__load_node_stats()
+
     '''
     Add information about a trusted RabbitMQ node to
     the container, for later use.
@@ -199,11 +242,97 @@ class NodeManager(object):
             self.set_next_host()
         if self.__current_node['is_open']:
             raise ArgumentError('Open nodes no longer supported! (Messaging service "'+credentials['url']+'")')
-        return self.__current_node['params']
+        params = self.__current_node['params']
+        params.socket_timeout = self.__get_socket_timeout(self.__current_node['host'])
+        return params
+
+    '''
+    Return the connection parameters for the current RabbitMQ
+    host and the next ones, so that connections to several of
+    them can be tried at the same time. The last of them is the
+    current host afterwards, until :func:`select_candidate` is
+    called.
+
+    :param num: Maximum number of candidates.
+    :return: List of connection parameters (of type
+        pika.ConnectionParameters), in the order in which the
+        nodes would have been tried one after the other.
+    '''
+    def get_candidate_connection_parameters(self, num):
+        if self.__current_node is None:
+            self.set_next_host()
+        candidates = [self.__current_node]
+        while len(candidates) < num and self.has_more_urls():
+            self.set_next_host()
+            candidates.append(self.__current_node)
+        self.__candidate_nodes = dict((node_info['host'], node_info) for node_info in candidates)
+        list_of_params = []
+        for node_info in candidates:
+            self.__set_current(node_info) # for the socket timeout of each node
+            list_of_params.append(self.get_connection_parameters())
+        return list_of_params
+
+    '''
+    Make one of the candidates (see
+    :func:`get_candidate_connection_parameters`)
+    the current host, e.g. the first one that
+    could be connected to.
+
+    :param host: The host of the candidate.
+    '''
+    def select_candidate(self, host):
+        self.__set_current(self.__candidate_nodes[host])
+
+    def __set_current(self, node_info):
+        self.__current_node = node_info
+        self.__exchange_name = node_info['exchange_name']
+
+    '''
+    For the active-active mode: Returns one NodeManager for
+    every trusted node of the best priority, containing only
+    this node (so that one connection can be kept to each).
+
+    Nodes whose circuit is open are left out, unless the
+    circuits of all of them are open. The new NodeManagers
+    share the state file with this one.
+
+    :return: List of NodeManager objects (at least one). If
+        there are no trusted nodes, the list contains only this
+        NodeManager.
+    '''
+    def get_node_managers_for_active_nodes(self):
+        self.__refresh_node_stats()
+        if len(self.__trusted_nodes_archive) == 0:
+            return [self]
+        priorities = self.__trusted_nodes_archive.keys()
+        priorities.sort(key=natural_keys)
+        best_nodes = self.__trusted_nodes_archive[priorities[0]]
+        active_nodes = [node_info for node_info in best_nodes if self.get_circuit_state(node_info['host']) != 'open']
+        if len(active_nodes) == 0:
+            logwarn(LOGGER, 'Circuits of all RabbitMQ nodes are open. Using all of them anyway.')
+            active_nodes = best_nodes
+
+        node_managers = []
+        for node_info in active_nodes:
+            priority = node_info['priority']
+            if priority == 'zzzz_last':
+                priority = None
+            node_manager = NodeManager(self.__state_file)
+            node_manager.add_trusted_node(
+                username=node_info['username'],
+                password=node_info['password'],
+                host=node_info['host'],
+                exchange_name=node_info['exchange_name'],
+                priority=priority,
+                vhost=node_info.get('vhost')
+            )
+            node_managers.append(node_manager)
+        logdebug(LOGGER, 'Active nodes: %s', ', '.join(node_info['host'] for node_info in active_nodes))
+        return node_managers
 
     '''
     Simple getter to find out if any URLs are
-    left.
+    left. Nodes whose circuit is open do not count.
 
     TODO: Needed for what, as we start over
     once all have been used? There is no end!
@@ -212,8 +341,10 @@ class NodeManager(object):
     '''
 
     def has_more_urls(self):
-        if self.get_num_left_urls() > 0:
-            return True
+        for list_of_nodes in self.__trusted_nodes.values() + self.__open_nodes.values():
+            for node_info in list_of_nodes:
+                if not self.get_circuit_state(node_info['host']) == 'open':
+                    return True
         return False
 
     '''
@@ -257,11 +388,11 @@ class NodeManager(object):
     def set_next_host(self):
 
         if len(self.__trusted_nodes) > 0:
-            self.__current_node = self.__get_highest_priority_node(self.__trusted_nodes)
+            self.__current_node = self.__get_next_available_node(self.__trusted_nodes)
             logdebug(LOGGER, 'Selected a trusted node: %s', self.__current_node['host'])
 
         elif len(self.__open_nodes) > 0:
-            self.__current_node = self.__get_highest_priority_node(self.__open_nodes)
+            self.__current_node = self.__get_next_available_node(self.__open_nodes)
             logdebug(LOGGER, 'Selected an open node: %s', self.__current_node['host'])
 
         else:
@@ -269,6 +400,29 @@ class NodeManager(object):
 
         self.__exchange_name = self.__current_node['exchange_name']
 
+    '''
+    Return the node with the highest priority whose circuit
+    breaker allows a connection attempt. The nodes that are
+    skipped are removed from the rotation, just like nodes
+    that were tried.
+
+    If the circuits of all nodes are open, the one that was
+    opened first is returned anyway, so there is always a
+    node to try.
+    '''
+    def __get_next_available_node(self, dict_of_nodes):
+        self.__refresh_node_stats()
+        skipped = []
+        while len(dict_of_nodes) > 0:
+            node_info = self.__get_highest_priority_node(dict_of_nodes)
+            if self.__allow_connection_attempt(node_info['host']):
+                return node_info
+            skipped.append(node_info)
+
+        node_info = min(skipped, key=lambda node: self.__node_stats[node['host']]['opened_at'])
+        logwarn(LOGGER, 'Circuits of all RabbitMQ nodes are open. Trying %s anyway.', node_info['host'])
+        return node_info
+
     def __get_highest_priority_node(self, dict_of_nodes):
 
         # Get highest priority:
@@ -283,6 +437,9 @@ class NodeManager(object):
             if len(list_of_priority_nodes)==0:
                 dict_of_nodes.pop(current_priority)
             return nexthost
+        elif self.__has_stats_for_any(list_of_priority_nodes):
+            nexthost = self.__select_and_remove_best_node_from_list(list_of_priority_nodes)
+            return nexthost
         else:
             nexthost = self.__select_and_remove_random_url_from_list(list_of_priority_nodes)
             return nexthost
@@ -312,6 +469,184 @@ class NodeManager(object):
         list_urls.remove(selected_url)
         return selected_url
 
+    '''
+    Select and return the best node from a list: The one
+    with the fewest failures since its last success, then
+    the one with the lowest connect latency. Nodes that were
+    never connected come after the healthy known ones. Ties
+    are broken randomly.
+    This modifies the list and returns the node!
+
+    :param list_nodes: The list of node info dictionaries.
+    :return: The selected node info dictionary.
+    '''
+    def __select_and_remove_best_node_from_list(self, list_nodes):
+        def score(node_info):
+            stats = self.__node_stats.get(node_info['host'], {})
+            latency = stats.get('latency')
+            if latency is None:
+                latency = float('inf')
+            return (stats.get('failures', 0), latency, random.random())
+        selected = min(list_nodes, key=score)
+        list_nodes.remove(selected)
+        return selected
+
+    def __has_stats_for_any(self, list_nodes):
+        for node_info in list_nodes:
+            if node_info['host'] in self.__node_stats:
+                return True
+        return False
+
+    ###############################
+    ### Latency/failure scores  ###
+    ###############################
+
+    '''
+    Called by the connection modules after a connection
+    to a node was opened successfully.
+
+    :param host: The host that was connected to.
+    :param seconds: How long it took to connect.
+    '''
+    def report_connection_success(self, host, seconds):
+        self.__refresh_node_stats()
+        stats = self.__get_or_create_stats(host)
+        alpha = esgfpid.defaults.RABBIT_NODE_LATENCY_EWMA_ALPHA
+        if stats['latency'] is None:
+            stats['latency'] = seconds
+        else:
+            stats['latency'] = alpha*seconds + (1-alpha)*stats['latency']
+        stats['failures'] = 0
+        if stats['opened_at'] is not None:
+            loginfo(LOGGER, 'Node %s is reachable again. Closing its circuit.', host)
+            stats['opened_at'] = None
+        logtrace(LOGGER, 'Node %s: Connect latency %.3f seconds (average %.3f).', host, seconds, stats['latency'])
+        self.__store_node_stats()
+
+    '''
+    Called by the connection modules after a connection
+    attempt to a node failed.
+
+    :param host: The host that could not be connected to.
+    '''
+    def report_connection_failure(self, host):
+        self.__refresh_node_stats()
+        stats = self.__get_or_create_stats(host)
+        stats['failures'] += 1
+        logtrace(LOGGER, 'Node %s: %i failures since last success.', host, stats['failures'])
+        if stats['failures'] >= esgfpid.defaults.RABBIT_NODE_BREAKER_FAILURE_THRESHOLD:
+            if stats['opened_at'] is None:
+                logwarn(LOGGER, 'Node %s failed %i times. Opening its circuit for %s seconds.',
+                    host, stats['failures'], esgfpid.defaults.RABBIT_NODE_BREAKER_COOLDOWN_SECONDS)
+            stats['opened_at'] = time.time()
+        self.__store_node_stats()
+
+    '''
+    :param host: The host of a node.
+    :return: The state of the node's circuit breaker:
+        "closed", "open" or "half-open".
+    '''
+    def get_circuit_state(self, host):
+        stats = self.__node_stats.get(host)
+        if stats is None or stats['opened_at'] is None:
+            return 'closed'
+        cooldown = esgfpid.defaults.RABBIT_NODE_BREAKER_COOLDOWN_SECONDS
+        if time.time() - stats['opened_at'] < cooldown:
+            return 'open'
+        return 'half-open'
+
+    '''
+    A half-open node is allowed one probe. Its circuit is
+    re-armed for the duration of the probe, so that other
+    processes (sharing the state file) do not probe, too.
+    '''
+    def __allow_connection_attempt(self, host):
+        state = self.get_circuit_state(host)
+        if state == 'closed':
+            return True
+        elif state == 'open':
+            logdebug(LOGGER, 'Skipping node %s (circuit open).', host)
+            return False
+        else:
+            loginfo(LOGGER, 'Probing node %s (circuit half-open).', host)
+            self.__node_stats[host]['opened_at'] = time.time()
+            self.__store_node_stats()
+            return True
+
+    '''
+    :return: A copy of the latency and failure scores, as
+        dictionary by host.
+    '''
+    def get_node_stats(self):
+        return copy.deepcopy(self.__node_stats)
+
+    def __get_or_create_stats(self, host):
+        if host not in self.__node_stats:
+            self.__node_stats[host] = dict(latency=None, failures=0, opened_at=None)
+        return self.__node_stats[host]
+
+    '''
+    The socket timeout of a node is a multiple of its
+    average connect latency, doubled for every failure
+    since its last success (in case the timeout was too
+    tight), within the limits defined in defaults.py.
+    Nodes that were never connected get the default.
+    '''
+    def __get_socket_timeout(self, host):
+        stats = self.__node_stats.get(host)
+        if stats is None or stats['latency'] is None:
+            return esgfpid.defaults.RABBIT_PIKA_SOCKET_TIMEOUT
+        timeout = stats['latency'] * esgfpid.defaults.RABBIT_NODE_SOCKET_TIMEOUT_FACTOR
+        timeout = timeout * 2**min(stats['failures'], 10)
+        timeout = max(timeout, esgfpid.defaults.RABBIT_NODE_SOCKET_TIMEOUT_MIN)
+        timeout = min(timeout, esgfpid.defaults.RABBIT_NODE_SOCKET_TIMEOUT_MAX)
+        return timeout
+
+    def __load_node_stats(self):
+        if self.__state_file is None or not os.path.isfile(self.__state_file):
+            return {}
+        try:
+            with open(self.__state_file, 'r') as statefile:
+                content = json.load(statefile)
+            node_stats = {}
+            for host, stats in content.iteritems():
+                node_stats[host] = dict(
+                    latency=stats.get('latency'),
+                    failures=int(stats.get('failures', 0)),
+                    opened_at=stats.get('opened_at'))
+            logdebug(LOGGER, 'Loaded scores of %i RabbitMQ nodes from %s.', len(node_stats), self.__state_file)
+            return node_stats
+        except (IOError, ValueError, AttributeError, TypeError) as e:
+            logwarn(LOGGER, 'Could not read node state file %s (%s). Ignoring it.', self.__state_file, e)
+            return {}
+
+    '''
+    Read the state file again, as other processes may
+    have updated it.
+    '''
+    def __refresh_node_stats(self):
+        if self.__state_file is not None:
+            self.__node_stats.update(self.__load_node_stats())
+
+    '''
+    Write to a temporary file and rename it, so that
+    concurrent processes never read a half-written file.
+    The temporary file is per thread, as the node managers
+    of the shards (active-active mode) share the state file.
+    Problems are only logged, they never affect the
+    sending of messages.
+    '''
+    def __store_node_stats(self):
+        if self.__state_file is None:
+            return
+        tmp_name = '%s.%i.%i.tmp' % (self.__state_file, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_name, 'w') as statefile:
+                json.dump(self.__node_stats, statefile)
+            os.rename(tmp_name, self.__state_file)
+        except (IOError, OSError) as e:
+            logwarn(LOGGER, 'Could not write node state file %s (%s).', self.__state_file, e)
+
     '''
     Return the current exchange name as string.
 
@@ -1,7 +1,13 @@
 import logging
 import pika
 import esgfpid.utils
-from esgfpid.utils import logwarn
+import esgfpid.defaults
+from esgfpid.utils import logwarn, logdebug
+from . import rabbitutils
+from .asynchronous.spool import MessageSpool
+from .asynchronous.bounded_queue import BoundedMessageQueue
+from .asynchronous.completion import Completion
+from .asynchronous.exceptions import OperationNotAllowed
 from .nodemanager import NodeManager
 from .asynchronous import AsynchronousRabbitConnector
 from .synchronous import SynchronousRabbitConnector
@@ -38,6 +44,35 @@ class RabbitMessageSender(object):
         should work in synchronous mode.
     :param test_publication: Mandatory. Boolean to tell whether
         a test flag should be added to all messages.
+    :param spool_dir: Optional. Directory for an on-disk spool of
+        the messages, so that unconfirmed messages are published
+        again in the next session. Only in asynchronous mode.
+        Defaults to the value defined in defaults.py.
+    :param spool_fsync: Optional. When to sync the spool to disk
+        ("always", "interval", "never"). Defaults to the value
+        defined in defaults.py.
+    :param queue_max_messages: Optional. Maximum number of messages
+        waiting to be published. Only in asynchronous mode. Defaults
+        to the value defined in defaults.py.
+    :param queue_max_bytes: Optional. Maximum number of bytes of the
+        messages waiting to be published. Only in asynchronous mode.
+        Defaults to the value defined in defaults.py.
+    :param queue_full_policy: Optional. What to do when a message is
+        sent while the queue is full ("block", "raise", "spill").
+        Defaults to the value defined in defaults.py.
+    :param persistent_session: Optional. Boolean. Keep one
+        synchronous connection open across datasets. Only in
+        synchronous mode. Defaults to the value defined in
+        defaults.py.
+    :param node_state_file: Optional. JSON file in which the
+        latency and failure scores of the RabbitMQ nodes are
+        kept across processes. Defaults to the value defined
+        in defaults.py.
+    :param active_active: Optional. Boolean. Publish via all
+        trusted nodes of the best priority at the same time
+        (see :class:`~esgfpid.rabbit.asynchronous.sharded.ShardedRabbitConnector`).
+        Only in asynchronous mode. Spooling is not used in this
+        mode. Defaults to the value defined in defaults.py.
 
     '''
     def __init__(self, **args):
@@ -58,9 +93,59 @@ class RabbitMessageSender(object):
 
     def __init_server_connector(self, args, node_manager):
         if self.__ASYNCHRONOUS:
-            return esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(node_manager)
+            if self.__is_active_active(args):
+                return self.__init_sharded_server_connector(args, node_manager)
+            spool = self.__make_spool(args)
+            queue = self.__make_queue(args)
+            return esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(node_manager, spool, queue)
         else:
-            return esgfpid.rabbit.synchronous.SynchronousRabbitConnector(node_manager)
+            if args.get('active_active'):
+                logwarn(LOGGER, 'Ignoring active-active mode: It is only available in asynchronous mode.')
+            if 'spool_dir' in args and args['spool_dir'] is not None:
+                logwarn(LOGGER, 'Ignoring spool directory "%s": Spooling is only available in asynchronous mode.', args['spool_dir'])
+            persistent_session = args.get('persistent_session')
+            if persistent_session is None:
+                persistent_session = esgfpid.defaults.RABBIT_SYN_PERSISTENT_SESSION
+            return esgfpid.rabbit.synchronous.SynchronousRabbitConnector(node_manager, persistent_session)
+
+    def __is_active_active(self, args):
+        active_active = args.get('active_active')
+        if active_active is None:
+            active_active = esgfpid.defaults.RABBIT_ACTIVE_ACTIVE
+        return active_active
+
+    def __init_sharded_server_connector(self, args, node_manager):
+        node_managers = node_manager.get_node_managers_for_active_nodes()
+        if len(node_managers) < 2:
+            logdebug(LOGGER, 'Active-active mode: Only one node available, using it normally.')
+            spool = self.__make_spool(args)
+            return esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(node_managers[0], spool, self.__make_queue(args))
+
+        if 'spool_dir' in args and args['spool_dir'] is not None:
+            logwarn(LOGGER, 'Ignoring spool directory "%s": Spooling is not available in active-active mode.', args['spool_dir'])
+        queue_args = dict(
+            max_messages=args.get('queue_max_messages'),
+            max_bytes=args.get('queue_max_bytes'),
+            full_policy=args.get('queue_full_policy')
+        )
+        return esgfpid.rabbit.asynchronous.ShardedRabbitConnector(node_managers, queue_args=queue_args)
+
+    def __make_spool(self, args):
+        if 'spool_dir' not in args or args['spool_dir'] is None:
+            args['spool_dir'] = esgfpid.defaults.RABBIT_SPOOL_DIR
+        if 'spool_fsync' not in args or args['spool_fsync'] is None:
+            args['spool_fsync'] = esgfpid.defaults.RABBIT_SPOOL_FSYNC
+
+        if args['spool_dir'] is None:
+            return None
+        return MessageSpool(args['spool_dir'], args['spool_fsync'])
+
+    def __make_queue(self, args):
+        return BoundedMessageQueue(
+            max_messages=args.get('queue_max_messages'),
+            max_bytes=args.get('queue_max_bytes'),
+            full_policy=args.get('queue_full_policy')
+        )
 
 
     '''
@@ -122,11 +207,19 @@ class RabbitMessageSender(object):
     asynchronous mode.
 
     Please see documentation of asynchronous rabbit module
-    (:func:`~rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector.force_finish_rabbit_thread`).
+    (:func:`~rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector.finish_rabbit_thread`).
+
+    In synchronous mode, this ends a persistent session
+    (:func:`~rabbit.synchronous.SynchronousRabbitConnector.close_session`).
+
+    :param timeout: Optional. Maximum number of seconds to wait
+        for pending messages.
     '''
-    def finish(self):
+    def finish(self, timeout=None):
         if self.__ASYNCHRONOUS:
-            self.__server_connector.finish_rabbit_thread()
+            self.__server_connector.finish_rabbit_thread(timeout)
+        else:
+            self.__server_connector.close_session()
 
     def is_finished(self):
         if self.__ASYNCHRONOUS:
@@ -147,6 +240,46 @@ class RabbitMessageSender(object):
         if self.__ASYNCHRONOUS:
             self.__server_connector.start_rabbit_thread()
 
+    '''
+    Like :func:`finish`, but does not block (for publishers
+    that run an event loop).
+
+    Please see documentation of asynchronous rabbit module
+    (:func:`~rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector.finish_rabbit_thread_in_background`).
+
+    In synchronous mode, the session is closed right away.
+
+    :param timeout: Optional. Maximum number of seconds to wait
+        for pending messages.
+    :return: A Completion (see :class:`~esgfpid.rabbit.asynchronous.completion.Completion`)
+        whose failed messages are the leftovers (as envelopes,
+        unlike :func:`get_leftovers`).
+    :raises: OperationNotAllowed: In active-active mode.
+    '''
+    def finish_in_background(self, timeout=None):
+        if self.__ASYNCHRONOUS:
+            return self.__get_connector_with_completions().finish_rabbit_thread_in_background(timeout)
+        else:
+            self.__server_connector.close_session()
+            return Completion(0)
+
+    '''
+    :return: A Completion that is done once all messages that
+        were sent with a Completion so far were confirmed (or
+        failed). In synchronous mode, it is done already.
+    :raises: OperationNotAllowed: In active-active mode.
+    '''
+    def flush(self):
+        if self.__ASYNCHRONOUS:
+            return self.__get_connector_with_completions().flush()
+        else:
+            return Completion(0)
+
+    def __get_connector_with_completions(self):
+        if not isinstance(self.__server_connector, AsynchronousRabbitConnector):
+            raise OperationNotAllowed('Completions are not available in active-active mode.')
+        return self.__server_connector
+
     '''
     Force-close a thread that communicates with RabbitMQ asynchronously.
 
@@ -163,9 +296,44 @@ class RabbitMessageSender(object):
         if self.__ASYNCHRONOUS:
             return self.__server_connector.any_leftovers()
 
+    '''
+    :return: The messages that were not published or not
+        confirmed, as the caller passed them (dictionaries,
+        or strings if they were not JSON), not as the
+        envelopes they are carried in internally.
+    '''
     def get_leftovers(self):
         if self.__ASYNCHRONOUS:
-            return self.__server_connector.get_leftovers()
+            leftovers = self.__server_connector.get_leftovers()
+            return rabbitutils.open_message_envelopes(leftovers)
+
+    '''
+    Get the status of the queue of messages waiting to be
+    published (see :func:`~rabbit.asynchronous.bounded_queue.BoundedMessageQueue.get_status`).
+
+    This only has an effect if the RabbitMessageSender is in
+    asynchronous mode.
+
+    :return: Dictionary, or None in synchronous mode.
+    '''
+    def get_queue_status(self):
+        if self.__ASYNCHRONOUS:
+            return self.__server_connector.get_queue_status()
+        else:
+            return None
+
+    '''
+    Get the status of every RabbitMQ node in active-active mode
+    (see :func:`~rabbit.asynchronous.sharded.ShardedRabbitConnector.get_node_status`).
+
+    :return: Dictionary by host, or None if not in active-active
+        mode.
+    '''
+    def get_node_status(self):
+        if isinstance(self.__server_connector, esgfpid.rabbit.asynchronous.ShardedRabbitConnector):
+            return self.__server_connector.get_node_status()
+        else:
+            return None
 
     '''
     Send a message to RabbitMQ.
@@ -177,21 +345,91 @@ class RabbitMessageSender(object):
     In synchronous mode, if the delivery was not successful,
     an exception is raised.
 
+    The message is serialized here, i.e. on the thread of
+    the caller, and handed on as an immutable
+    :class:`~esgfpid.rabbit.rabbitutils.MessageEnvelope`.
+
     :param: JSON message as string or dictionary. It should
         include its routing key as a dictionary entry with
         key "ROUTING_KEY", Otherwise a default routing key
-        will be used to send the message.
+        will be used to send the message. May also be an
+        envelope (e.g. a leftover), which is sent as is.
     :raises: esgfpid.exceptions.MessageNotDeliveredException:
         In case the message was not delivered. Only in
         synchronous mode.
+    :raises: esgfpid.rabbit.asynchronous.exceptions.MessageQueueFull:
+        If the queue of messages waiting to be published is
+        full (depending on the policy). Only in asynchronous mode.
+    :raises: ValueError: If the message cannot be serialized.
     '''
     def send_message_to_queue(self, message):
-        if self.__test_publication == True:
-            message['test_publication'] = True
+        if not isinstance(message, rabbitutils.MessageEnvelope):
+            if self.__test_publication == True:
+                message['test_publication'] = True
+            message = rabbitutils.make_message_envelope(message)
         self.__server_connector.send_message_to_queue(message)
 
+    '''
+    Send many messages to RabbitMQ.
+
+    In synchronous mode, the messages are published without
+    waiting for each confirm before publishing the next one
+    (please see :func:`~rabbit.synchronous.SynchronousRabbitConnector.send_many_messages`).
+    If any delivery was not successful, an exception is raised
+    that lists the undelivered messages.
+
+    In asynchronous mode, the messages are handed to the
+    rabbit thread all at once.
+
+    :param messages: List of JSON messages (see
+        :func:`send_message_to_queue`).
+    :raises: esgfpid.exceptions.MessageNotDeliveredException:
+        In case any message was not delivered. Only in
+        synchronous mode.
+    :raises: ValueError: If a message cannot be serialized.
+    '''
+    def send_many_messages_to_queue(self, messages):
+        envelopes = self.__make_envelopes(messages)
+        if self.__ASYNCHRONOUS:
+            self.__server_connector.send_many_messages_to_queue(envelopes)
+        else:
+            self.__server_connector.send_many_messages(envelopes)
+
+    '''
+    Send many messages to RabbitMQ, and get a Completion that
+    tells when they were confirmed, without blocking (for
+    publishers that run an event loop).
+
+    In synchronous mode, this blocks until the messages were
+    confirmed (see :func:`send_many_messages_to_queue`), and
+    the returned Completion is done already.
+
+    :param messages: List of JSON messages (see
+        :func:`send_message_to_queue`).
+    :return: A Completion (see :class:`~esgfpid.rabbit.asynchronous.completion.Completion`).
+    :raises: OperationNotAllowed: In active-active mode.
+    :raises: ValueError: If a message cannot be serialized.
+    '''
+    def send_many_messages_to_queue_with_completion(self, messages):
+        envelopes = self.__make_envelopes(messages)
+        if self.__ASYNCHRONOUS:
+            return self.__get_connector_with_completions().send_many_messages_to_queue_with_completion(envelopes)
+        else:
+            self.__server_connector.send_many_messages(envelopes)
+            return Completion(0)
+
+    def __make_envelopes(self, messages):
+        envelopes = []
+        for message in messages:
+            if not isinstance(message, rabbitutils.MessageEnvelope):
+                if self.__test_publication == True:
+                    message['test_publication'] = True
+                message = rabbitutils.make_message_envelope(message)
+            envelopes.append(message)
+        return envelopes
+
     def __make_rabbit_settings(self, args):
-        node_manager = NodeManager()
+        node_manager = NodeManager(args.get('node_state_file'))
 
         # Add all RabbitMQ nodes:
         for cred in args['credentials']:
@@ -1,12 +1,158 @@
 import json
 import random
 import logging
+import collections
 import esgfpid.defaults
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+'''
+A message that is ready to be published: The routing key
+(without the open/trusted word, which is only known once
+the node is chosen) and the serialized body.
+
+Messages are serialized once, on the thread of the caller
+who sends them, and then carried around in this immutable
+form (through the queue of unpublished messages, the
+confirmer, the leftovers), so the thread that talks to
+RabbitMQ does not have to do any JSON work.
+
+If the messages are spooled to disk, the envelope also
+carries the message's id in the spool (otherwise None).
+
+The ordering key (see :func:`get_ordering_key`) tells the
+thread which messages must be published in order, on the
+same channel (otherwise None).
+'''
+MessageEnvelope = collections.namedtuple('MessageEnvelope', ['routing_key', 'body', 'spool_id', 'ordering_key'])
+MessageEnvelope.__new__.__defaults__ = (None, None)
+
+#
+# JSON encoders
+#
+
+def _dumps_orjson(obj):
+    import orjson
+    return orjson.dumps(obj)
+
+def _dumps_rapidjson(obj):
+    import rapidjson
+    return rapidjson.dumps(obj)
+
+def _dumps_ujson(obj):
+    import ujson
+    return ujson.dumps(obj, escape_forward_slashes=False)
+
+def _dumps_stdlib(obj):
+    return json.dumps(obj)
+
+JSON_ENCODERS = collections.OrderedDict([
+    ('orjson', _dumps_orjson),
+    ('rapidjson', _dumps_rapidjson),
+    ('ujson', _dumps_ujson),
+    ('json', _dumps_stdlib)
+])
+
+_json_encoder = None
+
+'''
+Set the function that serializes the messages to JSON.
+
+:param encoder: Name of an encoder ("orjson", "rapidjson",
+    "ujson" or "json"), or "auto" to use the fastest installed
+    one, or any callable that takes a dictionary and returns
+    a string. The callable must raise TypeError or ValueError
+    for objects that cannot be serialized.
+:raises: ValueError: If the encoder name is unknown.
+:raises: ImportError: If the named encoder is not installed.
+'''
+def set_json_encoder(encoder):
+    global _json_encoder
+    if callable(encoder):
+        _json_encoder = encoder
+    elif encoder == 'auto':
+        _json_encoder = _find_fastest_json_encoder()
+    elif encoder in JSON_ENCODERS:
+        __import__(encoder)
+        _json_encoder = JSON_ENCODERS[encoder]
+    else:
+        raise ValueError('Unknown JSON encoder "%s" (known: auto, %s).' % (encoder, ', '.join(JSON_ENCODERS.keys())))
+    logdebug(LOGGER, 'Using JSON encoder: %s', encoder)
+
+def _find_fastest_json_encoder():
+    for name, encoder in JSON_ENCODERS.iteritems():
+        try:
+            __import__(name)
+            return encoder
+        except ImportError:
+            pass
+
+'''
+Serialize an object to JSON, with the encoder that was
+configured (see :func:`set_json_encoder` and
+esgfpid.defaults.RABBIT_JSON_ENCODER).
+'''
+def encode_json(obj):
+    if _json_encoder is None:
+        set_json_encoder(esgfpid.defaults.RABBIT_JSON_ENCODER)
+    return _json_encoder(obj)
+
+'''
+Serialize a message and wrap it, together with its routing
+key, in an immutable :class:`MessageEnvelope`.
+
+If the message is an envelope already, it is returned as is.
+
+:param msg: Message as JSON string or dictionary, or envelope.
+:return: MessageEnvelope.
+:raises: ValueError: If the message cannot be serialized.
+'''
+def make_message_envelope(msg):
+    if isinstance(msg, MessageEnvelope):
+        return msg
+    routing_key, msg_string = get_routing_key_and_string_message_from_message_if_possible(msg)
+    return MessageEnvelope(routing_key, msg_string, None, get_ordering_key(msg))
+
+'''
+Turn envelopes back into messages as the library caller
+passes them: The dictionary, or the string if the body is
+not JSON. Used where messages are handed out of the library
+(e.g. the leftovers), so that callers get what they sent.
+
+:param messages: List of envelopes. Anything else is
+    returned as it is.
+:return: List of messages.
+'''
+def open_message_envelopes(messages):
+    opened = []
+    for msg in messages:
+        if isinstance(msg, MessageEnvelope):
+            try:
+                msg = json.loads(msg.body)
+            except ValueError:
+                msg = msg.body
+        opened.append(msg)
+    return opened
+
+'''
+Returns the key that keeps the messages of one dataset in
+order: The dataset handle for file messages ("parent_dataset"),
+the handle for dataset messages, or else the drs id.
+
+:param msg: Message as dictionary. For anything else, no
+    key is returned.
+:return: The ordering key, or None.
+'''
+def get_ordering_key(msg):
+    if not isinstance(msg, dict):
+        return None
+    for key in ['parent_dataset', 'handle', 'drs_id']:
+        if msg.get(key) is not None:
+            return msg[key]
+    return None
+
 '''
 Retrieves the routing key from the message, checks
 the message's validity and returns
@@ -50,20 +196,19 @@ def get_routing_key_and_string_message_from_message_if_possible(msg):
     else:
         try:
             # Message is json already.
-            msg_string = json.dumps(msg)
+            msg_string = encode_json(msg)
             msg_json = msg
             json_ok = True
             logtrace(LOGGER, 'Message was already json.')
 
-        except TypeError as e:
-            if 'not JSON serializable' in e.message:
+        except (TypeError, ValueError, OverflowError) as e:
 
-                # Message was whatever.
-                msg_string = str(msg)
-                json_ok = False
-                msg = ('Message was neither JSON nor string and not understandable: %s' % msg_string)
-                loginfo(LOGGER, msg)
-                raise ValueError(msg)
+            # Message was whatever.
+            msg_string = str(msg)
+            json_ok = False
+            msg = ('Message was neither JSON nor string and not understandable: %s' % msg_string)
+            loginfo(LOGGER, msg)
+            raise ValueError(msg)
 
 
     # If we succeeded, try to get routing key:
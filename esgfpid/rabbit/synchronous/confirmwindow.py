@@ -0,0 +1,127 @@
+import logging
+import collections
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+from ..exceptions import PIDServerException
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+=============
+ConfirmWindow
+=============
+
+Keeps track of the messages that the synchronous connector
+published on a pipelining channel, but that were not confirmed
+yet (the "window").
+
+The delivery tags are counted here, as RabbitMQ numbers the
+messages of one channel 1, 2, 3, ... in the order they were
+published. So one window must be used for one channel only.
+
+Messages that were nacked, or returned (unroutable) before
+their ack, or that were still in the window when the connector
+gave up waiting, are collected as "not confirmed", so they can
+be sent again.
+
+API:
+ * add() called by the connector, after every publish
+ * on_delivery_confirmation() and on_return() called by pika
+ * give_up() and get_not_confirmed() called by the connector
+
+'''
+class ConfirmWindow(object):
+
+    def __init__(self):
+        self.__in_flight = collections.OrderedDict() # delivery tag -> envelope, oldest first
+        self.__last_delivery_tag = 0
+        self.__returned_bodies = []
+        self.__not_confirmed = []
+        self.__num_confirmed = 0
+
+    '''
+    Called by the connector, after the envelope was
+    published on the channel of this window.
+    '''
+    def add(self, envelope):
+        self.__last_delivery_tag += 1
+        self.__in_flight[self.__last_delivery_tag] = envelope
+
+    def get_num_in_flight(self):
+        return len(self.__in_flight)
+
+    def get_num_confirmed(self):
+        return self.__num_confirmed
+
+    '''
+    :return: The envelopes that were not confirmed, in the
+        order in which they were noticed as not confirmed.
+    '''
+    def get_not_confirmed(self):
+        return self.__not_confirmed[:]
+
+    '''
+    Called by the connector, if the confirms did not
+    arrive in time, or the channel broke down. All
+    messages in the window count as not confirmed.
+    '''
+    def give_up(self):
+        if len(self.__in_flight) > 0:
+            logdebug(LOGGER, 'Giving up waiting for %i confirms.', len(self.__in_flight))
+        self.__not_confirmed.extend(self.__in_flight.values())
+        self.__in_flight.clear()
+
+    '''
+    Callback, called by pika (via the connection's
+    process_data_events()).
+    '''
+    def on_delivery_confirmation(self, method_frame):
+        try:
+            deliv_tag = method_frame.method.delivery_tag
+            confirmation_type = method_frame.method.NAME.split('.')[1].lower()
+            multiple = method_frame.method.multiple
+        except (AttributeError, IndexError) as e:
+            raise PIDServerException('Unknown confirm from messaging service: %s (%s)' % (method_frame, e))
+
+        if multiple:
+            confirmed = self.__pop_up_to(deliv_tag)
+        else:
+            confirmed = self.__pop_one(deliv_tag)
+
+        if confirmation_type == 'ack':
+            logtrace(LOGGER, 'Received "ACK" for delivery tag %i (multiple: %s).', deliv_tag, multiple)
+            for envelope in confirmed:
+                self.__react_on_ack(envelope)
+        else:
+            logwarn(LOGGER, 'Received "NACK" for delivery tag %i (multiple: %s).', deliv_tag, multiple)
+            self.__not_confirmed.extend(confirmed)
+
+    '''
+    Callback, called by pika when a message could not be
+    routed. RabbitMQ sends the return before the ack of the
+    same message, so the message is noted as returned here
+    and treated as not confirmed once its ack arrives.
+    '''
+    def on_return(self, channel, method, properties, body):
+        logwarn(LOGGER, 'Message was returned by messaging service (%s).', method.reply_text)
+        self.__returned_bodies.append(body)
+
+    def __react_on_ack(self, envelope):
+        if envelope.body in self.__returned_bodies:
+            self.__returned_bodies.remove(envelope.body)
+            self.__not_confirmed.append(envelope)
+        else:
+            self.__num_confirmed += 1
+
+    def __pop_one(self, deliv_tag):
+        envelope = self.__in_flight.pop(deliv_tag, None)
+        if envelope is None:
+            logdebug(LOGGER, 'Received confirm for unknown delivery tag %i.', deliv_tag)
+            return []
+        return [envelope]
+
+    def __pop_up_to(self, deliv_tag):
+        popped = []
+        while len(self.__in_flight) > 0 and next(iter(self.__in_flight)) <= deliv_tag:
+            popped.append(self.__in_flight.popitem(last=False)[1])
+        return popped
@@ -0,0 +1,54 @@
+import logging
+import threading
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+The HeartbeatKeeper is a lightweight daemon thread used by the
+synchronous connector in persistent session mode.
+
+A pika.BlockingConnection only answers heartbeats (and notices
+a broken connection) while the library calls it. Between two
+datasets, the publisher may not send anything for a long time,
+so RabbitMQ would close the connection. The keeper calls the
+given function every few seconds, which lets pika process the
+pending events.
+
+The keeper does not touch the connection itself: The function
+it calls is responsible for thread-safety.
+'''
+class HeartbeatKeeper(threading.Thread):
+
+    '''
+    :param service_function: Mandatory. Function without arguments
+        that is called every interval.
+    :param interval_seconds: Mandatory. Seconds between two calls.
+    '''
+    def __init__(self, service_function, interval_seconds):
+        threading.Thread.__init__(self, name='esgfpid-heartbeat-keeper')
+        self.daemon = True # must not keep the process alive
+        self.__service_function = service_function
+        self.__interval_seconds = interval_seconds
+        self.__stop_event = threading.Event()
+
+    def run(self):
+        logdebug(LOGGER, 'Heartbeat keeper started (every %s seconds).', self.__interval_seconds)
+        while not self.__stop_event.wait(self.__interval_seconds):
+            try:
+                self.__service_function()
+            except Exception as e:
+                logwarn(LOGGER, 'Error in heartbeat keeper: %s: %s', e.__class__.__name__, e)
+        logdebug(LOGGER, 'Heartbeat keeper stopped.')
+
+    '''
+    Called by the connector (from the library caller's thread).
+    Does not wait for the keeper to end, as it never blocks for
+    longer than one call of the service function.
+    '''
+    def stop(self):
+        self.__stop_event.set()
+
+    def is_stopped(self):
+        return self.__stop_event.is_set()
@@ -0,0 +1,89 @@
+import logging
+import pika
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+=================
+PipeliningChannel
+=================
+
+The BlockingChannel of pika only allows to wait for the
+confirm right after each publish. To publish many messages
+without waiting for each confirm, the synchronous connector
+publishes on the (asynchronous) pika channel underneath it,
+and lets the connection process the confirms when it waits.
+
+That channel is not part of pika's public API ("_impl"), so
+all access to it is kept in this module, and it is only used
+with the pika versions it was checked with. With other
+versions, the connector sends the messages one by one.
+
+API:
+ * is_supported() called by the connector, before making one
+ * basic_publish(), close() and is_open, like a BlockingChannel
+
+'''
+
+'''
+Major versions of pika whose BlockingChannel has the
+asynchronous channel as "_impl", with confirm_delivery(),
+add_on_return_callback() and basic_publish() taking the
+arguments used here.
+'''
+SUPPORTED_PIKA_MAJOR_VERSIONS = ['0', '1']
+
+REQUIRED_METHODS = ['confirm_delivery', 'add_on_return_callback', 'basic_publish']
+
+'''
+:param blocking_channel: A pika BlockingChannel.
+:return: True if a PipeliningChannel can be made on it.
+'''
+def is_supported(blocking_channel):
+    version = getattr(pika, '__version__', '')
+    if version.split('.')[0] not in SUPPORTED_PIKA_MAJOR_VERSIONS:
+        logdebug(LOGGER, 'Pipelining not supported for pika version "%s".', version)
+        return False
+    impl = getattr(blocking_channel, '_impl', None)
+    for name in REQUIRED_METHODS:
+        if not callable(getattr(impl, name, None)):
+            logdebug(LOGGER, 'Pipelining not supported: pika channel has no "%s".', name)
+            return False
+    return True
+
+
+class PipeliningChannel(object):
+
+    '''
+    :param blocking_channel: A pika BlockingChannel, on which
+        is_supported() returned True.
+    :param window: The ConfirmWindow that receives the confirms
+        and returns of this channel.
+    '''
+    def __init__(self, blocking_channel, window):
+        self.__blocking_channel = blocking_channel
+        self.__impl = blocking_channel._impl
+        self.__impl.add_on_return_callback(window.on_return)
+        self.__impl.confirm_delivery(window.on_delivery_confirmation)
+
+    @property
+    def is_open(self):
+        return self.__blocking_channel.is_open
+
+    '''
+    Publish without waiting for the confirm. It arrives
+    at the window when the connection processes events.
+    '''
+    def basic_publish(self, exchange, routing_key, body, mandatory, properties):
+        self.__impl.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            mandatory=mandatory,
+            properties=properties
+        )
+
+    def close(self):
+        self.__blocking_channel.close()
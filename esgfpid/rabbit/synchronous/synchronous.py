@@ -3,12 +3,16 @@ import datetime
 import json
 import pika
 import time
+import threading
 import esgfpid.utils
 import esgfpid.defaults as defaults
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
 from esgfpid.exceptions import MessageNotDeliveredException
 from esgfpid.utils import get_now_utc_as_formatted_string as get_now_utc_as_formatted_string
 from .. import rabbitutils as rabbitutils
+from .confirmwindow import ConfirmWindow
+from . import pipeliningchannel
+from .heartbeatkeeper import HeartbeatKeeper
 from ..exceptions import PIDServerException
 
 
@@ -25,9 +29,16 @@ class SynchronousRabbitConnector(object):
     :param node_manager: NodeManager object that contains 
         the info about all the available RabbitMQ instances,
         their credentials, their priorities.
+    :param persistent_session: Optional. Boolean. If True, the
+        connection is kept open across many
+        open_rabbit_connection()/close_rabbit_connection()
+        calls (e.g. across many datasets), its heartbeats are
+        serviced by a background thread, and it is reopened
+        transparently if it was lost. It is only closed by
+        close_session(). Defaults to False.
 
     '''
-    def __init__(self, nodemanager):
+    def __init__(self, nodemanager, persistent_session=False):
 
         loginfo(LOGGER, 'Init of SynchronousRabbitConnector!!! Bla')
 
@@ -85,6 +96,8 @@ class SynchronousRabbitConnector(object):
         self.__mandatory_flag = esgfpid.defaults.RABBIT_MANDATORY_DELIVERY
         self.__max_tries = esgfpid.defaults.RABBIT_SYN_MESSAGE_MAX_TRIES
         self.__timeout_milliseconds = esgfpid.defaults.RABBIT_SYN_MESSAGE_TIMEOUT_MILLISEC
+        self.__confirm_window_size = max(1, esgfpid.defaults.RABBIT_SYN_CONFIRM_WINDOW)
+        self.__confirm_timeout_seconds = esgfpid.defaults.RABBIT_SYN_CONFIRM_TIMEOUT_SECONDS
         self.__candidate_fallback_exchange_name = defaults.RABBIT_FALLBACK_EXCHANGE_NAME
 
         # Other settings:
@@ -94,6 +107,16 @@ class SynchronousRabbitConnector(object):
         self.__connection_last_process_event_call = 0
         self.__error_messages_during_init = []
 
+        '''
+        Persistent session: The connection is shared with the
+        heartbeat keeper thread, so all access to it is
+        protected by this lock (reentrant, as sending many
+        messages may send single messages).
+        '''
+        self.__persistent_session = persistent_session
+        self.__heartbeat_keeper = None
+        self.__lock = threading.RLock()
+
 
     ########################################
     ### This actually connects to rabbit ###
@@ -112,8 +135,19 @@ class SynchronousRabbitConnector(object):
     The maximum number of connection attempts is
     determined in the esgfpid.defaults.
 
+    In a persistent session, an open connection is reused,
+    and the heartbeat keeper is started.
+
     '''
-    def open_rabbit_connection(self):    
+    def open_rabbit_connection(self):
+        with self.__lock:
+            if self.__persistent_session and self.__is_connection_alive():
+                logdebug(LOGGER, 'Reusing the open connection to RabbitMQ (persistent session).')
+                return
+            self.__open_rabbit_connection()
+            self.__start_heartbeat_keeper_if_needed()
+
+    def __open_rabbit_connection(self):
 
         continue_connecting = True
         while continue_connecting:
@@ -122,6 +156,7 @@ class SynchronousRabbitConnector(object):
 
             if success:
                 continue_connecting = False
+                self.__reconnect_counter = 0
 
             else:
 
@@ -217,6 +252,7 @@ class SynchronousRabbitConnector(object):
             time_passed = datetime.datetime.now() - self.__start_connect_time
             time_seconds = time_passed.total_seconds()
             loginfo(LOGGER, 'Connection to RabbitMQ at %s opened after %i seconds... (%s)', params.host, time_seconds, time_now)
+            self.__nodemanager.report_connection_success(params.host, time_seconds)
             return conn
 
         except pika.exceptions.ProbableAuthenticationError as e:
@@ -230,6 +266,7 @@ class SynchronousRabbitConnector(object):
                      params.host))
             LOGGER.error(msg)
             self.__error_messages_during_init.append(msg)
+            self.__nodemanager.report_connection_failure(params.host)
             return None
 
         except pika.exceptions.AMQPConnectionError as e:
@@ -239,6 +276,7 @@ class SynchronousRabbitConnector(object):
             logerror(LOGGER, 'Caught AMQPConnectionError Exception after %s seconds during connection ("%s").', time_seconds, error_name)
             msg = ('Problem setting up the rabbit connection to %s.' % params.host)
             self.__error_messages_during_init.append(msg)
+            self.__nodemanager.report_connection_failure(params.host)
             return None
 
         except Exception as e:
@@ -285,12 +323,77 @@ class SynchronousRabbitConnector(object):
     ### Close connection ###
     ########################
 
+    '''
+    Close the connection. In a persistent session, the
+    connection is kept open (see close_session()).
+    '''
     def close_rabbit_connection(self):
+        if self.__persistent_session:
+            logdebug(LOGGER, 'Keeping the connection to RabbitMQ open (persistent session).')
+            return
+        with self.__lock:
+            self.__close_connection()
+
+    '''
+    End a persistent session: Stop the heartbeat keeper
+    and close the connection.
+    '''
+    def close_session(self):
+        if self.__heartbeat_keeper is not None:
+            self.__heartbeat_keeper.stop()
+            self.__heartbeat_keeper = None
+        with self.__lock:
+            self.__close_connection()
+            self.__communication_established = False
+
+    def __close_connection(self):
         if (self.__connection is not None) and (self.__connection.is_open):
             self.__connection.close()
             # From pika doc: If there are any open channels, it will attempt to
             # close them prior to fully disconnecting
 
+    ##########################
+    ### Persistent session ###
+    ##########################
+
+    def __is_connection_alive(self):
+        return (self.__communication_established and
+            self.__connection is not None and self.__connection.is_open and
+            self.__channel is not None and self.__channel.is_open)
+
+    def __start_heartbeat_keeper_if_needed(self):
+        if self.__persistent_session and self.__heartbeat_keeper is None:
+            interval = defaults.RABBIT_SYN_HEARTBEAT_KEEPER_SECONDS
+            self.__heartbeat_keeper = HeartbeatKeeper(self.__service_heartbeats, interval)
+            self.__heartbeat_keeper.start()
+
+    '''
+    Called by the heartbeat keeper thread. Lets pika answer
+    heartbeats while the connection is idle.
+
+    If the connection is in use, nothing needs to be done (the
+    library caller's thread services the heartbeats while it
+    sends). If the connection was lost, it is reopened at the
+    next send.
+    '''
+    def __service_heartbeats(self):
+        if not self.__lock.acquire(False):
+            return
+        try:
+            if self.__is_connection_alive():
+                self.__connection.process_data_events()
+                self.__connection_last_process_event_call = time.time()
+        except pika.exceptions.AMQPError as e:
+            logwarn(LOGGER, 'Lost idle connection to RabbitMQ (%s). Reconnecting at next message.', e.__class__.__name__)
+            self.__communication_established = False
+        finally:
+            self.__lock.release()
+
+    def __reconnect(self, e):
+        logwarn(LOGGER, 'Lost connection to RabbitMQ (%s). Reconnecting (persistent session).', e.__class__.__name__)
+        self.__communication_established = False
+        self.__open_rabbit_connection()
+
     ####################
     ### Send message ###
     ####################
@@ -300,12 +403,18 @@ class SynchronousRabbitConnector(object):
     delivery was not successful, an exception is raised.
 
     :param: JSON message. TODO what needs to be included?
+        (May be serialized already, as envelope.)
     :raises: esgfpid.exceptions.MessageNotDeliveredException:
         In case the message was not delivered.
     '''
     def send_message_to_queue(self, message):
+        with self.__lock:
+            self.__send_message_to_queue(message)
+
+    def __send_message_to_queue(self, message):
         self.__open_connection_if_not_open()
-        routing_key, msg_string = rabbitutils.get_routing_key_and_string_message_from_message_if_possible(message)
+        envelope = rabbitutils.make_message_envelope(message)
+        routing_key, msg_string = envelope.routing_key, envelope.body
         success = False
         error_msg = None
 
@@ -329,8 +438,146 @@ class SynchronousRabbitConnector(object):
         if not success:
             raise MessageNotDeliveredException(error_msg, msg_string)
 
+    '''
+    Send many messages to RabbitMQ, synchronously. If any
+    delivery was not successful, an exception is raised.
+
+    Unlike calling send_message_to_queue() for every message,
+    this does not wait for the confirm of one message before
+    publishing the next one: Up to RABBIT_SYN_CONFIRM_WINDOW
+    messages are published and not confirmed yet at any time,
+    and their confirms are collected as they arrive.
+
+    Messages that were nacked, returned (unroutable) or not
+    confirmed in time are sent again one by one, using
+    send_message_to_queue() (with its retries and emergency
+    routing key). Note that a message that was not confirmed
+    in time may still have been delivered (its confirm may
+    arrive after we gave up, when the channel is closed
+    already), so it may be delivered twice.
+
+    If pipelining is not supported with the installed pika
+    version, all messages are sent one by one.
+
+    :param messages: List of JSON messages (may be serialized
+        already, as envelopes).
+    :raises: esgfpid.exceptions.MessageNotDeliveredException:
+        In case any message was not delivered. Its "rabbit_msg"
+        is the list of the undelivered messages (as strings).
+    '''
+    def send_many_messages(self, messages):
+        with self.__lock:
+            self.__send_many_messages(messages)
+
+    def __send_many_messages(self, messages):
+        self.__open_connection_if_not_open()
+        envelopes = [rabbitutils.make_message_envelope(msg) for msg in messages]
+        not_confirmed = self.__send_many_messages_pipelined(envelopes)
+
+        undelivered = []
+        if len(not_confirmed) > 0:
+            loginfo(LOGGER, '%i of %i messages were not confirmed. Sending them one by one.', len(not_confirmed), len(envelopes))
+            for envelope in not_confirmed:
+                try:
+                    self.__send_message_to_queue(envelope)
+                except MessageNotDeliveredException:
+                    undelivered.append(envelope.body)
+
+        if len(undelivered) > 0:
+            error_msg = '%i of %i messages were not delivered' % (len(undelivered), len(envelopes))
+            logerror(LOGGER, error_msg)
+            raise MessageNotDeliveredException(error_msg, undelivered)
+
+    '''
+    Publishes the messages on a separate channel, keeping
+    up to the window size of them unconfirmed.
+
+    :return: List of the envelopes that were not confirmed
+        (nacked, returned, timed out, or not published at all
+        because the channel broke down).
+    '''
+    def __send_many_messages_pipelined(self, envelopes):
+        window = ConfirmWindow()
+        num_published = 0
+        channel = None
+        try:
+            channel = self.__make_pipelining_channel(window)
+            if channel is None:
+                return list(envelopes)
+            timed_out = False
+            for envelope in envelopes:
+                if not self.__wait_for_confirms(window, self.__confirm_window_size-1):
+                    timed_out = True
+                    break
+                self.__do_send_message_without_waiting(channel, envelope.routing_key, envelope.body, self.__props)
+                window.add(envelope)
+                num_published += 1
+            if not timed_out: # or we would wait twice as long
+                self.__wait_for_confirms(window, 0)
+            logdebug(LOGGER, 'Pipelined %i messages, %i confirmed.', num_published, window.get_num_confirmed())
+
+        except pika.exceptions.AMQPError as e:
+            logwarn(LOGGER, 'Error while pipelining messages (%s: %s).', e.__class__.__name__, e)
+
+        finally:
+            self.__close_pipelining_channel(channel)
+
+        window.give_up()
+        return window.get_not_confirmed() + envelopes[num_published:]
+
+    '''
+    Lets pika process the incoming confirms, until no more
+    than the given number of messages are unconfirmed.
+
+    :return: True if this was reached, False if the confirms
+        did not arrive in time.
+    '''
+    def __wait_for_confirms(self, window, max_in_flight):
+        deadline = time.time() + self.__confirm_timeout_seconds
+        while window.get_num_in_flight() > max_in_flight:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logwarn(LOGGER, 'No confirms from messaging service within %s seconds (%i unconfirmed).', self.__confirm_timeout_seconds, window.get_num_in_flight())
+                return False
+            self.__connection.process_data_events(time_limit=remaining)
+        return True
+
+    '''
+    Opens a channel on which messages can be published
+    without blocking until each is confirmed (see
+    pipeliningchannel.py).
+
+    :return: The channel, or None if this is not supported
+        with the installed pika version.
+    '''
+    def __make_pipelining_channel(self, window): # This is easy to mock during unit tests
+        channel = self.__connection.channel()
+        if not pipeliningchannel.is_supported(channel):
+            self.__close_pipelining_channel(channel)
+            return None
+        return pipeliningchannel.PipeliningChannel(channel, window)
+
+    def __close_pipelining_channel(self, channel):
+        try:
+            if channel is not None and channel.is_open:
+                channel.close()
+        except pika.exceptions.AMQPError as e:
+            logdebug(LOGGER, 'Error while closing pipelining channel (%s: %s).', e.__class__.__name__, e)
+
+    def __do_send_message_without_waiting(self, channel, routing_key, messagebody, props): # This is easy to mock during unit tests
+        channel.basic_publish(
+            exchange=self.__get_exchange_name(),
+            routing_key=routing_key,
+            body=messagebody,
+            mandatory=self.__mandatory_flag,
+            properties=props
+        )
+
     def __open_connection_if_not_open(self):
-        if not self.__communication_established:
+        if self.__persistent_session:
+            if not self.__is_connection_alive():
+                self.open_rabbit_connection()
+        elif not self.__communication_established:
             self.open_rabbit_connection()
 
     def __try_sending_message_several_times(self, routing_key, message):
@@ -372,7 +619,13 @@ class SynchronousRabbitConnector(object):
     def __send_message_to_queue_once(self, routing_key, messagebody):
         delivered = False
         try:
-            delivered = self.__do_send_message(routing_key, messagebody, self.__props)
+            try:
+                delivered = self.__do_send_message(routing_key, messagebody, self.__props)
+            except (pika.exceptions.ConnectionClosed, pika.exceptions.ChannelClosed) as e:
+                if not self.__persistent_session:
+                    raise
+                self.__reconnect(e)
+                delivered = self.__do_send_message(routing_key, messagebody, self.__props)
             self.__avoid_connection_shutdown()
             
         except pika.exceptions.UnroutableError:
@@ -0,0 +1,231 @@
+import logging
+import threading
+import collections
+import copy
+import time
+import esgfpid.defaults
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+This class keeps the results of solr lookups in memory,
+so that repeated lookups for the same dataset (e.g. an
+unpublication followed by a republication during one
+publication session) do not need another query.
+
+The entries are keyed by the task and its arguments, the
+first argument always being the drs_id, so that all entries
+of a dataset can be invalidated after we published or
+unpublished it ourselves.
+
+ - Entries expire after a time-to-live.
+ - Empty results are cached too, but for a shorter time, as
+   they are likely to change soon (e.g. while the index is
+   being updated).
+ - Errors are never cached.
+ - If there are too many entries, the least recently used
+   ones are dropped.
+ - If several threads ask for the same key at the same time,
+   only the first one queries solr. The others wait for its
+   result (or its exception).
+
+'''
+class SolrCache(object):
+
+    '''
+    :param max_entries: Optional. How many results to keep.
+        0 switches the cache off. Defaults to SOLR_CACHE_MAX_ENTRIES.
+    :param ttl_seconds: Optional. How long to keep a result.
+        Defaults to SOLR_CACHE_TTL_SECONDS.
+    :param negative_ttl_seconds: Optional. How long to keep an
+        empty result. Defaults to SOLR_CACHE_NEGATIVE_TTL_SECONDS.
+    '''
+    def __init__(self, max_entries=None, ttl_seconds=None, negative_ttl_seconds=None):
+        if max_entries is None:
+            max_entries = esgfpid.defaults.SOLR_CACHE_MAX_ENTRIES
+        if ttl_seconds is None:
+            ttl_seconds = esgfpid.defaults.SOLR_CACHE_TTL_SECONDS
+        if negative_ttl_seconds is None:
+            negative_ttl_seconds = esgfpid.defaults.SOLR_CACHE_NEGATIVE_TTL_SECONDS
+        self.__max_entries = max_entries
+        self.__ttl_seconds = ttl_seconds
+        self.__negative_ttl_seconds = negative_ttl_seconds
+        self.__lock = threading.Lock()
+        # key -> (expiry time, result), least recently used first
+        self.__entries = collections.OrderedDict()
+        # key -> _InFlight, for the lookups that are running
+        self.__in_flight = {}
+        self.__num_hits = 0
+        self.__num_misses = 0
+
+    # easy to mock/patch in unit test!
+    def __get_time(self):
+        return time.time()
+
+    '''
+    Return the cached result for the key, or call the fetch
+    function to get it (once, even if several threads ask).
+
+    :param key: Tuple. Its first item must be the drs_id.
+    :param fetch: Function without arguments that queries solr.
+        Its exceptions are passed on to all callers of this key.
+    :param is_empty: Function that tells whether a result is empty.
+    :return: A copy of the result, so callers can modify it.
+    '''
+    def get_or_fetch(self, key, fetch, is_empty):
+        if self.__max_entries <= 0:
+            return fetch()
+
+        with self.__lock:
+            result = self.__get_if_valid(key)
+            if result is not None:
+                self.__num_hits += 1
+                logdebug(LOGGER, 'Solr cache hit for %s.', key)
+                return copy.deepcopy(result)
+            in_flight = self.__in_flight.get(key)
+            is_leader = in_flight is None
+            if is_leader:
+                self.__num_misses += 1
+                in_flight = _InFlight()
+                self.__in_flight[key] = in_flight
+
+        if is_leader:
+            self.__fetch_and_store(key, fetch, is_empty, in_flight)
+        else:
+            logdebug(LOGGER, 'Waiting for running solr lookup for %s.', key)
+            in_flight.done.wait()
+
+        if in_flight.error is not None:
+            raise in_flight.error
+        return copy.deepcopy(in_flight.result)
+
+    def __get_if_valid(self, key):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        expiry, result = entry
+        if expiry <= self.__get_time():
+            del self.__entries[key]
+            return None
+        # Move to the end, as it was used most recently:
+        del self.__entries[key]
+        self.__entries[key] = entry
+        return result
+
+    def __fetch_and_store(self, key, fetch, is_empty, in_flight):
+        try:
+            in_flight.result = fetch()
+        except Exception as e:
+            in_flight.error = e
+        with self.__lock:
+            # Only store if nobody invalidated it meanwhile:
+            if self.__in_flight.get(key) is in_flight:
+                del self.__in_flight[key]
+                if in_flight.error is None:
+                    self.__store(key, in_flight.result, is_empty(in_flight.result))
+        in_flight.done.set()
+
+    def __store(self, key, result, empty):
+        ttl = self.__negative_ttl_seconds if empty else self.__ttl_seconds
+        if ttl <= 0:
+            return
+        self.__entries.pop(key, None)
+        self.__entries[key] = (self.__get_time()+ttl, result)
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+
+    '''
+    :return: The cached result for the key, or None. It must
+        not be modified.
+    '''
+    def get(self, key):
+        if self.__max_entries <= 0:
+            return None
+        with self.__lock:
+            result = self.__get_if_valid(key)
+            if result is not None:
+                self.__num_hits += 1
+            return result
+
+    '''
+    Like :func:`get`, but if a lookup for the key is running,
+    wait for its result instead of starting another one.
+
+    :return: The cached result for the key, the result of the
+        running lookup, or None (also if that lookup failed).
+        It must not be modified.
+    '''
+    def get_or_wait(self, key):
+        if self.__max_entries <= 0:
+            return None
+        with self.__lock:
+            result = self.__get_if_valid(key)
+            if result is not None:
+                self.__num_hits += 1
+                return result
+            in_flight = self.__in_flight.get(key)
+            if in_flight is None:
+                return None
+            self.__num_hits += 1
+
+        logdebug(LOGGER, 'Waiting for running solr lookup for %s.', key)
+        in_flight.done.wait()
+        return in_flight.result
+
+    '''
+    Store a result that was retrieved elsewhere (e.g. for
+    many datasets at once).
+
+    :param key: Tuple. Its first item must be the drs_id.
+    :param result: The result.
+    :param empty: Whether the result is empty.
+    '''
+    def put(self, key, result, empty):
+        if self.__max_entries <= 0:
+            return
+        with self.__lock:
+            self.__store(key, result, empty)
+
+    '''
+    Drop all results for the dataset, e.g. after we sent a
+    publication or unpublication for it. Lookups that are
+    running now are not stored.
+
+    :param drs_id: The drs_id of the dataset.
+    '''
+    def invalidate(self, drs_id):
+        with self.__lock:
+            keys = [key for key in self.__entries if key[0] == drs_id]
+            for key in keys:
+                del self.__entries[key]
+            running = [key for key in self.__in_flight if key[0] == drs_id]
+            for key in running:
+                del self.__in_flight[key]
+        if len(keys) > 0:
+            logdebug(LOGGER, 'Invalidated %i solr cache entries for "%s".', len(keys), drs_id)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__in_flight.clear()
+
+    '''
+    :return: Dict with the number of entries, hits and misses.
+    '''
+    def get_status(self):
+        with self.__lock:
+            return dict(
+                num_entries=len(self.__entries),
+                num_hits=self.__num_hits,
+                num_misses=self.__num_misses
+            )
+
+
+class _InFlight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
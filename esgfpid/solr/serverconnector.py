@@ -1,5 +1,8 @@
 import logging
 import requests
+import requests.adapters
+from requests.packages.urllib3.util.retry import Retry
+import os
 import sys
 import json
 import esgfpid.utils
@@ -18,6 +21,12 @@ validate and parse the result and return it.
 It basically only provides one method,
 :func:`~solr.SolrServerConnector.send_query`.
 
+The queries are sent through a session that keeps
+a pool of connections to the solr instance open, so
+that many queries in a row (e.g. the consistency checks
+of many datasets) do not need a new TCP connection and
+TLS handshake each.
+
 '''
 class SolrServerConnector(object):
 
@@ -27,21 +36,51 @@ class SolrServerConnector(object):
     :param solr_url: Mandatory.
     :param https_verify: Mandatory. Boolean.
     :param disable_insecure_request_warning: Mandatory. Boolean.
+    :param pool_maxsize: Optional. Number of connections to keep
+        open. Defaults to SOLR_HTTP_POOL_MAXSIZE.
+    :param keep_alive: Optional. Boolean. Whether to reuse the
+        connections. Defaults to SOLR_HTTP_KEEP_ALIVE.
+    :param max_retries: Optional. How often to retry a query after
+        connection errors or HTTP 502/503/504. Defaults to
+        SOLR_HTTP_MAX_RETRIES.
+    :param gzip: Optional. Boolean. Whether to ask for compressed
+        responses. Defaults to SOLR_HTTP_GZIP.
     '''
     def __init__(self, **args):
         self.__check_presence_of_args(args)
+        self.__define_defaults_for_optional_args(args)
         self.__set_attributes(args)
         self.__disable_warning_if_desired(args)
+        self.__session = self.__make_session()
+        self.__pid = self.__getpid()
 
     def __check_presence_of_args(self, args):
         mandatory_args = ['solr_url', 'https_verify', 'disable_insecure_request_warning']
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
         esgfpid.utils.check_noneness_of_mandatory_args(args, mandatory_args)
 
+    def __define_defaults_for_optional_args(self, args):
+        if 'pool_maxsize' not in args or args['pool_maxsize'] is None:
+            args['pool_maxsize'] = esgfpid.defaults.SOLR_HTTP_POOL_MAXSIZE
+        if 'keep_alive' not in args or args['keep_alive'] is None:
+            args['keep_alive'] = esgfpid.defaults.SOLR_HTTP_KEEP_ALIVE
+        if 'max_retries' not in args or args['max_retries'] is None:
+            args['max_retries'] = esgfpid.defaults.SOLR_HTTP_MAX_RETRIES
+        if 'gzip' not in args or args['gzip'] is None:
+            args['gzip'] = esgfpid.defaults.SOLR_HTTP_GZIP
+
     def __set_attributes(self, args):
         self.__solr_url = args['solr_url'].strip('/')
         self.__https_verify = args['https_verify']
         self.__solr_headers = {'Accept': 'application/json,text/json', 'Content-Type': 'application/json'}
+        self.__pool_maxsize = args['pool_maxsize']
+        self.__max_retries = args['max_retries']
+        if args['gzip']:
+            self.__solr_headers['Accept-Encoding'] = 'gzip'
+        else:
+            self.__solr_headers['Accept-Encoding'] = 'identity'
+        if not args['keep_alive']:
+            self.__solr_headers['Connection'] = 'close'
 
     def __disable_warning_if_desired(self, args):
         if args['disable_insecure_request_warning']:
@@ -53,6 +92,57 @@ class SolrServerConnector(object):
         from requests.packages.urllib3.exceptions import InsecureRequestWarning
         requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+    # easy to mock/patch in unit test!
+    def __getpid(self):
+        return os.getpid()
+
+    '''
+    The session, with one connection pool for the solr
+    instance (both for http and https), which retries
+    idempotent requests with exponential backoff. Requests
+    decompresses gzip responses on its own.
+    '''
+    def __make_session(self):
+        logdebug(LOGGER, 'Creating HTTP session for solr (pool size %s, %s retries).',
+            self.__pool_maxsize, self.__max_retries)
+        retry = Retry(
+            total=self.__max_retries,
+            backoff_factor=esgfpid.defaults.SOLR_HTTP_RETRY_BACKOFF_FACTOR,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False # we want the last response, to report its code
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.__pool_maxsize,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.headers.update(self.__solr_headers)
+        session.verify = self.__https_verify
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    '''
+    Sockets must not be shared with a parent process
+    after a fork, so a child gets its own session.
+    '''
+    def __get_session(self):
+        pid = self.__getpid()
+        if pid != self.__pid:
+            logdebug(LOGGER, 'Process %s was forked from %s, creating new HTTP session for solr.', pid, self.__pid)
+            self.__pid = pid
+            self.__session = self.__make_session()
+        return self.__session
+
+    '''
+    Close the pooled connections to solr. A later query
+    opens new ones.
+    '''
+    def close(self):
+        logdebug(LOGGER, 'Closing HTTP session for solr.')
+        self.__session.close()
+
     '''
     Send a message to a solr instance.
 
@@ -70,14 +160,43 @@ class SolrServerConnector(object):
         response_json = self.__get_json_from_response(response)
         return response_json
 
-    def __get_request_to_solr(self, query_dict):
+    '''
+    Send a message to a solr instance, and return the
+    response content piece by piece while it arrives
+    (decompressed, but not parsed), so that large
+    responses need not be kept in memory.
+
+    The same errors as in
+    :func:`~solr.SolrServerConnector.send_query` are raised,
+    either right away or while iterating (if the connection
+    breaks off).
+
+     :raises: esgfpid.exceptions.SolrError
+     :return: A generator of byte strings.
+    '''
+    def send_query_and_stream(self, query):
+        response = self.__get_request_to_solr(query, stream=True)
+        try:
+            self.__check_response_for_error_codes(response, check_content=False)
+            for chunk in response.iter_content(esgfpid.defaults.SOLR_STREAM_CHUNK_BYTES):
+                yield chunk
+        except requests.exceptions.RequestException as e:
+            msg = 'Connection to solr broke off while reading the response: %s.' % e.__class__.__name__
+            logerror(LOGGER, msg)
+            raise esgfpid.exceptions.SolrError(msg)
+        finally:
+            if response is not None:
+                response.close()
+
+    def __get_request_to_solr(self, query_dict, stream=False):
         logdebug(LOGGER, 'Sending GET request to solr at "'+self.__solr_url+'".')
         try:
-            resp = requests.get(
+            resp = self.__get_session().get(
                 self.__solr_url,
                 params=query_dict,
                 headers=self.__solr_headers,
-                verify=self.__https_verify
+                verify=self.__https_verify,
+                stream=stream
             )
             return resp
         except requests.exceptions.ConnectionError as e:
@@ -96,7 +215,7 @@ class SolrServerConnector(object):
             logerror(LOGGER, msg)
             raise esgfpid.exceptions.SolrError(msg)
 
-    def __check_response_for_error_codes(self, response):
+    def __check_response_for_error_codes(self, response, check_content=True):
 
         if response is None:
             msg = 'Solr returned no response (None)'
@@ -104,7 +223,7 @@ class SolrServerConnector(object):
             raise esgfpid.exceptions.SolrError(msg)
 
         elif response.status_code == 200:
-            if response.content is None:
+            if check_content and response.content is None:
                 msg = 'Solr returned an empty response (with content None)'
                 logerror(LOGGER, msg)
                 raise esgfpid.exceptions.SolrError(msg)
@@ -1,10 +1,13 @@
 import logging
+import threading
 import requests
 import json
 import esgfpid.utils
 import esgfpid.solr.tasks.filehandles_same_dataset
+import esgfpid.solr.tasks.filehandles_many_datasets
 import esgfpid.solr.tasks.all_versions_of_dataset
 import esgfpid.solr.serverconnector
+import esgfpid.solr.cache
 import esgfpid.defaults
 import esgfpid.exceptions
 from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
@@ -40,6 +43,13 @@ class SolrInteractor(object):
     :param solr_url: Mandatory if not switched off.
     :param https_verify: Mandatory if not switched off.
     :param disable_insecure_request_warning: Mandatory if not switched off.
+    :param http_pool_maxsize: Optional. See SolrServerConnector.
+    :param http_keep_alive: Optional. See SolrServerConnector.
+    :param http_max_retries: Optional. See SolrServerConnector.
+    :param http_gzip: Optional. See SolrServerConnector.
+    :param cache_max_entries: Optional. See SolrCache.
+    :param cache_ttl_seconds: Optional. See SolrCache.
+    :param file_handle_query_mode: Optional. See FindFilesOfSameDatasetVersion.
     '''
     def __init__(self, **args):
 
@@ -67,12 +77,23 @@ class SolrInteractor(object):
         self.__switched_on = False
         self.__prefix = None
         self.__solr_server_connector = None
+        self.__cache = None
+        self.__prefetched = None
+        self.__file_handle_query_mode = None
 
     def __init_with_access(self, args):
         self.__switched_on = True
         self.__check_presence_of_args(args)
         self.__prefix = args['prefix']
+        self.__set_file_handle_query_mode(args)
         self.__make_server_connector(args)
+        self.__cache = esgfpid.solr.cache.SolrCache(
+            max_entries = args.get('cache_max_entries'),
+            ttl_seconds = args.get('cache_ttl_seconds')
+        )
+        # (drs_id, 'file_handles', version_number, data_node) -> handles, until used:
+        self.__prefetched = {}
+        self.__prefetched_lock = threading.Lock()
 
     def __check_presence_of_args(self, args):
         mandatory_args = ['solr_url', 'prefix', 'https_verify',
@@ -80,11 +101,23 @@ class SolrInteractor(object):
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
         esgfpid.utils.check_noneness_of_mandatory_args(args, mandatory_args)
 
+    def __set_file_handle_query_mode(self, args):
+        mode = args.get('file_handle_query_mode') or esgfpid.defaults.SOLR_FILE_HANDLE_QUERY_MODE
+        allowed = esgfpid.solr.tasks.filehandles_same_dataset.FindFilesOfSameDatasetVersion.MODES
+        if mode not in allowed:
+            msg = 'Unknown query mode for file handles: "%s". Allowed: %s' % (mode, ', '.join(allowed))
+            raise esgfpid.exceptions.ArgumentError(msg)
+        self.__file_handle_query_mode = mode
+
     def __make_server_connector(self, args):
         self.__solr_server_connector = esgfpid.solr.serverconnector.SolrServerConnector(
             solr_url = args['solr_url'],
             https_verify = args ['https_verify'],
-            disable_insecure_request_warning = args['disable_insecure_request_warning']
+            disable_insecure_request_warning = args['disable_insecure_request_warning'],
+            pool_maxsize = args.get('http_pool_maxsize'),
+            keep_alive = args.get('http_keep_alive'),
+            max_retries = args.get('http_max_retries'),
+            gzip = args.get('http_gzip')
         )
 
     # Getter
@@ -99,6 +132,31 @@ class SolrInteractor(object):
     def is_switched_off(self):
         return not self.__switched_on
 
+    '''
+    :returns: Dict with the number of entries, hits and
+        misses of the cache, and the number of prefetched
+        results not used yet, or None if switched off.
+    '''
+    def get_cache_status(self):
+        if self.__switched_on:
+            status = self.__cache.get_status()
+            with self.__prefetched_lock:
+                status['num_prefetched'] = len(self.__prefetched)
+            return status
+
+    '''
+    Forget the cached lookup results for a dataset. To be
+    called after publishing or unpublishing it, as solr
+    will change.
+    '''
+    def invalidate_cache(self, drs_id):
+        if self.__switched_on:
+            self.__cache.invalidate(drs_id)
+            with self.__prefetched_lock:
+                keys = [key for key in self.__prefetched if key[0] == drs_id]
+                for key in keys:
+                    del self.__prefetched[key]
+
     # Methods called by tasks:
 
     def send_query(self, query):
@@ -110,6 +168,15 @@ class SolrInteractor(object):
             LOGGER.debug(msg)
             raise esgfpid.exceptions.SolrSwitchedOff(msg)
 
+    def send_query_and_stream(self, query):
+        ''' This method is called by the tasks. It is redirected to the submodule.'''
+        if self.__switched_on:
+            return self.__solr_server_connector.send_query_and_stream(query)
+        else:
+            msg = 'Not sending query'
+            LOGGER.debug(msg)
+            raise esgfpid.exceptions.SolrSwitchedOff(msg)
+
     def make_solr_base_query(self):
         query_dict = {}
         query_dict['distrib'] = esgfpid.defaults.SOLR_QUERY_DISTRIB
@@ -141,12 +208,121 @@ class SolrInteractor(object):
             msg = 'Cannot retrieve handles of files of the same dataset.'
             raise esgfpid.exceptions.SolrSwitchedOff(msg)
 
+    def __make_key_for_file_handles(self, drs_id, version_number, data_node):
+        return (drs_id, 'file_handles', str(version_number), data_node)
+
     def __retrieve_file_handles_of_same_dataset(self, **args):
-        finder = esgfpid.solr.tasks.filehandles_same_dataset.FindFilesOfSameDatasetVersion(self)
+        key = self.__make_key_for_file_handles(args['drs_id'], args['version_number'], args['data_node'])
+        file_handles = self.__take_prefetched(key)
+        if file_handles is not None:
+            return file_handles
+        fetch = lambda: self.__retrieve_file_handles_of_same_dataset_from_solr(**args)
+        return self.__cache.get_or_fetch(key, fetch, lambda handles: len(handles) == 0)
+
+    '''
+    Remove prefetched handles from the store and put them into
+    the cache instead, where they stay for repeated lookups
+    like any other result.
+
+    :return: The prefetched handles for the key, or None.
+    '''
+    def __take_prefetched(self, key):
+        with self.__prefetched_lock:
+            file_handles = self.__prefetched.pop(key, None)
+        if file_handles is not None:
+            logdebug(LOGGER, 'Using prefetched file handles for %s.', key)
+            self.__cache.put(key, file_handles, False)
+            return list(file_handles)
+        return None
+
+    def __retrieve_file_handles_of_same_dataset_from_solr(self, **args):
+        finder = esgfpid.solr.tasks.filehandles_same_dataset.FindFilesOfSameDatasetVersion(
+            self, mode=self.__file_handle_query_mode)
         args['prefix'] = self.__prefix
         file_handles = finder.retrieve_file_handles_of_same_dataset(**args)
         return file_handles
 
+    def iterate_file_handles_of_same_dataset(self, **args):
+        '''
+        Like :func:`retrieve_file_handles_of_same_dataset`, but
+        returns the handles while they arrive from solr, so large
+        datasets need not be kept in memory.
+
+        Only the 'sequential' query mode streams. The 'concurrent'
+        and 'hedged' modes need the complete result of both queries
+        to pick one, so there, the handles are retrieved (and
+        cached) as in :func:`retrieve_file_handles_of_same_dataset`.
+
+        When streaming, the handles are taken from the prefetched
+        ones or the cache if they are there, or from a lookup for
+        the same dataset that is running already. The streamed
+        handles are not put into the cache, as that would mean
+        keeping them all in memory, which streaming is meant
+        to avoid.
+
+        :return: Iterator of handles, possibly none.
+        :raise: SolrSwitchedOff (at once)
+        :raise SolrError: While iterating, if both strategies to
+            find file handles failed (at once if not streaming).
+        '''
+        mandatory_args = ['drs_id', 'version_number', 'data_node']
+        esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+
+        if not self.__switched_on:
+            msg = 'Cannot retrieve handles of files of the same dataset.'
+            raise esgfpid.exceptions.SolrSwitchedOff(msg)
+
+        if self.__file_handle_query_mode != 'sequential':
+            return iter(self.__retrieve_file_handles_of_same_dataset(**args))
+
+        key = self.__make_key_for_file_handles(args['drs_id'], args['version_number'], args['data_node'])
+        file_handles = self.__take_prefetched(key) or self.__cache.get_or_wait(key)
+        if file_handles is not None:
+            return iter(file_handles)
+
+        finder = esgfpid.solr.tasks.filehandles_same_dataset.FindFilesOfSameDatasetVersion(
+            self, mode=self.__file_handle_query_mode)
+        args['prefix'] = self.__prefix
+        return finder.iterate_file_handles_of_same_dataset(**args)
+
+    # Task 1, for many datasets
+
+    def prefetch_file_handles_of_many_datasets(self, datasets):
+        '''
+        Retrieve the file handles of many datasets in a few
+        batched queries and keep them, so that the consistency
+        checks of these datasets need no query.
+
+        They are not kept in the cache, whose size and time-to-live
+        are too small for many datasets that are published one after
+        the other. Instead, they are kept (in memory) until the
+        first lookup of each dataset takes them, or until the
+        dataset is invalidated.
+
+        Datasets whose files were not found are not kept, so
+        their consistency check will query solr as usual.
+
+        :param datasets: List of tuples (drs_id, version_number, data_node).
+        :return: Dict: (drs_id, version_number, data_node) -> list
+            of handles (empty if none were found, None if the
+            query failed).
+        :raise: SolrSwitchedOff
+        '''
+        if not self.__switched_on:
+            msg = 'Cannot retrieve handles of files of many datasets.'
+            raise esgfpid.exceptions.SolrSwitchedOff(msg)
+
+        finder = esgfpid.solr.tasks.filehandles_many_datasets.FindFilesOfManyDatasetVersions(self)
+        result = finder.retrieve_file_handles_of_many_datasets(datasets, self.__prefix)
+        num_found = 0
+        with self.__prefetched_lock:
+            for dataset, file_handles in result.iteritems():
+                if file_handles:
+                    self.__prefetched[self.__make_key_for_file_handles(*dataset)] = file_handles
+                    num_found += 1
+        logdebug(LOGGER, 'Prefetched the files of %i of %i datasets.', num_found, len(result))
+        return result
+
     # Task 2
 
     def retrieve_datasethandles_or_versionnumbers_of_allversions(self, drs_id):
@@ -160,6 +336,15 @@ class SolrInteractor(object):
             raise esgfpid.exceptions.SolrSwitchedOff(msg)
 
     def __retrieve_datasethandles_or_versionnumbers_of_allversions(self, drs_id):
+        key = (drs_id, 'all_versions')
+        fetch = lambda: self.__retrieve_datasethandles_or_versionnumbers_of_allversions_from_solr(drs_id)
+        return self.__cache.get_or_fetch(key, fetch, self.__is_empty_result_of_allversions)
+
+    def __is_empty_result_of_allversions(self, result_dict):
+        return (not result_dict['dataset_handles'] and
+                not result_dict['version_numbers'])
+
+    def __retrieve_datasethandles_or_versionnumbers_of_allversions_from_solr(self, drs_id):
         finder = esgfpid.solr.tasks.all_versions_of_dataset.FindVersionsOfSameDataset(self)
         result_dict = finder.retrieve_dataset_handles_or_version_numbers_of_all_versions(drs_id, self.__prefix)
         return result_dict
@@ -0,0 +1,104 @@
+import esgfpid.utils
+import esgfpid.exceptions
+import esgfpid.defaults
+import logging
+from . import utils as solrutils
+from esgfpid.utils import loginfo, logdebug, logtrace, logerror, logwarn
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+Finds the handles of the files of many dataset versions in a
+few queries, instead of one or two per dataset.
+
+The datasets are asked for in batches, each in one query
+that OR's their exact dataset_ids (i.e. like the first
+strategy of :class:`~esgfpid.solr.tasks.filehandles_same_dataset.FindFilesOfSameDatasetVersion`).
+Instead of facets, the file documents are retrieved (only
+their dataset_id and tracking_id), page by page, and grouped
+by dataset.
+
+Datasets whose files were not found (e.g. as they were
+published at a different data node) are not retried with
+the second strategy here. Their lookup is left to the
+per-dataset task.
+'''
+class FindFilesOfManyDatasetVersions(object):
+
+    '''
+    :param solr_interactor: Mandatory.
+    :param datasets_per_query: Optional. Defaults to
+        SOLR_BULK_DATASETS_PER_QUERY.
+    :param page_size: Optional. Defaults to SOLR_BULK_PAGE_SIZE.
+    '''
+    def __init__(self, solr_interactor, datasets_per_query=None, page_size=None):
+        self.__solr_interactor = solr_interactor
+        self.__datasets_per_query = datasets_per_query or esgfpid.defaults.SOLR_BULK_DATASETS_PER_QUERY
+        self.__page_size = page_size or esgfpid.defaults.SOLR_BULK_PAGE_SIZE
+
+    '''
+    :param datasets: List of tuples (drs_id, version_number, data_node).
+    :param prefix: The handle prefix.
+    :return: Dict: (drs_id, version_number, data_node) -> list of
+        handles, or None if the query of its batch failed. The
+        list is empty if no files were found. Never returns None.
+    :raise: SolrSwitchedOff
+    '''
+    def retrieve_file_handles_of_many_datasets(self, datasets, prefix):
+        result = {}
+        datasets = list(datasets)
+        num_batches = 0
+        for start in xrange(0, len(datasets), self.__datasets_per_query):
+            batch = datasets[start:start+self.__datasets_per_query]
+            result.update(self.__retrieve_batch(batch, prefix))
+            num_batches += 1
+        logdebug(LOGGER, 'Asked solr for the files of %i datasets in %i batches.', len(datasets), num_batches)
+        return result
+
+    def __retrieve_batch(self, batch, prefix):
+        dataset_ids = {}
+        for dataset in batch:
+            dataset_ids[self.__make_dataset_id(*dataset)] = dataset
+
+        try:
+            handles_by_dataset_id = self.__ask_solr_for_handles_of_files_of_datasets(dataset_ids.keys(), prefix)
+        except (esgfpid.exceptions.SolrError, esgfpid.exceptions.SolrResponseError) as e:
+            logwarn(LOGGER, 'Could not retrieve the files of %i datasets from solr: %s', len(batch), e.message)
+            return dict((dataset, None) for dataset in batch)
+
+        result = {}
+        for dataset_id, dataset in dataset_ids.iteritems():
+            result[dataset] = handles_by_dataset_id.get(dataset_id, [])
+        return result
+
+    def __make_dataset_id(self, drs_id, version_number, data_node):
+        return drs_id + '.v' + str(version_number) + '|' + data_node
+
+    # Querying solr for the files of several datasets, page by page:
+
+    def __ask_solr_for_handles_of_files_of_datasets(self, dataset_ids, prefix):
+        handles_by_dataset_id = {}
+        offset = 0
+        while True:
+            query = self.__make_query_for_files_of_datasets(dataset_ids, offset)
+            LOGGER.debug('Query: %s', query)
+            response_json = self.__solr_interactor.send_query(query) # can raise SolrError or SolrSwitchedOff, but can't be None
+            page = solrutils.extract_file_handles_by_dataset_from_response_json(response_json, prefix) # can raise SolrResponseError
+            for dataset_id, handles in page.iteritems():
+                handles_by_dataset_id.setdefault(dataset_id, set()).update(handles)
+            offset += self.__page_size
+            if offset >= solrutils.extract_num_found_from_response_json(response_json):
+                break
+        return dict((dataset_id, list(handles)) for dataset_id, handles in handles_by_dataset_id.iteritems())
+
+    def __make_query_for_files_of_datasets(self, dataset_ids, offset):
+        query_dict = self.__solr_interactor.make_solr_base_query()
+        query_dict['type'] = 'File'
+        query_dict['fields'] = 'dataset_id,tracking_id'
+        query_dict['limit'] = self.__page_size
+        query_dict['offset'] = offset
+        quoted = ['"%s"' % dataset_id for dataset_id in sorted(dataset_ids)]
+        query_dict['query'] = 'dataset_id:(' + ' OR '.join(quoted) + ')'
+        return query_dict
@@ -1,17 +1,60 @@
 import esgfpid.utils
 import esgfpid.exceptions
+import esgfpid.defaults
 import logging
+import threading
 from . import utils as solrutils
 
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+'''
+Finds the handles of the files of a dataset version, using
+two queries: The first one (exact dataset_id, i.e. same data
+node) and, if that returns nothing, the second one (any data
+node).
+
+How the two queries are sent depends on the mode:
+
+ - 'sequential': The second query is only sent after the first
+   one returned nothing.
+ - 'concurrent': Both are sent at once.
+ - 'hedged': The second query is sent if the first one did not
+   return (or returned nothing) after a short delay.
+
+In all modes, the result is the same: The result of the first
+query if it is not empty, otherwise the result of the second
+query. In the concurrent and hedged modes, a query whose
+result is not needed anymore is not waited for (HTTP requests
+cannot be aborted, so it finishes in the background and its
+result is discarded).
+
+In all modes, each query is sent in pages (facet limit/offset),
+so that datasets with very many files are not cut off. For
+these, the handles can also be streamed (see
+:func:`iterate_file_handles_of_same_dataset`).
+'''
 class FindFilesOfSameDatasetVersion(object):
 
-    def __init__(self, solr_interactor):
+    MODES = ['sequential', 'concurrent', 'hedged']
+
+    '''
+    :param solr_interactor: Mandatory.
+    :param mode: Optional. One of MODES. Defaults to
+        SOLR_FILE_HANDLE_QUERY_MODE.
+    :param hedge_delay_seconds: Optional. Delay of the second
+        query in 'hedged' mode. Defaults to SOLR_HEDGE_DELAY_SECONDS.
+    '''
+    def __init__(self, solr_interactor, mode=None, hedge_delay_seconds=None):
         self.__solr_interactor = solr_interactor
         self.__error_messages = None
+        self.__mode = mode or esgfpid.defaults.SOLR_FILE_HANDLE_QUERY_MODE
+        self.__hedge_delay_seconds = hedge_delay_seconds
+        if self.__hedge_delay_seconds is None:
+            self.__hedge_delay_seconds = esgfpid.defaults.SOLR_HEDGE_DELAY_SECONDS
+        if self.__mode not in self.MODES:
+            raise esgfpid.exceptions.ArgumentError('Unknown query mode "%s". Allowed: %s' % (self.__mode, ', '.join(self.MODES)))
 
     def __reset_error_messages(self):
         self.__error_messages = []
@@ -28,6 +71,13 @@ class FindFilesOfSameDatasetVersion(object):
         esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
         self.__reset_error_messages()
 
+        if self.__mode == 'sequential':
+            return self.__retrieve_sequentially(args)
+        else:
+            return self.__retrieve_in_parallel(args)
+
+    def __retrieve_sequentially(self, args):
+
         # Try plan A
         file_handles = None
         try:
@@ -49,6 +99,136 @@ class FindFilesOfSameDatasetVersion(object):
 
         return file_handles
 
+    def __retrieve_in_parallel(self, args):
+        plan_a = _BackgroundQuery(lambda: self.__strategy1(args))
+        plan_b = _BackgroundQuery(lambda: self.__strategy2(args))
+
+        plan_a.start()
+        if self.__mode == 'concurrent':
+            plan_b.start()
+        else:
+            plan_a.wait(self.__hedge_delay_seconds)
+            if not plan_a.returned_handles():
+                LOGGER.debug('First query did not return handles after %s seconds, sending second query.', self.__hedge_delay_seconds)
+                plan_b.start()
+
+        # Plan A has precedence if it returns handles:
+        plan_a.wait()
+        if plan_a.error is not None:
+            self.__error_messages.append('Error during first query: '+plan_a.error.message)
+        if plan_a.returned_handles():
+            LOGGER.debug('Retrieved file handles from solr in first query.')
+            return plan_a.result
+
+        # Otherwise plan B:
+        plan_b.start()
+        plan_b.wait()
+        if plan_b.error is not None:
+            self.__error_messages.append('Error during second query: '+plan_b.error.message)
+            msg = '/n'.join(self.__error_messages)
+            raise esgfpid.exceptions.SolrError('Failure in both queries. Messages:\n'+msg)
+        return plan_b.result
+
+    def iterate_file_handles_of_same_dataset(self, **args):
+        '''
+        Like :func:`retrieve_file_handles_of_same_dataset`, but the
+        handles are yielded while the responses arrive, and they
+        are retrieved in pages (facet limit/offset), so that large
+        datasets neither need much memory nor risk being cut off.
+        The queries are always sent one after the other.
+
+        :return: Generator of handles, possibly none.
+        :raise: SolrSwitchedOff
+        :raise SolrError: If both strategies to find file handles
+            failed, or if the first one failed after it had
+            yielded handles already (e.g. because the server
+            does not page).
+        '''
+        mandatory_args = ['drs_id', 'version_number', 'data_node', 'prefix']
+        esgfpid.utils.check_presence_of_mandatory_args(args, mandatory_args)
+        self.__reset_error_messages()
+
+        # Try plan A
+        dataset_id = self.__make_dataset_id_from_drsid_and_versnum(args['drs_id'], args['version_number'], args['data_node'])
+        query = self.__make_query_handles_of_files_with_same_dataset_id(dataset_id)
+        num_handles = 0
+        try:
+            for handle in self.__iterate_pages_streamed(query, args['prefix']):
+                num_handles += 1
+                yield handle
+        except esgfpid.exceptions.SolrError as e:
+            if num_handles > 0:
+                raise esgfpid.exceptions.SolrError('Failure in first query after %i handles: %s' % (num_handles, e.message))
+            self.__error_messages.append('Error during first query: '+e.message)
+
+        if num_handles > 0:
+            LOGGER.debug('Retrieved %i file handles from solr in first query.', num_handles)
+            return
+        self.__error_messages.append('First query returned an empty list.')
+
+        # Try plan B
+        part_of_dataset_id = self.__make_half_dataset_id_from_drsid_and_versnum(args['drs_id'], args['version_number'])
+        query = self.__make_query_for_handles_of_files_with_same_drsid_and_version(part_of_dataset_id)
+        try:
+            for handle in self.__iterate_pages_streamed(query, args['prefix']):
+                num_handles += 1
+                yield handle
+        except esgfpid.exceptions.SolrError as e:
+            self.__error_messages.append('Error during second query: '+e.message)
+            msg = '/n'.join(self.__error_messages)
+            raise esgfpid.exceptions.SolrError('Failure in both queries. Messages:\n'+msg)
+        LOGGER.debug('Retrieved %i file handles from solr in second query.', num_handles)
+
+    def __iterate_pages(self, query, fetch_page):
+        '''
+        Send the query page by page (facet limit/offset) and
+        yield the handles of all pages.
+
+        Paging stops at the first page that is not full. If a
+        page has more handles than asked for, the server ignored
+        the limit, so it was the complete result. If a page
+        repeats handles of the previous one, the server ignores
+        the offset, and we would never get further.
+
+        :param fetch_page: Function that sends one query and
+            returns the handles of the response (list or generator).
+        :raise SolrError: If the server ignores the offset, or if
+            there are more than SOLR_FACET_MAX_PAGES pages.
+        '''
+        page_size = esgfpid.defaults.SOLR_FACET_PAGE_SIZE
+        max_pages = esgfpid.defaults.SOLR_FACET_MAX_PAGES
+        previous_page = set()
+        for page_number in xrange(max_pages):
+            query['facet.limit'] = page_size
+            query['facet.offset'] = page_number*page_size
+            LOGGER.debug('Query: %s', query)
+            this_page = set()
+            for handle in fetch_page(dict(query)): # can raise SolrError or SolrSwitchedOff
+                if handle in previous_page:
+                    msg = ('Page %i repeats handle "%s" of the previous page. The server seems'+
+                        ' to ignore "facet.offset", so the handles cannot be retrieved in pages.') % (page_number+1, handle)
+                    raise esgfpid.exceptions.SolrError(msg)
+                this_page.add(handle)
+                yield handle
+            if len(this_page) < page_size:
+                return
+            if len(this_page) > page_size:
+                LOGGER.debug('Server returned %i handles, more than the limit of %i, so it did not page.', len(this_page), page_size)
+                return
+            previous_page = this_page
+        msg = 'Gave up after %i pages of %i handles.' % (max_pages, page_size)
+        raise esgfpid.exceptions.SolrError(msg)
+
+    def __iterate_pages_streamed(self, query, prefix):
+        fetch_page = lambda query: solrutils.iterate_file_handles_from_response_chunks(
+            self.__solr_interactor.send_query_and_stream(query), prefix) # can raise SolrResponseError
+        return self.__iterate_pages(query, fetch_page)
+
+    def __retrieve_pages(self, query, prefix):
+        fetch_page = lambda query: solrutils.extract_file_handles_from_response_json(
+            self.__solr_interactor.send_query(query), prefix) # can raise SolrReponseError
+        return list(self.__iterate_pages(query, fetch_page))
+
     def __strategy1(self, args):
         return self.__retrieve_file_handles_of_same_dataset_if_same_datanode(
             args['drs_id'],
@@ -64,8 +244,7 @@ class FindFilesOfSameDatasetVersion(object):
 
     def __retrieve_file_handles_of_same_dataset_if_same_datanode(self, drs_id, version_number, data_node, prefix):
         dataset_id = self.__make_dataset_id_from_drsid_and_versnum(drs_id, version_number, data_node)
-        response_json = self.__ask_solr_for_handles_of_files_with_same_dataset_id(dataset_id) # can raise SolrError or SolrSwitchedOff, but can't be None
-        file_handles = solrutils.extract_file_handles_from_response_json(response_json, prefix) # can raise SolrReponseError
+        file_handles = self.__ask_solr_for_handles_of_files_with_same_dataset_id(dataset_id, prefix) # can raise SolrError or SolrSwitchedOff, but can't be None
         if len(file_handles)==0:
             msg = 'First query returned an empty list.'
             LOGGER.debug(msg)
@@ -77,20 +256,17 @@ class FindFilesOfSameDatasetVersion(object):
         return dataset_id
 
     def __retrieve_file_handles_of_same_dataset_if_different_datanode(self, drs_id, version_number, prefix):
-        response_json = self.__ask_solr_for_handles_of_files_with_same_drsid_and_version(drs_id, version_number) # can raise SolrError or SolrSwitchedOff, but can't be None
-        file_handles = solrutils.extract_file_handles_from_response_json(response_json, prefix) # can raise SolrReponseError
+        file_handles = self.__ask_solr_for_handles_of_files_with_same_drsid_and_version(drs_id, version_number, prefix) # can raise SolrError or SolrSwitchedOff, but can't be None
         if len(file_handles)==0:
             self.__error_messages.append('Second query returned an empty list.')
         return file_handles
 
     # Querying solr for handles of files with the same dataset id:
 
-    def __ask_solr_for_handles_of_files_with_same_dataset_id(self, dataset_id):
+    def __ask_solr_for_handles_of_files_with_same_dataset_id(self, dataset_id, prefix):
         LOGGER.debug('Asking solr for all handles or files with the dataset_id "%s".', dataset_id)
         query = self.__make_query_handles_of_files_with_same_dataset_id(dataset_id)
-        LOGGER.debug('Query: %s', query)
-        response_json = self.__solr_interactor.send_query(query) # can raise SolrError or SolrSwitchedOff, but can't be None
-        return response_json
+        return self.__retrieve_pages(query, prefix) # can raise SolrError or SolrSwitchedOff
 
     def __make_query_handles_of_files_with_same_dataset_id(self, dataset_id):
         query_dict = self.__solr_interactor.make_solr_base_query()
@@ -101,13 +277,11 @@ class FindFilesOfSameDatasetVersion(object):
 
     # Querying solr for the dataset_ids of all versions with the same drs_id:
 
-    def __ask_solr_for_handles_of_files_with_same_drsid_and_version(self, drs_id, version_number):
+    def __ask_solr_for_handles_of_files_with_same_drsid_and_version(self, drs_id, version_number, prefix):
         part_of_dataset_id = self.__make_half_dataset_id_from_drsid_and_versnum(drs_id, version_number)
         LOGGER.debug('Asking solr for all handles or files with the "half dataset_id" "%s".', part_of_dataset_id)
         query = self.__make_query_for_handles_of_files_with_same_drsid_and_version(part_of_dataset_id)
-        LOGGER.debug('Query: %s', query)
-        response_json = self.__solr_interactor.send_query(query) # can raise SolrError or SolrSwitchedOff, but can't be None
-        return response_json
+        return self.__retrieve_pages(query, prefix) # can raise SolrError or SolrSwitchedOff
 
     def __make_half_dataset_id_from_drsid_and_versnum(self, drs_id, version_number):
         part_of_dataset_id = drs_id + '.v' + str(version_number) + '|'
@@ -119,3 +293,44 @@ class FindFilesOfSameDatasetVersion(object):
         query_dict['facets'] = 'tracking_id'
         query_dict['query'] = 'dataset_id:'+part_of_dataset_id+'*'
         return query_dict
+
+
+'''
+Runs one query in a daemon thread, so that nobody has to
+wait for it if its result is not needed.
+'''
+class _BackgroundQuery(object):
+
+    def __init__(self, function):
+        self.__function = function
+        self.__thread = None
+        self.__finished = threading.Event()
+        self.result = None
+        self.error = None
+
+    ''' Start the query, unless it was started already. '''
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def __run(self):
+        try:
+            self.result = self.__function()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.__finished.set()
+
+    '''
+    Wait for the query. Errors other than SolrError are
+    passed on to the caller, as in sequential mode.
+    '''
+    def wait(self, timeout=None):
+        self.__finished.wait(timeout)
+        if self.__finished.is_set() and self.error is not None and not isinstance(self.error, esgfpid.exceptions.SolrError):
+            raise self.error
+
+    def returned_handles(self):
+        return self.__finished.is_set() and self.result is not None and len(self.result) > 0
@@ -0,0 +1,193 @@
+import re
+import json
+import codecs
+import logging
+import esgfpid.exceptions
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+'''
+A small incremental JSON parser, to read the values of one
+(possibly very long) array from a solr response while it
+arrives, without keeping the whole response in memory.
+
+It only keeps the current chunk and the path to the current
+position. The other parts of the response are skipped.
+'''
+
+_WHITESPACE = ' \t\r\n'
+_SCALAR = re.compile(r'-?[0-9][0-9.eE+-]*|true|false|null')
+# Fast path for array items that are simple strings or integers, followed by a comma:
+_SIMPLE_ITEM = re.compile(r'(?:"([^"\\]*)"|(-?[0-9]+))[ \t\r\n]*,[ \t\r\n]*')
+
+class _NeedMoreData(Exception):
+    pass
+
+class _Frame(object):
+
+    def __init__(self, is_object, key):
+        self.is_object = is_object
+        self.key = key # Key of this container in its parent (None for array items and root)
+        self.next_key = None # Key of the next value (objects only)
+        self.expect_key = is_object
+
+'''
+Yield the scalar items of the array at the given path.
+
+:param chunks: Iterable of byte strings (UTF-8), e.g. the
+    response content as it arrives.
+:param path: List of the object keys that lead to the array,
+    e.g. ['facet_counts', 'facet_fields', 'tracking_id'].
+:raise SolrResponseError: If there is no array at the path.
+:raise SolrError: If the response is no valid JSON (e.g.
+    because it was cut off).
+'''
+def iterate_array_items(chunks, path):
+    parser = _Parser(path)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        for item in parser.feed(decoder.decode(chunk)):
+            yield item
+    for item in parser.feed(decoder.decode('', final=True), final=True):
+        yield item
+    if not parser.found_path:
+        raise esgfpid.exceptions.SolrResponseError('No field "%s" in response' % path[-1])
+
+
+class _Parser(object):
+
+    def __init__(self, path):
+        self.__path = list(path)
+        self.__stack = []
+        self.__buffer = u''
+        self.__pos = 0
+        self.__finished = False
+        self.__at_target = False
+        self.found_path = False
+
+    def feed(self, text, final=False):
+        self.__buffer = self.__buffer[self.__pos:] + text
+        self.__pos = 0
+        items = []
+        try:
+            while not self.__finished:
+                self.__skip_whitespace()
+                if self.__at_target:
+                    self.__read_simple_items(items)
+                if self.__pos >= len(self.__buffer):
+                    raise _NeedMoreData()
+                item = self.__next_token(final)
+                if item is not None:
+                    items.append(item[0])
+        except _NeedMoreData:
+            if final:
+                raise esgfpid.exceptions.SolrError('Error while parsing Solr response. It seems to be no valid JSON (incomplete).')
+        return items
+
+    def __skip_whitespace(self):
+        while self.__pos < len(self.__buffer) and self.__buffer[self.__pos] in _WHITESPACE:
+            self.__pos += 1
+
+    def __read_simple_items(self, items):
+        match = _SIMPLE_ITEM.match(self.__buffer, self.__pos)
+        while match is not None:
+            string, integer = match.groups()
+            items.append(string if integer is None else int(integer))
+            self.__pos = match.end()
+            match = _SIMPLE_ITEM.match(self.__buffer, self.__pos)
+
+    def __is_at_target(self):
+        if len(self.__stack) != len(self.__path)+1 or self.__stack[-1].is_object:
+            return False
+        keys = [frame.key for frame in self.__stack[1:]]
+        return keys == self.__path
+
+    '''
+    Consume one token. Returns a one-tuple with the value if it is
+    an item of the target array, else None.
+    '''
+    def __next_token(self, final):
+        char = self.__buffer[self.__pos]
+        frame = self.__stack[-1] if len(self.__stack) > 0 else None
+
+        if char in ',:':
+            if frame is None:
+                self.__invalid()
+            if char == ',' and frame.is_object:
+                frame.expect_key = True
+            self.__pos += 1
+            return None
+
+        if char in '}]':
+            if frame is None or frame.is_object != (char == '}'):
+                self.__invalid()
+            self.__stack.pop()
+            self.__at_target = self.__is_at_target()
+            self.__pos += 1
+            if len(self.__stack) == 0:
+                self.__finished = True
+            return None
+
+        if char == '"':
+            value = self.__read_string()
+            if frame is not None and frame.is_object and frame.expect_key:
+                frame.next_key = value
+                frame.expect_key = False
+                return None
+            return self.__value(value, frame)
+
+        if char in '{[':
+            if frame is not None and frame.is_object and frame.expect_key:
+                self.__invalid()
+            key = frame.next_key if frame is not None and frame.is_object else None
+            self.__stack.append(_Frame(char == '{', key))
+            self.__pos += 1
+            self.__at_target = self.__is_at_target()
+            if self.__at_target:
+                self.found_path = True
+            return None
+
+        return self.__value(self.__read_scalar(final), frame)
+
+    def __value(self, value, frame):
+        if frame is None:
+            self.__finished = True
+            return None
+        if self.__at_target:
+            return (value,)
+        return None
+
+    def __read_string(self):
+        end = self.__pos + 1
+        while True:
+            end = self.__buffer.find('"', end)
+            if end < 0:
+                raise _NeedMoreData()
+            num_backslashes = 0
+            while self.__buffer[end-1-num_backslashes] == '\\':
+                num_backslashes += 1
+            if num_backslashes % 2 == 0:
+                break
+            end += 1
+        raw = self.__buffer[self.__pos:end+1]
+        self.__pos = end+1
+        return json.loads(raw)
+
+    def __read_scalar(self, final):
+        match = _SCALAR.match(self.__buffer, self.__pos)
+        if match is None:
+            if not final and len(self.__buffer) - self.__pos < len('false'):
+                raise _NeedMoreData() # e.g. "-" or "tr" at the end of the chunk
+            self.__invalid()
+        if match.end() == len(self.__buffer) and not final:
+            raise _NeedMoreData() # might continue in the next chunk
+        raw = match.group(0)
+        self.__pos = match.end()
+        try:
+            return json.loads(raw)
+        except ValueError:
+            self.__invalid()
+
+    def __invalid(self):
+        raise esgfpid.exceptions.SolrError('Error while parsing Solr response. It seems to be no valid JSON (at "%s").' % self.__buffer[self.__pos:self.__pos+20])
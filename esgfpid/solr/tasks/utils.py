@@ -1,5 +1,6 @@
 import logging
 import esgfpid.exceptions
+from . import jsonstream
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -19,6 +20,72 @@ def extract_file_handles_from_response_json(response_json, prefix):
 def _extract_file_handles_from_facetfield_trackingid(response_json, prefix):
     return _extract_handles_from_specified_facetfield(response_json, prefix, 'tracking_id')
 
+'''
+Like :func:`extract_file_handles_from_response_json`, but
+parses the response while it arrives, yielding the handles
+one by one. Duplicates are not removed.
+
+:param chunks: The response content, in pieces.
+:return: A generator of handles.
+'''
+def iterate_file_handles_from_response_chunks(chunks, prefix):
+    path = ['facet_counts', 'facet_fields', 'tracking_id']
+    for item in jsonstream.iterate_array_items(chunks, path): # raises esgfpid.exceptions.SolrResponseError
+        if not isinstance(item, (int, long, float)): # the counts
+            if prefix+'/' not in item:
+                item = prefix+'/'+item
+            if not item.startswith('hdl:'):
+                item = 'hdl:'+item
+            yield item
+
+#
+# Utils for task 1, for many datasets at once:
+#
+
+'''
+Extract the file handles from a response that lists file
+documents (not facets), grouped by their dataset_id.
+
+:return: Dict: dataset_id -> list of handles. Datasets without
+    files do not appear.
+'''
+def extract_file_handles_by_dataset_from_response_json(response_json, prefix):
+
+    if response_json is None:
+        raise esgfpid.exceptions.SolrResponseError('Response is None')
+
+    handles_by_dataset = {}
+    for doc in _extract_docs(response_json): # raises esgfpid.exceptions.SolrResponseError
+        try:
+            dataset_id = doc['dataset_id']
+            tracking_ids = doc['tracking_id']
+        except KeyError:
+            continue # file without handle
+        if not isinstance(tracking_ids, list):
+            tracking_ids = [tracking_ids]
+        handles_by_dataset.setdefault(dataset_id, []).extend(tracking_ids)
+
+    for dataset_id, tracking_ids in handles_by_dataset.iteritems():
+        handles = _prepend_prefix_to_list_items_if_not_there(_remove_duplicates_from_list(tracking_ids), prefix)
+        handles_by_dataset[dataset_id] = _prepend_hdl_to_list_items_of_not_there(handles)
+    return handles_by_dataset
+
+'''
+:return: The total number of documents found (not only
+    those in this response).
+'''
+def extract_num_found_from_response_json(response_json):
+    try:
+        return response_json['response']['numFound']
+    except (KeyError, TypeError):
+        raise esgfpid.exceptions.SolrResponseError('No "response" and/or "numFound" in response')
+
+def _extract_docs(response_json):
+    try:
+        return response_json['response']['docs']
+    except (KeyError, TypeError):
+        raise esgfpid.exceptions.SolrResponseError('No "response" and/or "docs" in response')
+
 #
 # Utils for task 2:
 #
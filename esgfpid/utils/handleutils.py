@@ -1,4 +1,10 @@
 import uuid
+import hashlib
+import itertools
+import threading
+import collections
+import multiprocessing
+import esgfpid.defaults
 from .argsutils import check_presence_of_mandatory_args
 
 def make_handle_from_drsid_and_versionnumber(**args):
@@ -14,17 +20,75 @@ def concatenate_drs_and_versionnumber(drs_id, version_number):
 
 def make_suffix_from_drsid_and_versionnumber(**args):
     check_presence_of_mandatory_args(args, ['drs_id','version_number'])
-    hash_basis = concatenate_drs_and_versionnumber(args['drs_id'], args['version_number'])
+    return _SUFFIX_MEMO.get_or_make(args['drs_id'], args['version_number'])
+
+def _make_suffix(drs_id, version_number):
+    hash_basis = concatenate_drs_and_versionnumber(drs_id, version_number)
     return _make_uuid_from_basis(hash_basis)
 
+# The namespace is hashed only once. For each uuid, a copy of the hash is
+# continued with the basis, which gives the same result as uuid.uuid3().
+_NAMESPACE_MD5 = hashlib.md5(uuid.NAMESPACE_URL.bytes)
+
 def _make_uuid_from_basis(hash_basis):
     hash_basis_utf8 = hash_basis.encode('utf-8')
-    ds_uuid = uuid.uuid3(uuid.NAMESPACE_URL, hash_basis_utf8) # Using uuid3, as this is easy to use also with Java
-    return str(ds_uuid)
+    md5 = _NAMESPACE_MD5.copy()
+    md5.update(hash_basis_utf8)
+    return _format_as_uuid3(md5.hexdigest()) # Using uuid3, as this is easy to use also with Java
     # Which NAMESPACE (1st arg) we use does not matter, as uuids only have to be unique inside ESGF, not globally.
     # It just has to stay the same all the time! Otherwise we will create
     # different handles for the same dataset.
 
+# Same as str(uuid.UUID(bytes=digest, version=3)), but faster: Set the
+# version (the 13th hex digit) to 3, and the variant (the two highest bits
+# of the 17th) to RFC 4122.
+_VARIANT_DIGITS = dict((digit, '89ab'[int(digit, 16) & 0x3]) for digit in '0123456789abcdef')
+
+def _format_as_uuid3(hexdigest):
+    return (hexdigest[:8]+'-'+hexdigest[8:12]+'-3'+hexdigest[13:16]+'-'+
+            _VARIANT_DIGITS[hexdigest[16]]+hexdigest[17:20]+'-'+hexdigest[20:32])
+
+'''
+Make the handles of many datasets at once, e.g. to map a
+whole index to PIDs. They are not kept in memory for later
+calls.
+
+:param datasets: Iterable of tuples (drs_id, version_number).
+:param prefix: The handle prefix (without "hdl:").
+:param processes: Optional. If more than 1, the handles are
+    made in this many processes, which get HANDLE_BULK_CHUNK_SIZE
+    datasets at a time. Only worth it for millions of datasets.
+:return: List of handle strings, in the same order as the datasets.
+'''
+def make_handles_from_drsids_and_versionnumbers(datasets, prefix, processes=None):
+    if processes is None or processes <= 1:
+        return _make_handles_of_chunk((prefix, datasets))
+
+    chunks = _iterate_chunks(datasets, esgfpid.defaults.HANDLE_BULK_CHUNK_SIZE)
+    pool = multiprocessing.Pool(processes)
+    try:
+        handles = []
+        for handles_of_chunk in pool.imap(_make_handles_of_chunk, ((prefix, chunk) for chunk in chunks)):
+            handles.extend(handles_of_chunk)
+        return handles
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _iterate_chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+# Module level, so it can be passed to other processes:
+def _make_handles_of_chunk(prefix_and_chunk):
+    prefix, chunk = prefix_and_chunk
+    start = 'hdl:'+prefix+'/'
+    return [start+_make_suffix(drs_id, version_number) for drs_id, version_number in chunk]
+
 def make_handle_from_list_of_strings(sorted_list_of_strings, prefix, addition=None):
     concatenated = ''.join(sorted_list_of_strings)
 
@@ -47,4 +111,36 @@ def make_sorted_lowercase_list_without_hdl(strings):
         string = string.replace('hdl:', '', 1)
         newlist.append(string)
     newlist.sort()
-    return newlist
\ No newline at end of file
+    return newlist
+
+'''
+Keeps the most recently made dataset handle suffixes (which
+do not depend on the prefix), as the same dataset's handle is
+often needed several times (publication, unpublication, errata).
+'''
+class _SuffixMemo(object):
+
+    def __init__(self, max_entries):
+        self.__max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__suffixes = collections.OrderedDict() # least recently used first
+
+    def get_or_make(self, drs_id, version_number):
+        if self.__max_entries <= 0:
+            return _make_suffix(drs_id, version_number)
+
+        key = (drs_id, str(version_number))
+        with self.__lock:
+            suffix = self.__suffixes.pop(key, None)
+            if suffix is not None:
+                self.__suffixes[key] = suffix # Move to the end, as it was used most recently
+                return suffix
+
+        suffix = _make_suffix(drs_id, version_number)
+        with self.__lock:
+            self.__suffixes[key] = suffix
+            while len(self.__suffixes) > self.__max_entries:
+                self.__suffixes.popitem(last=False)
+        return suffix
+
+_SUFFIX_MEMO = _SuffixMemo(esgfpid.defaults.HANDLE_MEMO_MAX_ENTRIES)
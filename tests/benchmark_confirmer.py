@@ -0,0 +1,89 @@
+'''
+Benchmark for the Confirmer (asynchronous rabbit module).
+
+Measures how long the confirmer needs to process the confirms
+for many messages in flight (10^5 to 10^6), for the typical
+confirm patterns sent by RabbitMQ:
+
+ * "multiple" acks, each confirming a burst of messages,
+ * single acks, in the order of publication,
+ * single acks, in random order,
+ * "multiple" nacks, each for a burst of messages.
+
+The time per confirm should stay constant when the number of
+messages in flight grows.
+
+Run from the "tests" directory:
+python benchmark_confirmer.py -n 100000 1000000 -b 100
+
+'''
+import argparse
+import logging
+import random
+import time
+from esgfpid.rabbit.asynchronous.thread_confirmer import Confirmer
+
+logging.basicConfig(level=logging.ERROR) # every nack is logged as a warning
+
+
+class BenchmarkMethod(object):
+    '''Like pika's Basic.Ack/Basic.Nack (mock objects are too slow here).'''
+
+    def __init__(self, tag, multiple, name):
+        self.delivery_tag = tag
+        self.multiple = multiple
+        self.NAME = name
+
+class BenchmarkMethodFrame(object):
+
+    def __init__(self, tag, multiple, name):
+        self.method = BenchmarkMethod(tag, multiple, name)
+
+def make_method_frame(tag, multiple, name):
+    return BenchmarkMethodFrame(tag, multiple, name)
+
+def make_filled_confirmer(num_messages):
+    confirmer = Confirmer()
+    for tag in xrange(1, num_messages+1):
+        confirmer.put_to_unconfirmed_messages(tag, 'message %i' % tag)
+    return confirmer
+
+def make_frames_multiple(num_messages, burst, name):
+    tags = range(burst, num_messages+1, burst)
+    if len(tags) == 0 or tags[-1] != num_messages:
+        tags.append(num_messages)
+    return [make_method_frame(tag, True, name) for tag in tags]
+
+def make_frames_single(num_messages, shuffle):
+    tags = range(1, num_messages+1)
+    if shuffle:
+        random.shuffle(tags)
+    return [make_method_frame(tag, False, 'Basic.Ack') for tag in tags]
+
+def run_once(num_messages, frames):
+    confirmer = make_filled_confirmer(num_messages)
+    start = time.time()
+    for frame in frames:
+        confirmer.on_delivery_confirmation(frame)
+    duration = time.time() - start
+    assert confirmer.get_num_unconfirmed() == 0
+    return duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark for the Confirmer.')
+    parser.add_argument('-n', '--num_messages', type=int, nargs='*', default=[100000, 1000000])
+    parser.add_argument('-b', '--burst', type=int, default=100)
+    param = parser.parse_args()
+
+    print('%10s %-22s %10s %10s %14s' % ('messages', 'pattern', 'confirms', 'seconds', 'us/confirm'))
+    for num_messages in param.num_messages:
+        patterns = [
+            ('multiple ack', make_frames_multiple(num_messages, param.burst, 'Basic.Ack')),
+            ('single ack, in order', make_frames_single(num_messages, False)),
+            ('single ack, shuffled', make_frames_single(num_messages, True)),
+            ('multiple nack', make_frames_multiple(num_messages, param.burst, 'Basic.Nack'))
+        ]
+        for name, frames in patterns:
+            duration = run_once(num_messages, frames)
+            print('%10i %-22s %10i %10.3f %14.2f' % (num_messages, name, len(frames), duration, duration*1000000/len(frames)))
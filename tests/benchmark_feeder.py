@@ -0,0 +1,131 @@
+'''
+Benchmark for the RabbitFeeder (asynchronous rabbit module).
+
+Measures how many messages per second the feeder can hand to
+a (mocked) pika channel, for different batch budgets. The ioloop
+is simulated by a simple loop that runs the scheduled callbacks
+one after the other, so the overhead of one callback per message
+(batch size 1) versus one callback per batch is visible.
+
+Run from the "tests" directory:
+python benchmark_feeder.py -n 50000 -b 1 10 100 1000
+
+'''
+import argparse
+import collections
+import logging
+import Queue
+import time
+import mock
+import esgfpid.defaults
+import esgfpid.rabbit.asynchronous.thread_feeder
+import esgfpid.rabbit.rabbitutils
+from esgfpid.rabbit.asynchronous.thread_statemachine import StateMachine
+from resources.pikamock import MockChannel
+
+logging.basicConfig(level=logging.WARN)
+
+
+class BenchmarkIoloop(object):
+    '''Runs the callbacks in the order they were added.'''
+
+    def __init__(self):
+        self.callbacks = collections.deque()
+        self.num_callbacks = 0
+
+    def add_timeout(self, seconds, callback):
+        self.callbacks.append(callback)
+
+    def run(self):
+        while len(self.callbacks) > 0:
+            self.num_callbacks += 1
+            self.callbacks.popleft()()
+
+
+class BenchmarkThread(object):
+    '''Provides the parts of the RabbitThread API that the feeder uses.'''
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._connection = BenchmarkIoloop()
+        self._channel = MockChannel()
+        self.feeder = None
+        self.num_unconfirmed = 0
+
+    def add_event_publish_message(self):
+        # Like the RabbitThread, which sends two events per trigger:
+        self._connection.add_timeout(0, self.feeder.publish_message)
+        self._connection.add_timeout(0, self.feeder.publish_message)
+
+    def add_event_publish_next_batch(self):
+        self._connection.add_timeout(0, self.feeder.publish_message)
+
+    def get_message_from_unpublished_stack(self, seconds):
+        return self.queue.get(block=True, timeout=seconds)
+
+    def put_one_message_into_queue_of_unsent_messages(self, message):
+        self.queue.put(message, block=False)
+
+    def get_num_unpublished(self):
+        return self.queue.qsize()
+
+    def get_exchange_name(self):
+        return 'exch'
+
+    def get_open_word_for_routing_key(self):
+        return 'trusted'
+
+    def put_to_unconfirmed_messages(self, tag, message):
+        self.num_unconfirmed += 1
+
+
+def make_message(i):
+    return dict(
+        handle='hdl:21.14100/file-%i' % i,
+        aggregation_level='file',
+        operation='publish',
+        file_name='file_%i.nc' % i,
+        file_size=10010,
+        data_node='esgf-data.dkrz.de',
+        ROUTING_KEY=esgfpid.defaults.ROUTING_KEY_BASIS+'publication.file.orig'
+    )
+
+def run_once(num_messages, batch_size):
+    with mock.patch.object(esgfpid.defaults, 'RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES', batch_size):
+        nodemanager = mock.MagicMock()
+        statemachine = StateMachine()
+        statemachine.set_to_available()
+        queue = Queue.Queue()
+        thread = BenchmarkThread(queue)
+        feeder = esgfpid.rabbit.asynchronous.thread_feeder.RabbitFeeder(thread, statemachine, nodemanager)
+        thread.feeder = feeder
+
+        # Messages are serialized by the sending thread, not by the feeder:
+        for i in xrange(num_messages):
+            queue.put(esgfpid.rabbit.rabbitutils.make_message_envelope(make_message(i)))
+
+        # Trigger like the AsynchronousRabbitConnector does:
+        to_be_sure = 10
+        num_events = esgfpid.rabbit.asynchronous.thread_feeder.get_num_publish_events_needed(num_messages+to_be_sure)
+        for i in xrange(num_events):
+            thread.add_event_publish_message()
+
+        start = time.time()
+        thread._connection.run()
+        duration = time.time() - start
+
+        assert thread.num_unconfirmed == num_messages
+        return duration, thread._connection.num_callbacks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark for the batch-draining RabbitFeeder.')
+    parser.add_argument('-n', '--num_messages', type=int, default=50000)
+    parser.add_argument('-b', '--batch_sizes', type=int, nargs='*', default=[1, 10, 100, 1000])
+    param = parser.parse_args()
+
+    print('Publishing %i messages to the pika mock.' % param.num_messages)
+    print('%10s %12s %10s %14s' % ('batch', 'callbacks', 'seconds', 'messages/s'))
+    for batch_size in param.batch_sizes:
+        duration, num_callbacks = run_once(param.num_messages, batch_size)
+        print('%10i %12i %10.3f %14.0f' % (batch_size, num_callbacks, duration, param.num_messages/duration))
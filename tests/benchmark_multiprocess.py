@@ -0,0 +1,102 @@
+'''
+Benchmark for publishers that fan out with multiprocessing.
+
+One Connector is created (and, in asynchronous mode, its messaging
+thread is started) in the parent process, before the worker
+processes are forked. Every worker then sends its share of
+messages (errata additions) through the inherited connector and
+finishes its own messaging thread. Afterwards, the parent sends
+a few messages too, to show that its connection still works.
+
+Measures the messages per second of all workers together, for
+different numbers of workers.
+
+Run from the "tests" directory, against a RabbitMQ instance:
+python benchmark_multiprocess.py -ho foo.com -u user -p passy -ex exch -n 10000 -w 1 2 4 8
+
+Or without RabbitMQ (synchronous mode, pika connection mocked):
+python benchmark_multiprocess.py --mock -n 10000 -w 1 2 4 8
+
+'''
+import argparse
+import logging
+import multiprocessing
+import time
+import mock
+import esgfpid
+from resources.pikamock import MockPikaBlockingConnection
+
+logging.basicConfig(level=logging.WARN)
+
+
+def make_connector(param):
+    cred = dict(user=param.user, password=param.password, url=param.host)
+    return esgfpid.Connector(
+        handle_prefix='21.14100',
+        messaging_service_exchange_name=param.exchange,
+        messaging_service_credentials=[cred],
+        message_service_synchronous=param.synchronous,
+        test_publication=True
+    )
+
+def send_messages(connector, worker, num_messages):
+    for i in xrange(num_messages):
+        connector.add_errata_ids(
+            drs_id='benchmark.worker%i.dataset%i' % (worker, i),
+            version_number=20170101,
+            errata_ids=['errata-%i' % i]
+        )
+
+def work(connector, worker, num_messages, results):
+    start = time.time()
+    send_messages(connector, worker, num_messages)
+    connector.finish_messaging_thread()
+    results.put(time.time() - start)
+
+def run_once(connector, num_workers, num_messages):
+    per_worker = num_messages // num_workers
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=work, args=(connector, w, per_worker, results)) for w in xrange(num_workers)]
+
+    start = time.time()
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    duration = time.time() - start
+
+    for process in workers:
+        assert process.exitcode == 0, 'Worker failed (exit code %s).' % process.exitcode
+    slowest = max(results.get() for process in workers)
+    return duration, slowest, per_worker*num_workers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark for publishing from several forked worker processes.')
+    parser.add_argument('-ho', '--host', default='localhost')
+    parser.add_argument('-u', '--user', default='guest')
+    parser.add_argument('-p', '--password', default='guest')
+    parser.add_argument('-ex', '--exchange', default='esgffed-exchange')
+    parser.add_argument('-n', '--num_messages', type=int, default=10000)
+    parser.add_argument('-w', '--num_workers', type=int, nargs='*', default=[1, 2, 4, 8])
+    parser.add_argument('--synchronous', action='store_true')
+    parser.add_argument('--mock', action='store_true', help='Do not connect to RabbitMQ (implies --synchronous).')
+    param = parser.parse_args()
+
+    if param.mock:
+        param.synchronous = True
+        mock.patch('pika.BlockingConnection', MockPikaBlockingConnection).start()
+
+    connector = make_connector(param)
+    connector.start_messaging_thread() # before forking, as the publishers do
+
+    print('Sending %i messages (%s mode).' % (param.num_messages, 'synchronous' if param.synchronous else 'asynchronous'))
+    print('%8s %10s %14s %14s' % ('workers', 'seconds', 'slowest worker', 'messages/s'))
+    for num_workers in param.num_workers:
+        duration, slowest, num_sent = run_once(connector, num_workers, param.num_messages)
+        print('%8i %10.3f %14.3f %14.0f' % (num_workers, duration, slowest, num_sent/duration))
+
+    # The parent's connection must not have been disturbed:
+    send_messages(connector, -1, 10)
+    connector.finish_messaging_thread()
+    print('Parent process sent its messages and finished.')
@@ -0,0 +1,110 @@
+'''
+Benchmark for the memory that the publication assistant needs
+to keep the files of a large dataset until the publication is
+finished.
+
+For comparison, the same files are also kept as complete file
+publication messages (one dict per file, plus a list of the
+handles), as the assistant used to keep them.
+
+Every variant runs in a new process, and the growth of its peak
+resident memory is measured (in KB on Linux, in bytes on macOS).
+
+Run from the "tests" directory:
+python benchmark_publication_memory.py -n 100000
+
+'''
+import argparse
+import logging
+import multiprocessing
+import resource
+import time
+import uuid
+import mock
+import esgfpid.assistant.messages
+from esgfpid.assistant.publish import DatasetPublicationAssistant
+
+logging.basicConfig(level=logging.WARN)
+
+PREFIX = '21.14100'
+DATA_NODE = 'esgf-data.dkrz.de'
+DRS_ID = 'CMIP6.CMIP.MPI-M.MPI-ESM1-2-HR.historical.r1i1p1f1.Amon.tas.gn'
+DATASET_HANDLE = 'hdl:'+PREFIX+'/'+str(uuid.uuid3(uuid.NAMESPACE_URL, DRS_ID))
+
+
+def make_file_args(i):
+    return dict(
+        file_name='tas_Amon_MPI-ESM1-2-HR_historical_r1i1p1f1_gn_%06i.nc' % i,
+        file_handle='hdl:%s/%s' % (PREFIX, uuid.uuid3(uuid.NAMESPACE_URL, str(i))),
+        file_size=123456789+i,
+        checksum='%064x' % (i*7919),
+        checksum_type='SHA256',
+        publish_path='CMIP6/CMIP/MPI-M/MPI-ESM1-2-HR/historical/r1i1p1f1/Amon/tas/gn/v20190710/file_%06i.nc' % i,
+        file_version='v20190710'
+    )
+
+def keep_in_assistant(num_files):
+    coupler = mock.MagicMock()
+    coupler.is_solr_switched_off.return_value = True
+    assistant = DatasetPublicationAssistant(
+        drs_id=DRS_ID,
+        version_number=20190710,
+        data_node=DATA_NODE,
+        prefix=PREFIX,
+        thredds_service_path='thredds/fileServer',
+        is_replica=False,
+        coupler=coupler,
+        consumer_solr_url=None
+    )
+    for i in xrange(num_files):
+        assistant.add_file(**make_file_args(i))
+    return assistant
+
+def keep_as_messages(num_files):
+    handles = []
+    messages = []
+    for i in xrange(num_files):
+        args = make_file_args(i)
+        handles.append(args['file_handle'])
+        messages.append(esgfpid.assistant.messages.publish_file(
+            file_handle=args['file_handle'],
+            file_size=args['file_size'],
+            file_name=args['file_name'],
+            checksum=args['checksum'],
+            data_url='http://'+DATA_NODE+'/thredds/fileServer/'+args['publish_path'],
+            data_node=DATA_NODE,
+            parent_dataset=DATASET_HANDLE,
+            checksum_type=args['checksum_type'],
+            file_version=args['file_version'],
+            is_replica=False,
+            timestamp='2019-07-10T12:00:00.000000+00:00'
+        ))
+    return handles, messages
+
+def get_peak_memory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_once(variant, num_files, results):
+    before = get_peak_memory()
+    start = time.time()
+    kept = VARIANTS[variant](num_files)
+    duration = time.time() - start
+    results.put((get_peak_memory()-before, duration))
+
+VARIANTS = {'assistant': keep_in_assistant, 'messages': keep_as_messages}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark for the memory of the publication assistant.')
+    parser.add_argument('-n', '--num_files', type=int, default=100000)
+    param = parser.parse_args()
+
+    print('Keeping %i files.' % param.num_files)
+    print('%10s %14s %14s %10s' % ('variant', 'peak memory', 'per file', 'seconds'))
+    for variant in ['messages', 'assistant']:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_once, args=(variant, param.num_files, results))
+        process.start()
+        memory, duration = results.get()
+        process.join()
+        print('%10s %14i %14.3f %10.3f' % (variant, memory, float(memory)/param.num_files, duration))
@@ -153,6 +153,12 @@ if __name__ == '__main__':
             n = tests.countTestCases()
             numtests += n
 
+            from testcases.solr.solr_task1_bulk_tests import SolrTask1BulkTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(SolrTask1BulkTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
             from testcases.solr.solr_task2_tests import SolrTask2TestCase
             tests = unittest.TestLoader().loadTestsFromTestCase(SolrTask2TestCase)
             tests_to_run.append(tests)
@@ -165,6 +171,18 @@ if __name__ == '__main__':
             n = tests.countTestCases()
             numtests += n
 
+            from testcases.solr.solr_cache_tests import SolrCacheTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(SolrCacheTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
+            from testcases.solr.solr_jsonstream_tests import SolrJsonStreamTestCase
+            tests = unittest.TestLoader().loadTestsFromTestCase(SolrJsonStreamTestCase)
+            tests_to_run.append(tests)
+            n = tests.countTestCases()
+            numtests += n
+
         if 'nodemanager' in param.modules or 'rabbit' in param.modules or 'all' in param.modules:
 
             from testcases.rabbit.nodemanager_tests import NodemanagerTestCase
@@ -219,6 +237,41 @@ if __name__ == '__main__':
                 tests = unittest.TestLoader().loadTestsFromTestCase(ThreadReturnerTestCase)
                 tests_to_run.append(tests)
                 numtests += tests.countTestCases()
+
+                from testcases.rabbit.asyn.spool_tests import SpoolTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(SpoolTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                from testcases.rabbit.asyn.bounded_queue_tests import BoundedQueueTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(BoundedQueueTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                from testcases.rabbit.asyn.thread_shutter_tests import ThreadShutterTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(ThreadShutterTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                from testcases.rabbit.asyn.connection_racing_tests import ConnectionRacingTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(ConnectionRacingTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                from testcases.rabbit.asyn.thread_channels_tests import ThreadChannelsTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(ThreadChannelsTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                from testcases.rabbit.asyn.sharded_tests import ShardedTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(ShardedTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
+
+                from testcases.rabbit.asyn.completion_tests import CompletionTestCase
+                tests = unittest.TestLoader().loadTestsFromTestCase(CompletionTestCase)
+                tests_to_run.append(tests)
+                numtests += tests.countTestCases()
                 
                 #from testcases.rabbit_thread_shutter_tests import ThreadShutterTestCase
                 #tests = unittest.TestLoader().loadTestsFromTestCase(ThreadShutterTestCase)
@@ -1,5 +1,7 @@
 import mock
 import esgfpid
+import esgfpid.rabbit.asynchronous.thread_channels
+from esgfpid.rabbit.asynchronous.completion import Completion
 import tests.mocks.responsemock
 import tests.mocks.solrmock
 import tests.mocks.rabbitmock
@@ -103,8 +105,10 @@ class MockThread(object):
     def add_event_force_finish(self):
         self.was_force_finished = True
 
-    def add_event_gently_finish(self):
+    def add_event_gently_finish(self, timeout=None):
         self.was_gently_finished = True
+        self.gently_finish_timeout = timeout
+        return True
 
     def is_alive(self):
         return self._is_alive
@@ -127,10 +131,16 @@ class MockThread2(object):
         self.undelivered_msg = []
         self.unconfirmed_tags = []
         self.exchange_name = 'foo'
+        self.num_next_batch_events = 0
         # Rabbit API, used by modules:
         self._channel = mock.MagicMock()
         if error is not None:
             self._channel.basic_publish.side_effect = error
+        self.publishing_channel = esgfpid.rabbit.asynchronous.thread_channels.PublishingChannel(0, self)
+        self.publishing_channel.channel = self._channel
+
+    def get_publishing_channel(self, ordering_key):
+        return self.publishing_channel
 
     def get_message_from_unpublished_stack(self, seconds):
         if len(self.messages) == 0:
@@ -151,12 +161,13 @@ class MockThread2(object):
     def get_exchange_name(self):
         return self.exchange_name
 
-    def put_to_unconfirmed_delivery_tags(self, tag):
+    def put_to_unconfirmed_messages(self, tag, msg):
         self.unconfirmed_tags.append(tag)
-
-    def put_to_unconfirmed_messages_dict(self, tag, msg):
         self.undelivered_msg.append(msg)
 
+    def add_event_publish_next_batch(self):
+        self.num_next_batch_events += 1
+
 
 '''
 Used for testing the thread_returner.
@@ -184,6 +195,15 @@ class MockRabbitSender(object):
         if self.please_print:
             print('Called "send_message_to_queue()" with '+str(msg))
 
+    def send_many_messages_to_queue(self, msgs):
+        self.received_messages.extend(msgs)
+        if self.please_print:
+            print('Called "send_many_messages_to_queue()" with '+str(msgs))
+
+    def send_many_messages_to_queue_with_completion(self, msgs):
+        self.send_many_messages_to_queue(msgs)
+        return Completion(0)
+
     def open_rabbit_connection(self):
         if self.please_print:
             print('Called "open_rabbit_connection()"')
@@ -196,7 +216,7 @@ class MockRabbitSender(object):
         if self.please_print:
             print('Called "start()"')
 
-    def finish(self):
+    def finish(self, timeout=None):
         if self.please_print:
             print('Called "finish()"')
 
@@ -310,6 +330,8 @@ def patch_solr_returns_previous_files(connector_or_coupler, previous_files):
     solrmock = mock.Mock()
     solrmock.retrieve_file_handles_of_same_dataset = mock.Mock()
     solrmock.retrieve_file_handles_of_same_dataset.return_value = previous_files
+    solrmock.iterate_file_handles_of_same_dataset = mock.Mock()
+    solrmock.iterate_file_handles_of_same_dataset.side_effect = lambda **args: None if previous_files is None else iter(previous_files)
     patch_with_solr_mock(connector_or_coupler, solrmock)
 
 def patch_solr_returns_list_of_datasets_and_versions(connector_or_coupler, datasets, versions):
@@ -324,6 +346,7 @@ def patch_solr_raises_error(connector_or_coupler, error_to_be_raised):
     methodmock = mock.Mock()
     methodmock.side_effect = error_to_be_raised
     solrmock.retrieve_file_handles_of_same_dataset = methodmock
+    solrmock.iterate_file_handles_of_same_dataset = methodmock
     solrmock.retrieve_datasethandles_or_versionnumbers_of_allversions = methodmock
     patch_with_solr_mock(connector_or_coupler, solrmock)
 
@@ -44,6 +44,55 @@ class MockChannel(object):
     def add_on_return_callback(self, *args, **kwargs): # This mocks the original API
         pass
 
+    def close(self): # This mocks the original API
+        self.is_open = False
+
+class MockMethod(object):
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+
+class MockPipeliningChannel(object):
+    '''
+    Channel used by the synchronous connector for sending many
+    messages. Confirms (or nacks/returns) all published messages
+    whenever the connection processes events.
+    '''
+
+    def __init__(self, window, nack_tags=(), return_tags=(), confirm=True):
+        self._impl = self # This mocks the original API
+        self.is_open = True # This mocks the original API
+        self.window = window
+        self.nack_tags = nack_tags
+        self.return_tags = return_tags
+        self.confirm = confirm
+        self.messages = []
+        self.routing_keys = []
+        self.num_confirmed = 0
+        self.max_in_flight = 0
+
+    def basic_publish(self, *args, **kwargs): # This mocks the original API
+        self.messages.append(kwargs['body'])
+        self.routing_keys.append(kwargs['routing_key'])
+        self.max_in_flight = max(self.max_in_flight, len(self.messages)-self.num_confirmed)
+
+    def process_data_events(self, time_limit=0): # Replaces the connection's method
+        if not self.confirm:
+            return
+        while self.num_confirmed < len(self.messages):
+            self.num_confirmed += 1
+            tag = self.num_confirmed
+            if tag in self.return_tags:
+                method = MockMethod(reply_text='NO_ROUTE')
+                self.window.on_return(self, method, None, self.messages[tag-1])
+            name = 'Basic.Nack' if tag in self.nack_tags else 'Basic.Ack'
+            frame = MockMethod(method=MockMethod(delivery_tag=tag, multiple=False, NAME=name))
+            self.window.on_delivery_confirmation(frame)
+
+    def close(self): # This mocks the original API
+        self.is_open = False
+
 class MockPikaBlockingConnection(object):
 
     def __init__(self, params):
@@ -68,7 +117,7 @@ class MockPikaBlockingConnection(object):
     def close(self): # This mocks the original API
         self.is_open = False
 
-    def process_data_events(self): # This mocks the original API
+    def process_data_events(self, time_limit=0): # This mocks the original API
         pass
 
 class MockPikaSelectConnection(object):
@@ -370,6 +370,28 @@ class ConnectorTestCase(unittest.TestCase):
 
         # Check result:
         self.assertIsInstance(wizard, esgfpid.assistant.publish.DatasetPublicationAssistant)
+        self.assertFalse(wizard._DatasetPublicationAssistant__stream_files)
+
+    def test_create_publication_assistant_streaming(self):
+
+        # Preparations: Create connector with data node and thredds:
+        args = TESTHELPERS.get_connector_args(
+            thredds_service_path='foo',
+            data_node='bar',
+            solr_switched_off=True
+        )
+        testconnector = esgfpid.Connector(**args)
+
+        # Run code to be tested: Init dataset wizard
+        wizard = testconnector.create_publication_assistant(
+            drs_id='baz',
+            version_number=2016,
+            is_replica=False,
+            stream_files=True
+        )
+
+        # Check result:
+        self.assertTrue(wizard._DatasetPublicationAssistant__stream_files)
 
 
     '''
@@ -751,12 +773,71 @@ class ConnectorTestCase(unittest.TestCase):
         testconnector.start_messaging_thread()
         rabbitmock.start.assert_called_with()
 
+    @mock.patch('esgfpid.rabbit.RabbitMessageSender')
+    def test_warm_up_starts_messaging_thread(self, senderpatch):
+        args = TESTHELPERS.get_connector_args(message_service_warm_up=True)
+        testconnector = esgfpid.Connector(**args)
+        senderpatch.return_value.start.assert_called_with()
+
+    @mock.patch('esgfpid.rabbit.RabbitMessageSender')
+    def test_no_warm_up_by_default(self, senderpatch):
+        testconnector = esgfpid.Connector(**TESTHELPERS.get_connector_args())
+        senderpatch.return_value.start.assert_not_called()
+
+    @mock.patch('esgfpid.rabbit.RabbitMessageSender')
+    def test_new_sender_after_fork(self, senderpatch):
+
+        # Preparation:
+        parent_sender = mock.MagicMock()
+        child_sender = mock.MagicMock()
+        senderpatch.side_effect = [parent_sender, child_sender]
+        testconnector = esgfpid.Connector(**TESTHELPERS.get_connector_args())
+
+        # Run code to be tested:
+        with mock.patch.object(esgfpid.coupling.Coupler, '_Coupler__getpid', return_value=-1):
+            testconnector.get_message_queue_status()
+            testconnector.get_message_queue_status()
+
+        # Check result:
+        self.assertEquals(senderpatch.call_count, 2)
+        parent_sender.get_queue_status.assert_not_called()
+        self.assertEquals(child_sender.get_queue_status.call_count, 2)
+        child_sender.start.assert_not_called()
+
+    @mock.patch('esgfpid.rabbit.RabbitMessageSender')
+    def test_child_thread_started_if_parent_started(self, senderpatch):
+
+        # Preparation:
+        parent_sender = mock.MagicMock()
+        child_sender = mock.MagicMock()
+        senderpatch.side_effect = [parent_sender, child_sender]
+        args = TESTHELPERS.get_connector_args(message_service_spool_dir='/tmp/foo')
+        testconnector = esgfpid.Connector(**args)
+        testconnector.start_messaging_thread()
+
+        # Run code to be tested:
+        with mock.patch.object(esgfpid.coupling.Coupler, '_Coupler__getpid', return_value=-1):
+            testconnector.finish_messaging_thread()
+
+        # Check result:
+        child_sender.start.assert_called_once_with()
+        child_sender.finish.assert_called_once_with(None)
+        parent_sender.finish.assert_not_called()
+        self.assertIsNone(senderpatch.call_args[1]['spool_dir'])
+
     def test_finish_messaging_thread(self):
         LOGGER.debug('Thread test')
         testconnector = TESTHELPERS.get_connector()
         rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testconnector, mock.MagicMock())
         testconnector.finish_messaging_thread()
-        rabbitmock.finish.assert_called_with()
+        rabbitmock.finish.assert_called_with(None)
+
+    def test_finish_messaging_thread_with_timeout(self):
+        LOGGER.debug('Thread test')
+        testconnector = TESTHELPERS.get_connector()
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testconnector, mock.MagicMock())
+        testconnector.finish_messaging_thread(timeout=3)
+        rabbitmock.finish.assert_called_with(3)
 
     def test_force_finish_messaging_thread(self):
         LOGGER.debug('Thread test')
@@ -772,4 +853,23 @@ class ConnectorTestCase(unittest.TestCase):
             version_number=DS_VERSION
         )
         expected_handle = DATASETHANDLE_HDL
-        self.assertEquals(received_handle, expected_handle)
\ No newline at end of file
+        self.assertEquals(received_handle, expected_handle)
+    def test_prefetch_solr_off(self):
+        testconnector = TESTHELPERS.get_connector(data_node=DATA_NODE)
+        self.assertEquals(testconnector.prefetch_solr_info_for_consistency_check([(DRS_ID, DS_VERSION)]), 0)
+
+    def test_prefetch_passes_datasets_at_data_node(self):
+
+        # Preparations:
+        testconnector = TESTHELPERS.get_connector(data_node='foo.de/', solr_url='foo')
+        solrmock = mock.MagicMock()
+        solrmock.is_switched_off.return_value = False
+        solrmock.prefetch_file_handles_of_many_datasets.return_value = {('abc', 2016, 'foo.de'): ['hdl:123/a'], ('def', 2017, 'foo.de'): []}
+        testconnector._Connector__coupler._Coupler__solr_sender = solrmock
+
+        # Run code to be tested:
+        num_found = testconnector.prefetch_solr_info_for_consistency_check([('abc', '2016'), ('def', 2017)])
+
+        # Check result:
+        solrmock.prefetch_file_handles_of_many_datasets.assert_called_once_with([('abc', 2016, 'foo.de'), ('def', 2017, 'foo.de')])
+        self.assertEquals(num_found, 1)
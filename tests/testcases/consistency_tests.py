@@ -1,5 +1,7 @@
 import unittest
 import logging
+import threading
+import mock
 from esgfpid.assistant.consistency import Checker as Checker
 import esgfpid.exceptions # need SolrError
 
@@ -236,4 +238,147 @@ class ConsistencyTestCase(unittest.TestCase):
         self.assertIsInstance(checker, Checker,
             'Preparation failed.')
         self.assertFalse(checker.can_run_check(),
-            'Without previous files, check should be disabled, but isn\'t.')
\ No newline at end of file
+            'Without previous files, check should be disabled, but isn\'t.')
+
+    def test_preparation_solr_breaks_off(self):
+
+        # Preparations: Make test coupler with solr that breaks off after the first file.
+        def previous_files(**args):
+            yield 'abc'
+            raise esgfpid.exceptions.SolrError('Broke off')
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, [])
+        testcoupler._Coupler__solr_sender.iterate_file_handles_of_same_dataset.side_effect = previous_files
+
+        # Preparations: Args for consistency checker.
+        args = TESTHELPERS.get_args_for_consistency_check()
+        args['coupler'] = testcoupler
+
+        # Run code to be tested:
+        checker = Checker(**args)
+
+        # Check result:
+        self.assertFalse(checker.can_run_check(),
+            'With incomplete previous files, check should be disabled, but isn\'t.')
+
+    def test_check_incremental_diff(self):
+
+        # Preparations: Make test coupler with patched solr.
+        prev = ['abc', 'def', 'ghi']
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, prev)
+
+        # Preparations: Make consistency checker.
+        args = TESTHELPERS.get_args_for_consistency_check()
+        args['coupler'] = testcoupler
+        checker = Checker(**args)
+
+        # Run code to be tested:
+        for file_handle in ['abc', 'xyz', 'def', 'xyz']:
+            checker.add_file_handle(file_handle)
+        success = checker.data_consistency_check()
+
+        # Check result:
+        self.assertFalse(success, 'The check should fail - different files passed.')
+        diff = checker.get_diff()
+        self.assertEquals(diff['missing_files'], ['ghi'])
+        self.assertEquals(diff['superfluous_files'], ['xyz'])
+        self.assertEquals(diff['num_previous_files'], 3)
+        self.assertEquals(diff['num_given_files'], 4)
+
+    def test_check_uuid_handles(self):
+
+        # Preparations: Make test coupler with patched solr.
+        prefix = TESTHELPERS.PREFIX_NO_HDL
+        uuid1 = 'hdl:%s/%s' % (prefix, TESTHELPERS.SUFFIX_DS)
+        uuid2 = 'hdl:%s/%s' % (prefix, TESTHELPERS.SUFFIX_DS2)
+        other = 'hdl:%s/%s' % (prefix, TESTHELPERS.SUFFIX_FILE)
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, [uuid1, uuid2, other])
+
+        # Preparations: Make consistency checker.
+        args = TESTHELPERS.get_args_for_consistency_check()
+        args['coupler'] = testcoupler
+        args['prefix'] = prefix
+        checker = Checker(**args)
+
+        # Run code to be tested:
+        success = checker.data_consistency_check([uuid1, other, 'abc'])
+
+        # Check result:
+        self.assertFalse(success, 'The check should fail - different files passed.')
+        diff = checker.get_diff()
+        self.assertEquals(diff['missing_files'], [uuid2])
+        self.assertEquals(diff['superfluous_files'], ['abc'])
+        self.assertTrue(checker.data_consistency_check([uuid2, uuid1, other]),
+            'The check should pass.')
+
+    def test_check_preparation_in_background(self):
+
+        # Preparations: Make test coupler with solr that replies only when we allow it.
+        solr_may_reply = threading.Event()
+        def previous_files(**args):
+            solr_may_reply.wait()
+            return iter(['abc', 'def'])
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, [])
+        testcoupler._Coupler__solr_sender.iterate_file_handles_of_same_dataset.side_effect = previous_files
+
+        # Preparations: Args for consistency checker.
+        args = TESTHELPERS.get_args_for_consistency_check()
+        args['coupler'] = testcoupler
+        args['in_background'] = True
+
+        # Run code to be tested: Add files before solr replies.
+        checker = Checker(**args)
+        checker.add_file_handle('abc')
+        solr_may_reply.set()
+        checker.add_file_handle('xyz')
+
+        # Check result:
+        self.assertTrue(checker.can_run_check(),
+            'With previous files, check should be enabled, but isn\'t.')
+        self.assertFalse(checker.data_consistency_check(), 'The check should fail - different files passed.')
+        diff = checker.get_diff()
+        self.assertEquals(diff['missing_files'], ['def'])
+        self.assertEquals(diff['superfluous_files'], ['xyz'])
+
+    def test_preparation_uses_query_mode_and_cache(self):
+
+        # Preparations: Make test coupler with real solr module in hedged mode.
+        prev = ['abc', 'def']
+        testcoupler = TESTHELPERS.get_coupler(solr_file_handle_query_mode='hedged')
+        args = TESTHELPERS.get_args_for_consistency_check()
+        args['coupler'] = testcoupler
+
+        # Run code to be tested: Two checks of the same dataset.
+        with mock.patch('esgfpid.solr.tasks.filehandles_same_dataset.FindFilesOfSameDatasetVersion') as findermock:
+            findermock.return_value.retrieve_file_handles_of_same_dataset.return_value = prev
+            checker1 = Checker(**args)
+            checker2 = Checker(**args)
+
+        # Check result: One query in hedged mode, the second check used the cache.
+        findermock.assert_called_once_with(mock.ANY, mode='hedged')
+        self.assertEquals(findermock.return_value.retrieve_file_handles_of_same_dataset.call_count, 1)
+        self.assertFalse(findermock.return_value.iterate_file_handles_of_same_dataset.called)
+        self.assertTrue(checker1.data_consistency_check(prev), 'The check should pass.')
+        self.assertTrue(checker2.data_consistency_check(prev), 'The check should pass.')
+
+    def test_preparation_streaming_uses_cache(self):
+
+        # Preparations: Make test coupler with real solr module, prefetch the files.
+        prev = ['abc', 'def']
+        testcoupler = TESTHELPERS.get_coupler()
+        args = TESTHELPERS.get_args_for_consistency_check()
+        args['coupler'] = testcoupler
+        solr = testcoupler._Coupler__solr_sender
+        key = (args['drs_id'], 'file_handles', str(args['version_number']), args['data_node'])
+        solr._SolrInteractor__cache.put(key, prev, False)
+
+        # Run code to be tested:
+        with mock.patch('esgfpid.solr.tasks.filehandles_same_dataset.FindFilesOfSameDatasetVersion') as findermock:
+            checker = Checker(**args)
+
+        # Check result: No query, as the files were cached.
+        self.assertFalse(findermock.called)
+        self.assertTrue(checker.data_consistency_check(prev), 'The check should pass.')
@@ -1,4 +1,6 @@
 import unittest
+import threading
+import mock
 import logging
 import tests.utils as utils
 from tests.utils import compare_json_return_errormessage as error_message
@@ -6,6 +8,7 @@ from tests.utils import compare_json_return_errormessage as error_message
 from esgfpid.defaults import ROUTING_KEY_BASIS as ROUTING_KEY_BASIS
 from esgfpid.assistant.publish import DatasetPublicationAssistant
 from esgfpid.exceptions import SolrSwitchedOff
+from esgfpid.rabbit.asynchronous.exceptions import MessageQueueFull
 
 # Logging
 LOGGER = logging.getLogger(__name__)
@@ -151,6 +154,30 @@ class PublishTestCase(unittest.TestCase):
         same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
         self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
 
+    def test_normal_publication_with_completion_ok(self):
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+        fileargs = TESTHELPERS.get_args_for_adding_file()
+
+        # Run code to be tested:
+        assistant.add_file(**fileargs)
+        completion = assistant.dataset_publication_finished_with_completion()
+
+        # Check result:
+        self.assertTrue(completion.done())
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 0)
+        expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_dataset()
+        same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+        self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 1)
+        expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_file()
+        same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+        self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+
     def test_normal_publication_sev_files_ok(self):
 
         # Test variables
@@ -193,6 +220,43 @@ class PublishTestCase(unittest.TestCase):
         same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
         self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
 
+    def test_publication_retried_after_queue_full(self):
+
+        # Test variables
+        handle1 = PREFIX_WITH_HDL+'/456'
+        handle2 = PREFIX_WITH_HDL+'/789'
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args1['file_handle'] = handle1
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = handle2
+        assistant.add_file(**args1)
+        assistant.add_file(**args2)
+
+        # The queue accepts only two messages the first time:
+        accept_all = rabbitmock.send_many_messages_to_queue
+        def accept_two(msgs):
+            msgs = list(msgs)
+            accept_all(msgs[:2])
+            rabbitmock.send_many_messages_to_queue = accept_all
+            raise MessageQueueFull(rejected_messages=msgs[2:])
+        rabbitmock.send_many_messages_to_queue = accept_two
+
+        # Run code to be tested:
+        with self.assertRaises(MessageQueueFull):
+            assistant.dataset_publication_finished()
+        assistant.dataset_publication_finished()
+
+        # Check result: Every message was sent once.
+        self.assertEquals(len(rabbitmock.received_messages), 3)
+        received_handles = [msg['handle'] for msg in rabbitmock.received_messages]
+        self.assertEquals(received_handles, [DATASETHANDLE_HDL, handle1, handle2])
+
     def test_add_file_wrong_prefix(self):
 
         # Preparations:
@@ -402,8 +466,10 @@ class PublishTestCase(unittest.TestCase):
         assistant.add_file(**args1)
 
         # Run code to be tested and check exception:
-        with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException):
+        with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException) as raised:
             assistant.dataset_publication_finished()
+        self.assertEquals(raised.exception.diff['missing_files'], [prev2])
+        self.assertEquals(raised.exception.diff['superfluous_files'], [])
 
     def test_normal_publication_with_neg_consis_check_too_many_files(self):
 
@@ -430,6 +496,197 @@ class PublishTestCase(unittest.TestCase):
         with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException):
             assistant.dataset_publication_finished()
 
+    def test_normal_publication_solr_replies_after_files_added(self):
+
+        # Test variables:
+        fileargs = TESTHELPERS.get_args_for_adding_file()
+        prev_list = [FILEHANDLE_HDL]
+
+        # Preparations: Solr replies only when we allow it.
+        solr_may_reply = threading.Event()
+        def previous_files(**args):
+            solr_may_reply.wait()
+            return iter(prev_list)
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, prev_list) # solr returns file list
+        testcoupler._Coupler__solr_sender.iterate_file_handles_of_same_dataset.side_effect = previous_files
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+
+        # Run code to be tested: The files are added before solr replied.
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+        assistant.add_file(**fileargs)
+        solr_may_reply.set()
+        assistant.dataset_publication_finished()
+
+        # Check result (dataset):
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 0)
+        expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_dataset()
+        same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+        self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+
+    def test_add_files_kept_compact(self):
+
+        # Test variables:
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = FILEHANDLE2_HDL
+        args2['checksum_type'] = ''.join(list(args1['checksum_type'])) # equal, but not the same object
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, **dsargs)
+
+        # Run code to be tested:
+        assistant.add_file(**args1)
+        assistant.add_file(**args2)
+
+        # Check result:
+        records = assistant._DatasetPublicationAssistant__file_records
+        self.assertEquals(len(records), 2)
+        self.assertFalse(hasattr(records[0], '__dict__'))
+        self.assertIs(records[0].checksum_type, records[1].checksum_type)
+
+    #
+    # Testing streaming mode
+    # File messages are sent while files are added
+    #
+
+    @mock.patch('esgfpid.defaults.PUBLICATION_STREAM_BATCH_SIZE', 1)
+    def test_streaming_publication_without_consis_check(self):
+
+        # Test variables:
+        fileargs = TESTHELPERS.get_args_for_adding_file()
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler(solr_switched_off=True)
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+
+        # Run code to be tested:
+        assistant.add_file(**fileargs)
+
+        # Check result (file sent right away):
+        self.assertEquals(len(rabbitmock.received_messages), 1)
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 0)
+        expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_file()
+        same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+        self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+
+        # Run code to be tested:
+        assistant.dataset_publication_finished()
+
+        # Check result (dataset sent at commit):
+        self.assertEquals(len(rabbitmock.received_messages), 2)
+        received_rabbit_task = TESTHELPERS.get_received_message_from_rabbitmock(testcoupler, 1)
+        expected_rabbit_task = TESTHELPERS.get_rabbit_message_publication_dataset()
+        same = utils.is_json_same(expected_rabbit_task, received_rabbit_task)
+        self.assertTrue(same, error_message(expected_rabbit_task, received_rabbit_task))
+
+    @mock.patch('esgfpid.defaults.PUBLICATION_STREAM_BATCH_SIZE', 1)
+    def test_streaming_republication_held_back(self):
+
+        # Test variables:
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = FILEHANDLE2_HDL
+        prev_list = [FILEHANDLE_HDL, FILEHANDLE2_HDL]
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, prev_list) # solr returns file list
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+        assistant._DatasetPublicationAssistant__consistency_checker.can_run_check() # wait for solr
+
+        # Run code to be tested:
+        assistant.add_file(**args1)
+        assistant.add_file(**args2)
+
+        # Check result: Nothing sent, as the check could still fail.
+        self.assertEquals(len(rabbitmock.received_messages), 0)
+
+        # Run code to be tested:
+        assistant.dataset_publication_finished()
+
+        # Check result:
+        handles = [msg['handle'] for msg in rabbitmock.received_messages]
+        self.assertEquals(handles, [DATASETHANDLE_HDL, FILEHANDLE_HDL, FILEHANDLE2_HDL])
+
+    @mock.patch('esgfpid.defaults.PUBLICATION_STREAM_BATCH_SIZE', 1)
+    def test_streaming_republication_check_fails(self):
+
+        # Test variables:
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = FILEHANDLE2_HDL
+        prev_list = [FILEHANDLE_HDL, 'hdl:'+PREFIX_NO_HDL+'/missing']
+
+        # Preparations:
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, prev_list) # solr returns file list
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+        assistant._DatasetPublicationAssistant__consistency_checker.can_run_check() # wait for solr
+        assistant.add_file(**args1)
+        assistant.add_file(**args2)
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.InconsistentFilesetException):
+            assistant.dataset_publication_finished()
+
+        # Check result: No file points to the dataset that was not published.
+        self.assertEquals(len(rabbitmock.received_messages), 0)
+
+        # Run code to be tested: Publish anyway.
+        assistant.dataset_publication_finished(ignore_exception=True)
+
+        # Check result:
+        handles = [msg['handle'] for msg in rabbitmock.received_messages]
+        self.assertEquals(handles, [DATASETHANDLE_HDL, FILEHANDLE_HDL, FILEHANDLE2_HDL])
+
+    @mock.patch('esgfpid.defaults.PUBLICATION_STREAM_BATCH_SIZE', 1)
+    def test_streaming_publication_waits_for_solr(self):
+
+        # Test variables:
+        args1 = TESTHELPERS.get_args_for_adding_file()
+        args2 = TESTHELPERS.get_args_for_adding_file()
+        args2['file_handle'] = FILEHANDLE2_HDL
+
+        # Preparations: Solr replies only when we allow it (first publication).
+        solr_may_reply = threading.Event()
+        def previous_files(**args):
+            solr_may_reply.wait()
+            return iter([])
+        testcoupler = TESTHELPERS.get_coupler()
+        TESTHELPERS.patch_solr_returns_previous_files(testcoupler, [])
+        testcoupler._Coupler__solr_sender.iterate_file_handles_of_same_dataset.side_effect = previous_files
+        rabbitmock = TESTHELPERS.patch_with_rabbit_mock(testcoupler)
+        dsargs = TESTHELPERS.get_args_for_publication_assistant()
+        assistant = DatasetPublicationAssistant(coupler=testcoupler, stream_files=True, **dsargs)
+
+        # Run code to be tested: Not sent before solr replied.
+        assistant.add_file(**args1)
+        self.assertEquals(len(rabbitmock.received_messages), 0)
+
+        # Run code to be tested: Sent once solr replied.
+        solr_may_reply.set()
+        assistant._DatasetPublicationAssistant__consistency_checker.can_run_check() # wait for solr
+        assistant.add_file(**args2)
+        self.assertEquals([msg['handle'] for msg in rabbitmock.received_messages], [FILEHANDLE_HDL, FILEHANDLE2_HDL])
+
+        # Run code to be tested:
+        assistant.dataset_publication_finished()
+
+        # Check result:
+        self.assertEquals(len(rabbitmock.received_messages), 3)
+        self.assertEquals(rabbitmock.received_messages[2]['handle'], DATASETHANDLE_HDL)
+
     #
     # Testing invalid operations
     # (publication actions occur at the wrong time / wrong state)
@@ -0,0 +1,236 @@
+import unittest
+import mock
+import logging
+import threading
+import Queue
+import esgfpid.defaults
+import esgfpid.exceptions
+import esgfpid.rabbit.asynchronous
+from esgfpid.rabbit.asynchronous.bounded_queue import BoundedMessageQueue
+from esgfpid.rabbit.asynchronous.exceptions import MessageQueueFull
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+from resources.TESTVALUES import *
+import resources.TESTVALUES as TESTHELPERS
+
+class BoundedQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_envelopes(self, num, size=10):
+        return [MessageEnvelope('rk.%i' % i, ('%i' % i).ljust(size, 'x')) for i in xrange(num)]
+
+    def get_all(self, queue):
+        content = []
+        while not queue.empty():
+            content.append(queue.get(block=False))
+        return content
+
+    #
+    # Limits
+    #
+
+    def test_no_limits_ok(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(full_policy='raise')
+
+        # Run code to be tested:
+        for env in self.make_envelopes(1000):
+            queue.put_message(env)
+
+        # Check result:
+        self.assertEquals(queue.qsize(), 1000)
+        self.assertEquals(queue.get_num_bytes(), 10000)
+
+    def test_limit_by_messages_raise(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_messages=3, full_policy='raise')
+        envelopes = self.make_envelopes(4)
+        for env in envelopes[:3]:
+            queue.put_message(env)
+
+        # Run code to be tested:
+        with self.assertRaises(Queue.Full):
+            queue.put_message(envelopes[3])
+
+        # Check result: There is space again after a get
+        queue.get()
+        queue.put_message(envelopes[3])
+        self.assertEquals(self.get_all(queue), envelopes[1:])
+
+    def test_limit_by_bytes_raise(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_bytes=25, full_policy='raise')
+        envelopes = self.make_envelopes(4)
+        for env in envelopes[:3]:
+            queue.put_message(env)
+
+        # Run code to be tested:
+        with self.assertRaises(Queue.Full):
+            queue.put_message(envelopes[3])
+
+        # Check result:
+        self.assertEquals(queue.get_num_bytes(), 30)
+
+    def test_large_message_into_empty_queue_ok(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_bytes=5, full_policy='raise')
+
+        # Run code to be tested:
+        queue.put_message(MessageEnvelope('rk', 100*'x'))
+
+        # Check result:
+        self.assertEquals(queue.qsize(), 1)
+
+    def test_unlimited_put_ignores_limits(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_messages=1, full_policy='raise')
+
+        # Run code to be tested (used by the rabbit thread):
+        for env in self.make_envelopes(3):
+            queue.put(env, block=False)
+
+        # Check result:
+        self.assertEquals(queue.qsize(), 3)
+
+    def test_unknown_policy_error(self):
+
+        # Run code to be tested:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            BoundedMessageQueue(full_policy='drop')
+
+    #
+    # Block
+    #
+
+    @mock.patch('esgfpid.defaults.RABBIT_QUEUE_BLOCK_TIMEOUT_SECONDS', 0.05)
+    def test_block_timeout(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_messages=1, full_policy='block')
+        envelopes = self.make_envelopes(2)
+        queue.put_message(envelopes[0])
+
+        # Run code to be tested:
+        with self.assertRaises(Queue.Full):
+            queue.put_message(envelopes[1])
+
+    def test_block_until_space(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_messages=1, full_policy='block')
+        envelopes = self.make_envelopes(2)
+        queue.put_message(envelopes[0])
+        received = []
+        def consume():
+            received.append(queue.get(timeout=5))
+        consumer = threading.Timer(0.05, consume)
+
+        # Run code to be tested:
+        consumer.start()
+        queue.put_message(envelopes[1])
+        consumer.join()
+
+        # Check result:
+        self.assertEquals(received, envelopes[:1])
+        self.assertEquals(self.get_all(queue), envelopes[1:])
+
+    #
+    # Spill
+    #
+
+    def test_spill_keeps_order(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_messages=2, full_policy='spill')
+        envelopes = self.make_envelopes(5)
+        envelopes.append(MessageEnvelope('rk.5', u'{"foo": "b\xe4r\\n"}\nfoo', 17))
+        envelopes.append(MessageEnvelope('rk.6', 'bar', None, 'hdl:foo/ds'))
+
+        # Run code to be tested:
+        for env in envelopes:
+            queue.put_message(env)
+
+        # Check result:
+        self.assertEquals(queue.get_num_spilled(), 5)
+        self.assertEquals(queue.qsize(), 7)
+        received = self.get_all(queue)
+        self.assertEquals(received[:5], envelopes[:5])
+        self.assertEquals(received[5].body, envelopes[5].body.encode('utf-8'))
+        self.assertEquals(received[5].spool_id, 17)
+        self.assertEquals(received[5].ordering_key, None)
+        self.assertEquals(received[6], envelopes[6])
+        self.assertEquals(queue.get_num_spilled(), 0)
+
+    def test_spill_moves_back_to_memory(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_messages=2, full_policy='spill')
+        for env in self.make_envelopes(4):
+            queue.put_message(env)
+
+        # Run code to be tested:
+        queue.get()
+
+        # Check result:
+        self.assertEquals(queue.get_num_spilled(), 1)
+        self.assertEquals(queue.get_status()['num_messages'], 3)
+
+    #
+    # Status
+    #
+
+    def test_status_ok(self):
+
+        # Preparation:
+        queue = BoundedMessageQueue(max_messages=2, max_bytes=1000, full_policy='spill')
+
+        # Run code to be tested:
+        for env in self.make_envelopes(3):
+            queue.put_message(env)
+
+        # Check result:
+        expected = dict(
+            num_messages=3,
+            num_bytes=20,
+            num_spilled=1,
+            max_messages=2,
+            max_bytes=1000,
+            full_policy='spill'
+        )
+        self.assertEquals(queue.get_status(), expected)
+
+    #
+    # Usage by the rabbit module
+    #
+
+    @mock.patch('esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_rabbit_module_raises_if_full(self, createpatch):
+
+        # Preparation:
+        createpatch.return_value = TESTHELPERS.get_thread_mock()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(
+            TESTHELPERS.get_nodemanager(),
+            queue=BoundedMessageQueue(max_messages=2, full_policy='raise'))
+        testrabbit.start_rabbit_thread()
+
+        # Run code to be tested:
+        testrabbit.send_many_messages_to_queue(self.make_envelopes(2))
+        with self.assertRaises(MessageQueueFull):
+            testrabbit.send_message_to_queue(self.make_envelopes(1)[0])
+
+        # Check result:
+        self.assertEquals(testrabbit.get_queue_status()['num_messages'], 2)
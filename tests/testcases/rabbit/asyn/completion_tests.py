@@ -0,0 +1,152 @@
+import unittest
+import mock
+import logging
+from esgfpid.rabbit.asynchronous.completion import Completion, CompletionTracker, gather_completions
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+def make_envelopes(*bodies):
+    return [MessageEnvelope('rk', body) for body in bodies]
+
+class CompletionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def test_acks_complete(self):
+
+        # Preparation:
+        tracker = CompletionTracker()
+        messages = make_envelopes('a', 'b')
+        completion = tracker.track(messages)
+        callback = mock.MagicMock()
+        completion.add_done_callback(callback)
+
+        # Run code to be tested:
+        tracker.report_confirms(messages[:1], [])
+        done_before = completion.done()
+        tracker.report_confirms(messages[1:], [])
+
+        # Check result:
+        self.assertFalse(done_before)
+        self.assertTrue(completion.succeeded())
+        callback.assert_called_once_with(completion)
+        self.assertFalse(tracker.is_tracking())
+
+    def test_nack_fails(self):
+
+        # Preparation:
+        tracker = CompletionTracker()
+        messages = make_envelopes('a', 'b')
+        completion = tracker.track(messages)
+
+        # Run code to be tested:
+        tracker.report_confirms(messages[:1], messages[1:])
+
+        # Check result:
+        self.assertTrue(completion.done())
+        self.assertFalse(completion.succeeded())
+        self.assertEquals(completion.get_failed_messages(), messages[1:])
+
+    def test_equal_messages_in_turn(self):
+
+        # Preparation:
+        tracker = CompletionTracker()
+        first = tracker.track(make_envelopes('a'))
+        second = tracker.track(make_envelopes('a'))
+
+        # Run code to be tested (e.g. after spilling to disk):
+        tracker.report_confirms(make_envelopes('a'), [])
+
+        # Check result:
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+
+    def test_unknown_messages_ignored(self):
+
+        # Preparation:
+        tracker = CompletionTracker()
+        completion = tracker.track(make_envelopes('a'))
+
+        # Run code to be tested:
+        tracker.report_confirms(make_envelopes('b'), make_envelopes('c'))
+
+        # Check result:
+        self.assertFalse(completion.done())
+
+    def test_fail_all_pending(self):
+
+        # Preparation:
+        tracker = CompletionTracker()
+        messages = make_envelopes('a', 'b')
+        completion = tracker.track(messages)
+        tracker.report_confirms(messages[:1], [])
+
+        # Run code to be tested:
+        tracker.fail_all_pending()
+
+        # Check result:
+        self.assertTrue(completion.done())
+        self.assertEquals(completion.get_failed_messages(), messages[1:])
+
+    def test_completion_of_all_pending(self):
+
+        # Preparation:
+        tracker = CompletionTracker()
+        first = make_envelopes('a')
+        second = make_envelopes('b')
+        tracker.track(first)
+        tracker.track(second)
+
+        # Run code to be tested:
+        flushed = tracker.get_completion_of_all_pending()
+        tracker.report_confirms(first, [])
+        done_before = flushed.done()
+        tracker.report_confirms([], second)
+
+        # Check result:
+        self.assertFalse(done_before)
+        self.assertTrue(flushed.done())
+        self.assertEquals(flushed.get_failed_messages(), second)
+
+    def test_nothing_pending_done_at_once(self):
+
+        # Run code to be tested:
+        flushed = CompletionTracker().get_completion_of_all_pending()
+        gathered = gather_completions([])
+
+        # Check result:
+        self.assertTrue(flushed.succeeded())
+        self.assertTrue(gathered.succeeded())
+
+    def test_callback_of_done_completion_called_at_once(self):
+
+        # Preparation:
+        completion = Completion(0)
+        callback = mock.MagicMock()
+
+        # Run code to be tested:
+        completion.add_done_callback(callback)
+
+        # Check result:
+        callback.assert_called_once_with(completion)
+
+    def test_callback_error_does_not_stop_others(self):
+
+        # Preparation:
+        completion = Completion(1)
+        callback = mock.MagicMock()
+        completion.add_done_callback(mock.MagicMock(side_effect=ValueError()))
+        completion.add_done_callback(callback)
+
+        # Run code to be tested:
+        completion.report(1)
+
+        # Check result:
+        callback.assert_called_once_with(completion)
+        self.assertTrue(completion.wait(0))
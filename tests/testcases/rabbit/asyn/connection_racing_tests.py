@@ -0,0 +1,226 @@
+import unittest
+import mock
+import logging
+import esgfpid.defaults
+import esgfpid.rabbit.nodemanager
+import esgfpid.rabbit.asynchronous.thread_builder
+from esgfpid.rabbit.asynchronous.thread_statemachine import StateMachine
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+import resources.TESTVALUES as TESTHELPERS
+
+class MockIOLoop(object):
+    '''Runs the callbacks passed on by the builder at once.'''
+
+    def add_timeout(self, seconds, callback):
+        callback()
+
+    def start(self):
+        pass
+
+class RacingConnectionFactory(object):
+    '''Replaces the creation of pika connections, keeping their callbacks.'''
+
+    def __init__(self):
+        self.connections = {}
+        self.on_open = {}
+        self.on_open_error = {}
+        self.on_close = {}
+        self.on_channel_open = {}
+        self.broken_hosts = []
+
+    def __call__(self, params, ioloop, on_open, on_open_error, on_close):
+        host = params.host
+        if host in self.broken_hosts:
+            raise ValueError('Cannot create connection to %s' % host)
+        connection = mock.MagicMock()
+        connection.is_open = False
+        connection.ioloop = ioloop
+        def channel(on_open_callback):
+            self.on_channel_open[host] = on_open_callback
+        connection.channel.side_effect = channel
+        self.connections[host] = connection
+        self.on_open[host] = on_open
+        self.on_open_error[host] = on_open_error
+        self.on_close[host] = on_close
+        return connection
+
+    def open(self, host):
+        self.connections[host].is_open = True
+        self.on_open[host](self.connections[host])
+
+    def open_channel(self, host):
+        self.on_channel_open[host](mock.MagicMock())
+
+    def fail(self, host):
+        self.on_open_error[host](self.connections[host], 'foo error')
+
+class ConnectionRacingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_builder(self):
+        self.nodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        for i in [1,2,3]:
+            self.nodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='foo%i' % i, priority=i))
+        self.thread = mock.MagicMock()
+        self.thread.get_num_unpublished.return_value = 0
+        self.statemachine = StateMachine()
+        builder = esgfpid.rabbit.asynchronous.thread_builder.ConnectionBuilder(
+            self.thread,
+            self.statemachine,
+            mock.MagicMock(), # returnhandler
+            mock.MagicMock(), # shutter
+            self.nodemanager)
+        self.factory = RacingConnectionFactory()
+        builder._ConnectionBuilder__make_racing_connection = self.factory
+        builder._ConnectionBuilder__make_ioloop = MockIOLoop
+        return builder
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE', 2)
+    def test_first_channel_wins(self):
+
+        # Preparation:
+        builder = self.make_builder()
+
+        # Run code to be tested:
+        builder.first_connection()
+        self.factory.open('foo1')
+        self.factory.open('foo2')
+        self.factory.open_channel('foo2')
+        self.factory.open_channel('foo1')
+
+        # Check result:
+        self.assertEquals(sorted(self.factory.connections.keys()), ['foo1', 'foo2'])
+        self.assertIs(self.thread._connection, self.factory.connections['foo2'])
+        self.assertEquals(self.nodemanager.get_connection_parameters().host, 'foo2')
+        self.assertTrue(self.statemachine.is_AVAILABLE())
+        self.factory.connections['foo1'].close.assert_called_with()
+        self.factory.connections['foo2'].close.assert_not_called()
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE', 2)
+    def test_late_loser_closed_when_open(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.first_connection()
+        self.factory.open('foo2')
+        self.factory.open_channel('foo2')
+
+        # Run code to be tested:
+        self.factory.open('foo1')
+
+        # Check result:
+        self.factory.connections['foo1'].close.assert_called_with()
+        self.assertNotIn('foo1', self.factory.on_channel_open)
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE', 2)
+    def test_one_fails_other_wins(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.on_connection_error = mock.MagicMock()
+
+        # Run code to be tested:
+        builder.first_connection()
+        self.factory.fail('foo1')
+        self.factory.open('foo2')
+        self.factory.open_channel('foo2')
+
+        # Check result:
+        builder.on_connection_error.assert_not_called()
+        self.assertIs(self.thread._connection, self.factory.connections['foo2'])
+        self.assertEquals(self.nodemanager.get_node_stats()['foo1']['failures'], 1)
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE', 2)
+    def test_all_fail(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.on_connection_error = mock.MagicMock()
+
+        # Run code to be tested:
+        builder.first_connection()
+        self.factory.fail('foo2')
+        self.factory.fail('foo1')
+        self.factory.on_close['foo1'](self.factory.connections['foo1'], 0, 'closed')
+
+        # Check result:
+        # Handled once, like one failed connection to the last failed node:
+        builder.on_connection_error.assert_called_once_with(self.factory.connections['foo1'], 'foo error')
+        self.assertEquals(self.nodemanager.get_connection_parameters().host, 'foo1')
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE', 2)
+    def test_creation_fails_other_wins(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.on_connection_error = mock.MagicMock()
+        self.factory.broken_hosts = ['foo1']
+
+        # Run code to be tested:
+        builder.first_connection()
+        self.factory.open('foo2')
+        self.factory.open_channel('foo2')
+
+        # Check result:
+        builder.on_connection_error.assert_not_called()
+        self.assertIs(self.thread._connection, self.factory.connections['foo2'])
+        self.assertEquals(self.nodemanager.get_node_stats()['foo1']['failures'], 1)
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE', 2)
+    def test_creation_fails_for_all(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        self.factory.broken_hosts = ['foo1', 'foo2']
+
+        # Run code to be tested:
+        with mock.patch('pika.SelectConnection') as connectionpatch:
+            builder.first_connection()
+
+        # Check result:
+        # The others are reported, the best one is tried on its own:
+        self.assertEquals(connectionpatch.call_count, 1)
+        params = connectionpatch.call_args[1]['parameters']
+        self.assertEquals(params.host, 'foo1')
+        self.assertEquals(self.nodemanager.get_connection_parameters().host, 'foo1')
+        self.assertEquals(self.nodemanager.get_node_stats()['foo2']['failures'], 1)
+        self.assertEquals(self.nodemanager.get_node_stats().get('foo1', {}).get('failures', 0), 0)
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_CONNECTION_RACE_SIZE', 2)
+    def test_winner_closed_handled_normally(self):
+
+        # Preparation:
+        builder = self.make_builder()
+        builder.on_connection_closed = mock.MagicMock()
+        builder.first_connection()
+        self.factory.open('foo1')
+        self.factory.open_channel('foo1')
+
+        # Run code to be tested:
+        self.factory.on_close['foo2'](self.factory.connections['foo2'], 0, 'closed by us')
+        self.factory.on_close['foo1'](self.factory.connections['foo1'], 320, 'broken')
+
+        # Check result:
+        builder.on_connection_closed.assert_called_once_with(self.factory.connections['foo1'], 320, 'broken')
+
+    def test_no_race_by_default(self):
+
+        # Preparation:
+        builder = self.make_builder()
+
+        # Run code to be tested:
+        with mock.patch('pika.SelectConnection') as connectionpatch:
+            builder.first_connection()
+
+        # Check result:
+        self.assertEquals(len(self.factory.connections), 0)
+        self.assertEquals(connectionpatch.call_count, 1)
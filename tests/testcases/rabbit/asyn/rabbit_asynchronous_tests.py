@@ -51,6 +51,7 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         with self.assertRaises(OperationNotAllowed):
             testrabbit.send_many_messages_to_queue(['a','b','c'])
 
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES', 1)
     @mock.patch('esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
     def test_send_message_ok(self, createpatch):
 
@@ -79,6 +80,45 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         self.assertIn('b', queue_content)
         self.assertIn('c', queue_content)
 
+    @mock.patch('esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_start_twice_ok(self, createpatch):
+
+        # Prepare patch
+        threadpatch = mock.MagicMock()
+        createpatch.return_value = threadpatch
+
+        # Preparations
+        testrabbit = TESTHELPERS.get_asynchronous_rabbit()
+
+        # Run code to be tested (e.g. warm-up, then normal start):
+        testrabbit.start_rabbit_thread()
+        testrabbit.start_rabbit_thread()
+
+        # Check result
+        threadpatch.start.assert_called_once_with()
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES', 100)
+    @mock.patch('esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_send_many_messages_one_event_per_batch(self, createpatch):
+
+        # Prepare patch
+        threadpatch = TESTHELPERS.get_thread_mock()
+        createpatch.return_value = threadpatch
+
+        # Preparations
+        testrabbit = TESTHELPERS.get_asynchronous_rabbit()
+
+        # Run code to be tested:
+        testrabbit.start_rabbit_thread()
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
+        testrabbit.send_many_messages_to_queue(['msg%i' % i for i in xrange(250)])
+
+        # Check result
+        # 250 (plus 10 to be sure) messages need three batches:
+        self.assertEquals(threadpatch.num_message_events, 3)
+        queue = testrabbit._AsynchronousRabbitConnector__unpublished_messages_queue
+        self.assertEquals(queue.qsize(), 250)
+
     #
     # Gently finish
     #
@@ -104,6 +144,100 @@ class RabbitAsynConnectorTestCase(unittest.TestCase):
         self.assertFalse(threadpatch.is_alive())
         self.assertTrue(testrabbit.is_finished())
 
+    @mock.patch('esgfpid.rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_gently_finish_with_timeout_ok(self, createpatch):
+
+        # Prepare patch
+        threadpatch = TESTHELPERS.get_thread_mock()
+        createpatch.return_value = threadpatch
+
+        # Preparations
+        testrabbit = TESTHELPERS.get_asynchronous_rabbit()
+        testrabbit.start_rabbit_thread()
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
+
+        # Run code to be tested:
+        testrabbit.finish_rabbit_thread(timeout=0.5)
+
+        # Check result
+        self.assertEquals(threadpatch.gently_finish_timeout, 0.5)
+        self.assertTrue(testrabbit.is_finished())
+
+    @mock.patch('esgfpid.rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_gently_finish_in_background_ok(self, createpatch):
+
+        # Prepare patch
+        threadpatch = TESTHELPERS.get_thread_mock()
+        threadpatch.unconfirmed = ['x']
+        createpatch.return_value = threadpatch
+
+        # Preparations
+        testrabbit = TESTHELPERS.get_asynchronous_rabbit()
+        testrabbit.start_rabbit_thread()
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
+
+        # Run code to be tested:
+        completion = testrabbit.finish_rabbit_thread_in_background(timeout=0.5)
+        done = completion.wait(5)
+
+        # Check result
+        self.assertTrue(done)
+        self.assertEquals(completion.get_failed_messages(), ['x'])
+        self.assertEquals(threadpatch.gently_finish_timeout, 0.5)
+        self.assertTrue(testrabbit.is_finished())
+
+    #
+    # Completions
+    #
+
+    @mock.patch('esgfpid.rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_send_many_messages_with_completion(self, createpatch):
+
+        # Prepare patch
+        threadpatch = TESTHELPERS.get_thread_mock()
+        createpatch.return_value = threadpatch
+
+        # Preparations
+        testrabbit = TESTHELPERS.get_asynchronous_rabbit()
+        testrabbit.start_rabbit_thread()
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
+        queue = testrabbit._AsynchronousRabbitConnector__unpublished_messages_queue
+
+        # Run code to be tested:
+        completion = testrabbit.send_many_messages_to_queue_with_completion(['a','b','c'])
+        flushed = testrabbit.flush()
+        envelopes = [queue.get() for i in xrange(3)]
+        testrabbit.report_confirms(envelopes[:2], [])
+        done_before = completion.done()
+        testrabbit.report_confirms([], envelopes[2:])
+
+        # Check result
+        self.assertFalse(done_before)
+        self.assertTrue(completion.done())
+        self.assertFalse(completion.succeeded())
+        self.assertEquals(completion.get_failed_messages(), envelopes[2:])
+        self.assertTrue(flushed.done())
+
+    @mock.patch('esgfpid.rabbit.asynchronous.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_completion_fails_when_finished(self, createpatch):
+
+        # Prepare patch
+        threadpatch = TESTHELPERS.get_thread_mock()
+        createpatch.return_value = threadpatch
+
+        # Preparations
+        testrabbit = TESTHELPERS.get_asynchronous_rabbit()
+        testrabbit.start_rabbit_thread()
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
+        completion = testrabbit.send_many_messages_to_queue_with_completion(['a'])
+
+        # Run code to be tested:
+        testrabbit.force_finish_rabbit_thread()
+
+        # Check result
+        self.assertTrue(completion.done())
+        self.assertEquals(len(completion.get_failed_messages()), 1)
+
     #
     # Force finish
     #
@@ -402,19 +402,16 @@ class ThreadBuilderTestCase(unittest.TestCase):
 
         # Preparation:
         builder = self.make_builder()
-        self.confirmer.put_to_unconfirmed_delivery_tags(1)
-        self.confirmer.put_to_unconfirmed_delivery_tags(2)
-        self.confirmer.put_to_unconfirmed_delivery_tags(3)
-        self.confirmer.put_to_unconfirmed_messages_dict(1,'foo1')
-        self.confirmer.put_to_unconfirmed_messages_dict(2,'foo2')
-        self.confirmer.put_to_unconfirmed_messages_dict(3,'foo3')
+        self.confirmer.put_to_unconfirmed_messages(1,'foo1')
+        self.confirmer.put_to_unconfirmed_messages(2,'foo2')
+        self.confirmer.put_to_unconfirmed_messages(3,'foo3')
 
         # Run code to be tested:
         builder.reconnect()
 
         # Check result:
         self.feeder.reset_message_number.assert_called_with()
-        self.acceptor.send_many_messages.assert_called_with(['foo1','foo3','foo2'])
+        self.acceptor.send_many_messages.assert_called_with(['foo1','foo2','foo3'])
         self.assertEquals(connpatch.call_count, 1)
         builder.thread._connection.ioloop.start.assert_any_call()
         builder.thread._connection.ioloop.stop.assert_any_call()
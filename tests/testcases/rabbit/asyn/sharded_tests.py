@@ -0,0 +1,209 @@
+import unittest
+import mock
+import logging
+import esgfpid.exceptions
+from esgfpid.rabbit.asynchronous.sharded import ShardedRabbitConnector
+from esgfpid.rabbit.asynchronous.exceptions import OperationNotAllowed, MessageQueueFull
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+class ShardedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_connector(self, hosts, strategy='round_robin'):
+        node_managers = []
+        for host in hosts:
+            node_manager = mock.MagicMock()
+            node_manager.get_connection_parameters.return_value.host = host
+            node_managers.append(node_manager)
+
+        self.shards = {}
+        def create_shard(node_manager, queue_args):
+            shard = mock.MagicMock()
+            shard.is_available.return_value = True
+            shard.has_failed.return_value = False
+            shard.get_num_pending.return_value = 0
+            self.shards[node_manager.get_connection_parameters().host] = shard
+            return shard
+
+        with mock.patch.object(ShardedRabbitConnector, '_ShardedRabbitConnector__create_shard', side_effect=create_shard):
+            connector = ShardedRabbitConnector(node_managers, strategy)
+        connector.start_rabbit_thread()
+        return connector
+
+    def get_sent(self, host):
+        sent = []
+        for call in self.shards[host].send_message_to_queue.call_args_list:
+            sent.append(call[0][0])
+        for call in self.shards[host].send_many_messages_to_queue.call_args_list:
+            sent.extend(call[0][0])
+        return sent
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            self.make_connector(['foo1'], 'random')
+
+    def test_not_started(self):
+
+        # Preparation:
+        node_manager = mock.MagicMock()
+        node_manager.get_connection_parameters.return_value.host = 'foo1'
+        with mock.patch.object(ShardedRabbitConnector, '_ShardedRabbitConnector__create_shard'):
+            connector = ShardedRabbitConnector([node_manager])
+
+        # Run code to be tested:
+        with self.assertRaises(OperationNotAllowed):
+            connector.send_message_to_queue('a')
+
+    def test_round_robin(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2', 'foo3'])
+
+        # Run code to be tested:
+        connector.send_many_messages_to_queue(['a','b','c','d'])
+        connector.send_message_to_queue('e')
+
+        # Check result:
+        self.assertEquals(sorted(self.get_sent('foo1')), ['a','d'])
+        self.assertEquals(sorted(self.get_sent('foo2')), ['b','e'])
+        self.assertEquals(self.get_sent('foo3'), ['c'])
+
+    def test_queue_full_rejected_collected(self):
+
+        # Preparation: The queue of foo1 only accepts one message.
+        connector = self.make_connector(['foo1', 'foo2'])
+        self.shards['foo1'].send_many_messages_to_queue.side_effect = lambda msgs: self.raise_queue_full(msgs[1:])
+
+        # Run code to be tested:
+        with self.assertRaises(MessageQueueFull) as raised:
+            connector.send_many_messages_to_queue(['a','b','c','d','e'])
+
+        # Check result: foo2 got its messages anyway.
+        self.assertEquals(sorted(raised.exception.rejected_messages), ['c','e'])
+        self.assertEquals(self.get_sent('foo2'), ['b','d'])
+
+    def raise_queue_full(self, rejected):
+        raise MessageQueueFull(rejected_messages=rejected)
+
+    def test_least_outstanding(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'], 'least_outstanding')
+        self.shards['foo1'].get_num_pending.return_value = 3
+
+        # Run code to be tested:
+        connector.send_many_messages_to_queue(['a','b','c','d','e'])
+
+        # Check result:
+        self.assertEquals(self.get_sent('foo1'), ['d'])
+        self.assertEquals(self.get_sent('foo2'), ['a','b','c','e'])
+
+    def test_unavailable_shard_skipped(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'])
+        self.shards['foo1'].is_available.return_value = False
+
+        # Run code to be tested:
+        connector.send_many_messages_to_queue(['a','b','c'])
+
+        # Check result:
+        self.assertEquals(self.get_sent('foo1'), [])
+        self.assertEquals(self.get_sent('foo2'), ['a','b','c'])
+
+    def test_none_available_all_used(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'])
+        for shard in self.shards.values():
+            shard.is_available.return_value = False
+
+        # Run code to be tested:
+        connector.send_many_messages_to_queue(['a','b'])
+
+        # Check result:
+        self.assertEquals(self.get_sent('foo1'), ['a'])
+        self.assertEquals(self.get_sent('foo2'), ['b'])
+
+    def test_failed_shard_messages_moved(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'])
+        self.shards['foo1'].has_failed.return_value = True
+        self.shards['foo1'].is_available.return_value = False
+        self.shards['foo1'].take_leftovers.return_value = ['x','y']
+
+        # Run code to be tested:
+        connector.send_message_to_queue('a')
+
+        # Check result:
+        self.assertEquals(self.get_sent('foo1'), [])
+        self.assertEquals(sorted(self.get_sent('foo2')), ['a','x','y'])
+        status = connector.get_node_status()
+        self.assertEquals(status['foo1']['state'], 'failed')
+        self.assertEquals(status['foo1']['num_moved_away'], 2)
+        self.assertEquals(status['foo2']['state'], 'available')
+        self.assertEquals(status['foo2']['num_sent'], 3)
+
+    def test_all_failed_last_one_kept(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'])
+        for shard in self.shards.values():
+            shard.has_failed.return_value = True
+            shard.is_available.return_value = False
+            shard.take_leftovers.return_value = ['x']
+
+        # Run code to be tested:
+        connector.send_message_to_queue('a')
+
+        # Check result:
+        self.shards['foo2'].take_leftovers.assert_not_called()
+        self.assertEquals(sorted(self.get_sent('foo2')), ['a','x'])
+
+    def test_finish_skips_failed(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'])
+        self.shards['foo1'].has_failed.return_value = True
+        self.shards['foo1'].take_leftovers.return_value = []
+
+        # Run code to be tested:
+        connector.finish_rabbit_thread(5)
+
+        # Check result:
+        self.shards['foo1'].finish_rabbit_thread.assert_not_called()
+        self.shards['foo2'].finish_rabbit_thread.assert_called_once_with(5)
+
+    def test_leftovers_collected(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'])
+        self.shards['foo1'].get_leftovers.return_value = ['x']
+        self.shards['foo2'].get_leftovers.return_value = ['y', 'z']
+
+        # Run code to be tested and check result:
+        self.assertEquals(connector.get_leftovers(), ['x', 'y', 'z'])
+        self.assertTrue(connector.any_leftovers())
+
+    def test_queue_status_summed(self):
+
+        # Preparation:
+        connector = self.make_connector(['foo1', 'foo2'])
+        for shard in self.shards.values():
+            shard.get_queue_status.return_value = dict(num_messages=2, num_bytes=10, num_spilled=0, max_messages=5, max_bytes=None, full_policy='block')
+
+        # Run code to be tested:
+        status = connector.get_queue_status()
+
+        # Check result:
+        self.assertEquals(status['num_messages'], 4)
+        self.assertEquals(status['num_bytes'], 20)
+        self.assertEquals(status['max_messages'], 5)
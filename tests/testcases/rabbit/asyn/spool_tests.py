@@ -0,0 +1,331 @@
+import unittest
+import mock
+import logging
+import os
+import shutil
+import tempfile
+import esgfpid.defaults
+import esgfpid.exceptions
+import esgfpid.rabbit.asynchronous
+import esgfpid.rabbit.asynchronous.thread_confirmer
+from esgfpid.rabbit.asynchronous.spool import MessageSpool
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
+from esgfpid.rabbit.asynchronous.bounded_queue import BoundedMessageQueue
+from esgfpid.rabbit.asynchronous.exceptions import MessageQueueFull
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+from resources.TESTVALUES import *
+import resources.TESTVALUES as TESTHELPERS
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+        shutil.rmtree(self.directory)
+
+    def make_spool(self, fsync='never'):
+        spool = MessageSpool(self.directory, fsync)
+        replay = spool.open()
+        return spool, replay
+
+    def make_envelopes(self, num):
+        return [MessageEnvelope('rk.%i' % i, '{"foo": "bar%i"}' % i) for i in xrange(num)]
+
+    def list_segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('segment-'))
+
+    #
+    # Put, confirm, replay
+    #
+
+    def test_put_and_replay_unconfirmed_ok(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+        self.assertEquals(replay, [])
+
+        # Run code to be tested:
+        spooled = spool.put_many(self.make_envelopes(3))
+        spool.confirm_many([spooled[1]])
+        spool.close()
+        spool2, replay = self.make_spool()
+
+        # Check result:
+        self.assertEquals([env.spool_id for env in spooled], [1,2,3])
+        self.assertEquals(replay, [spooled[0], spooled[2]])
+        self.assertEquals(spool2.get_num_unconfirmed(), 2)
+
+        # New messages get new ids:
+        self.assertEquals(spool2.put(self.make_envelopes(1)[0]).spool_id, 4)
+
+    def test_all_confirmed_segments_removed_ok(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+
+        # Run code to be tested:
+        spooled = spool.put_many(self.make_envelopes(3))
+        spool.confirm_many(spooled)
+        spool.close()
+
+        # Check result:
+        self.assertEquals(self.list_segments(), [])
+        spool2, replay = self.make_spool()
+        self.assertEquals(replay, [])
+
+    def test_spooled_messages_not_spooled_again(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+        spooled = spool.put_many(self.make_envelopes(2))
+
+        # Run code to be tested:
+        spooled_again = spool.put_many(spooled)
+
+        # Check result:
+        self.assertEquals(spooled_again, spooled)
+        self.assertEquals(spool.get_num_unconfirmed(), 2)
+
+    def test_put_json_message_ok(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+
+        # Run code to be tested:
+        spooled = spool.put({"foo":"bar", "ROUTING_KEY":"my.key"})
+        spool.close()
+        spool2, replay = self.make_spool()
+
+        # Check result:
+        self.assertEquals(replay[0].routing_key, 'my.key')
+        self.assertEquals(replay[0].body, spooled.body)
+
+    def test_body_with_newlines_ok(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+        envelope = MessageEnvelope('my.key', 'line1\nC 1\nline3')
+
+        # Run code to be tested:
+        spool.put(envelope)
+        spool.close()
+        spool2, replay = self.make_spool()
+
+        # Check result:
+        self.assertEquals(replay, [envelope._replace(spool_id=1)])
+
+    def test_ordering_key_replayed_ok(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+        envelopes = [
+            MessageEnvelope('my.key', '{}', None, 'hdl:123/ab c'),
+            MessageEnvelope('my key', '{}', None, None)
+        ]
+
+        # Run code to be tested:
+        spool.put_many(envelopes)
+        spool.close()
+        spool2, replay = self.make_spool()
+
+        # Check result:
+        self.assertEquals(replay, [envelopes[0]._replace(spool_id=1), envelopes[1]._replace(spool_id=2)])
+
+    #
+    # Lock
+    #
+
+    def test_spool_not_used_by_second_process(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+        spooled = spool.put_many(self.make_envelopes(2))
+
+        # Run code to be tested:
+        # (flock locks are per open file, so this behaves like another process)
+        spool2, replay2 = self.make_spool()
+        not_spooled = spool2.put_many(self.make_envelopes(1))
+        spool2.confirm_many(spooled)
+        spool2.close()
+
+        # Check result:
+        self.assertEquals(replay2, [])
+        self.assertIsNone(not_spooled[0].spool_id)
+        self.assertEquals(spool.get_num_unconfirmed(), 2)
+        self.assertEquals(len(self.list_segments()), 1)
+        spool.close()
+        spool3, replay3 = self.make_spool()
+        self.assertEquals(replay3, spooled)
+
+    #
+    # Segments
+    #
+
+    @mock.patch('esgfpid.defaults.RABBIT_SPOOL_SEGMENT_MAX_BYTES', 20) # one message per segment
+    def test_segments_compacted_once_confirmed(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+
+        # Run code to be tested:
+        spooled = [spool.put(env) for env in self.make_envelopes(4)]
+        num_segments_before = spool.get_num_segments()
+        spool.confirm_many(spooled[:2])
+
+        # Check result:
+        self.assertEquals(num_segments_before, 5) # 4 full ones, 1 empty
+        self.assertEquals(spool.get_num_segments(), 3)
+        spool.close()
+        spool2, replay = self.make_spool()
+        self.assertEquals(replay, spooled[2:])
+
+    @mock.patch('esgfpid.defaults.RABBIT_SPOOL_SEGMENT_MAX_BYTES', 20) # one message per segment
+    def test_segments_not_compacted_out_of_order(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+        spooled = [spool.put(env) for env in self.make_envelopes(3)]
+
+        # Run code to be tested:
+        spool.confirm_many([spooled[1], spooled[2]])
+
+        # Check result (the oldest segment is still needed):
+        self.assertEquals(spool.get_num_segments(), 4)
+        spool.close()
+        spool2, replay = self.make_spool()
+        self.assertEquals(replay, [spooled[0]])
+
+    def test_incomplete_record_ignored(self):
+
+        # Preparation:
+        spool, replay = self.make_spool()
+        spooled = spool.put_many(self.make_envelopes(2))
+        spool.close()
+        segment = os.path.join(self.directory, self.list_segments()[-1])
+        with open(segment, 'ab') as f:
+            f.write('P 3 100 rk.3\n{"foo": "ba') # process died while writing
+
+        # Run code to be tested:
+        spool2, replay = self.make_spool()
+
+        # Check result:
+        self.assertEquals(replay, spooled)
+
+    #
+    # Fsync
+    #
+
+    @mock.patch('os.fsync')
+    def test_fsync_always(self, fsyncpatch):
+
+        # Preparation:
+        spool, replay = self.make_spool(fsync='always')
+
+        # Run code to be tested:
+        spool.put_many(self.make_envelopes(3))
+        spool.put_many(self.make_envelopes(3))
+
+        # Check result (once per call):
+        self.assertEquals(fsyncpatch.call_count, 2)
+
+    @mock.patch('os.fsync')
+    def test_fsync_never(self, fsyncpatch):
+
+        # Preparation:
+        spool, replay = self.make_spool(fsync='never')
+
+        # Run code to be tested:
+        spool.put_many(self.make_envelopes(3))
+        spool.close()
+
+        # Check result:
+        fsyncpatch.assert_not_called()
+
+    def test_fsync_unknown_error(self):
+
+        # Run code to be tested:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            MessageSpool(self.directory, 'sometimes')
+
+    #
+    # Usage by confirmer and rabbit module
+    #
+
+    def test_confirmer_confirms_acked_in_spool(self):
+
+        # Preparation:
+        spool = mock.MagicMock()
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(spool)
+        for tag in [1,2,3]:
+            confirmer.put_to_unconfirmed_messages(tag, 'foo%i' % tag)
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = 2
+        method_frame.method.multiple = True
+
+        # Run code to be tested:
+        method_frame.method.NAME = 'foo.nack'
+        confirmer.on_delivery_confirmation(method_frame)
+        method_frame.method.NAME = 'foo.ack'
+        method_frame.method.delivery_tag = 3
+        confirmer.on_delivery_confirmation(method_frame)
+
+        # Check result (nacked ones are left in the spool):
+        spool.confirm_many.assert_called_once_with(['foo3'])
+
+    @mock.patch('esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_rabbit_module_replays_and_spools(self, createpatch):
+
+        # Preparation:
+        createpatch.return_value = TESTHELPERS.get_thread_mock()
+        spool, replay = self.make_spool()
+        leftovers = spool.put_many(self.make_envelopes(2))
+        spool.close()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(
+            TESTHELPERS.get_nodemanager(),
+            MessageSpool(self.directory, 'never'))
+
+        # Run code to be tested:
+        testrabbit.start_rabbit_thread()
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
+        testrabbit.send_message_to_queue(MessageEnvelope('rk', 'new'))
+
+        # Check result:
+        queue = testrabbit._AsynchronousRabbitConnector__unpublished_messages_queue
+        queue_content = []
+        while not queue.empty():
+            queue_content.append(queue.get())
+        self.assertEquals(queue_content, leftovers+[MessageEnvelope('rk', 'new', 3)])
+
+    @mock.patch('esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_rabbit_module_withdraws_rejected_from_spool(self, createpatch):
+
+        # Preparation: Queue that raises when full.
+        createpatch.return_value = TESTHELPERS.get_thread_mock()
+        testrabbit = esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector(
+            TESTHELPERS.get_nodemanager(),
+            MessageSpool(self.directory, 'never'),
+            queue=BoundedMessageQueue(max_messages=2, full_policy='raise'))
+        testrabbit.start_rabbit_thread()
+        testrabbit._AsynchronousRabbitConnector__statemachine.set_to_available()
+
+        # Run code to be tested:
+        envelopes = self.make_envelopes(4)
+        with self.assertRaises(MessageQueueFull) as raised1:
+            testrabbit.send_many_messages_to_queue(envelopes[:3])
+        with self.assertRaises(MessageQueueFull) as raised2:
+            testrabbit.send_message_to_queue(envelopes[3])
+        testrabbit._AsynchronousRabbitConnector__spool.close()
+
+        # Check result: Only the accepted messages are replayed.
+        spool, replay = self.make_spool()
+        self.assertEquals([envelope.body for envelope in replay], [envelopes[0].body, envelopes[1].body])
+        # The rejected ones are passed to the caller, without spool id:
+        self.assertEquals(raised1.exception.rejected_messages, [envelopes[2]])
+        self.assertEquals(raised2.exception.rejected_messages, [envelopes[3]])
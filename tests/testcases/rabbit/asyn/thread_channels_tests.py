@@ -0,0 +1,214 @@
+import unittest
+import mock
+import logging
+import datetime
+import esgfpid.rabbit.nodemanager
+import esgfpid.rabbit.asynchronous.thread_builder
+from esgfpid.rabbit.asynchronous.thread_channels import ChannelPool
+from esgfpid.rabbit.asynchronous.thread_statemachine import StateMachine
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+import resources.TESTVALUES as TESTHELPERS
+
+class ThreadChannelsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_pool(self, num, num_open=None):
+        pool = ChannelPool(num)
+        if num_open is None:
+            num_open = num
+        for pubchannel in pool.get_all()[:num_open]:
+            pubchannel.channel = mock.MagicMock()
+            pubchannel.channel.is_open = True
+        return pool
+
+    def make_builder(self, pool):
+        self.thread = mock.MagicMock()
+        self.thread.get_num_unpublished.return_value = 0
+        self.thread.get_publishing_channels.side_effect = pool.get_all
+        self.on_channel_open = []
+        def channel(on_open_callback):
+            self.on_channel_open.append(on_open_callback)
+        self.thread._connection.channel.side_effect = channel
+        self.statemachine = StateMachine()
+        self.statemachine.set_to_waiting_to_be_available()
+        nodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        nodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager())
+        nodemanager.set_next_host()
+        builder = esgfpid.rabbit.asynchronous.thread_builder.ConnectionBuilder(
+            self.thread,
+            self.statemachine,
+            mock.MagicMock(), # returnhandler
+            mock.MagicMock(), # shutter
+            nodemanager)
+        builder._ConnectionBuilder__start_connect_time = datetime.datetime.now()
+        return builder
+
+    def open_channels(self, builder):
+        builder._ConnectionBuilder__please_open_rabbit_channels()
+        channels = []
+        for callback in self.on_channel_open:
+            channel = mock.MagicMock()
+            channel.is_open = True
+            callback(channel)
+            channels.append(channel)
+        self.on_channel_open = []
+        return channels
+
+    def open_channels_from_callbacks(self):
+        for callback in self.on_channel_open:
+            callback(mock.MagicMock())
+        self.on_channel_open = []
+
+    #
+    # Choosing the channel
+    #
+
+    def test_no_ordering_key_spread_in_turn(self):
+
+        # Preparation:
+        pool = self.make_pool(3)
+
+        # Run code to be tested:
+        numbers = [pool.get_channel_for(None).number for i in xrange(6)]
+
+        # Check result:
+        self.assertEquals(numbers, [0,1,2,0,1,2])
+
+    def test_same_ordering_key_same_channel(self):
+
+        # Preparation:
+        pool = self.make_pool(4)
+
+        # Run code to be tested:
+        chosen = [pool.get_channel_for('hdl:foo/dataset%i' % (i%3)) for i in xrange(30)]
+
+        # Check result:
+        for i in xrange(3, 30):
+            self.assertIs(chosen[i], chosen[i-3])
+
+    def test_ordering_key_channel_closed_uses_other(self):
+
+        # Preparation:
+        pool = self.make_pool(2)
+        key = 'hdl:foo/dataset'
+        usual = pool.get_channel_for(key)
+        usual.channel = None
+
+        # Run code to be tested:
+        chosen = pool.get_channel_for(key)
+
+        # Check result:
+        self.assertIsNot(chosen, usual)
+        self.assertTrue(chosen.is_open())
+
+    def test_no_channel_open_returns_first(self):
+
+        # Preparation:
+        pool = self.make_pool(3, num_open=0)
+
+        # Run code to be tested:
+        chosen = pool.get_channel_for('foo')
+
+        # Check result:
+        self.assertIs(chosen, pool.get_all()[0])
+
+    #
+    # Delivery tags
+    #
+
+    def test_delivery_tags_per_channel(self):
+
+        # Preparation:
+        pool = self.make_pool(2)
+        first, second = pool.get_all()
+
+        # Run code to be tested:
+        tags = [first.put_to_unconfirmed_messages('a'),
+                second.put_to_unconfirmed_messages('b'),
+                first.put_to_unconfirmed_messages('c')]
+
+        # Check result:
+        self.assertEquals(tags, [1,1,2])
+        self.assertEquals(pool.get_num_unconfirmed(), 3)
+        self.assertEquals(sorted(pool.get_unconfirmed_messages_as_list_copy()), ['a','b','c'])
+
+    #
+    # Opening and closing the channels
+    #
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_NUM_CHANNELS', 3)
+    def test_open_all_channels(self):
+
+        # Preparation:
+        pool = self.make_pool(3, num_open=0)
+        builder = self.make_builder(pool)
+
+        # Run code to be tested:
+        channels = self.open_channels(builder)
+
+        # Check result:
+        self.assertEquals([pubchannel.channel for pubchannel in pool.get_all()], channels)
+        for pubchannel in pool.get_all():
+            pubchannel.channel.confirm_delivery.assert_called_with(callback=pubchannel.confirmer.on_delivery_confirmation)
+        self.assertTrue(self.statemachine.is_AVAILABLE())
+
+    def test_missing_exchange_reopens_only_that_channel(self):
+
+        # Preparation:
+        pool = self.make_pool(2, num_open=0)
+        builder = self.make_builder(pool)
+        first, second = self.open_channels(builder)
+        pool.get_all()[0].put_to_unconfirmed_messages('a')
+        pool.get_all()[1].put_to_unconfirmed_messages('b')
+
+        # Run code to be tested:
+        builder.on_channel_closed(second, 404, "NOT_FOUND - no exchange 'foo'")
+
+        # Check result:
+        self.thread.set_exchange_name.assert_called_with('FALLBACK')
+        self.thread.send_many_messages.assert_called_once_with(['b'])
+        self.assertIs(pool.get_all()[0].channel, first)
+        self.assertIsNone(pool.get_all()[1].channel)
+        self.assertEquals(pool.get_all()[0].get_delivery_number(), 2)
+        self.assertEquals(pool.get_all()[1].get_delivery_number(), 1)
+        self.assertEquals(len(self.on_channel_open), 1)
+        self.assertTrue(self.statemachine.is_AVAILABLE())
+        self.thread._connection.close.assert_not_called()
+
+    def test_missing_exchange_last_channel_waits(self):
+
+        # Preparation:
+        pool = self.make_pool(1, num_open=0)
+        builder = self.make_builder(pool)
+        channel, = self.open_channels(builder)
+
+        # Run code to be tested:
+        builder.on_channel_closed(channel, 404, "NOT_FOUND - no exchange 'foo'")
+        waiting = self.statemachine.is_WAITING_TO_BE_AVAILABLE()
+        self.open_channels_from_callbacks()
+
+        # Check result:
+        self.assertTrue(waiting)
+        self.assertTrue(self.statemachine.is_AVAILABLE())
+
+    def test_unexpected_channel_close_closes_connection(self):
+
+        # Preparation:
+        pool = self.make_pool(2, num_open=0)
+        builder = self.make_builder(pool)
+        first, second = self.open_channels(builder)
+
+        # Run code to be tested:
+        builder.on_channel_closed(first, 500, 'foo')
+
+        # Check result:
+        self.thread._connection.close.assert_called_with()
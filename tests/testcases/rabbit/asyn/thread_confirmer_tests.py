@@ -1,7 +1,6 @@
 import unittest
 import mock
 import logging
-import copy
 import os
 import esgfpid.rabbit.asynchronous.thread_confirmer
 
@@ -9,7 +8,7 @@ LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
 UNCONFIRMED_TAGS = [1,2,3,4]
-UNCONFIRMED_MESSAGES = {'1':'foo1', '2':'foo2', '3':'foo3', '4':'foo4'}
+UNCONFIRMED_MESSAGES = {1:'foo1', 2:'foo2', 3:'foo3', 4:'foo4'}
 
 class ThreadConfirmerTestCase(unittest.TestCase):
 
@@ -21,10 +20,17 @@ class ThreadConfirmerTestCase(unittest.TestCase):
 
     def make_confirmer(self):
         confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer()
-        confirmer._Confirmer__unconfirmed_delivery_tags = copy.copy(UNCONFIRMED_TAGS)
-        confirmer._Confirmer__unconfirmed_messages_dict = copy.copy(UNCONFIRMED_MESSAGES)
+        for tag in UNCONFIRMED_TAGS:
+            confirmer.put_to_unconfirmed_messages(tag, UNCONFIRMED_MESSAGES[tag])
         return confirmer
 
+    def make_method_frame(self, tag, multiple, name='foo.ack'):
+        method_frame = mock.MagicMock()
+        method_frame.method.delivery_tag = tag
+        method_frame.method.multiple = multiple
+        method_frame.method.NAME = name
+        return method_frame
+
     # Tests
 
     #
@@ -46,13 +52,13 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer.on_delivery_confirmation(method_frame)
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [1,3,4]
         self.assertEquals(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'1':'foo1', '3':'foo3', '4':'foo4'}
+        unconf_dict = confirmer._Confirmer__unconfirmed_messages
+        expected_unconf_dict = {1:'foo1', 3:'foo3', 4:'foo4'}
         self.assertEquals(unconf_dict, expected_unconf_dict,
             'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
 
@@ -72,16 +78,96 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer.on_delivery_confirmation(method_frame)
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [3,4]
         self.assertEquals(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'3':'foo3', '4':'foo4'}
+        unconf_dict = confirmer._Confirmer__unconfirmed_messages
+        expected_unconf_dict = {3:'foo3', 4:'foo4'}
         self.assertEquals(unconf_dict, expected_unconf_dict,
             'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
 
+    def test_single_acks_out_of_order_ok(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer()
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_method_frame(3, False))
+        confirmer.on_delivery_confirmation(self.make_method_frame(1, False))
+
+        # Check result:
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
+        self.assertEquals(unconf, [2,4])
+        self.assertEquals(confirmer.get_num_unconfirmed(), 2)
+        self.assertEquals(confirmer.get_unconfirmed_messages_as_list_copy(), ['foo2', 'foo4'])
+        self.assertEquals(confirmer._Confirmer__low_water_mark, 2)
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_method_frame(2, False))
+
+        # Check result (low water mark skips the already confirmed 3):
+        self.assertEquals(confirmer.get_copy_of_unconfirmed_tags(), [4])
+        self.assertEquals(confirmer._Confirmer__low_water_mark, 4)
+
+    def test_multiple_ack_after_single_acks_ok(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer()
+        confirmer.on_delivery_confirmation(self.make_method_frame(2, False))
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_method_frame(3, True))
+
+        # Check result:
+        self.assertEquals(confirmer.get_copy_of_unconfirmed_tags(), [4])
+        self.assertEquals(confirmer.get_num_unconfirmed(), 1)
+
+    def test_ack_unknown_tag_ok(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer()
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_method_frame(17, False))
+        confirmer.on_delivery_confirmation(self.make_method_frame(1, False))
+        confirmer.on_delivery_confirmation(self.make_method_frame(1, False))
+
+        # Check result:
+        self.assertEquals(confirmer.get_copy_of_unconfirmed_tags(), [2,3,4])
+
+    def test_multiple_ack_all_ok(self):
+
+        # Preparation:
+        confirmer = self.make_confirmer()
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_method_frame(4, True))
+        confirmer.put_to_unconfirmed_messages(5, 'foo5')
+
+        # Check result:
+        self.assertEquals(confirmer.get_copy_of_unconfirmed_tags(), [5])
+        self.assertEquals(confirmer.get_unconfirmed_messages_as_list_copy(), ['foo5'])
+
+    def test_many_messages_ok(self):
+
+        # Preparation:
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer()
+        for tag in xrange(1, 10001):
+            confirmer.put_to_unconfirmed_messages(tag, 'foo%i' % tag)
+
+        # Run code to be tested:
+        for tag in xrange(2, 5001, 2):
+            confirmer.on_delivery_confirmation(self.make_method_frame(tag, False))
+        confirmer.on_delivery_confirmation(self.make_method_frame(4000, True, 'foo.nack'))
+        confirmer.on_delivery_confirmation(self.make_method_frame(10000, True))
+
+        # Check result:
+        self.assertEquals(confirmer.get_num_unconfirmed(), 0)
+        self.assertEquals(len(confirmer.get_copy_of_nacked()), 2000)
+        self.assertEquals(confirmer.get_copy_of_nacked()[:2], ['foo1', 'foo3'])
+
     #
     # Nacks
     #
@@ -101,13 +187,13 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer.on_delivery_confirmation(method_frame)
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [1,3,4]
         self.assertEquals(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'1':'foo1', '3':'foo3', '4':'foo4'}
+        unconf_dict = confirmer._Confirmer__unconfirmed_messages
+        expected_unconf_dict = {1:'foo1', 3:'foo3', 4:'foo4'}
         self.assertEquals(unconf_dict, expected_unconf_dict,
             'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
         # Check result (nacked)
@@ -132,13 +218,13 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         nacked_copy = confirmer.get_copy_of_nacked()
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [3,4]
         self.assertEquals(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'3':'foo3', '4':'foo4'}
+        unconf_dict = confirmer._Confirmer__unconfirmed_messages
+        expected_unconf_dict = {3:'foo3', 4:'foo4'}
         self.assertEquals(unconf_dict, expected_unconf_dict,
             'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
         # Check result (nacked)
@@ -161,17 +247,16 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         confirmer = self.make_confirmer()
 
         # Run code to be tested:
-        confirmer.put_to_unconfirmed_delivery_tags(100)
-        confirmer.put_to_unconfirmed_messages_dict(100, 'foo100')
+        confirmer.put_to_unconfirmed_messages(100, 'foo100')
 
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         expected_unconf = [1,2,3,4,100]
         self.assertEquals(unconf, expected_unconf,
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, expected_unconf))
         # Check result (messages)
-        unconf_dict = confirmer._Confirmer__unconfirmed_messages_dict
-        expected_unconf_dict = {'1':'foo1', '2':'foo2', '3':'foo3', '4':'foo4', '100':'foo100'}
+        unconf_dict = confirmer._Confirmer__unconfirmed_messages
+        expected_unconf_dict = {1:'foo1', 2:'foo2', 3:'foo3', 4:'foo4', 100:'foo100'}
         self.assertEquals(unconf_dict, expected_unconf_dict,
             'Unconfirmed messages: %s, expected %s' % (unconf_dict, expected_unconf_dict))
 
@@ -190,7 +275,7 @@ class ThreadConfirmerTestCase(unittest.TestCase):
 
         # Check result (delivery tags)
         expected_messages = ['foo1', 'foo2', 'foo3', 'foo4']
-        self.assertEquals(set(mylist), set(expected_messages),
+        self.assertEquals(mylist, expected_messages,
             'Leftover messages: %s, expected %s' % (mylist, expected_messages))
         self.assertEquals(len(mylist), 4)
         self.assertEquals(num, 4)
@@ -209,7 +294,7 @@ class ThreadConfirmerTestCase(unittest.TestCase):
         unconf_retrieved = confirmer.get_copy_of_unconfirmed_tags()
     
         # Check result (delivery tags)
-        unconf = confirmer._Confirmer__unconfirmed_delivery_tags
+        unconf = confirmer.get_copy_of_unconfirmed_tags()
         self.assertEquals(unconf, [],
             'Unconfirmed delivery tags: %s, expected %s' % (unconf, []))
         self.assertEquals(unconf_retrieved, [],
@@ -219,6 +304,43 @@ class ThreadConfirmerTestCase(unittest.TestCase):
     # Error
     #
 
+    def test_thread_told_when_all_confirmed(self):
+
+        # Preparation:
+        thread = mock.MagicMock()
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(None, thread)
+        for tag in UNCONFIRMED_TAGS:
+            confirmer.put_to_unconfirmed_messages(tag, UNCONFIRMED_MESSAGES[tag])
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_method_frame(3, True))
+        num_calls_before = thread.finish_gently_if_nothing_pending.call_count
+        confirmer.on_delivery_confirmation(self.make_method_frame(4, False, 'foo.nack'))
+
+        # Check result (nacked messages are not pending anymore):
+        self.assertEquals(num_calls_before, 0)
+        thread.finish_gently_if_nothing_pending.assert_called_once_with()
+
+    def test_thread_told_which_confirmed(self):
+
+        # Preparation:
+        thread = mock.MagicMock()
+        confirmer = esgfpid.rabbit.asynchronous.thread_confirmer.Confirmer(None, thread)
+        for tag in UNCONFIRMED_TAGS:
+            confirmer.put_to_unconfirmed_messages(tag, UNCONFIRMED_MESSAGES[tag])
+
+        # Run code to be tested:
+        confirmer.on_delivery_confirmation(self.make_method_frame(2, True))
+        confirmer.on_delivery_confirmation(self.make_method_frame(3, False, 'foo.nack'))
+        confirmer.on_delivery_confirmation(self.make_method_frame(4, False))
+
+        # Check result:
+        self.assertEquals(thread.report_confirms.call_args_list, [
+            mock.call(['foo1','foo2'], []),
+            mock.call([], ['foo3']),
+            mock.call(['foo4'], [])
+        ])
+
     def test_neither_ack_nor_nack_error(self):
 
         # Preparation:
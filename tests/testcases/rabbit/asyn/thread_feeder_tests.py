@@ -1,4 +1,5 @@
 import unittest
+import mock
 import logging
 import Queue
 import pika
@@ -88,6 +89,89 @@ class ThreadFeederTestCase(unittest.TestCase):
         self.assertIn(msg, thread.messages)
         self.assertIn(msg, thread.put_back)
 
+    def test_send_many_messages_in_one_batch(self):
+
+        # Preparation:
+        msgs = ["{'foo':'bar%i'}" % i for i in xrange(5)]
+        feeder, thread = self.make_feeder()
+        thread.messages.extend(msgs)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # All were published in one go, no other batch needed:
+        self.assertEquals(thread._channel.basic_publish.call_count, 5)
+        self.assertEquals(len(thread.messages), 0)
+        self.assertEquals(len(thread.unconfirmed_tags), 5)
+        self.assertEquals(thread.num_next_batch_events, 0)
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES', 2)
+    def test_send_many_messages_batch_limit_messages(self):
+
+        # Preparation:
+        msgs = ["{'foo':'bar%i'}" % i for i in xrange(5)]
+        feeder, thread = self.make_feeder()
+        thread.messages.extend(msgs)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # Only two were published, next batch was scheduled:
+        self.assertEquals(thread._channel.basic_publish.call_count, 2)
+        self.assertEquals(len(thread.messages), 3)
+        self.assertEquals(thread.num_next_batch_events, 1)
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_BYTES', 1)
+    def test_send_many_messages_batch_limit_bytes(self):
+
+        # Preparation:
+        msgs = ["{'foo':'bar%i'}" % i for i in xrange(3)]
+        feeder, thread = self.make_feeder()
+        thread.messages.extend(msgs)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # Only one fits into the byte budget, next batch was scheduled:
+        self.assertEquals(thread._channel.basic_publish.call_count, 1)
+        self.assertEquals(len(thread.messages), 2)
+        self.assertEquals(thread.num_next_batch_events, 1)
+
+    @mock.patch('esgfpid.defaults.RABBIT_ASYN_FEEDER_BATCH_MAX_MESSAGES', 2)
+    def test_send_many_messages_batch_limit_nothing_left(self):
+
+        # Preparation:
+        msgs = ["{'foo':'bar%i'}" % i for i in xrange(2)]
+        feeder, thread = self.make_feeder()
+        thread.messages.extend(msgs)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # Budget used up, but nothing left, so no next batch:
+        self.assertEquals(thread._channel.basic_publish.call_count, 2)
+        self.assertEquals(thread.num_next_batch_events, 0)
+
+    def test_send_many_messages_error_stops_batch(self):
+
+        # Preparation:
+        msgs = ["{'foo':'bar%i'}" % i for i in xrange(3)]
+        feeder, thread = self.make_feeder(error=pika.exceptions.ChannelClosed)
+        thread.messages.extend(msgs)
+
+        # Run code to be tested:
+        feeder.publish_message()
+
+        # Check result:
+        # Publish was tried once, message was put back, no retry in same batch:
+        thread._channel.basic_publish.assert_called_once()
+        self.assertEquals(len(thread.messages), 3)
+        self.assertEquals(len(thread.put_back), 1)
+
     def test_send_message_NOT_STARTED_YET(self):
 
         # Preparation:
@@ -4,6 +4,7 @@ import Queue
 import pika
 import mock
 import esgfpid.rabbit.asynchronous.thread_returnhandler
+from esgfpid.rabbit.rabbitutils import MessageEnvelope
 from esgfpid.rabbit.asynchronous.exceptions import OperationNotAllowed
 
 LOGGER = logging.getLogger(__name__)
@@ -55,7 +56,7 @@ class ThreadReturnerTestCase(unittest.TestCase):
         # Check result:
         thread.send_a_message.assert_called_once()
         expected = '{"original_routing_key": "%s", "foo": "bar", "ROUTING_KEY": "%s"}' % (routing_key, emergency_routing_key)
-        thread.send_a_message.assert_called_with(expected)
+        thread.send_a_message.assert_called_with(MessageEnvelope(emergency_routing_key, expected))
 
     def test_send_message_second_time(self):
 
@@ -95,7 +96,7 @@ class ThreadReturnerTestCase(unittest.TestCase):
         # Check result:
         thread.send_a_message.assert_called_once()
         expected = '{"original_routing_key": "%s", "foo": "bar", "ROUTING_KEY": "%s"}' % (routing_key, emergency_routing_key)
-        thread.send_a_message.assert_called_with(expected)
+        thread.send_a_message.assert_called_with(MessageEnvelope(emergency_routing_key, expected))
 
 
     def test_send_message_no_key(self):
@@ -116,7 +117,7 @@ class ThreadReturnerTestCase(unittest.TestCase):
         # Check result:
         thread.send_a_message.assert_called_once()
         expected = '{"original_routing_key": "None", "foo": "bar", "ROUTING_KEY": "%s"}' % (emergency_routing_key)
-        thread.send_a_message.assert_called_with(expected)
+        thread.send_a_message.assert_called_with(MessageEnvelope(emergency_routing_key, expected))
 
 
     def test_send_message_error(self):
@@ -138,4 +139,4 @@ class ThreadReturnerTestCase(unittest.TestCase):
         # Can not check if error was raised...
         thread.send_a_message.assert_called_once()
         expected = '{"original_routing_key": "None", "foo": "bar", "ROUTING_KEY": "%s"}' % (emergency_routing_key)
-        thread.send_a_message.assert_called_with(expected)
\ No newline at end of file
+        thread.send_a_message.assert_called_with(MessageEnvelope(emergency_routing_key, expected))
\ No newline at end of file
@@ -0,0 +1,150 @@
+import unittest
+import mock
+import logging
+import esgfpid.defaults
+import esgfpid.rabbit.asynchronous.thread_shutter
+from esgfpid.rabbit.asynchronous.thread_statemachine import StateMachine
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+class MockThread(object):
+    '''Provides the parts of the RabbitThread API that the shutter uses.'''
+
+    def __init__(self, num_unpublished=0, num_unconfirmed=0):
+        self._connection = mock.MagicMock()
+        self._connection.is_closed = False
+        self._connection.is_closing = False
+        self._connection.is_open = True
+        self.num_unpublished = num_unpublished
+        self.num_unconfirmed = num_unconfirmed
+        self.num_publish_events = 0
+        self.publisher_was_told = False
+        self.ERROR_CODE_CONNECTION_CLOSED_BY_USER = 999
+        self.ERROR_TEXT_CONNECTION_FORCE_CLOSED = '(forced finish)'
+        self.ERROR_TEXT_CONNECTION_NORMAL_SHUTDOWN = '(not reopen)'
+
+    def get_num_unpublished(self):
+        return self.num_unpublished
+
+    def get_num_unconfirmed(self):
+        return self.num_unconfirmed
+
+    def add_event_publish_message(self):
+        self.num_publish_events += 1
+
+    def tell_publisher_to_stop_waiting_for_gentle_finish(self):
+        self.publisher_was_told = True
+
+    def make_permanently_closed_by_user(self):
+        pass
+
+class ThreadShutterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_shutter(self, thread):
+        statemachine = StateMachine()
+        statemachine.set_to_available()
+        shutter = esgfpid.rabbit.asynchronous.thread_shutter.ShutDowner(thread, statemachine)
+        return shutter, statemachine
+
+    def get_close_text(self, thread):
+        return thread._connection.close.call_args[1]['reply_text']
+
+    #
+    # Gentle finish
+    #
+
+    def test_gently_finish_nothing_pending_closes_at_once(self):
+
+        # Preparation:
+        thread = MockThread()
+        shutter, statemachine = self.make_shutter(thread)
+
+        # Run code to be tested:
+        shutter.finish_gently()
+
+        # Check result:
+        self.assertTrue(thread.publisher_was_told)
+        self.assertIn('(not reopen)', self.get_close_text(thread))
+        thread._connection.add_timeout.assert_not_called()
+
+    def test_gently_finish_pending_closes_on_last_confirm(self):
+
+        # Preparation:
+        thread = MockThread(num_unconfirmed=3)
+        shutter, statemachine = self.make_shutter(thread)
+
+        # Run code to be tested:
+        shutter.finish_gently()
+        closed_before = thread._connection.close.called
+        thread.num_unconfirmed = 0
+        shutter.finish_gently_if_nothing_pending()
+
+        # Check result:
+        self.assertFalse(closed_before)
+        self.assertTrue(thread.publisher_was_told)
+        self.assertIn('(not reopen)', self.get_close_text(thread))
+
+    def test_gently_finish_pending_safety_check_scheduled(self):
+
+        # Preparation:
+        thread = MockThread(num_unpublished=5)
+        shutter, statemachine = self.make_shutter(thread)
+
+        # Run code to be tested:
+        shutter.finish_gently()
+
+        # Check result:
+        self.assertFalse(thread.publisher_was_told)
+        self.assertTrue(thread.num_publish_events > 0)
+        seconds, callback = thread._connection.add_timeout.call_args[0]
+        self.assertEquals(seconds, esgfpid.defaults.RABBIT_ASYN_FINISH_SAFETY_CHECK_SECONDS)
+        self.assertEquals(callback, shutter.recursive_decision_about_closing)
+
+    def test_gently_finish_deadline_passed(self):
+
+        # Preparation:
+        thread = MockThread(num_unconfirmed=3)
+        shutter, statemachine = self.make_shutter(thread)
+
+        # Run code to be tested:
+        shutter.finish_gently(timeout=0)
+
+        # Check result:
+        self.assertTrue(thread.publisher_was_told)
+        self.assertTrue(statemachine.is_PERMANENTLY_UNAVAILABLE())
+        self.assertIn('(forced finish)', self.get_close_text(thread))
+
+    def test_safety_check_after_close_does_nothing(self):
+
+        # Preparation:
+        thread = MockThread(num_unconfirmed=3)
+        shutter, statemachine = self.make_shutter(thread)
+        shutter.finish_gently()
+        thread.num_unconfirmed = 0
+        shutter.finish_gently_if_nothing_pending()
+
+        # Run code to be tested:
+        shutter.recursive_decision_about_closing()
+
+        # Check result:
+        self.assertEquals(thread._connection.close.call_count, 1)
+
+    def test_last_confirm_without_finish_does_nothing(self):
+
+        # Preparation:
+        thread = MockThread()
+        shutter, statemachine = self.make_shutter(thread)
+
+        # Run code to be tested:
+        shutter.finish_gently_if_nothing_pending()
+
+        # Check result:
+        self.assertFalse(thread.publisher_was_told)
+        thread._connection.close.assert_not_called()
@@ -1,7 +1,14 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
 import unittest
+import mock
 import logging
 import pika
 import esgfpid.rabbit
+import esgfpid.defaults
 import tests.globalvar
 
 LOGGER = logging.getLogger(__name__)
@@ -593,3 +600,282 @@ class NodemanagerTestCase(unittest.TestCase):
         # Check result
         self.assertIsInstance(props, pika.BasicProperties)
 
+    #
+    # Latency-aware selection among nodes of the same priority
+    #
+
+    def make_nodemanager_same_prio(self, state_file=None):
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager(state_file)
+        for host in ['foo1', 'foo2', 'foo3']:
+            mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host=host, priority=1))
+        return mynodemanager
+
+    def get_order_of_hosts(self, mynodemanager):
+        hosts = []
+        mynodemanager.set_next_host()
+        hosts.append(mynodemanager.get_connection_parameters().host)
+        while mynodemanager.has_more_urls():
+            mynodemanager.set_next_host()
+            hosts.append(mynodemanager.get_connection_parameters().host)
+        return hosts
+
+    def test_select_fastest_healthy_node(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+        mynodemanager.report_connection_success('foo1', 0.5)
+        mynodemanager.report_connection_success('foo2', 0.5)
+        mynodemanager.report_connection_failure('foo2')
+        mynodemanager.report_connection_success('foo3', 0.1)
+
+        # Run code to be tested:
+        hosts = self.get_order_of_hosts(mynodemanager)
+
+        # Check result:
+        self.assertEquals(hosts, ['foo3', 'foo1', 'foo2'])
+
+    def test_unknown_nodes_after_healthy_nodes(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+        mynodemanager.report_connection_success('foo2', 1.0)
+
+        # Run code to be tested:
+        hosts = self.get_order_of_hosts(mynodemanager)
+
+        # Check result:
+        self.assertEquals(hosts[0], 'foo2')
+
+    def test_latency_ewma(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+
+        # Run code to be tested:
+        mynodemanager.report_connection_success('foo1', 1.0)
+        mynodemanager.report_connection_success('foo1', 2.0)
+        mynodemanager.report_connection_failure('foo1')
+
+        # Check result:
+        alpha = esgfpid.defaults.RABBIT_NODE_LATENCY_EWMA_ALPHA
+        stats = mynodemanager.get_node_stats()['foo1']
+        self.assertAlmostEqual(stats['latency'], alpha*2.0 + (1-alpha)*1.0)
+        self.assertEquals(stats['failures'], 1)
+
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_SOCKET_TIMEOUT_FACTOR', 4)
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_SOCKET_TIMEOUT_MIN', 0.1)
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_SOCKET_TIMEOUT_MAX', 5)
+    def test_socket_timeout_adapts(self):
+
+        # Preparation:
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='foo'))
+
+        # Run code to be tested and check result:
+        # Unknown node: default
+        params = mynodemanager.get_connection_parameters()
+        self.assertEquals(params.socket_timeout, esgfpid.defaults.RABBIT_PIKA_SOCKET_TIMEOUT)
+        # Known node: multiple of its latency
+        mynodemanager.report_connection_success('foo', 0.2)
+        params = mynodemanager.get_connection_parameters()
+        self.assertAlmostEqual(params.socket_timeout, 0.8)
+        # After a failure: doubled
+        mynodemanager.report_connection_failure('foo')
+        params = mynodemanager.get_connection_parameters()
+        self.assertAlmostEqual(params.socket_timeout, 1.6)
+        # Very slow node: maximum
+        for i in xrange(5):
+            mynodemanager.report_connection_failure('foo')
+        params = mynodemanager.get_connection_parameters()
+        self.assertAlmostEqual(params.socket_timeout, 5)
+        # Very fast node: minimum
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='foo'))
+        mynodemanager.report_connection_success('foo', 0.001)
+        params = mynodemanager.get_connection_parameters()
+        self.assertAlmostEqual(params.socket_timeout, 0.1)
+
+    def test_state_file_kept_across_instances(self):
+
+        # Preparation:
+        tempdir = tempfile.mkdtemp()
+        state_file = os.path.join(tempdir, 'nodes.json')
+        try:
+            first = self.make_nodemanager_same_prio(state_file)
+            first.report_connection_success('foo1', 0.9)
+            first.report_connection_success('foo3', 0.05)
+
+            # Run code to be tested:
+            second = self.make_nodemanager_same_prio(state_file)
+            hosts = self.get_order_of_hosts(second)
+
+            # Check result:
+            self.assertEquals(hosts[:2], ['foo3', 'foo1'])
+            with open(state_file) as statefile:
+                self.assertEquals(sorted(json.load(statefile).keys()), ['foo1', 'foo3'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_broken_state_file_ignored(self):
+
+        # Preparation:
+        tempdir = tempfile.mkdtemp()
+        state_file = os.path.join(tempdir, 'nodes.json')
+        with open(state_file, 'w') as statefile:
+            statefile.write('{not json')
+        try:
+
+            # Run code to be tested:
+            mynodemanager = self.make_nodemanager_same_prio(state_file)
+
+            # Check result:
+            self.assertEquals(mynodemanager.get_node_stats(), {})
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_state_file_written_by_several_threads(self):
+
+        # Preparation:
+        tempdir = tempfile.mkdtemp()
+        state_file = os.path.join(tempdir, 'nodes.json')
+        try:
+            shards = [self.make_nodemanager_same_prio(state_file) for i in xrange(4)]
+            def report(mynodemanager):
+                for i in xrange(50):
+                    mynodemanager.report_connection_success('foo1', 0.1)
+
+            # Run code to be tested:
+            threads = [threading.Thread(target=report, args=(shard,)) for shard in shards]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Check result:
+            with open(state_file) as statefile:
+                self.assertEquals(json.load(statefile).keys(), ['foo1'])
+            self.assertEquals(os.listdir(tempdir), ['nodes.json'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    #
+    # Circuit breaker
+    #
+
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_BREAKER_FAILURE_THRESHOLD', 2)
+    def test_circuit_opens_after_failures(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+
+        # Run code to be tested:
+        mynodemanager.report_connection_failure('foo1')
+        state_after_one = mynodemanager.get_circuit_state('foo1')
+        mynodemanager.report_connection_failure('foo1')
+
+        # Check result:
+        self.assertEquals(state_after_one, 'closed')
+        self.assertEquals(mynodemanager.get_circuit_state('foo1'), 'open')
+
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_BREAKER_FAILURE_THRESHOLD', 1)
+    def test_open_node_skipped(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+        mynodemanager.report_connection_failure('foo1')
+        mynodemanager.report_connection_failure('foo3')
+
+        # Run code to be tested:
+        hosts = self.get_order_of_hosts(mynodemanager)
+
+        # Check result:
+        self.assertEquals(hosts, ['foo2'])
+
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_BREAKER_FAILURE_THRESHOLD', 1)
+    def test_all_open_tries_oldest(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+        with mock.patch('time.time', return_value=1000):
+            mynodemanager.report_connection_failure('foo2')
+        for host in ['foo1', 'foo3']:
+            mynodemanager.report_connection_failure(host)
+
+        # Run code to be tested:
+        mynodemanager.set_next_host()
+
+        # Check result:
+        self.assertEquals(mynodemanager.get_connection_parameters().host, 'foo2')
+
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_BREAKER_FAILURE_THRESHOLD', 1)
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_BREAKER_COOLDOWN_SECONDS', 30)
+    def test_half_open_probe(self):
+
+        # Preparation:
+        mynodemanager = esgfpid.rabbit.nodemanager.NodeManager()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='foo1', priority=1))
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='foo2', priority=2))
+        with mock.patch('time.time', return_value=1000):
+            mynodemanager.report_connection_failure('foo1')
+
+        # Run code to be tested:
+        state_before = mynodemanager.get_circuit_state('foo1')
+        mynodemanager.set_next_host()
+        state_during_probe = mynodemanager.get_circuit_state('foo1')
+        mynodemanager.report_connection_success('foo1', 0.1)
+
+        # Check result:
+        self.assertEquals(state_before, 'half-open')
+        self.assertEquals(state_during_probe, 'open')
+        self.assertEquals(mynodemanager.get_circuit_state('foo1'), 'closed')
+
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_BREAKER_FAILURE_THRESHOLD', 1)
+    def test_circuit_shared_through_state_file(self):
+
+        # Preparation:
+        tempdir = tempfile.mkdtemp()
+        state_file = os.path.join(tempdir, 'nodes.json')
+        try:
+            first = self.make_nodemanager_same_prio(state_file)
+            second = self.make_nodemanager_same_prio(state_file)
+
+            # Run code to be tested:
+            first.report_connection_failure('foo1')
+            first.report_connection_failure('foo2')
+            hosts = self.get_order_of_hosts(second)
+
+            # Check result:
+            self.assertEquals(hosts, ['foo3'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    #
+    # Active-active
+    #
+
+    def test_node_managers_for_active_nodes(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+        mynodemanager.add_trusted_node(**TESTHELPERS.get_args_for_nodemanager(host='bar', priority=2))
+
+        # Run code to be tested:
+        node_managers = mynodemanager.get_node_managers_for_active_nodes()
+
+        # Check result:
+        hosts = [self.get_order_of_hosts(nm) for nm in node_managers]
+        self.assertEquals(sorted(hosts), [['foo1'], ['foo2'], ['foo3']])
+
+    @mock.patch('esgfpid.defaults.RABBIT_NODE_BREAKER_FAILURE_THRESHOLD', 1)
+    def test_node_managers_for_active_nodes_skip_open_circuit(self):
+
+        # Preparation:
+        mynodemanager = self.make_nodemanager_same_prio()
+        mynodemanager.report_connection_failure('foo2')
+
+        # Run code to be tested:
+        node_managers = mynodemanager.get_node_managers_for_active_nodes()
+
+        # Check result:
+        hosts = [self.get_order_of_hosts(nm) for nm in node_managers]
+        self.assertEquals(sorted(hosts), [['foo1'], ['foo3']])
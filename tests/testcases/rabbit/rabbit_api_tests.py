@@ -3,6 +3,8 @@ import mock
 import logging
 import json
 import sys
+import esgfpid.defaults
+from esgfpid.rabbit.rabbitutils import MessageEnvelope, make_message_envelope
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
@@ -108,10 +110,68 @@ class RabbitTestCase(unittest.TestCase):
         rabbit_asyn.send_message_to_queue(msg)
 
         # Check result
+        expected = MessageEnvelope(esgfpid.defaults.RABBIT_DEFAULT_ROUTING_KEY, msg)
         mock_connector = rabbit_syn._RabbitMessageSender__server_connector
-        mock_connector.send_message_to_queue.assert_called_with(msg)
+        mock_connector.send_message_to_queue.assert_called_with(expected)
         mock_connector = rabbit_asyn._RabbitMessageSender__server_connector
-        mock_connector.send_message_to_queue.assert_called_with(msg)
+        mock_connector.send_message_to_queue.assert_called_with(expected)
+
+    def test_send_many_messages_to_queue(self):
+
+        # Test variables
+        msgs = ['FOO', 'BAR']
+
+        # Make test rabbit and replace the connector with a mock:
+        rabbit_syn  = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=True)
+        rabbit_asyn = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=False)
+        TESTHELPERS.patch_rabbit_with_magic_mock(rabbit_syn)
+        TESTHELPERS.patch_rabbit_with_magic_mock(rabbit_asyn)
+
+        # Run code to be tested
+        rabbit_syn.send_many_messages_to_queue(msgs)
+        rabbit_asyn.send_many_messages_to_queue(msgs)
+
+        # Check result
+        expected = [MessageEnvelope(esgfpid.defaults.RABBIT_DEFAULT_ROUTING_KEY, msg) for msg in msgs]
+        mock_connector = rabbit_syn._RabbitMessageSender__server_connector
+        mock_connector.send_many_messages.assert_called_with(expected)
+        mock_connector = rabbit_asyn._RabbitMessageSender__server_connector
+        mock_connector.send_many_messages_to_queue.assert_called_with(expected)
+
+    def test_send_message_to_queue_serialized_once(self):
+
+        # Test variables
+        msg = {'foo':'bar', 'ROUTING_KEY':'my.key'}
+
+        # Make test rabbit and replace the connector with a mock:
+        rabbit_asyn = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=False)
+        TESTHELPERS.patch_rabbit_with_magic_mock(rabbit_asyn)
+
+        # Run code to be tested
+        rabbit_asyn.send_message_to_queue(msg)
+
+        # Check result
+        mock_connector = rabbit_asyn._RabbitMessageSender__server_connector
+        envelope = mock_connector.send_message_to_queue.call_args[0][0]
+        self.assertIsInstance(envelope, MessageEnvelope)
+        self.assertEquals(envelope.routing_key, 'my.key')
+        self.assertEquals(json.loads(envelope.body), msg)
+
+    def test_send_envelope_to_queue(self):
+
+        # Test variables
+        envelope = MessageEnvelope('my.key', '{"foo": "bar"}')
+
+        # Make test rabbit and replace the connector with a mock:
+        rabbit_asyn = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=False)
+        TESTHELPERS.patch_rabbit_with_magic_mock(rabbit_asyn)
+
+        # Run code to be tested
+        rabbit_asyn.send_message_to_queue(envelope)
+
+        # Check result
+        mock_connector = rabbit_asyn._RabbitMessageSender__server_connector
+        mock_connector.send_message_to_queue.assert_called_with(envelope)
 
 
     def test_is_finished(self):
@@ -148,8 +208,9 @@ class RabbitTestCase(unittest.TestCase):
         # Check result
         mock_connector = rabbit_syn._RabbitMessageSender__server_connector
         mock_connector.finish_rabbit_thread.assert_not_called()
+        mock_connector.close_session.assert_called_with()
         mock_connector = rabbit_asyn._RabbitMessageSender__server_connector
-        mock_connector.finish_rabbit_thread.assert_called_with()
+        mock_connector.finish_rabbit_thread.assert_called_with(None)
 
 
     def test_force_finish_ok(self):
@@ -211,4 +272,28 @@ class RabbitTestCase(unittest.TestCase):
         self.assertEquals(result_list, ['a', 'b', 'c'],
             'We asked the mock to return a list, not %s.' % result_list)
         mock_connector.any_leftovers.assert_called_with()
-        mock_connector.get_leftovers.assert_called_with()
\ No newline at end of file
+        mock_connector.get_leftovers.assert_called_with()
+
+    @mock.patch('esgfpid.rabbit.asynchronous.AsynchronousRabbitConnector._AsynchronousRabbitConnector__create_thread')
+    def test_leftovers_of_real_connector_are_opened(self, createpatch):
+
+        # Make test rabbit with a real connector, whose thread
+        # leaves some unconfirmed messages (envelopes):
+        msg = {'ROUTING_KEY':'foo', 'bar':'baz'}
+        threadmock = TESTHELPERS.get_thread_mock()
+        threadmock.unconfirmed = [make_message_envelope(msg), MessageEnvelope('foo', 'not json', None, None)]
+        createpatch.return_value = threadmock
+        rabbit_asyn = TESTHELPERS.get_rabbit_message_sender(is_synchronous_mode=False)
+        rabbit_asyn.start()
+
+        # Run code to be tested
+        result_before = rabbit_asyn.any_leftovers()
+        rabbit_asyn.force_finish()
+        result_bool = rabbit_asyn.any_leftovers()
+        result_list = rabbit_asyn.get_leftovers()
+
+        # Check result:
+        self.assertFalse(result_before)
+        self.assertTrue(result_bool)
+        self.assertEquals(result_list, [msg, 'not json'],
+            'Leftovers should be the messages, not %s.' % result_list)
\ No newline at end of file
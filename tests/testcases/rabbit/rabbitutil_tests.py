@@ -1,5 +1,6 @@
 import unittest
 import logging
+import json
 
 import esgfpid.defaults
 import esgfpid.rabbit.rabbitutils as rutils
@@ -163,3 +164,74 @@ class RabbitUtilsTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             received_key, received_message = rutils.get_routing_key_and_string_message_from_message_if_possible(passed_message)
 
+
+
+    #
+    # Test envelopes and JSON encoders
+    #
+
+    def reset_json_encoder(self):
+        rutils.set_json_encoder(esgfpid.defaults.RABBIT_JSON_ENCODER)
+
+    def test_make_message_envelope_ok(self):
+
+        # Test variables:
+        passed_message = {"bla":"foo", "ROUTING_KEY":"roukey"}
+
+        # Run code to be checked:
+        envelope = rutils.make_message_envelope(passed_message)
+
+        # Check result:
+        self.assertEquals(envelope.routing_key, 'roukey')
+        self.assertEquals(json.loads(envelope.body), passed_message)
+        self.assertIs(rutils.make_message_envelope(envelope), envelope)
+        with self.assertRaises(AttributeError):
+            envelope.body = 'something else'
+
+    def test_make_message_envelope_ordering_key(self):
+
+        # Preparation:
+        file_message = {"ROUTING_KEY":"roukey", "handle":"hdl:foo/file", "parent_dataset":"hdl:foo/ds"}
+        ds_message = {"ROUTING_KEY":"roukey", "handle":"hdl:foo/ds", "drs_id":"foo.bar"}
+        unpubli_message = {"ROUTING_KEY":"roukey", "drs_id":"foo.bar"}
+
+        # Run code to be checked:
+        envelopes = [rutils.make_message_envelope(msg) for msg in [file_message, ds_message, unpubli_message, '{"foo":"bar"}']]
+
+        # Check result:
+        self.assertEquals([env.ordering_key for env in envelopes], ['hdl:foo/ds', 'hdl:foo/ds', 'foo.bar', None])
+
+    def test_set_json_encoder_callable(self):
+
+        # Run code to be checked:
+        self.addCleanup(self.reset_json_encoder)
+        rutils.set_json_encoder(lambda obj: 'encoded')
+        envelope = rutils.make_message_envelope({"bla":"foo"})
+
+        # Check result:
+        self.assertEquals(envelope.body, 'encoded')
+
+    def test_set_json_encoder_stdlib(self):
+
+        # Run code to be checked:
+        self.addCleanup(self.reset_json_encoder)
+        rutils.set_json_encoder('json')
+
+        # Check result:
+        self.assertEquals(rutils.encode_json({"bla":"foo"}), '{"bla": "foo"}')
+
+    def test_set_json_encoder_unknown(self):
+
+        # Run code to be checked:
+        self.addCleanup(self.reset_json_encoder)
+        with self.assertRaises(ValueError):
+            rutils.set_json_encoder('foojson')
+
+    def test_set_json_encoder_auto(self):
+
+        # Run code to be checked:
+        self.addCleanup(self.reset_json_encoder)
+        rutils.set_json_encoder('auto')
+
+        # Check result (whichever encoder was found, it is valid json):
+        self.assertEquals(json.loads(rutils.encode_json({"bla":"foo"})), {"bla":"foo"})
@@ -2,6 +2,8 @@ import unittest
 import mock
 import logging
 import json
+import time
+import threading
 import tests.resources.pikamock
 import tests.main_test_script
 import pika.exceptions
@@ -456,4 +458,289 @@ class RabbitConnectorTestCase(unittest.TestCase):
         self.assertIn(json.dumps(msg), channel.messages,
             'Message %s not found in channel\'s list: %s' % (msg, channel.messages))
         self.assertIn(key, channel.routing_keys,
-            'Routing key %s not found in channel\'s list: %s' % (key, channel.routing_keys))
\ No newline at end of file
+            'Routing key %s not found in channel\'s list: %s' % (key, channel.routing_keys))
+    #
+    # Send many messages
+    #
+
+    def make_rabbit_with_pipelining_channel(self, connectionmock, pipelinemock, **kwargs):
+        connectionmock.side_effect = tests.resources.pikamock.MockPikaBlockingConnection
+        testrabbit = TESTHELPERS.get_synchronous_rabbit()
+        testrabbit.open_rabbit_connection()
+        connection = testrabbit._SynchronousRabbitConnector__connection
+        channels = []
+        def make_mocked_pipelining_channel(window):
+            channel = tests.resources.pikamock.MockPipeliningChannel(window, **kwargs)
+            connection.process_data_events = channel.process_data_events
+            channels.append(channel)
+            return channel
+        pipelinemock.side_effect = make_mocked_pipelining_channel
+        return testrabbit, channels
+
+    def make_messages(self, num):
+        return [{"foo":"bar%i" % i, "ROUTING_KEY":"mykey"} for i in xrange(num)]
+
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_CONFIRM_WINDOW', 100)
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_pipelining_channel')
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_ok(self, connectionmock, pipelinemock):
+
+        # Preparation:
+        testrabbit, channels = self.make_rabbit_with_pipelining_channel(connectionmock, pipelinemock)
+        messages = self.make_messages(250)
+
+        # Run code to be tested:
+        testrabbit.send_many_messages(messages)
+
+        # Check result:
+        # All messages were pipelined, none sent one by one:
+        self.assertEquals(channels[0].messages, [json.dumps(msg) for msg in messages])
+        self.assertEquals(channels[0].max_in_flight, 100)
+        self.assertFalse(channels[0].is_open)
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEquals(channel.publish_counter, 0)
+
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_pipelining_channel')
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_nacked_and_returned_resent(self, connectionmock, pipelinemock):
+
+        # Preparation:
+        testrabbit, channels = self.make_rabbit_with_pipelining_channel(connectionmock, pipelinemock,
+            nack_tags=[2], return_tags=[4])
+        messages = self.make_messages(5)
+
+        # Run code to be tested:
+        testrabbit.send_many_messages(messages)
+
+        # Check result:
+        # The nacked and the returned message were sent again, one by one:
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEquals(channel.messages, [json.dumps(messages[1]), json.dumps(messages[3])])
+        self.assertEquals(channel.success_counter, 2)
+
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_pipelining_channel')
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_fail(self, connectionmock, pipelinemock):
+
+        # Preparation:
+        testrabbit, channels = self.make_rabbit_with_pipelining_channel(connectionmock, pipelinemock,
+            nack_tags=[2,3])
+        messages = self.make_messages(5)
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        channel.num_failures = float('inf') # always failure!
+
+        # Run code to be tested:
+        with self.assertRaises(esgfpid.exceptions.MessageNotDeliveredException) as e:
+            testrabbit.send_many_messages(messages)
+
+        # Check result:
+        # Exactly the nacked messages are reported:
+        self.assertEquals(e.exception.rabbit_msg, [json.dumps(messages[1]), json.dumps(messages[2])])
+
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_CONFIRM_TIMEOUT_SECONDS', 0)
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_CONFIRM_WINDOW', 2)
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_pipelining_channel')
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_no_confirms(self, connectionmock, pipelinemock):
+
+        # Preparation:
+        testrabbit, channels = self.make_rabbit_with_pipelining_channel(connectionmock, pipelinemock,
+            confirm=False)
+        messages = self.make_messages(5)
+
+        # Run code to be tested:
+        testrabbit.send_many_messages(messages)
+
+        # Check result:
+        # The window was filled, then all messages were sent one by one:
+        self.assertEquals(len(channels[0].messages), 2)
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEquals(channel.messages, [json.dumps(msg) for msg in messages])
+
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_CONFIRM_TIMEOUT_SECONDS', 0)
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_CONFIRM_WINDOW', 2)
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_pipelining_channel')
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_no_confirms_waits_once(self, connectionmock, pipelinemock):
+
+        # Preparation:
+        testrabbit, channels = self.make_rabbit_with_pipelining_channel(connectionmock, pipelinemock,
+            confirm=False)
+        connector_class = esgfpid.rabbit.synchronous.SynchronousRabbitConnector
+        wait = connector_class._SynchronousRabbitConnector__wait_for_confirms
+        waitmock = mock.MagicMock(side_effect=lambda *args: wait(testrabbit, *args))
+        messages = self.make_messages(5)
+
+        # Run code to be tested:
+        with mock.patch.object(connector_class, '_SynchronousRabbitConnector__wait_for_confirms',
+                               lambda self, *args: waitmock(*args)):
+            testrabbit.send_many_messages(messages)
+
+        # Check result:
+        # Two messages published, the third wait timed out, no wait after that:
+        self.assertEquals(waitmock.call_count, 3)
+
+    @mock.patch('esgfpid.rabbit.synchronous.pipeliningchannel.is_supported')
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_send_many_messages_pipelining_not_supported(self, connectionmock, supportedmock):
+
+        # Preparation:
+        connectionmock.side_effect = tests.resources.pikamock.MockPikaBlockingConnection
+        supportedmock.return_value = False
+        testrabbit = TESTHELPERS.get_synchronous_rabbit()
+        messages = self.make_messages(3)
+
+        # Run code to be tested:
+        testrabbit.send_many_messages(messages)
+
+        # Check result:
+        # All messages were sent one by one:
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEquals(channel.messages, [json.dumps(msg) for msg in messages])
+
+    def test_pipelining_channel_supported(self):
+
+        # Preparation:
+        blocking_channel = mock.MagicMock()
+        window = mock.MagicMock()
+        pipeliningchannel = esgfpid.rabbit.synchronous.pipeliningchannel
+
+        # Run code to be tested:
+        supported = pipeliningchannel.is_supported(blocking_channel)
+        channel = pipeliningchannel.PipeliningChannel(blocking_channel, window)
+        channel.basic_publish(exchange='exch', routing_key='rk', body='foo', mandatory=True, properties=None)
+
+        # Check result:
+        self.assertTrue(supported)
+        blocking_channel._impl.confirm_delivery.assert_called_once_with(window.on_delivery_confirmation)
+        blocking_channel._impl.add_on_return_callback.assert_called_once_with(window.on_return)
+        blocking_channel._impl.basic_publish.assert_called_once_with(
+            exchange='exch', routing_key='rk', body='foo', mandatory=True, properties=None)
+
+    def test_pipelining_channel_not_supported(self):
+
+        # Preparation:
+        pipeliningchannel = esgfpid.rabbit.synchronous.pipeliningchannel
+
+        # Run code to be tested and check result:
+        self.assertFalse(pipeliningchannel.is_supported(object()))
+        with mock.patch('pika.__version__', '99.0.0'):
+            self.assertFalse(pipeliningchannel.is_supported(mock.MagicMock()))
+
+    #
+    # Persistent session
+    #
+
+    def make_persistent_rabbit(self, connectionmock):
+        connections = []
+        def make_mocked_connection(params):
+            conn = tests.resources.pikamock.MockPikaBlockingConnection(params)
+            conn.process_data_events = mock.MagicMock()
+            connections.append(conn)
+            return conn
+        connectionmock.side_effect = make_mocked_connection
+        testrabbit = esgfpid.rabbit.synchronous.SynchronousRabbitConnector(
+            TESTHELPERS.get_nodemanager(), persistent_session=True)
+        return testrabbit, connections
+
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_HEARTBEAT_KEEPER_SECONDS', 60)
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_persistent_session_reuses_connection(self, connectionmock):
+
+        # Preparation:
+        testrabbit, connections = self.make_persistent_rabbit(connectionmock)
+        msg = {"foo":"bar", "ROUTING_KEY":"mykey"}
+
+        # Run code to be tested (two datasets):
+        for i in xrange(2):
+            testrabbit.open_rabbit_connection()
+            testrabbit.send_message_to_queue(msg)
+            testrabbit.close_rabbit_connection()
+
+        # Check result:
+        # Only one connection, still open:
+        self.assertEquals(len(connections), 1)
+        self.assertTrue(connections[0].is_open)
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEquals(channel.success_counter, 2)
+
+        # Run code to be tested: End of session
+        keeper = testrabbit._SynchronousRabbitConnector__heartbeat_keeper
+        testrabbit.close_session()
+
+        # Check result:
+        self.assertFalse(connections[0].is_open)
+        self.assertTrue(keeper.is_stopped())
+
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_HEARTBEAT_KEEPER_SECONDS', 60)
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_persistent_session_reconnects_lost_connection(self, connectionmock):
+
+        # Preparation:
+        testrabbit, connections = self.make_persistent_rabbit(connectionmock)
+        msg = {"foo":"bar", "ROUTING_KEY":"mykey"}
+        testrabbit.open_rabbit_connection()
+        connections[0].is_open = False # lost while idle
+
+        # Run code to be tested:
+        testrabbit.send_message_to_queue(msg)
+
+        # Check result:
+        self.assertEquals(len(connections), 2)
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEquals(channel.success_counter, 1)
+        testrabbit.close_session()
+
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_HEARTBEAT_KEEPER_SECONDS', 60)
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_persistent_session_reconnects_during_publish(self, connectionmock):
+
+        # Preparation:
+        testrabbit, connections = self.make_persistent_rabbit(connectionmock)
+        msg = {"foo":"bar", "ROUTING_KEY":"mykey"}
+        testrabbit.open_rabbit_connection()
+        channel = testrabbit._SynchronousRabbitConnector__channel
+        channel.basic_publish = mock.MagicMock(side_effect=pika.exceptions.ConnectionClosed())
+
+        # Run code to be tested:
+        testrabbit.send_message_to_queue(msg)
+
+        # Check result:
+        # Sent once more on the new connection:
+        self.assertEquals(len(connections), 2)
+        new_channel = testrabbit._SynchronousRabbitConnector__channel
+        self.assertEquals(new_channel.success_counter, 1)
+        testrabbit.close_session()
+
+    @mock.patch('esgfpid.defaults.RABBIT_SYN_HEARTBEAT_KEEPER_SECONDS', 0.01)
+    @mock.patch('esgfpid.rabbit.synchronous.SynchronousRabbitConnector._SynchronousRabbitConnector__make_connection')
+    def test_persistent_session_heartbeats_serviced(self, connectionmock):
+
+        # Preparation:
+        testrabbit, connections = self.make_persistent_rabbit(connectionmock)
+        called = threading.Event()
+        testrabbit.open_rabbit_connection()
+        connections[0].process_data_events.side_effect = lambda *args, **kwargs: called.set()
+
+        # Run code to be tested:
+        serviced = called.wait(5)
+        testrabbit.close_session()
+
+        # Check result:
+        self.assertTrue(serviced)
+
+    def test_heartbeat_keeper_stops(self):
+
+        # Preparation:
+        calls = []
+        keeper = esgfpid.rabbit.synchronous.heartbeatkeeper.HeartbeatKeeper(lambda: calls.append(1), 0.01)
+
+        # Run code to be tested:
+        keeper.start()
+        time.sleep(0.1)
+        keeper.stop()
+        keeper.join(5)
+
+        # Check result:
+        self.assertTrue(len(calls) > 0)
+        self.assertFalse(keeper.is_alive())
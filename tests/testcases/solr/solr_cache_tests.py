@@ -0,0 +1,174 @@
+import unittest
+import mock
+import logging
+import threading
+import esgfpid.exceptions
+from esgfpid.solr.cache import SolrCache
+
+# Logging:
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+def is_empty(result):
+    return len(result) == 0
+
+class SolrCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def make_cache(self, **args):
+        cache = SolrCache(**args)
+        self.now = 1000
+        patcher = mock.patch.object(SolrCache, '_SolrCache__get_time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return cache
+
+    def test_second_lookup_cached(self):
+
+        # Preparation:
+        cache = self.make_cache(max_entries=10, ttl_seconds=60)
+        fetch = mock.MagicMock(return_value=['a','b'])
+
+        # Run code to be tested:
+        first = cache.get_or_fetch(('abc', 'task'), fetch, is_empty)
+        first.append('changed by caller')
+        second = cache.get_or_fetch(('abc', 'task'), fetch, is_empty)
+
+        # Check result:
+        self.assertEquals(fetch.call_count, 1)
+        self.assertEquals(second, ['a','b'])
+        self.assertEquals(cache.get_status()['num_hits'], 1)
+
+    def test_expired(self):
+
+        # Preparation:
+        cache = self.make_cache(max_entries=10, ttl_seconds=60, negative_ttl_seconds=5)
+        fetch = mock.MagicMock(return_value=['a'])
+        fetch_empty = mock.MagicMock(return_value=[])
+        cache.get_or_fetch(('abc', 'task'), fetch, is_empty)
+        cache.get_or_fetch(('def', 'task'), fetch_empty, is_empty)
+
+        # Run code to be tested:
+        self.now += 10
+        cache.get_or_fetch(('abc', 'task'), fetch, is_empty)
+        cache.get_or_fetch(('def', 'task'), fetch_empty, is_empty)
+        self.now += 60
+        cache.get_or_fetch(('abc', 'task'), fetch, is_empty)
+
+        # Check result:
+        self.assertEquals(fetch_empty.call_count, 2) # empty results expire sooner
+        self.assertEquals(fetch.call_count, 2)
+
+    def test_least_recently_used_dropped(self):
+
+        # Preparation:
+        cache = self.make_cache(max_entries=2)
+        fetch = mock.MagicMock(return_value=['a'])
+        cache.get_or_fetch(('a',), fetch, is_empty)
+        cache.get_or_fetch(('b',), fetch, is_empty)
+        cache.get_or_fetch(('a',), fetch, is_empty)
+
+        # Run code to be tested:
+        cache.get_or_fetch(('c',), fetch, is_empty)
+        cache.get_or_fetch(('a',), fetch, is_empty)
+        cache.get_or_fetch(('b',), fetch, is_empty)
+
+        # Check result:
+        self.assertEquals(fetch.call_count, 4) # a, b, c, b
+
+    def test_errors_not_cached(self):
+
+        # Preparation:
+        cache = self.make_cache()
+        fetch = mock.MagicMock(side_effect=[esgfpid.exceptions.SolrError('bla'), ['a']])
+
+        # Run code to be tested:
+        with self.assertRaises(esgfpid.exceptions.SolrError):
+            cache.get_or_fetch(('abc',), fetch, is_empty)
+        result = cache.get_or_fetch(('abc',), fetch, is_empty)
+
+        # Check result:
+        self.assertEquals(result, ['a'])
+
+    def test_invalidate(self):
+
+        # Preparation:
+        cache = self.make_cache()
+        fetch = mock.MagicMock(return_value=['a'])
+        cache.get_or_fetch(('abc', 'files', '2016'), fetch, is_empty)
+        cache.get_or_fetch(('abc', 'versions'), fetch, is_empty)
+        cache.get_or_fetch(('def', 'versions'), fetch, is_empty)
+
+        # Run code to be tested:
+        cache.invalidate('abc')
+
+        # Check result:
+        self.assertEquals(cache.get_status()['num_entries'], 1)
+
+    def test_switched_off(self):
+
+        # Preparation:
+        cache = self.make_cache(max_entries=0)
+        fetch = mock.MagicMock(return_value=['a'])
+
+        # Run code to be tested:
+        cache.get_or_fetch(('abc',), fetch, is_empty)
+        cache.get_or_fetch(('abc',), fetch, is_empty)
+
+        # Check result:
+        self.assertEquals(fetch.call_count, 2)
+
+    def test_concurrent_lookups_coalesced(self):
+
+        # Preparation:
+        cache = self.make_cache()
+        may_return = threading.Event()
+        def fetch():
+            may_return.wait(5)
+            return ['a']
+        fetch_mock = mock.MagicMock(side_effect=fetch)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch(('abc',), fetch_mock, is_empty))) for i in xrange(3)]
+
+        # Run code to be tested:
+        for thread in threads:
+            thread.start()
+        while cache.get_status()['num_misses'] == 0:
+            pass
+        may_return.set()
+        for thread in threads:
+            thread.join(5)
+
+        # Check result:
+        self.assertEquals(fetch_mock.call_count, 1)
+        self.assertEquals(results, [['a'], ['a'], ['a']])
+
+    def test_get_or_wait_joins_running_lookup(self):
+
+        # Preparation:
+        cache = self.make_cache()
+        may_return = threading.Event()
+        def fetch():
+            may_return.wait(5)
+            return ['a']
+        thread = threading.Thread(target=lambda: cache.get_or_fetch(('abc',), fetch, is_empty))
+        thread.start()
+        while cache.get_status()['num_misses'] == 0:
+            pass
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(cache.get_or_wait(('abc',))))
+
+        # Run code to be tested:
+        waiter.start()
+        may_return.set()
+        waiter.join(5)
+        thread.join(5)
+
+        # Check result:
+        self.assertEquals(results, [['a']])
+        self.assertIsNone(cache.get_or_wait(('def',)))
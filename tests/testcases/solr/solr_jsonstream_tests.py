@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import unittest
+import logging
+import json
+import esgfpid.exceptions
+from esgfpid.solr.tasks.jsonstream import iterate_array_items
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+PATH = ['facet_counts', 'facet_fields', 'tracking_id']
+
+def make_chunks(text, size):
+    return [text[i:i+size] for i in xrange(0, len(text), size)]
+
+class SolrJsonStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def test_items_in_any_chunk_size(self):
+
+        # Test variables:
+        response_json = {
+            "responseHeader": {"params": {"facets": "tracking_id", "x": [1, {"tracking_id": ["not this one"]}]}},
+            "facet_counts": {"facet_queries": {}, "facet_fields": {"tracking_id": [
+                "abc", 1, "with \"quotes\", and comma", 2, u"é", 3, -3.5e2, True, None, [1], {"a": 1}, "def"]}}
+        }
+        text = json.dumps(response_json, ensure_ascii=False).encode('utf-8')
+        expected = ["abc", 1, "with \"quotes\", and comma", 2, u"é", 3, -3.5e2, True, None, "def"]
+
+        for size in [1, 2, 3, 7, 64, len(text)]:
+
+            # Run code to be tested:
+            received = list(iterate_array_items(make_chunks(text, size), PATH))
+
+            # Check result:
+            self.assertEquals(received, expected, 'Chunk size %i: %s' % (size, received))
+
+    def test_no_such_field(self):
+
+        # Test variables:
+        text = json.dumps({"facet_counts": {"facet_fields": {"pid": ["abc", 1]}}})
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrResponseError):
+            list(iterate_array_items([text], PATH))
+
+    def test_cut_off(self):
+
+        # Test variables:
+        text = json.dumps({"facet_counts": {"facet_fields": {"tracking_id": ["abc", 1, "def", 2]}}})
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            list(iterate_array_items(make_chunks(text[:-10], 5), PATH))
+        self.assertIn('no valid JSON', raised.exception.message)
+
+    def test_invalid(self):
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            list(iterate_array_items(['NONE'], PATH))
+        self.assertIn('no valid JSON', raised.exception.message)
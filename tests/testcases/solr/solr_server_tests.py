@@ -26,7 +26,7 @@ no other modules need to be used or mocked.
 
 However, it talks to a solr server (via requests
 module), so we need to mock that one. We patch all
-calls to requests.get()
+calls to the get() of its pooled requests.Session
 '''
 class SolrServerConnectorTestCase(unittest.TestCase):
 
@@ -63,7 +63,7 @@ class SolrServerConnectorTestCase(unittest.TestCase):
         self.assertIsInstance(testsolr, esgfpid.solr.serverconnector.SolrServerConnector, 'Constructor fail.')
         self.assertTrue(testsolr._SolrServerConnector__https_verify, 'HTTPS verify not set to True.')
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_ok_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -81,7 +81,7 @@ class SolrServerConnectorTestCase(unittest.TestCase):
         self.assertTrue('responseHeader' in response, 'Solr response was not correct JSON: '+str(response))
         self.assertTrue(len(response['facet_counts']['facet_fields']['bla'])==4, 'JSON content was not transmitted correctly.')
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_200_empty_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -96,7 +96,7 @@ class SolrServerConnectorTestCase(unittest.TestCase):
             response = testsolr.send_query('blah')
         self.assertIn('empty response', raised.exception.message)
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_broken_json_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -112,7 +112,7 @@ class SolrServerConnectorTestCase(unittest.TestCase):
             response = testsolr.send_query('blah')
         self.assertIn('no valid JSON', raised.exception.message)
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_return_none_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -126,7 +126,7 @@ class SolrServerConnectorTestCase(unittest.TestCase):
             response = testsolr.send_query('blah')
         self.assertIn('no response', raised.exception.message)
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_http_404_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -141,7 +141,7 @@ class SolrServerConnectorTestCase(unittest.TestCase):
             response = testsolr.send_query('blah')
         self.assertIn('HTTP 404', raised.exception.message)
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_patched_connection_error(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -155,7 +155,7 @@ class SolrServerConnectorTestCase(unittest.TestCase):
             response = testsolr.send_query('blah')
         self.assertIn('ConnectionError', raised.exception.message)
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_patched_5000(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -169,3 +169,84 @@ class SolrServerConnectorTestCase(unittest.TestCase):
         with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
             response = testsolr.send_query('blah')
         self.assertIn('code 5000', raised.exception.message)
+
+    def test_session_pooled_and_reused(self):
+
+        # Preparation:
+        testsolr = esgfpid.solr.serverconnector.SolrServerConnector(
+            solr_url = 'https://foo.foo/solr',
+            https_verify = True,
+            disable_insecure_request_warning = False,
+            pool_maxsize = 7,
+            max_retries = 3
+        )
+
+        # Run code to be tested:
+        session = testsolr._SolrServerConnector__get_session()
+        again = testsolr._SolrServerConnector__get_session()
+
+        # Check result:
+        self.assertIs(session, again)
+        adapter = session.get_adapter('https://foo.foo/solr')
+        self.assertEquals(adapter._pool_maxsize, 7)
+        self.assertEquals(adapter.max_retries.total, 3)
+        self.assertEquals(session.headers['Accept-Encoding'], 'gzip')
+        self.assertEquals(session.headers['Connection'], 'keep-alive')
+
+    def test_session_without_keep_alive_and_gzip(self):
+
+        # Run code to be tested:
+        testsolr = esgfpid.solr.serverconnector.SolrServerConnector(
+            solr_url = 'https://foo.foo/solr',
+            https_verify = True,
+            disable_insecure_request_warning = False,
+            keep_alive = False,
+            gzip = False
+        )
+
+        # Check result:
+        session = testsolr._SolrServerConnector__get_session()
+        self.assertEquals(session.headers['Connection'], 'close')
+        self.assertEquals(session.headers['Accept-Encoding'], 'identity')
+
+    def test_new_session_after_fork(self):
+
+        # Preparation:
+        testsolr = TESTHELPERS.get_testsolr_connector()
+        session = testsolr._SolrServerConnector__get_session()
+
+        # Run code to be tested:
+        with mock.patch.object(esgfpid.solr.serverconnector.SolrServerConnector, '_SolrServerConnector__getpid', return_value=-1):
+            child_session = testsolr._SolrServerConnector__get_session()
+
+        # Check result:
+        self.assertIsNot(session, child_session)
+
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
+    def test_send_query_and_stream_ok_patched(self, getpatch):
+
+        # Define the replacement for the patched method:
+        mock_response = mock.MagicMock(status_code=200)
+        mock_response.iter_content.return_value = iter(['{"a":', ' 1}'])
+        getpatch.return_value = mock_response
+
+        # Run code to be tested:
+        chunks = list(TESTHELPERS.get_testsolr_connector().send_query_and_stream('blah'))
+
+        # Check result:
+        self.assertEquals(chunks, ['{"a":', ' 1}'])
+        self.assertTrue(getpatch.call_args[1]['stream'])
+        mock_response.close.assert_called_once_with()
+
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
+    def test_send_query_and_stream_broken_off_patched(self, getpatch):
+
+        # Define the replacement for the patched method:
+        mock_response = mock.MagicMock(status_code=200)
+        mock_response.iter_content.side_effect = requests.exceptions.ChunkedEncodingError()
+        getpatch.return_value = mock_response
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            list(TESTHELPERS.get_testsolr_connector().send_query_and_stream('blah'))
+        self.assertIn('broke off', raised.exception.message)
@@ -0,0 +1,135 @@
+import unittest
+import mock
+import logging
+import esgfpid.solr.solr
+import esgfpid.solr.tasks.filehandles_many_datasets as task
+import esgfpid.exceptions
+
+# Logging:
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Test resources:
+import resources.TESTVALUES as TESTHELPERS
+
+DATASETS = [('abc', 2016, 'foo.de'), ('def', 2017, 'foo.de'), ('ghi', 2018, 'foo.de')]
+
+class SolrTask1BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        LOGGER.info('######## Next test (%s) ##########', __name__)
+
+    def tearDown(self):
+        LOGGER.info('#############################')
+
+    def fake_solr_response(self, num_found, docs):
+        return {"response": {"numFound": num_found, "docs": docs}}
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_batches_and_pages(self, getpatch):
+
+        # Define the replacement for the patched method:
+        responses = [
+            self.fake_solr_response(3, [
+                {"dataset_id": "abc.v2016|foo.de", "tracking_id": ["123/a"]},
+                {"dataset_id": "abc.v2016|foo.de", "tracking_id": ["hdl:123/b"]}]),
+            self.fake_solr_response(3, [
+                {"dataset_id": "def.v2017|foo.de", "tracking_id": "c"}]),
+            self.fake_solr_response(0, [])
+        ]
+        getpatch.side_effect = responses
+
+        # Preparations
+        testtask = task.FindFilesOfManyDatasetVersions(TESTHELPERS.get_testsolr(), datasets_per_query=2, page_size=2)
+
+        # Run code to be tested:
+        result = testtask.retrieve_file_handles_of_many_datasets(DATASETS, '123')
+
+        # Check result:
+        self.assertEquals(getpatch.call_count, 3) # two pages for the first batch, one for the second
+        first_query = getpatch.call_args_list[0][0][0]
+        self.assertEquals(first_query['query'], 'dataset_id:("abc.v2016|foo.de" OR "def.v2017|foo.de")')
+        self.assertEquals(first_query['fields'], 'dataset_id,tracking_id')
+        self.assertEquals(getpatch.call_args_list[1][0][0]['offset'], 2)
+        self.assertEquals(sorted(result[DATASETS[0]]), ['hdl:123/a', 'hdl:123/b'])
+        self.assertEquals(result[DATASETS[1]], ['hdl:123/c'])
+        self.assertEquals(result[DATASETS[2]], [])
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_failed_batch(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = [
+            esgfpid.exceptions.SolrError('Whatever...'),
+            self.fake_solr_response(1, [{"dataset_id": "ghi.v2018|foo.de", "tracking_id": ["123/a"]}])
+        ]
+
+        # Preparations
+        testtask = task.FindFilesOfManyDatasetVersions(TESTHELPERS.get_testsolr(), datasets_per_query=2)
+
+        # Run code to be tested:
+        result = testtask.retrieve_file_handles_of_many_datasets(DATASETS, '123')
+
+        # Check result:
+        self.assertIsNone(result[DATASETS[0]])
+        self.assertIsNone(result[DATASETS[1]])
+        self.assertEquals(result[DATASETS[2]], ['hdl:123/a'])
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_prefetched_used_by_single_lookup(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.return_value = self.fake_solr_response(1, [{"dataset_id": "abc.v2016|foo.de", "tracking_id": ["a"]}])
+        testsolr = TESTHELPERS.get_testsolr()
+
+        # Run code to be tested:
+        testsolr.prefetch_file_handles_of_many_datasets(DATASETS[:1])
+        received_handles = testsolr.retrieve_file_handles_of_same_dataset(
+            drs_id='abc', version_number=2016, data_node='foo.de')
+
+        # Check result:
+        getpatch.assert_called_once()
+        self.assertEquals(received_handles, ['hdl:%s/a' % TESTHELPERS.PREFIX_NO_HDL])
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_prefetched_kept_beyond_cache_size_and_ttl(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.return_value = self.fake_solr_response(3, [
+            {"dataset_id": "abc.v2016|foo.de", "tracking_id": ["a"]},
+            {"dataset_id": "def.v2017|foo.de", "tracking_id": ["b"]},
+            {"dataset_id": "ghi.v2018|foo.de", "tracking_id": ["c"]}])
+        testsolr = TESTHELPERS.get_testsolr(cache_max_entries=1, cache_ttl_seconds=0)
+
+        # Run code to be tested:
+        testsolr.prefetch_file_handles_of_many_datasets(DATASETS)
+        status_before = testsolr.get_cache_status()
+        received_handles = [testsolr.retrieve_file_handles_of_same_dataset(
+            drs_id=drs_id, version_number=version_number, data_node=data_node)
+            for drs_id, version_number, data_node in DATASETS]
+
+        # Check result:
+        getpatch.assert_called_once()
+        self.assertEquals(received_handles, [['hdl:%s/%s' % (TESTHELPERS.PREFIX_NO_HDL, name)] for name in 'abc'])
+        self.assertEquals(status_before['num_prefetched'], 3)
+        self.assertEquals(testsolr.get_cache_status()['num_prefetched'], 0)
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_prefetched_dropped_on_invalidate(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.return_value = self.fake_solr_response(1, [{"dataset_id": "abc.v2016|foo.de", "tracking_id": ["a"]}])
+        testsolr = TESTHELPERS.get_testsolr()
+        testsolr.prefetch_file_handles_of_many_datasets(DATASETS[:1])
+
+        # Run code to be tested:
+        testsolr.invalidate_cache('abc')
+
+        # Check result:
+        self.assertEquals(testsolr.get_cache_status()['num_prefetched'], 0)
+
+    def test_prefetch_switched_off(self):
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrSwitchedOff):
+            TESTHELPERS.get_testsolr(switched_off=True).prefetch_file_handles_of_many_datasets(DATASETS)
@@ -2,6 +2,7 @@ import unittest
 import mock
 import logging
 import json
+import threading
 import esgfpid.solr.solr
 import esgfpid.solr.tasks.filehandles_same_dataset as task
 import tests.mocks.responsemock
@@ -20,8 +21,8 @@ import resources.TESTVALUES as TESTHELPERS
 PATH_RES = tests.utils.get_super_neighbour_directory(__file__, 'resources')
 SOLR_RESPONSE = json.load(open(PATH_RES+'/solr_response.json'))
 
-QUERY1 = {'format': 'application/solr+json', 'facets': 'tracking_id', 'limit': 0, 'distrib': False, 'dataset_id':'abc.v2016|foo.de', 'type': 'File'}
-QUERY2 = {'format': 'application/solr+json', 'facets': 'tracking_id', 'limit': 0, 'distrib': False, 'query': 'dataset_id:abc.v2016|*', 'type': 'File'}
+QUERY1 = {'format': 'application/solr+json', 'facets': 'tracking_id', 'limit': 0, 'distrib': False, 'dataset_id':'abc.v2016|foo.de', 'type': 'File', 'facet.limit': 10000, 'facet.offset': 0}
+QUERY2 = {'format': 'application/solr+json', 'facets': 'tracking_id', 'limit': 0, 'distrib': False, 'query': 'dataset_id:abc.v2016|*', 'type': 'File', 'facet.limit': 10000, 'facet.offset': 0}
 
 
 class SolrTask1TestCase(unittest.TestCase):
@@ -301,3 +302,240 @@ class SolrTask1TestCase(unittest.TestCase):
         self.assertIn('First query returned an empty list', raised.exception.message)
         self.assertIn('Whatever 2', raised.exception.message)
 
+
+    def test_unknown_mode(self):
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.ArgumentError):
+            task.FindFilesOfSameDatasetVersion(TESTHELPERS.get_testsolr(), mode='random')
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_concurrent_A_ok_B_not_waited_for(self, getpatch):
+
+        # Define the replacement for the patched method:
+        handles = ["123/456",1]
+        query2_may_return = threading.Event()
+        def different_mock_response_depending_on_query(query):
+            if query == QUERY1:
+                return self.fake_solr_response(handles)
+            else:
+                query2_may_return.wait(5)
+                return self.fake_solr_response(["123/999",1])
+        getpatch.side_effect = different_mock_response_depending_on_query
+
+        # Preparations
+        testtask = task.FindFilesOfSameDatasetVersion(TESTHELPERS.get_testsolr(), mode='concurrent')
+
+        # Run code to be tested:
+        received_handles = testtask.retrieve_file_handles_of_same_dataset(**self.get_args_dict())
+        query2_may_return.set()
+
+        # Check result:
+        self.assertEqual(received_handles, ['hdl:123/456'])
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_concurrent_A_nohandle_B_ok(self, getpatch):
+
+        # Define the replacement for the patched method:
+        def different_mock_response_depending_on_query(query):
+            if query == QUERY1:
+                return self.fake_solr_response([])
+            else:
+                return self.fake_solr_response(["123/456",1])
+        getpatch.side_effect = different_mock_response_depending_on_query
+
+        # Preparations
+        testtask = task.FindFilesOfSameDatasetVersion(TESTHELPERS.get_testsolr(), mode='concurrent')
+
+        # Run code to be tested:
+        received_handles = testtask.retrieve_file_handles_of_same_dataset(**self.get_args_dict())
+
+        # Check result:
+        self.assertEqual(received_handles, ['hdl:123/456'])
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_concurrent_both_error(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = esgfpid.exceptions.SolrError('Whatever...')
+
+        # Preparations
+        testtask = task.FindFilesOfSameDatasetVersion(TESTHELPERS.get_testsolr(), mode='concurrent')
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            testtask.retrieve_file_handles_of_same_dataset(**self.get_args_dict())
+        self.assertIn('Error during first query', raised.exception.message)
+        self.assertIn('Error during second query', raised.exception.message)
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_hedged_A_fast_B_not_sent(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.return_value = self.fake_solr_response(["123/456",1])
+
+        # Preparations
+        testtask = task.FindFilesOfSameDatasetVersion(TESTHELPERS.get_testsolr(), mode='hedged', hedge_delay_seconds=5)
+
+        # Run code to be tested:
+        received_handles = testtask.retrieve_file_handles_of_same_dataset(**self.get_args_dict())
+
+        # Check result:
+        getpatch.assert_called_once_with(QUERY1)
+        self.assertEqual(received_handles, ['hdl:123/456'])
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_hedged_A_slow_B_sent(self, getpatch):
+
+        # Define the replacement for the patched method:
+        query2_sent = threading.Event()
+        def different_mock_response_depending_on_query(query):
+            if query == QUERY1:
+                query2_sent.wait(5)
+                return self.fake_solr_response([])
+            else:
+                query2_sent.set()
+                return self.fake_solr_response(["123/456",1])
+        getpatch.side_effect = different_mock_response_depending_on_query
+
+        # Preparations
+        testtask = task.FindFilesOfSameDatasetVersion(TESTHELPERS.get_testsolr(), mode='hedged', hedge_delay_seconds=0.01)
+
+        # Run code to be tested:
+        received_handles = testtask.retrieve_file_handles_of_same_dataset(**self.get_args_dict())
+
+        # Check result:
+        self.assertTrue(query2_sent.is_set())
+        self.assertEqual(received_handles, ['hdl:123/456'])
+
+    @mock.patch('esgfpid.defaults.SOLR_FACET_PAGE_SIZE', 2)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_retrieve_A_ok_in_pages(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = [
+            self.fake_solr_response(["123/456",3,"123/234",1]),
+            self.fake_solr_response(["987/567",2])
+        ]
+
+        # Run code to be tested:
+        received_handles = self.make_testtask().retrieve_file_handles_of_same_dataset(**self.get_args_dict())
+
+        # Check result:
+        self.assertEqual(sorted(received_handles), ['hdl:123/234', 'hdl:123/456', 'hdl:123/987/567'])
+        self.assertEqual(getpatch.call_args_list[1][0][0]['facet.offset'], 2)
+
+    def make_stream(self, ids):
+        text = json.dumps(self.fake_solr_response(ids))
+        return iter([text[:10], text[10:]])
+
+    @mock.patch('esgfpid.defaults.SOLR_FACET_PAGE_SIZE', 2)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query_and_stream')
+    def test_iterate_A_ok_in_pages(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = [
+            self.make_stream(["123/456",3,"123/234",1]),
+            self.make_stream(["987/567",2])
+        ]
+
+        # Run code to be tested:
+        received_handles = list(self.make_testtask().iterate_file_handles_of_same_dataset(**self.get_args_dict()))
+
+        # Check result:
+        self.assertEqual(received_handles, ['hdl:123/456', 'hdl:123/234', 'hdl:123/987/567'])
+        first_query = getpatch.call_args_list[0][0][0]
+        second_query = getpatch.call_args_list[1][0][0]
+        self.assertEqual(first_query['dataset_id'], QUERY1['dataset_id'])
+        self.assertEqual((first_query['facet.limit'], first_query['facet.offset']), (2, 0))
+        self.assertEqual(second_query['facet.offset'], 2)
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query_and_stream')
+    def test_iterate_A_nohandle_B_ok(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = [
+            self.make_stream([]),
+            self.make_stream(["123/456",3])
+        ]
+
+        # Run code to be tested:
+        received_handles = list(self.make_testtask().iterate_file_handles_of_same_dataset(**self.get_args_dict()))
+
+        # Check result:
+        self.assertEqual(received_handles, ['hdl:123/456'])
+        self.assertEqual(getpatch.call_args_list[1][0][0]['query'], QUERY2['query'])
+
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query_and_stream')
+    def test_iterate_A_error_B_error(self, getpatch):
+
+        # Define the replacement for the patched method:
+        getpatch.side_effect = esgfpid.exceptions.SolrError('Whatever...')
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            list(self.make_testtask().iterate_file_handles_of_same_dataset(**self.get_args_dict()))
+        self.assertIn('Failure in both queries', raised.exception.message)
+
+    @mock.patch('esgfpid.defaults.SOLR_FACET_PAGE_SIZE', 2)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query_and_stream')
+    def test_iterate_server_ignores_limit_and_offset(self, getpatch):
+
+        # Define the replacement for the patched method:
+        # The server always returns the same complete list:
+        getpatch.side_effect = lambda query: self.make_stream(["a",1,"b",1,"c",1])
+
+        # Run code to be tested:
+        received_handles = list(self.make_testtask().iterate_file_handles_of_same_dataset(**self.get_args_dict()))
+
+        # Check result:
+        self.assertEqual(received_handles, ['hdl:123/a', 'hdl:123/b', 'hdl:123/c'])
+        self.assertEqual(getpatch.call_count, 1)
+
+    @mock.patch('esgfpid.defaults.SOLR_FACET_PAGE_SIZE', 2)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query_and_stream')
+    def test_iterate_server_ignores_offset(self, getpatch):
+
+        # Define the replacement for the patched method:
+        # The server always returns the first page:
+        getpatch.side_effect = lambda query: self.make_stream(["a",1,"b",1])
+
+        # Run code to be tested:
+        received_handles = []
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            for handle in self.make_testtask().iterate_file_handles_of_same_dataset(**self.get_args_dict()):
+                received_handles.append(handle)
+
+        # Check result:
+        self.assertEqual(received_handles, ['hdl:123/a', 'hdl:123/b'])
+        self.assertEqual(getpatch.call_count, 2)
+        self.assertIn('facet.offset', raised.exception.message)
+
+    @mock.patch('esgfpid.defaults.SOLR_FACET_PAGE_SIZE', 2)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query')
+    def test_retrieve_server_ignores_offset(self, getpatch):
+
+        # Define the replacement for the patched method:
+        # The server always returns the first page:
+        getpatch.return_value = self.fake_solr_response(["a",1,"b",1])
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            self.make_testtask().retrieve_file_handles_of_same_dataset(**self.get_args_dict())
+        self.assertIn('Failure in both queries', raised.exception.message)
+        self.assertEqual(getpatch.call_count, 4)
+
+    @mock.patch('esgfpid.defaults.SOLR_FACET_MAX_PAGES', 3)
+    @mock.patch('esgfpid.defaults.SOLR_FACET_PAGE_SIZE', 1)
+    @mock.patch('esgfpid.solr.serverconnector.SolrServerConnector.send_query_and_stream')
+    def test_iterate_too_many_pages(self, getpatch):
+
+        # Define the replacement for the patched method:
+        # Every page is full, with a new handle:
+        getpatch.side_effect = lambda query: self.make_stream([str(query['facet.offset']),1])
+
+        # Run code to be tested and check exception:
+        with self.assertRaises(esgfpid.exceptions.SolrError) as raised:
+            list(self.make_testtask().iterate_file_handles_of_same_dataset(**self.get_args_dict()))
+        self.assertIn('Gave up after 3 pages', raised.exception.message)
+        self.assertEqual(getpatch.call_count, 3)
@@ -93,7 +93,7 @@ class SolrTestCase(unittest.TestCase):
         with self.assertRaises(esgfpid.exceptions.SolrSwitchedOff):
             response = testsolr.send_query(query)
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_ok_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -112,7 +112,7 @@ class SolrTestCase(unittest.TestCase):
         self.assertTrue('responseHeader' in response, 'Solr response was not correct JSON: '+str(response))
         self.assertTrue(len(response['facet_counts']['facet_fields']['bla'])==4, 'JSON content was not transmitted correctly.')
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_404_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -129,7 +129,7 @@ class SolrTestCase(unittest.TestCase):
         self.assertIn('HTTP 404', raised.exception.message)
 
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_5000_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -160,7 +160,7 @@ class SolrTestCase(unittest.TestCase):
             )
 
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_retrieve_file_handles_of_same_dataset_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -196,7 +196,7 @@ class SolrTestCase(unittest.TestCase):
         ok = (set(resp) == set(expected))
         self.assertTrue(ok, 'Solr returned:\n'+str(resp)+'\nExpected:\n'+str(expected))
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_send_query_patched_connection_error(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -211,7 +211,7 @@ class SolrTestCase(unittest.TestCase):
             response = testsolr.send_query(query)
         self.assertIn('ConnectionError', raised.exception.message)
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_retrieve_datasethandles_or_versionnumbers_of_allversions_pids_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -243,7 +243,7 @@ class SolrTestCase(unittest.TestCase):
         ok = (set(resp) == set(expected))
         self.assertTrue(ok, 'Solr returned:\n'+str(resp)+'\nExpected:\n'+str(expected))
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_retrieve_datasethandles_or_versionnumbers_of_allversions_vers_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -277,7 +277,7 @@ class SolrTestCase(unittest.TestCase):
         self.assertTrue(ok, 'Solr returned:\n'+str(resp)+'\nExpected:\n'+str(expected))
 
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_retrieve_datasethandles_or_versionnumbers_of_allversions_both_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -319,7 +319,7 @@ class SolrTestCase(unittest.TestCase):
         ok = (set(resp) == set(expected))
         self.assertTrue(ok, 'Solr returned:\n'+str(resp)+'\nExpected:\n'+str(expected))
 
-    @mock.patch('esgfpid.solr.serverconnector.requests.get')
+    @mock.patch('esgfpid.solr.serverconnector.requests.Session.get')
     def test_retrieve_datasethandles_or_versionnumbers_of_allversions_none_patched(self, getpatch):
 
         # Define the replacement for the patched method:
@@ -46,6 +46,62 @@ class UtilsTestCase(unittest.TestCase):
         expected_handle = DATASETHANDLE_HDL
         self.assertEquals(received_handle, expected_handle)
 
+    def test_make_handle_same_as_uuid3(self):
+
+        for drs_id in [DRS_ID, u'some.dataset', u'dataset.with.\xe4']:
+            hash_basis = drs_id+'.v'+str(DS_VERSION)
+            expected_suffix = str(uuid.uuid3(uuid.NAMESPACE_URL, hash_basis.encode('utf-8')))
+
+            # Twice, to get it from the memo too:
+            for i in range(2):
+                received_handle = esgfpid.utils.make_handle_from_drsid_and_versionnumber(
+                    drs_id=drs_id,
+                    version_number=DS_VERSION,
+                    prefix=PREFIX_NO_HDL
+                )
+                self.assertEquals(received_handle, PREFIX_WITH_HDL+'/'+expected_suffix)
+
+    def test_make_handle_memo_is_bounded(self):
+
+        # Preparations:
+        memo = esgfpid.utils.handleutils._SuffixMemo(2)
+
+        # Run code to be tested:
+        suffixes = [memo.get_or_make(drs_id, DS_VERSION) for drs_id in ['a', 'b', 'a', 'c']]
+
+        # Check result:
+        self.assertEquals(suffixes[0], suffixes[2])
+        self.assertEquals(len(memo._SuffixMemo__suffixes), 2)
+        self.assertEquals(memo._SuffixMemo__suffixes.keys(), [('a', str(DS_VERSION)), ('c', str(DS_VERSION))])
+
+    def test_make_handles_from_drsids_and_versionnumbers(self):
+
+        # Test variables:
+        datasets = [(DRS_ID, DS_VERSION), (DRS_ID, DS_VERSION2), ('foo', 1)]
+        expected_handles = [esgfpid.utils.make_handle_from_drsid_and_versionnumber(
+            drs_id=drs_id, version_number=version_number, prefix=PREFIX_NO_HDL)
+            for drs_id, version_number in datasets]
+
+        # Run code to be tested:
+        received_handles = esgfpid.utils.make_handles_from_drsids_and_versionnumbers(iter(datasets), PREFIX_NO_HDL)
+
+        # Check result:
+        self.assertEquals(received_handles, expected_handles)
+        self.assertEquals(received_handles[0], DATASETHANDLE_HDL)
+
+    @mock.patch('esgfpid.defaults.HANDLE_BULK_CHUNK_SIZE', 2)
+    def test_make_handles_from_drsids_and_versionnumbers_processes(self):
+
+        # Test variables:
+        datasets = [('dataset%i' % i, 2016) for i in range(5)]
+        expected_handles = esgfpid.utils.make_handles_from_drsids_and_versionnumbers(datasets, PREFIX_NO_HDL)
+
+        # Run code to be tested:
+        received_handles = esgfpid.utils.make_handles_from_drsids_and_versionnumbers(datasets, PREFIX_NO_HDL, processes=2)
+
+        # Check result:
+        self.assertEquals(received_handles, expected_handles)
+
     #
     # argsutils
     #